@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'dbsystem.instrumentation.QueryStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -87,24 +88,80 @@ WSGI_APPLICATION = 'base_dbsystem.wsgi.application'
 #     }
 # }
 
-# DATABASES = {
-#     'default': {
-#         'ENGINE': 'django.db.backends.sqlite3',
-#         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-#     }
-# }
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    }
+}
 MONGODB_DATABASES = {
         'default': {'name': 'django_mongoengine'}
 }
 
-DATABASES = {
-        'default': {
-            'ENGINE' : None,
-        }
+# Mongo连接（dbsystem/mongoconn.py）：按别名配置，启动时只登记参数，第一次访问时才连接。
+# 其他键原样传给pymongo.MongoClient；read_preference是primary/primaryPreferred/secondary/secondaryPreferred/nearest
+MONGO_CONNECTIONS = {
+    'default': {
+        'db': 'dbsystem',
+        'host': 'localhost',
+        'read_preference': 'primary',
+        'maxPoolSize': 50,
+        'minPoolSize': 0,
+        'maxIdleTimeMS': 60000,
+        'waitQueueTimeoutMS': 2000,
+        'connectTimeoutMS': 2000,
+        'serverSelectionTimeoutMS': 3000,
+        'socketTimeoutMS': 30000,
+    },
 }
-
-from mongoengine import connect
-connect('dbsystem')
+# 文档类 → 连接别名，例如 {'ProblemCondition': 'answers'}；没有列出的用default
+MONGO_ALIASES = {}
+# /health/ 在连接池使用率达到多少时报告不就绪
+MONGO_POOL_SATURATION_LIMIT = 0.9
+
+# Mongo文档保存/删除时同步写到SQL（dbsystem/mongosync.py），需要安装blinker
+MONGO_DUAL_WRITE = False
+
+# 每个视图保留最近多少次请求的统计，超过多少毫秒算慢查询，最多跟踪多少条还没结束的Mongo命令
+DB_STATS_WINDOW = 1000
+DB_STATS_SLOW_MS = 100
+DB_STATS_MONGO_PENDING = 10000
+
+# manage.py archive_answers 写归档文件的目录
+ANSWER_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# 引用数据缓存（dbsystem/refcache.py）：进程内LRU的条目数和过期秒数，
+# REF_CACHE_BACKEND是CACHES里的别名，设置后多个进程共享一级缓存
+REF_CACHE_SIZE = 10000
+REF_CACHE_TTL = 300
+REF_CACHE_BACKEND = None
+
+# 题目全文检索的索引文件（dbsystem/search.py），manage.py rebuild_search 建立
+SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search.sqlite3')
+
+# 题目/解答图片（dbsystem/images.py）：文件目录，缩略图的最长边，生成缩略图的进程数（0是同步生成）
+IMAGE_STORE_DIR = os.path.join(BASE_DIR, 'images')
+IMAGE_THUMBNAIL_SIZES = (96, 320, 800)
+IMAGE_WORKERS = 2
+
+# 后台报表（dbsystem/reports.py）：结果文件目录，manage.py report_worker 的进程数（0是在worker进程里直接执行）和轮询间隔秒数
+REPORT_DIR = os.path.join(BASE_DIR, 'reports')
+REPORT_WORKERS = 2
+REPORT_POLL_SECONDS = 1
+
+# 答题数据列式快照（dbsystem/snapshot.py）的目录，manage.py snapshot 写入
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'snapshot')
+
+# 在线答题提交（dbsystem/submit.py）：每个请求最多多少行，每次组提交最多多少行，
+# 队列里最多多少行，队列满了以后新请求最多等多少秒（然后返回503）
+SUBMIT_MAX_LINES = 5000
+SUBMIT_GROUP_ROWS = 5000
+SUBMIT_QUEUE_ROWS = 50000
+SUBMIT_WAIT_SECONDS = 2
+# 有提交以后，后台线程隔多少秒刷新一次答题汇总（AnswerRollup）
+SUBMIT_ROLLUP_SECONDS = 60
+# 答题客户端的访问令牌，请求头带 Authorization: Bearer <令牌>；为空时拒绝所有提交
+SUBMIT_API_TOKENS = ()
 
 
 # Password validation
@@ -20,5 +20,18 @@ import dbsystem.views
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^dbsystem/', dbsystem.views.index),
+    url(r'^Students2Problem/export', dbsystem.views.Students2ProblemExport),
     url(r'^Students2Problem', dbsystem.views.Students2Problem),
+    url(r'^reports/(?P<job_id>\d+)/$', dbsystem.views.ReportStatus),
+    url(r'^reports/(?P<job_id>\d+)/download/$', dbsystem.views.ReportDownload),
+    url(r'^dbstats/', dbsystem.views.DBStats),
+    url(r'^health/', dbsystem.views.Health),
+    url(r'^recommend/', dbsystem.views.Recommend),
+    url(r'^ranking/', dbsystem.views.Ranking),
+    url(r'^students/similar/', dbsystem.views.SimilarStudents),
+    url(r'^students/groups/', dbsystem.views.StudyGroups),
+    url(r'^api/problem-conditions/', dbsystem.views.ProblemConditions),
+    url(r'^api/answers/', dbsystem.views.SubmitAnswers),
+    url(r'^search/', dbsystem.views.Search),
+    url(r'^images/(?P<digest>[0-9a-f]{64})/(?:(?P<size>\d+)/)?$', dbsystem.views.Images),
 ]
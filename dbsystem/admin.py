@@ -1,19 +1,221 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+
 from .models_mysql import *
 
-'''
-admin.site.register(Subject)
-admin.site.register(Tag)
-admin.site.register(School)
-admin.site.register(Group)
-admin.site.register(Teacher)
-admin.site.register(Student)
-admin.site.register(Problem)
-admin.site.register(Exercise)
-admin.site.register(ProblemCondition)
-admin.site.register(ExerciseCondition)
-admin.site.register(Book)
-admin.site.register(Chapter)
-admin.site.register(Folder)
-admin.site.register(Wrong)
-'''
+
+# 行数超过这个值时，不带过滤条件的列表页用估计行数
+ESTIMATE_THRESHOLD = 10000
+
+
+def estimate_count(model):
+    # mysql/postgresql读统计信息，sqlite用最大主键近似，都不扫表
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                           'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        else:
+            cursor.execute('SELECT MAX(%s) FROM %s' % (connection.ops.quote_name(model._meta.pk.column),
+                                                       connection.ops.quote_name(table)))
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list.model)
+            if estimate is not None and estimate > ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(Subject)
+class SubjectAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name')
+    search_fields = ('name',)
+
+
+@admin.register(Book)
+class BookAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'series', 'subject')
+    list_select_related = ('subject',)
+    search_fields = ('name', 'series')
+
+
+@admin.register(Chapter)
+class ChapterAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', '__str__', 'book')
+    list_select_related = ('book',)
+    search_fields = ('name', 'book__name')
+    autocomplete_fields = ('book',)
+
+
+@admin.register(Tag)
+class TagAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'category', 'difficulty', 'book', 'chapter')
+    list_select_related = ('book', 'chapter__book')
+    list_filter = ('category',)
+    search_fields = ('name', 'description')
+    autocomplete_fields = ('book', 'chapter', 'precursor')
+
+
+@admin.register(School)
+class SchoolAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'area', 'property', 'level', 'rank')
+    list_filter = ('property', 'level')
+    search_fields = ('name', 'area')
+
+
+@admin.register(Class)
+class ClassAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'entry_year', 'rank')
+    search_fields = ('name',)
+
+
+@admin.register(People)
+class PeopleAdmin(LargeTableAdmin):
+    list_display = ('entity_id', 'name', 'sex', 'born_year', 'school')
+    list_select_related = ('school',)
+    search_fields = ('name',)
+    autocomplete_fields = ('school', 'classes')
+
+
+@admin.register(Teacher)
+class TeacherAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'position', 'subject', 'school')
+    list_select_related = ('subject', 'school')
+    search_fields = ('name',)
+    autocomplete_fields = ('school', 'classes', 'subject')
+
+
+@admin.register(Student)
+class StudentAdmin(LargeTableAdmin):
+    list_display = ('entity_id', 'name', 'sex', 'born_year', 'school')
+    list_select_related = ('school',)
+    search_fields = ('name',)
+    autocomplete_fields = ('school', 'classes', 'subjects')
+
+
+@admin.register(Stuff)
+class StuffAdmin(admin.ModelAdmin):
+    list_display = ('entity_id', 'name', 'entry_year', 'school')
+    list_select_related = ('school',)
+    search_fields = ('name',)
+    autocomplete_fields = ('school', 'classes')
+
+
+@admin.register(TagAbility)
+class TagAbilityAdmin(LargeTableAdmin):
+    list_display = ('id', '__str__', 'student', 'tag', 'degree')
+    list_select_related = ('student', 'tag')
+    raw_id_fields = ('student',)
+    autocomplete_fields = ('tag',)
+
+
+@admin.register(Problem)
+class ProblemAdmin(LargeTableAdmin):
+    list_display = ('entity_id', 'name')
+    search_fields = ('name',)
+
+
+@admin.register(Exercise)
+class ExerciseAdmin(LargeTableAdmin):
+    list_display = ('entity_id', 'name', 'types', 'aim', 'subject', 'release_people', 'release_time')
+    list_select_related = ('subject', 'release_people')
+    list_filter = ('types', 'aim')
+    search_fields = ('name',)
+    raw_id_fields = ('problems',)
+    autocomplete_fields = ('subject', 'release_people', 'release_target')
+
+
+@admin.register(ProblemCondition)
+class ProblemConditionAdmin(LargeTableAdmin):
+    list_display = ('id', '__str__', 'student', 'problem', 'points', 'cost')
+    list_select_related = ('student', 'problem')
+    raw_id_fields = ('student', 'problem')
+
+
+@admin.register(ExerciseCondition)
+class ExerciseConditionAdmin(LargeTableAdmin):
+    list_display = ('id', '__str__', 'student', 'exercise', 'finish_time')
+    list_select_related = ('student', 'exercise')
+    raw_id_fields = ('student', 'exercise', 'results')
+
+
+@admin.register(ProblemStat)
+class ProblemStatAdmin(LargeTableAdmin):
+    list_display = ('problem', 'count', 'correct_count', 'accuracy', 'average_cost')
+    list_select_related = ('problem',)
+    raw_id_fields = ('problem',)
+
+
+@admin.register(ExerciseStat)
+class ExerciseStatAdmin(admin.ModelAdmin):
+    list_display = ('exercise', 'count', 'correct_count', 'accuracy', 'average_cost')
+    list_select_related = ('exercise',)
+    raw_id_fields = ('exercise',)
+
+
+@admin.register(MongoIdMap)
+class MongoIdMapAdmin(LargeTableAdmin):
+    list_display = ('id', 'collection', 'mongo_id', 'sql_id')
+    search_fields = ('=collection', 'mongo_id')
+
+
+@admin.register(AnswerRollup)
+class AnswerRollupAdmin(LargeTableAdmin):
+    list_display = ('id', 'period', 'bucket', 'group', 'subject', 'problem', 'count', 'accuracy')
+    list_select_related = ('group', 'subject', 'problem')
+    list_filter = ('period',)
+    raw_id_fields = ('problem',)
+    autocomplete_fields = ('group', 'subject')
+
+
+@admin.register(RollupState)
+class RollupStateAdmin(admin.ModelAdmin):
+    list_display = ('id', 'last_result', 'archived_before')
+
+
+@admin.register(AnswerKey)
+class AnswerKeyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'exercise', 'problem', 'answer', 'points')
+    list_select_related = ('exercise', 'problem')
+    raw_id_fields = ('exercise', 'problem')
+
+
+@admin.register(Submission)
+class SubmissionAdmin(LargeTableAdmin):
+    list_display = ('id', 'student', 'exercise', 'problem', 'answer', 'submitted_at', 'problem_condition_id')
+    list_select_related = ('student', 'exercise', 'problem')
+    raw_id_fields = ('student', 'exercise', 'problem', 'problem_condition')
+
+
+@admin.register(ImageBlob)
+class ImageBlobAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'content_type', 'width', 'height', 'size', 'created_at')
+    search_fields = ('=digest',)
+
+
+@admin.register(DataVersion)
+class DataVersionAdmin(admin.ModelAdmin):
+    list_display = ('name', 'version')
+
+
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'total', 'size', 'created_at', 'finished_at')
+    list_filter = ('status',)
@@ -0,0 +1,284 @@
+# -*- coding: UTF-8 -*-
+
+# ProblemStat / ExerciseStat 的增量维护
+# 每个汇总是 (完成次数, 正确次数, 总得分, 总用时) 四元组，保存和删除时只更新差值，
+# 读取时按主键取一行即可，不需要再对ProblemCondition做GROUP BY
+# bulk_create / queryset.update 不发信号，回填数据后需要执行 manage.py rebuild_stats
+
+import threading
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, When
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from dbsystem import reports
+from dbsystem.models_mysql import ExerciseCondition, ExerciseStat, ProblemCondition, ProblemStat
+
+
+Results = ExerciseCondition.results.through
+
+ZERO = (0, 0, 0.0, 0)
+
+BATCH_SIZE = 500
+
+_deleting = threading.local()
+
+
+def correct_q(prefix=''):
+    # 与 ProblemCondition.is_correct 一致
+    return ~Q(**{prefix + 'result': ''}) & Q(**{prefix + 'judge': ''})
+
+
+def _totals(queryset, key, prefix=''):
+    # 按key分组求四元组，rebuild和增量更新共用
+    return queryset.values(key).annotate(
+        total=Count('pk'),
+        correct=Sum(Case(When(correct_q(prefix), then=1), default=0, output_field=IntegerField())),
+        points=Sum(prefix + 'points'),
+        cost=Sum(prefix + 'cost'),
+    ).values_list(key, 'total', 'correct', 'points', 'cost').order_by()
+
+
+def problem_totals(queryset=None):
+    if queryset is None:
+        queryset = ProblemCondition.objects.all()
+    for problem_id, count, correct, points, cost in _totals(queryset, 'problem_id'):
+        yield problem_id, (count, correct or 0, points or 0.0, cost or 0)
+
+
+def exercise_totals(links=None):
+    # links 是 ExerciseCondition.results 中间表的查询，一条关联算一次
+    if links is None:
+        links = Results.objects.all()
+    for exercise_id, count, correct, points, cost in _totals(links, 'exercisecondition__exercise_id',
+                                                              'problemcondition__'):
+        yield exercise_id, (count, correct or 0, points or 0.0, cost or 0)
+
+
+def _contribution(condition):
+    return 1, int(condition.is_correct()), condition.points, condition.cost
+
+
+def _add(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+
+def _sub(a, b):
+    return tuple(x - y for x, y in zip(a, b))
+
+
+def _neg(a):
+    return _sub(ZERO, a)
+
+
+def _apply(model, pk, delta):
+    count, correct, points, cost = delta
+    if not any(delta):
+        return
+    updated = model.objects.filter(pk=pk).update(
+        count=F('count') + count,
+        correct_count=F('correct_count') + correct,
+        points_sum=F('points_sum') + points,
+        cost_sum=F('cost_sum') + cost,
+    )
+    if updated:
+        return
+    # 汇总行不存在时按零起算，差值不丢；扣减的差值不建行（建出来次数/正确数是负的），
+    # 这种汇总本来就缺了之前的部分，由rebuild_stats改正
+    if count < 0 or correct < 0:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(pk=pk, count=count, correct_count=correct, points_sum=points, cost_sum=cost)
+    except IntegrityError:
+        _apply(model, pk, delta)
+
+
+def _apply_exercises(links, sign):
+    for exercise_id, delta in exercise_totals(links):
+        _apply(ExerciseStat, exercise_id, delta if sign > 0 else _neg(delta))
+
+
+@receiver(pre_save, sender=ProblemCondition)
+def remember_problem_condition(sender, instance, raw, **kwargs):
+    instance._stat_old = None
+    if raw or instance.pk is None:
+        return
+    old = ProblemCondition.objects.filter(pk=instance.pk).only(
+        'problem_id', 'result', 'judge', 'points', 'cost').first()
+    if old is not None:
+        instance._stat_old = (old.problem_id, _contribution(old))
+
+
+@receiver(post_save, sender=ProblemCondition)
+def update_problem_condition(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    new = _contribution(instance)
+    old = getattr(instance, '_stat_old', None)
+    instance._stat_old = None
+    if old is None:
+        _apply(ProblemStat, instance.problem_id, new)
+        return
+    old_problem_id, old_contribution = old
+    if old_problem_id == instance.problem_id:
+        _apply(ProblemStat, instance.problem_id, _sub(new, old_contribution))
+    else:
+        _apply(ProblemStat, old_problem_id, _neg(old_contribution))
+        _apply(ProblemStat, instance.problem_id, new)
+    # 已经关联到练习的题目，练习汇总只变分数/用时/正确数，不变次数
+    delta = _sub(new, old_contribution)
+    for exercise_id in Results.objects.filter(problemcondition_id=instance.pk).values_list(
+            'exercisecondition__exercise_id', flat=True):
+        _apply(ExerciseStat, exercise_id, delta)
+
+
+@receiver(pre_delete, sender=ProblemCondition)
+def delete_problem_condition(sender, instance, **kwargs):
+    _apply(ProblemStat, instance.problem_id, _neg(_contribution(instance)))
+    instance._stat_links = _subtract_links(Results.objects.filter(problemcondition=instance))
+
+
+@receiver(pre_delete, sender=ExerciseCondition)
+def delete_exercise_condition(sender, instance, **kwargs):
+    instance._stat_links = _subtract_links(Results.objects.filter(exercisecondition=instance))
+
+
+@receiver(post_delete, sender=ProblemCondition)
+@receiver(post_delete, sender=ExerciseCondition)
+def forget_deleted_links(sender, instance, **kwargs):
+    _deleting_links().difference_update(getattr(instance, '_stat_links', ()))
+
+
+def _deleting_links():
+    links = getattr(_deleting, 'links', None)
+    if links is None:
+        links = _deleting.links = set()
+    return links
+
+
+def _subtract_links(links):
+    # 自动生成的中间表在级联删除时不发信号，只能在两端的pre_delete里扣减；
+    # 删除学生时题目完成情况和练习完成情况会一起被删，同一条关联只扣一次
+    deleting = _deleting_links()
+    ids = list(links.values_list('pk', flat=True))
+    todo = [pk for pk in ids if pk not in deleting]
+    deleting.update(todo)
+    if len(todo) == len(ids):
+        _apply_exercises(links, -1)
+    else:
+        for i in range(0, len(todo), BATCH_SIZE):
+            _apply_exercises(Results.objects.filter(pk__in=todo[i:i + BATCH_SIZE]), -1)
+    return ids
+
+
+@receiver(m2m_changed, sender=Results)
+def change_result_links(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+    if reverse:
+        links = Results.objects.filter(problemcondition=instance)
+        if pk_set is not None:
+            links = links.filter(exercisecondition_id__in=pk_set)
+    else:
+        links = Results.objects.filter(exercisecondition=instance)
+        if pk_set is not None:
+            links = links.filter(problemcondition_id__in=pk_set)
+    # post_add时pk_set里只有新加的关联，pre_remove时过滤掉本来就不存在的
+    _apply_exercises(links, 1 if action == 'post_add' else -1)
+
+
+@receiver(pre_save, sender=ExerciseCondition)
+def remember_exercise_condition(sender, instance, raw, **kwargs):
+    instance._stat_old_exercise_id = None
+    if raw or instance.pk is None:
+        return
+    instance._stat_old_exercise_id = ExerciseCondition.objects.filter(pk=instance.pk).values_list(
+        'exercise_id', flat=True).first()
+
+
+@receiver(post_save, sender=ExerciseCondition)
+def move_exercise_condition(sender, instance, raw, **kwargs):
+    old_exercise_id = getattr(instance, '_stat_old_exercise_id', None)
+    instance._stat_old_exercise_id = None
+    if raw or old_exercise_id is None or old_exercise_id == instance.exercise_id:
+        return
+    links = Results.objects.filter(exercisecondition=instance)
+    totals = dict(exercise_totals(links))
+    delta = totals.get(instance.exercise_id, ZERO)
+    _apply(ExerciseStat, old_exercise_id, _neg(delta))
+    _apply(ExerciseStat, instance.exercise_id, delta)
+
+
+def rebuild():
+    # 只统计库里还在的行，答题记录归档（rollups.archive）以后再重建会丢掉已归档部分的累计
+    with transaction.atomic():
+        ProblemStat.objects.all().delete()
+        ExerciseStat.objects.all().delete()
+        ProblemStat.objects.bulk_create(
+            ProblemStat(problem_id=pk, count=count, correct_count=correct, points_sum=points, cost_sum=cost)
+            for pk, (count, correct, points, cost) in problem_totals())
+        ExerciseStat.objects.bulk_create(
+            ExerciseStat(exercise_id=pk, count=count, correct_count=correct, points_sum=points, cost_sum=cost)
+            for pk, (count, correct, points, cost) in exercise_totals())
+    # 报表里的题目正确率读汇总表
+    reports.bump()
+    return ProblemStat.objects.count(), ExerciseStat.objects.count()
+
+
+_STAT_COLUMNS = ('count', 'correct_count', 'points_sum', 'cost_sum')
+
+
+def _apply_many(model, deltas):
+    # 一次executemany更新已有的汇总行，不存在的行逐行走_apply；按主键顺序加锁，并发的批量写入不会互相死锁
+    deltas = {pk: delta for pk, delta in deltas.items() if any(delta)}
+    existing = set()
+    keys = sorted(deltas)
+    for i in range(0, len(keys), BATCH_SIZE):
+        existing.update(model.objects.filter(pk__in=keys[i:i + BATCH_SIZE]).values_list('pk', flat=True))
+    quote = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        quote(model._meta.db_table), ', '.join('%s = %s + %%s' % (quote(c), quote(c)) for c in _STAT_COLUMNS),
+        quote(model._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [tuple(deltas[pk]) + (pk,) for pk in keys if pk in existing])
+    for pk in keys:
+        if pk not in existing:
+            _apply(model, pk, deltas[pk])
+
+
+def add_created(conditions, exercise_ids):
+    # 批量新建的ProblemCondition（bulk_create不发信号）按差值计入汇总，exercise_ids[i]是第i条关联到的练习
+    problems, exercises = {}, {}
+    for condition, exercise_id in zip(conditions, exercise_ids):
+        delta = _contribution(condition)
+        problems[condition.problem_id] = _add(problems.get(condition.problem_id, ZERO), delta)
+        exercises[exercise_id] = _add(exercises.get(exercise_id, ZERO), delta)
+    _apply_many(ProblemStat, problems)
+    _apply_many(ExerciseStat, exercises)
+
+
+def add_updated(old_conditions, conditions, exercise_ids):
+    # 批量更新的ProblemCondition（bulk_update不发信号）按新旧差值计入汇总，不从现有行重算，归档过的累计不受影响；
+    # old_conditions[i]是conditions[i]更新前的值，exercise_ids[i]是它关联到的所有练习
+    problems, exercises = {}, {}
+    for old, condition, linked in zip(old_conditions, conditions, exercise_ids):
+        new = _contribution(condition)
+        problems[old.problem_id] = _sub(problems.get(old.problem_id, ZERO), _contribution(old))
+        problems[condition.problem_id] = _add(problems.get(condition.problem_id, ZERO), new)
+        delta = _sub(new, _contribution(old))
+        for exercise_id in linked:
+            exercises[exercise_id] = _add(exercises.get(exercise_id, ZERO), delta)
+    _apply_many(ProblemStat, problems)
+    _apply_many(ExerciseStat, exercises)
+
+
+def problem_stat(problem_id):
+    stat = ProblemStat.objects.filter(pk=problem_id).first()
+    return stat if stat is not None else ProblemStat(problem_id=problem_id)
+
+
+def exercise_stat(exercise_id):
+    stat = ExerciseStat.objects.filter(pk=exercise_id).first()
+    return stat if stat is not None else ExerciseStat(exercise_id=exercise_id)
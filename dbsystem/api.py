@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+
+# 题目完成情况的JSON分页接口（/api/problem-conditions/）
+# 按主键做keyset分页：下一页是 id > 上一页最后一个id，WHERE直接在主键/外键索引上定位，
+# 第1000页和第1页的代价一样，不用OFFSET，也不算总数。
+# 过滤条件都写成子查询（id IN (...)），关联多行时也不会重复或者打乱主键顺序。
+# 每页只取需要的列（only()），学生名字、练习时间、题目正确率、标签和章节按本页的ID各批量取一次，
+# 标签和章节走引用缓存。
+
+from django.db.models import Q
+
+from dbsystem import refcache
+from dbsystem.models_mysql import Chapter, ExerciseCondition, People, Problem, ProblemCondition, ProblemStat, Tag
+
+
+DEFAULT_LIMIT = 100
+
+MAX_LIMIT = 500
+
+FIELDS = ('id', 'student_id', 'problem_id', 'result', 'judge', 'points', 'cost')
+
+
+def _filters(exercise=None, group=None, student=None, chapter=None):
+    q = Q()
+    if student is not None:
+        q &= Q(student_id=student)
+    if group is not None:
+        q &= Q(student_id__in=People.classes.through.objects.filter(class_id=group).values('people_id'))
+    if exercise is not None:
+        q &= Q(pk__in=ExerciseCondition.results.through.objects.filter(
+            exercisecondition__exercise_id=exercise).values('problemcondition_id'))
+    if chapter is not None:
+        q &= Q(problem_id__in=Problem.tags.through.objects.filter(tag__chapter_id=chapter).values('problem_id'))
+    return q
+
+
+def page(after=0, limit=DEFAULT_LIMIT, **filters):
+    # 返回 (本页的行, 下一页的after，没有下一页时是None)
+    limit = max(1, min(limit, MAX_LIMIT))
+    queryset = ProblemCondition.objects.filter(_filters(**filters), pk__gt=after).only(*FIELDS).order_by('pk')
+    conditions = list(queryset[:limit + 1])
+    more = len(conditions) > limit
+    conditions = conditions[:limit]
+    if not conditions:
+        return [], None
+
+    student_ids = {condition.student_id for condition in conditions}
+    problem_ids = {condition.problem_id for condition in conditions}
+    names = dict(People.objects.filter(pk__in=student_ids).values_list('pk', 'name'))
+    stats = ProblemStat.objects.in_bulk(problem_ids)
+    problem_tags = {}
+    for problem_id, tag_id in Problem.tags.through.objects.filter(problem_id__in=problem_ids).values_list(
+            'problem_id', 'tag_id').order_by('pk'):
+        problem_tags.setdefault(problem_id, []).append(tag_id)
+    finish_times = {}
+    for condition_id, finish_time in ExerciseCondition.results.through.objects.filter(
+            problemcondition_id__in=[condition.pk for condition in conditions]).values_list(
+            'problemcondition_id', 'exercisecondition__finish_time').order_by('pk'):
+        finish_times.setdefault(condition_id, finish_time)
+    tags = refcache.get_many(Tag, {tag_id for tag_ids in problem_tags.values() for tag_id in tag_ids})
+    chapters = refcache.get_many(Chapter, {tag.chapter_id for tag in tags.values()})
+
+    rows = []
+    for condition in conditions:
+        stat = stats.get(condition.problem_id)
+        row_tags = [tags[tag_id] for tag_id in problem_tags.get(condition.problem_id, ()) if tag_id in tags]
+        row_chapters = list(dict.fromkeys(tag.chapter_id for tag in row_tags))
+        rows.append({
+            'id': condition.pk,
+            'student_id': condition.student_id,
+            'student_name': names.get(condition.student_id, ''),
+            'problem_id': condition.problem_id,
+            'finish_time': finish_times[condition.pk].isoformat() if condition.pk in finish_times else None,
+            'chapters': [str(chapters[chapter_id]) for chapter_id in row_chapters if chapter_id in chapters],
+            'tags': [tag.name for tag in row_tags],
+            'finished': bool(condition.result),
+            'correct': condition.is_correct(),
+            'points': condition.points,
+            'cost': condition.cost,
+            'accuracy': stat.accuracy if stat is not None else None,
+        })
+    return rows, conditions[-1].pk if more else None
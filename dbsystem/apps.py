@@ -3,3 +3,16 @@ from django.apps import AppConfig
 
 class DbsystemConfig(AppConfig):
     name = 'dbsystem'
+
+    def ready(self):
+        # 连接信号
+        from . import aggregates, hierarchy, mastery, profiles, ranking, recommend, refcache, reports, search, \
+            submit, taggraph
+        hierarchy.connect_signals()
+        # Mongo只登记连接参数，第一次访问时才连接
+        from . import mongoconn
+        mongoconn.register()
+        from django.conf import settings
+        if getattr(settings, 'MONGO_DUAL_WRITE', False):
+            from . import mongosync
+            mongosync.enable_dual_write()
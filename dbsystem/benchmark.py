@@ -0,0 +1,302 @@
+# -*- coding: UTF-8 -*-
+
+# 核心负载的计时，manage.py benchmark 调用
+# 每个负载返回处理的行数，用来算吞吐量；结果写成JSON，两次提交之间可以直接对比
+
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+
+from dbsystem import aggregates, mastery, profiles, ranking, recommend, search, snapshot, submit, taggraph
+from dbsystem.export import problem_rows, stream_csv
+from dbsystem.models_mysql import Class, Exercise, ExerciseCondition, Problem, Student, Tag, TagAbility
+from dbsystem.synthetic import TOPICS
+
+
+WORKLOADS = []
+
+
+def workload(name, repeat=None):
+    def register(func):
+        WORKLOADS.append((name, func, repeat))
+        return func
+    return register
+
+
+class Context(object):
+
+    def __init__(self, seed=0, sample=100):
+        rnd = random.Random(seed)
+        self.random = rnd
+
+        def pick(model):
+            ids = list(model.objects.values_list('pk', flat=True))
+            return rnd.sample(ids, min(sample, len(ids)))
+        self.problem_ids = pick(Problem)
+        self.student_ids = pick(Student)
+        self.exercise_ids = pick(Exercise)[:10]
+        self.tag_ids = pick(Tag)
+        self.class_ids = pick(Class)[:10]
+        self._matrix = None
+        self.search_path = os.path.join(tempfile.gettempdir(), 'dbsystem-benchmark-search.sqlite3')
+        self.search_built = False
+        self.snapshot_path = os.path.join(tempfile.gettempdir(), 'dbsystem-benchmark-snapshot')
+        self.snapshot_built = False
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = mastery.MasteryMatrix.load()
+        return self._matrix
+
+
+@workload('students2problem_all_rows', repeat=1)
+def students2problem_all_rows(ctx):
+    return sum(1 for _ in problem_rows())
+
+
+@workload('students2problem_all_csv', repeat=1)
+def students2problem_all_csv(ctx):
+    # 减去表头
+    return sum(chunk.count(b'\n') for chunk in stream_csv(problem_rows())) - 1
+
+
+@workload('students2problem_one_exercise')
+def students2problem_one_exercise(ctx):
+    return sum(sum(1 for _ in problem_rows(exercise_id)) for exercise_id in ctx.exercise_ids)
+
+
+@workload('accuracy_group_by')
+def accuracy_group_by(ctx):
+    return sum(1 for _ in aggregates.problem_totals())
+
+
+@workload('accuracy_stat_lookup')
+def accuracy_stat_lookup(ctx):
+    for problem_id in ctx.problem_ids:
+        aggregates.problem_stat(problem_id).accuracy
+    return len(ctx.problem_ids)
+
+
+@workload('mastery_orm_per_student')
+def mastery_orm_per_student(ctx):
+    rows = 0
+    for student_id in ctx.student_ids:
+        rows += len(list(TagAbility.objects.filter(student_id=student_id).values_list('tag_id', 'degree')))
+    return rows
+
+
+@workload('mastery_matrix_load')
+def mastery_matrix_load(ctx):
+    ctx._matrix = mastery.MasteryMatrix.load()
+    return ctx.matrix.nnz
+
+
+@workload('mastery_class_means')
+def mastery_class_means(ctx):
+    groups, means = ctx.matrix.class_means()
+    return means.size
+
+
+@workload('mastery_weakest_10')
+def mastery_weakest_10(ctx):
+    return len(ctx.matrix.top_k(10)[0])
+
+
+@workload('tag_graph_closure')
+def tag_graph_closure(ctx):
+    graph = taggraph.TagGraph.load()
+    return sum(len(graph.prerequisites(tag_id)) for tag_id in ctx.tag_ids)
+
+
+@workload('recommend_index_load', repeat=1)
+def recommend_index_load(ctx):
+    recommend.invalidate()
+    return len(recommend.get_index().problem_tags)
+
+
+@workload('recommend_per_student')
+def recommend_per_student(ctx):
+    # 单个学生的延迟 = 总时间 / 学生数
+    for student_id in ctx.student_ids:
+        recommend.recommend(student_id)
+    return len(ctx.student_ids)
+
+
+@workload('recommend_class_batch')
+def recommend_class_batch(ctx):
+    return sum(len(recommend.recommend_class(class_id)) for class_id in ctx.class_ids)
+
+
+@workload('profile_index_load', repeat=1)
+def profile_index_load(ctx):
+    profiles.invalidate()
+    return len(profiles.get_index())
+
+
+@workload('profile_neighbors_batch')
+def profile_neighbors_batch(ctx):
+    # 一批学生一次查询，每个学生的延迟 = 总时间 / 学生数
+    profiles.similar(ctx.student_ids)
+    return len(ctx.student_ids)
+
+
+@workload('profile_groups_per_class')
+def profile_groups_per_class(ctx):
+    return sum(sum(len(group) for group in profiles.study_groups(4, class_id=class_id))
+               for class_id in ctx.class_ids)
+
+
+@workload('ranking_sort_exercise')
+def ranking_sort_exercise(ctx):
+    # 对照：每次都对整个练习的完成情况按得分排序
+    return sum(len(list(ExerciseCondition.objects.filter(exercise_id=exercise_id).values('student_id')
+                        .annotate(points=Sum('results__points')).order_by('-points')))
+               for exercise_id in ctx.exercise_ids)
+
+
+@workload('ranking_load', repeat=1)
+def ranking_load(ctx):
+    ranking.invalidate()
+    return len(ranking.get_ranking().boards)
+
+
+@workload('ranking_student_rank')
+def ranking_student_rank(ctx):
+    # 抽样学生在抽样练习里的名次和百分位，单次查询的延迟 = 总时间 / 查询数
+    for exercise_id in ctx.exercise_ids:
+        for student_id in ctx.student_ids:
+            ranking.rank('exercise', exercise_id, student_id)
+    return len(ctx.exercise_ids) * len(ctx.student_ids)
+
+
+@workload('search_rebuild', repeat=1)
+def search_rebuild(ctx):
+    ctx.search_built = True
+    return search.rebuild(ctx.search_path)
+
+
+@workload('search_query')
+def search_query(ctx):
+    # 中文短语、单字前缀、公式、加章节过滤各一组，单次查询的延迟 = 总时间 / 查询数
+    if not ctx.search_built:
+        search_rebuild(ctx)
+    chapter_ids = list(Tag.objects.filter(pk__in=ctx.tag_ids[:10]).values_list('chapter_id', flat=True))
+    queries = [(topic, None) for topic in TOPICS] + [(topic[0], None) for topic in TOPICS[:5]]
+    queries += [(r'x^{2}', None), (r'\frac', None), (r'$\sin^2 x$', None)]
+    queries += [(TOPICS[i % len(TOPICS)], chapter_id) for i, chapter_id in enumerate(chapter_ids)]
+    for query, chapter_id in queries:
+        search.search(query, chapter=chapter_id, path=ctx.search_path)
+    return len(queries)
+
+
+@workload('snapshot_rebuild', repeat=1)
+def snapshot_rebuild(ctx):
+    ctx.snapshot_built = True
+    return sum(snapshot.write(path=ctx.snapshot_path, rebuild=True).values())
+
+
+@workload('snapshot_accuracy_group_by')
+def snapshot_accuracy_group_by(ctx):
+    # 和accuracy_group_by同样的汇总，从内存映射的列上算
+    if not ctx.snapshot_built:
+        snapshot_rebuild(ctx)
+    table = snapshot.open_table('problem_conditions', ctx.snapshot_path)
+    problem_ids, counts, correct = table.group('problem', 'correct')
+    return len(problem_ids)
+
+
+@workload('bulk_ingest', repeat=1)
+def bulk_ingest(ctx, rows=20000):
+    rnd = ctx.random
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for _ in range(rows):
+                f.write(json.dumps({
+                    'student': rnd.choice(ctx.student_ids), 'problem': rnd.choice(ctx.problem_ids),
+                    'exercise': rnd.choice(ctx.exercise_ids), 'finish_time': '2019-01-01T08:00:00',
+                    'result': 'A', 'judge': '', 'cost': 60, 'points': 5,
+                }) + '\n')
+        call_command('ingest_answers', path, workers=2, skip_stats=True, stdout=StringIO())
+    finally:
+        os.remove(path)
+    return rows
+
+
+@workload('submit_group_commit', repeat=1)
+def submit_group_commit(ctx, threads=8, requests=25, lines=40):
+    # 多个请求线程同时提交，每个请求先解析NDJSON再等组提交完成
+    pairs = list(Exercise.problems.through.objects.filter(exercise_id__in=ctx.exercise_ids).values_list(
+        'exercise_id', 'problem_id'))
+
+    def client(seed):
+        rnd = random.Random(seed)
+        try:
+            for _ in range(requests):
+                body = '\n'.join(json.dumps(dict(zip(('exercise', 'problem'), rnd.choice(pairs)),
+                                                  student=rnd.choice(ctx.student_ids), result='A', cost=60, points=5))
+                                 for _ in range(lines))
+                submit.submit(submit.parse(body)[0])
+        finally:
+            connection.close()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return threads * requests * lines
+
+
+def _startup(*args):
+    # 在新进程里计时，和当前进程已经加载的模块、建立的连接无关
+    subprocess.run([sys.executable] + list(args), cwd=settings.BASE_DIR, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@workload('startup_manage_check')
+def startup_manage_check(ctx):
+    _startup('manage.py', 'check')
+    return 1
+
+
+@workload('startup_wsgi_import')
+def startup_wsgi_import(ctx):
+    _startup('-c', 'import base_dbsystem.wsgi')
+    return 1
+
+
+def run(repeat=3, seed=0, only=None, log=None):
+    log = log or (lambda message: None)
+    ctx = Context(seed)
+    results = {}
+    for name, func, fixed_repeat in WORKLOADS:
+        if only and name not in only:
+            continue
+        timings = []
+        for _ in range(fixed_repeat or repeat):
+            start = time.perf_counter()
+            rows = func(ctx)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results[name] = {
+            'min': best,
+            'median': statistics.median(timings),
+            'repeat': len(timings),
+            'rows': rows,
+            'rows_per_sec': rows / best if best else None,
+        }
+        log('%-32s %10.4fs %12d rows %14.0f rows/s' % (name, best, rows, results[name]['rows_per_sec'] or 0))
+    return results
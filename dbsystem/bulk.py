@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+
+# 批量写入的公共部分：主键按当前最大值顺序分配（bulk_create在sqlite/mysql上不返回主键），
+# 多表继承的模型先批量写父表，再直接插入子表
+# 分配主键前先更新同一行DataVersion（ID_LOCK），行锁持有到事务结束：批改、在线提交、导入、Mongo迁移
+# 同时写入时在这里排队，不会拿到同一个max+1。调用方必须在transaction.atomic里分配并写完这些行；
+# 同一个事务里还要bump其他版本号的，先bump其他的再分配主键，加锁顺序一致才不会死锁
+
+from django.db import connection
+from django.db.models import Max
+
+from dbsystem import reports
+
+
+BATCH_SIZE = 500
+
+ID_LOCK = 'ids'
+
+
+def next_id(model):
+    reports.bump(ID_LOCK)
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+def insert_children(model, objs):
+    # bulk_create不支持多表继承，子表直接executemany
+    fields = model._meta.local_concrete_fields
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote(model._meta.db_table), ', '.join(quote(f.column) for f in fields), ', '.join(['%s'] * len(fields)))
+    rows = [[f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields] for obj in objs]
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), BATCH_SIZE):
+            cursor.executemany(sql, rows[i:i + BATCH_SIZE])
+
+
+def insert_rows(model, columns, rows):
+    # 值已经是数据库类型（整数、字符串、浮点数）的行直接executemany，不经过模型实例
+    quote = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        quote(model._meta.db_table), ', '.join(quote(model._meta.get_field(name).column) for name in columns),
+        ', '.join(['%s'] * len(columns)))
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), BATCH_SIZE):
+            cursor.executemany(sql, rows[i:i + BATCH_SIZE])
+
+
+def bulk_insert(model, objs):
+    # objs的主键（以及多表继承的父表指针）必须已经赋值
+    parents = model._meta.get_parent_list()
+    if not parents:
+        model.objects.bulk_create(objs, batch_size=BATCH_SIZE)
+        return
+    root = parents[-1]
+    root.objects.bulk_create([root(**{f.attname: getattr(obj, f.attname) for f in root._meta.concrete_fields})
+                              for obj in objs], batch_size=BATCH_SIZE)
+    for parent in reversed(parents[:-1]):
+        insert_children(parent, objs)
+    insert_children(model, objs)
@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+
+import csv
+import math
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from dbsystem.models_mysql import ExerciseCondition, ProblemStat
+
+
+CHUNK_SIZE = 2000
+
+HEADER = ['学生ID', '学生姓名', '题目ID', '题目名字', '练习ID', '练习名字',
+          '练习时间', '是否完成', '是否正确', '得到分数', '完成所花时间', '题目正确率']
+
+# 第一列是中间表的主键，只用来做keyset分页，不输出
+_FIELDS = (
+    'id',
+    'problemcondition__student__entity_id',
+    'problemcondition__student__name',
+    'problemcondition__problem__entity_id',
+    'problemcondition__problem__name',
+    'exercisecondition__exercise__entity_id',
+    'exercisecondition__exercise__name',
+    'exercisecondition__finish_time',
+    'problemcondition__result',
+    'problemcondition__judge',
+    'problemcondition__points',
+    'problemcondition__cost',
+)
+
+
+def problem_rows(exercise_id=None, chunk_size=CHUNK_SIZE):
+    # 按ExerciseCondition.results中间表的主键分块读取，
+    # 每次只取chunk_size行，服务端内存与总行数无关
+    through = ExerciseCondition.results.through
+    queryset = through.objects.order_by('id')
+    if exercise_id is not None:
+        queryset = queryset.filter(exercisecondition__exercise_id=exercise_id)
+    last = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last).values_list(*_FIELDS)[:chunk_size])
+        if not chunk:
+            return
+        # 题目正确率直接读汇总表，每块一次按主键批量查询
+        stats = ProblemStat.objects.in_bulk({row[3] for row in chunk})
+        for row in chunk:
+            (_, student_id, student_name, problem_id, problem_name, exercise_id_, exercise_name,
+             finish_time, result, judge, points, cost) = row
+            finished = bool(result)
+            stat = stats.get(problem_id)
+            accuracy = stat.accuracy if stat is not None else None
+            yield [student_id, student_name, problem_id, problem_name, exercise_id_, exercise_name,
+                   finish_time.strftime('%Y-%m-%d %H:%M:%S') if finish_time else '',
+                   '是' if finished else '否',
+                   '是' if finished and not judge else '否',
+                   points, cost, '' if accuracy is None else '%.1f%%' % (accuracy * 100)]
+        last = chunk[-1][0]
+
+
+class _Pipe(object):
+    # 只写不可seek的缓冲区，csv和zipfile写进来的数据由生成器取走
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if not self.chunks:
+            return None
+        data = self.chunks[0][:0].join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_csv(rows, header=HEADER):
+    pipe = _Pipe()
+    writer = csv.writer(pipe)
+    # 带BOM，Excel打开中文不乱码
+    pipe.write('\ufeff')
+    writer.writerow(header)
+    yield pipe.drain().encode('utf-8')
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_SIZE == 0:
+            yield pipe.drain().encode('utf-8')
+    data = pipe.drain()
+    if data:
+        yield data.encode('utf-8')
+
+
+_XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+_XLSX_PARTS = (
+    ('[Content_Types].xml',
+     _XML_HEAD +
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" '
+     'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     _XML_HEAD +
+     '<Relationships xmlns="%s"><Relationship Id="rId1" Type="%s/officeDocument" '
+     'Target="xl/workbook.xml"/></Relationships>' % (_NS_PKG_REL, _NS_REL)),
+    ('xl/workbook.xml',
+     _XML_HEAD +
+     '<workbook xmlns="%s" xmlns:r="%s"><sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/>'
+     '</sheets></workbook>' % (_NS_MAIN, _NS_REL)),
+    ('xl/_rels/workbook.xml.rels',
+     _XML_HEAD +
+     '<Relationships xmlns="%s"><Relationship Id="rId1" Type="%s/worksheet" '
+     'Target="worksheets/sheet1.xml"/></Relationships>' % (_NS_PKG_REL, _NS_REL)),
+)
+
+_ILLEGAL_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_cell(value):
+    # NaN和无穷大不是合法的数字单元格，Excel会报文件损坏，和CSV一样按文本写出
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return '<c><v>%r</v></c>' % value
+    if value is None:
+        value = ''
+    return '<c t="inlineStr"><is><t>%s</t></is></c>' % escape(_ILLEGAL_XML.sub('', str(value)))
+
+
+def _xlsx_row(row):
+    return ('<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>').encode('utf-8')
+
+
+def stream_xlsx(rows, header=HEADER):
+    # zipfile写到不可seek的流时会用data descriptor，
+    # 所以可以边生成sheet边把压缩好的字节交给响应
+    pipe = _Pipe()
+    archive = zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in _XLSX_PARTS:
+        archive.writestr(name, content)
+    sheet = archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True)
+    sheet.write((_XML_HEAD + '<worksheet xmlns="%s"><sheetData>' % _NS_MAIN).encode('utf-8'))
+    sheet.write(_xlsx_row(header))
+    yield pipe.drain()
+    for i, row in enumerate(rows, 1):
+        sheet.write(_xlsx_row(row))
+        if i % CHUNK_SIZE == 0:
+            data = pipe.drain()
+            if data:
+                yield data
+    sheet.write(b'</sheetData></worksheet>')
+    sheet.close()
+    archive.close()
+    data = pipe.drain()
+    if data:
+        yield data
@@ -0,0 +1,261 @@
+# -*- coding: UTF-8 -*-
+
+# 练习/考试的批量批改：Submission（原始作答）→ ProblemCondition + ExerciseCondition.results
+# 1. 整个练习的标准答案（AnswerKey）一次读出、规范化，按题目ID排好，进程池启动时传给每个工作进程一次
+# 2. 主进程按主键分块读作答，交给工作进程打分：作答先去重再规范化，
+#    然后用numpy按题目ID查标准答案，整列比较得到是否正确和得分；
+#    主进程写上一块的同时工作进程在算下一块
+# 3. 每块一个事务：新作答bulk_create ProblemCondition并建立results关联，
+#    已经批改过的bulk_update原来那条ProblemCondition，所以重新批改是幂等的
+# 4. 题目/练习统计在每块的事务里按差值更新；最后重算这些学生在练习题目的标签上的TagAbility
+#
+# result是原始作答（去掉首尾空白），judge在答错时是学生的错误答案，答对或者没作答时为空。
+# 没有标准答案的题目不批改。TagAbility.degree取学生在带这个标签的题目上的历史正确率（0-100），
+# 每次从ProblemCondition重新计算，不依赖上一次的值。
+# 主键用bulk.next_id分配，锁持有到每块的事务提交，考试进行中在线提交的作答可以同时写入。
+
+import re
+import time
+from datetime import timedelta
+from multiprocessing import Pool
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Max, Min, Sum, When
+from django.utils import timezone
+
+from dbsystem import aggregates, mastery, ranking, recommend, reports, rollups
+from dbsystem.bulk import BATCH_SIZE, next_id
+from dbsystem.models_mysql import (AnswerKey, Exercise, ExerciseCondition, Problem, ProblemCondition, Submission,
+                                   TagAbility)
+
+
+CHUNK_SIZE = 20000
+
+Results = ExerciseCondition.results.through
+
+_SEPARATORS = re.compile(r'[\s,，;；、]+')
+
+_CHOICES = re.compile(r'^[A-H]+$')
+
+
+def normalize(answer):
+    answer = _SEPARATORS.sub('', answer or '').upper()
+    # 多选题和选项顺序无关
+    if _CHOICES.match(answer):
+        answer = ''.join(sorted(set(answer)))
+    return answer
+
+
+def load_keys(exercise_id):
+    rows = sorted(AnswerKey.objects.filter(exercise_id=exercise_id).values_list('problem_id', 'answer', 'points'))
+    return (np.array([row[0] for row in rows], dtype=np.int64),
+            np.array([normalize(row[1]) for row in rows], dtype=object),
+            np.array([row[2] for row in rows], dtype=np.float64))
+
+
+_keys = None
+
+
+def _init_worker(keys):
+    global _keys
+    _keys = keys
+
+
+def score(task):
+    # 在工作进程里执行，不访问数据库。task: (题目ID列表, 作答列表)
+    # 返回 (有没有标准答案, 是否作答, 是否正确, 得分) 四个数组
+    problem_ids, answers = task
+    key_problems, key_answers, key_points = _keys
+    problem_ids = np.asarray(problem_ids, dtype=np.int64)
+    if not len(problem_ids) or not len(key_problems):
+        empty = np.zeros(len(problem_ids), dtype=bool)
+        return empty, empty, empty, np.zeros(len(problem_ids))
+    # 同一道题的作答大多相同，只规范化不同的作答
+    unique, inverse = np.unique(np.asarray(answers, dtype=str), return_inverse=True)
+    normalized = np.array([normalize(answer) for answer in unique], dtype=object)[inverse.reshape(-1)]
+    index = np.minimum(np.searchsorted(key_problems, problem_ids), len(key_problems) - 1)
+    has_key = key_problems[index] == problem_ids
+    answered = normalized != ''
+    correct = has_key & answered & (normalized == key_answers[index])
+    points = np.where(correct, key_points[index], 0.0)
+    return has_key, answered, correct, points
+
+
+class _Inline(object):
+    # 不用进程池时的同步结果，接口和AsyncResult一样
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def _chunks(exercise_id, chunk_size, new_only):
+    submissions = Submission.objects.filter(exercise_id=exercise_id)
+    if new_only:
+        submissions = submissions.filter(problem_condition__isnull=True)
+    last = 0
+    while True:
+        chunk = list(submissions.filter(pk__gt=last).order_by('pk').values_list(
+            'pk', 'student_id', 'problem_id', 'answer', 'cost', 'submitted_at', 'problem_condition_id')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1][0]
+
+
+def _exercise_conditions(exercise_id, chunk):
+    # 每个学生一条ExerciseCondition，新建的完成时间取最后一次提交
+    finish_times = {}
+    for _, student_id, _, _, _, submitted_at, _ in chunk:
+        if student_id not in finish_times or submitted_at > finish_times[student_id]:
+            finish_times[student_id] = submitted_at
+    student_ids = list(finish_times)
+    conditions = {}
+    for i in range(0, len(student_ids), BATCH_SIZE):
+        conditions.update(ExerciseCondition.objects.filter(
+            exercise_id=exercise_id, student_id__in=student_ids[i:i + BATCH_SIZE]).values_list('student_id', 'pk'))
+    created = [student_id for student_id in student_ids if student_id not in conditions]
+    if created:
+        first = next_id(ExerciseCondition)
+        ExerciseCondition.objects.bulk_create([
+            ExerciseCondition(pk=first + i, exercise_id=exercise_id, student_id=student_id,
+                              finish_time=finish_times[student_id]) for i, student_id in enumerate(created)
+        ], batch_size=BATCH_SIZE)
+        conditions.update((student_id, first + i) for i, student_id in enumerate(created))
+    return conditions
+
+
+def _before_update(pks):
+    # 重新批改前的ProblemCondition和它们关联到的练习，用来算统计的差值
+    old, linked = {}, {}
+    for i in range(0, len(pks), BATCH_SIZE):
+        batch = pks[i:i + BATCH_SIZE]
+        old.update((condition.pk, condition) for condition in ProblemCondition.objects.filter(pk__in=batch).only(
+            'problem_id', 'result', 'judge', 'cost', 'points'))
+        for condition_id, exercise in Results.objects.filter(problemcondition_id__in=batch).values_list(
+                'problemcondition_id', 'exercisecondition__exercise_id'):
+            linked.setdefault(condition_id, []).append(exercise)
+    return old, linked
+
+
+def _write(exercise_id, chunk, scored, report):
+    has_key, answered, correct, points = scored
+    with transaction.atomic():
+        # 先bump再分配主键，和在线提交的加锁顺序一致
+        reports.bump()
+        graded = [(row, bool(ok), float(score)) for row, key, ok, score in zip(chunk, has_key, correct, points) if key]
+        conditions = _exercise_conditions(exercise_id, [row for row, _, _ in graded])
+        created, updated, links, submissions = [], [], [], []
+        first = next_id(ProblemCondition)
+        for row, ok, score in graded:
+            pk, student_id, problem_id, answer, cost, _, condition_id = row
+            result = (answer or '').strip()
+            judge = '' if ok or not normalize(result) else result
+            if condition_id is None:
+                condition_id = first + len(created)
+                created.append(ProblemCondition(pk=condition_id, student_id=student_id, problem_id=problem_id,
+                                                result=result, judge=judge, cost=cost, points=score))
+                links.append(Results(exercisecondition_id=conditions[student_id], problemcondition_id=condition_id))
+                submissions.append(Submission(pk=pk, problem_condition_id=condition_id))
+            else:
+                updated.append(ProblemCondition(pk=condition_id, student_id=student_id, problem_id=problem_id,
+                                                result=result, judge=judge, cost=cost, points=score))
+        old, linked = _before_update([condition.pk for condition in updated])
+        ProblemCondition.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        Results.objects.bulk_create(links, batch_size=BATCH_SIZE)
+        Submission.objects.bulk_update(submissions, ['problem_condition'], batch_size=BATCH_SIZE)
+        ProblemCondition.objects.bulk_update(updated, ['result', 'judge', 'cost', 'points'], batch_size=BATCH_SIZE)
+        # bulk写入不发信号，统计按差值补上
+        aggregates.add_created(created, [exercise_id] * len(created))
+        aggregates.add_updated([old[condition.pk] for condition in updated], updated,
+                               [linked.get(condition.pk, ()) for condition in updated])
+    report['submissions'] += len(chunk)
+    report['no_key'] += len(chunk) - len(graded)
+    report['created'] += len(created)
+    report['updated'] += len(updated)
+    report['correct'] += sum(1 for _, ok, _ in graded if ok)
+    report['students'].update(conditions)
+
+
+def update_abilities(student_ids, tag_ids):
+    # 从ProblemCondition重新计算这些学生在这些标签上的掌握程度
+    student_ids, tag_ids = list(student_ids), list(tag_ids)
+    written = 0
+    for i in range(0, len(student_ids), BATCH_SIZE):
+        batch = student_ids[i:i + BATCH_SIZE]
+        totals = ProblemCondition.objects.filter(student_id__in=batch, problem__tags__in=tag_ids).values(
+            'student_id', 'problem__tags').annotate(
+            total=Count('pk'),
+            correct=Sum(Case(When(aggregates.correct_q(), then=1), default=0, output_field=IntegerField())),
+        ).values_list('student_id', 'problem__tags', 'total', 'correct').order_by()
+        degrees = {(student_id, tag_id): round(100 * (correct or 0) / total)
+                   for student_id, tag_id, total, correct in totals}
+        with transaction.atomic():
+            existing = {(student_id, tag_id): pk for pk, student_id, tag_id in TagAbility.objects.filter(
+                student_id__in=batch, tag_id__in=tag_ids).values_list('pk', 'student_id', 'tag_id')}
+            TagAbility.objects.bulk_update([TagAbility(pk=existing[key], degree=degree)
+                                            for key, degree in degrees.items() if key in existing],
+                                           ['degree'], batch_size=BATCH_SIZE)
+            TagAbility.objects.bulk_create([TagAbility(student_id=key[0], tag_id=key[1], degree=degree)
+                                            for key, degree in degrees.items() if key not in existing],
+                                           batch_size=BATCH_SIZE)
+        written += len(degrees)
+    return written
+
+
+def grade(exercise_id, workers=1, chunk_size=CHUNK_SIZE, new_only=False, log=None):
+    log = log or (lambda message: None)
+    started = time.perf_counter()
+    keys = load_keys(exercise_id)
+    report = {'exercise': exercise_id, 'submissions': 0, 'no_key': 0, 'created': 0, 'updated': 0, 'correct': 0,
+              'students': {}}
+    pool = Pool(workers, initializer=_init_worker, initargs=(keys,)) if workers > 1 else None
+    if pool is None:
+        _init_worker(keys)
+    try:
+        pending = None
+        for chunk in _chunks(exercise_id, chunk_size, new_only):
+            task = ([row[2] for row in chunk], [row[3] or '' for row in chunk])
+            result = pool.apply_async(score, (task,)) if pool else _Inline(score(task))
+            if pending is not None:
+                _write(exercise_id, pending[0], pending[1].get(), report)
+                log('exercise %d: %d submissions graded' % (exercise_id, report['submissions']))
+            pending = (chunk, result)
+        if pending is not None:
+            _write(exercise_id, pending[0], pending[1].get(), report)
+            log('exercise %d: %d submissions graded' % (exercise_id, report['submissions']))
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    # 掌握程度在这里补上
+    problem_ids = keys[0].tolist()
+    tag_ids = set(Problem.tags.through.objects.filter(problem_id__in=problem_ids).values_list('tag_id', flat=True))
+    report['abilities'] = update_abilities(report['students'], tag_ids) if tag_ids else 0
+    if report['updated']:
+        # 重新批改改变了已经汇总过的日期
+        days = ExerciseCondition.objects.filter(exercise_id=exercise_id).aggregate(
+            first=Min('finish_time'), last=Max('finish_time'))
+        rollups.rebuild_range(timezone.localtime(days['first']).date(), timezone.localtime(days['last']).date())
+    mastery.invalidate()
+    recommend.invalidate()
+    ranking.mark_stale(report['students'])
+
+    report['students'] = len(report['students'])
+    report['seconds'] = time.perf_counter() - started
+    report['rows_per_sec'] = report['submissions'] / report['seconds'] if report['seconds'] else None
+    return report
+
+
+def closed_exams(now=None):
+    # 已经结束（布置时刻 + 时长）并且还有没批改的作答的考试
+    now = now or timezone.now()
+    exercise_ids = Submission.objects.filter(problem_condition__isnull=True).values('exercise_id').distinct()
+    exams = Exercise.objects.filter(pk__in=exercise_ids, types='2').values_list('pk', 'release_time', 'length')
+    return sorted(pk for pk, release_time, length in exams if release_time + timedelta(minutes=length) <= now)
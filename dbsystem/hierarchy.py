@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+
+# Chapter/Folder/Problem的sub是自引用列表，按层遍历要每个节点一次往返。
+# 这里给每个节点维护物化的上级列表ancestors（从根开始）和深度depth，ancestors上有多键索引：
+#   所有下级        descendants(Chapter, x)    → {ancestors: x}
+#   所有上级        ancestors(chapter)         → {_id: {$in: chapter.ancestors}}
+#   章节下所有题目  problems_under(x)          → Problem {chapters: x}
+# Problem.chapters是题目所属章节加上它的所有上级章节。
+# 一个节点出现在多个sub里时，ancestors是所有上级的并集，depth取最短的一条。
+#
+# 新建/删除文档通过mongoengine信号自动刷新（需要blinker）；直接改sub请用attach()/detach()，
+# 或者改完以后调用refresh()。全量重建：manage.py rebuild_hierarchy
+
+import logging
+
+from mongoengine import Document, signals
+
+from dbsystem.models import Chapter, Folder, Problem
+from dbsystem.prefetch import document_id, reference_ids
+
+
+logger = logging.getLogger('dbsystem.hierarchy')
+
+DOCUMENTS = (Chapter, Folder, Problem)
+
+BATCH_SIZE = 1000
+
+
+def _in(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield {'$in': ids[i:i + BATCH_SIZE]}
+
+
+def _resolve(nodes, subs, fixed):
+    # nodes: 要计算的节点；subs: {节点: [子节点]}，包括不在nodes里的上级；
+    # fixed: 不在nodes里的上级已经存好的 (ancestors, depth)
+    parents = {}
+    for parent, children in subs.items():
+        for child in children:
+            if child in nodes:
+                parents.setdefault(child, []).append(parent)
+    waiting = {node: sum(1 for parent in parents.get(node, ()) if parent in nodes) for node in nodes}
+    ready = [node for node, count in waiting.items() if count == 0]
+    result = {}
+    depths = {node: info[1] for node, info in fixed.items()}
+
+    def resolve(node):
+        ancestors = set()
+        depth = None
+        for parent in parents.get(node, ()):
+            info = result.get(parent) or fixed.get(parent)
+            if info is None:
+                continue
+            ancestors.add(parent)
+            ancestors.update(info[0])
+            depth = info[1] + 1 if depth is None else min(depth, info[1] + 1)
+        depths[node] = depth or 0
+        result[node] = (sorted(ancestors, key=lambda a: (depths.get(a, 0), str(a))), depth or 0)
+
+    while ready:
+        node = ready.pop()
+        resolve(node)
+        for child in subs.get(node, ()):
+            if child in waiting:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append(child)
+    cycle = [node for node in nodes if node not in result]
+    if cycle:
+        # 环上的节点只从已经算出来的上级继承
+        logger.warning('%d nodes are in a sub cycle: %s', len(cycle), ', '.join(str(node) for node in cycle[:10]))
+        for node in cycle:
+            resolve(node)
+    return result
+
+
+def _write(collection, result):
+    # 同一个上级下的兄弟节点ancestors相同，合成一条update_many
+    groups = {}
+    for node, (ancestors, depth) in result.items():
+        groups.setdefault((tuple(ancestors), depth), []).append(node)
+    for (ancestors, depth), nodes in groups.items():
+        for ids in _in(nodes):
+            collection.update_many({'_id': ids}, {'$set': {'ancestors': list(ancestors), 'depth': depth}})
+
+
+def refresh_problem_chapters(chapter_ids=None):
+    query = {'_id': {'$in': list(chapter_ids)}} if chapter_ids is not None else {}
+    problems = Problem._get_collection()
+    for chapter in Chapter._get_collection().find(query, {'ancestors': 1}):
+        problems.update_many({'chapter': chapter['_id']},
+                             {'$set': {'chapters': (chapter.get('ancestors') or []) + [chapter['_id']]}})
+
+
+def _problem_chapters(problem_id, chapter_id):
+    chapter = Chapter._get_collection().find_one({'_id': chapter_id}, {'ancestors': 1}) if chapter_id else None
+    chapters = (chapter.get('ancestors') or []) + [chapter['_id']] if chapter else []
+    Problem._get_collection().update_one({'_id': problem_id}, {'$set': {'chapters': chapters}})
+
+
+def rebuild(document):
+    collection = document._get_collection()
+    subs = {doc['_id']: doc.get('sub') or [] for doc in collection.find({}, {'sub': 1})}
+    result = _resolve(set(subs), subs, {})
+    _write(collection, result)
+    if document is Chapter:
+        refresh_problem_chapters()
+    elif document is Problem:
+        collection.update_many({'chapter': None}, {'$set': {'chapters': []}})
+        refresh_problem_chapters()
+    return len(result)
+
+
+def refresh(document, node_ids):
+    # 重新计算这些节点和它们（修改前后）的所有下级，返回重新计算的节点
+    collection = document._get_collection()
+    node_ids = list(node_ids)
+    affected = set(node_ids)
+    for ids in _in(node_ids):
+        affected.update(doc['_id'] for doc in collection.find({'ancestors': ids}, {'_id': 1}))
+    subs = {}
+    frontier = affected
+    while frontier:
+        found = set()
+        for ids in _in(frontier):
+            for doc in collection.find({'_id': ids}, {'sub': 1}):
+                subs[doc['_id']] = doc.get('sub') or []
+                found.update(doc.get('sub') or [])
+        frontier = found - affected
+        affected |= frontier
+    # 已经删除的节点不再计算
+    affected &= subs.keys()
+    fixed = {}
+    for ids in _in(affected):
+        for doc in collection.find({'sub': ids}, {'sub': 1, 'ancestors': 1, 'depth': 1}):
+            if doc['_id'] not in affected:
+                subs[doc['_id']] = doc.get('sub') or []
+                fixed[doc['_id']] = (doc.get('ancestors') or [], doc.get('depth') or 0)
+    result = _resolve(affected, subs, fixed)
+    _write(collection, result)
+    if document is Chapter:
+        refresh_problem_chapters(result)
+    return set(result)
+
+
+def attach(document, parent_id, child_id):
+    document._get_collection().update_one({'_id': parent_id}, {'$addToSet': {'sub': child_id}})
+    return refresh(document, [child_id])
+
+
+def detach(document, parent_id, child_id):
+    document._get_collection().update_one({'_id': parent_id}, {'$pull': {'sub': child_id}})
+    return refresh(document, [child_id])
+
+
+def descendants(document, node_id):
+    return document.objects(ancestors=node_id)
+
+
+def ancestors(node):
+    return type(node).objects(__raw__={'_id': {'$in': list(node.ancestors)}}).order_by('depth')
+
+
+def problems_under(chapter_id):
+    return Problem.objects(chapters=chapter_id)
+
+
+def _base(document):
+    for base in DOCUMENTS:
+        if isinstance(document, base):
+            return base
+    return None
+
+
+def _post_save(sender, document, **kwargs):
+    base = _base(document)
+    if base is None:
+        return
+    refresh(base, [document_id(document)])
+    if base is Problem:
+        chapter = document._data.get('chapter')
+        if isinstance(chapter, Document):
+            chapter = document_id(chapter)
+        _problem_chapters(document_id(document), next(reference_ids(chapter), None))
+
+
+def _post_delete(sender, document, **kwargs):
+    base = _base(document)
+    if base is not None:
+        refresh(base, [document_id(document)])
+
+
+def connect_signals():
+    if not signals.signals_available:
+        logger.info('blinker is not installed, run rebuild_hierarchy after changing sub lists')
+        return
+    signals.post_save.connect(_post_save)
+    signals.post_delete.connect(_post_delete)
@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+
+# 题目/解答图片的内容寻址存储
+# 原图按内容的SHA-256存放（ab/abcdef...），同样的图片不管出现在多少道题里都只存一份，ImageBlob记录类型和尺寸。
+# 每张图按IMAGE_THUMBNAIL_SIZES（最长边像素）生成缩略图（ab/abcdef...-320），
+# 上传时交给后台进程池生成，不等待；访问时还没生成的当场生成。
+# 文件放在IMAGE_STORE_DIR下，通过Django的FileSystemStorage读写。
+# Mongo的Problem/Solution.image_digests和images一一对应：
+#   import_gridfs()把GridFS里已有的图片导入进来，add_images()上传新图片
+# /images/<digest>/ 和 /images/<digest>/<size>/ 读取图片：内容不会变，ETag就是摘要，支持Range分段下载
+# 进程池在第一次上传时创建（fork），IMAGE_WORKERS为0时在当前进程里同步生成
+
+import hashlib
+import re
+import threading
+from io import BytesIO
+from multiprocessing import Pool
+
+import gridfs
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from PIL import Image, features
+
+from dbsystem import models as mongo
+from dbsystem.bulk import BATCH_SIZE
+from dbsystem.models_mysql import ImageBlob
+
+
+DOCUMENTS = (mongo.Problem, mongo.Solution)
+
+CHUNK_SIZE = 64 * 1024
+
+THUMBNAIL_TYPES = {'WEBP': 'image/webp', 'PNG': 'image/png', 'JPEG': 'image/jpeg'}
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def storage():
+    return FileSystemStorage(location=settings.IMAGE_STORE_DIR)
+
+
+def thumbnail_sizes():
+    return tuple(getattr(settings, 'IMAGE_THUMBNAIL_SIZES', (96, 320, 800)))
+
+
+def name(digest, size=None):
+    return '%s/%s%s' % (digest[:2], digest, '' if size is None else '-%d' % size)
+
+
+def _thumbnail_mode(image):
+    return 'RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB'
+
+
+def _thumbnail_format(mode):
+    # WebP压缩率高而且有透明通道；没有编译WebP支持时，透明图用PNG，其他用JPEG
+    if features.check('webp'):
+        return 'WEBP'
+    return 'PNG' if mode == 'RGBA' else 'JPEG'
+
+
+def _write(files, path, data):
+    # 内容相同的文件名也相同，已经存在就不用再写；并发写入时FileSystemStorage会换名字，删掉多出来的那份
+    if files.exists(path):
+        return
+    saved = files.save(path, ContentFile(data))
+    if saved != path:
+        files.delete(saved)
+
+
+def make_thumbnails(location, digest, sizes):
+    # 在工作进程里执行，不访问数据库
+    files = FileSystemStorage(location=location)
+    with files.open(name(digest)) as f:
+        # 动图只取第一帧
+        original = Image.open(f)
+        original.load()
+    mode = _thumbnail_mode(original)
+    image = original.convert(mode)
+    fmt = _thumbnail_format(mode)
+    for size in sizes:
+        if files.exists(name(digest, size)):
+            continue
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        thumbnail.save(buffer, fmt, quality=85)
+        _write(files, name(digest, size), buffer.getvalue())
+    return digest
+
+
+def _make_thumbnails(task):
+    return make_thumbnails(*task)
+
+
+_pool = None
+_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = Pool(settings.IMAGE_WORKERS)
+        return _pool
+
+
+def shutdown():
+    # 等进程池里的缩略图生成完，关闭进程池
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+
+
+def submit_thumbnails(digests):
+    # IMAGE_WORKERS为0时同步生成；否则交给进程池，返回AsyncResult
+    tasks = [(settings.IMAGE_STORE_DIR, digest, thumbnail_sizes()) for digest in digests]
+    if not getattr(settings, 'IMAGE_WORKERS', 0):
+        for task in tasks:
+            _make_thumbnails(task)
+        return None
+    return _get_pool().map_async(_make_thumbnails, tasks)
+
+
+def put(data, thumbnails=True):
+    # 存一张图片，返回ImageBlob；已经存过的直接返回。不是图片时Pillow抛出异常
+    digest = hashlib.sha256(data).hexdigest()
+    blob = ImageBlob.objects.filter(pk=digest).first()
+    if blob is not None:
+        return blob
+    image = Image.open(BytesIO(data))
+    image.verify()
+    image = Image.open(BytesIO(data))
+    _write(storage(), name(digest), data)
+    blob = ImageBlob(digest=digest, content_type=Image.MIME.get(image.format, 'application/octet-stream'),
+                     thumbnail_type=THUMBNAIL_TYPES[_thumbnail_format(_thumbnail_mode(image))],
+                     width=image.width, height=image.height, size=len(data))
+    try:
+        with transaction.atomic():
+            blob.save(force_insert=True)
+    except IntegrityError:
+        # 别的进程同时存了同一张图
+        return ImageBlob.objects.get(pk=digest)
+    if thumbnails:
+        submit_thumbnails([digest])
+    return blob
+
+
+def add_images(document, doc_id, files):
+    # 给Mongo的题目/解答加图片，files是上传的文件或者bytes，返回摘要列表
+    digests = [put(f if isinstance(f, bytes) else f.read()).digest for f in files]
+    # 显式声明了_id的Document用save()会插入新文档，这里直接更新
+    document._get_collection().update_one({'_id': doc_id}, {'$push': {'image_digests': {'$each': digests}}})
+    return digests
+
+
+def import_gridfs(document, batch_size=BATCH_SIZE, log=None):
+    # 把GridFS里的图片导入内容寻址存储，写入image_digests；已经导入过的文档跳过，中断后重新运行即可
+    log = log or (lambda message: None)
+    collection = document._get_collection()
+    fs = gridfs.GridFS(document._get_db(), collection=document._fields['images'].field.collection_name)
+    counts = {'documents': 0, 'images': 0, 'distinct': 0}
+    digests = []
+    last = None
+    while True:
+        query = {'images.0': {'$exists': True}}
+        if last is not None:
+            query['_id'] = {'$gt': last}
+        docs = list(collection.find(query, {'images': 1, 'image_digests': 1}).sort('_id', 1).limit(batch_size))
+        if not docs:
+            break
+        for doc in docs:
+            if len(doc.get('image_digests') or ()) == len(doc['images']):
+                continue
+            values = []
+            for file_id in doc['images']:
+                blob = put(fs.get(file_id).read(), thumbnails=False)
+                values.append(blob.digest)
+                counts['images'] += 1
+                digests.append(blob.digest)
+            collection.update_one({'_id': doc['_id']}, {'$set': {'image_digests': values}})
+            counts['documents'] += 1
+        last = docs[-1]['_id']
+        log('%s: %d documents, %d images' % (document.__name__, counts['documents'], counts['images']))
+    digests = list(dict.fromkeys(digests))
+    counts['distinct'] = len(digests)
+    result = submit_thumbnails(digests)
+    if result is not None:
+        result.get()
+    return counts
+
+
+def image_urls(doc, size=None):
+    return ['/images/%s/%s' % (digest, '' if size is None else '%d/' % size) for digest in doc.image_digests]
+
+
+def parse_range(header, length):
+    # 只支持一段：返回 (开始, 结束)，结束包含在内；没有Range或者是多段时返回None，按整个文件返回
+    # 范围超出文件时抛出ValueError，对应416
+    match = _RANGE.match((header or '').strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-500 是最后500字节
+        suffix = int(last)
+        if not suffix:
+            raise ValueError(header)
+        return max(0, length - suffix), length - 1
+    start = int(first)
+    end = min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def read(f, start, end):
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,257 @@
+# -*- coding: UTF-8 -*-
+
+# 每个请求的数据库统计：SQL查询次数/耗时（Django execute_wrapper），
+# Mongo命令次数/耗时（pymongo command monitoring），以及视图总耗时。
+# 结果写进响应头，同时按视图保留最近若干次请求，GET /dbstats/ 返回分位数和慢查询日志，POST清空。
+# mongo_listener由mongoconn.register()登记到每个Mongo连接上
+
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+
+from pymongo import monitoring
+
+
+logger = logging.getLogger('dbsystem.slow_query')
+
+_local = threading.local()
+
+_HERE = os.path.abspath(__file__)
+
+
+def _setting(name, default):
+    from django.conf import settings
+    return getattr(settings, name, default)
+
+
+_IN_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    sql = _IN_LIST.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+def normalize_mongo(event_name, command):
+    collection = command.get(event_name)
+    keys = []
+    for key in ('filter', 'query', 'q'):
+        if isinstance(command.get(key), dict):
+            keys = sorted(command[key])
+            break
+    return '%s %s {%s}' % (event_name, collection, ', '.join(keys))
+
+
+def call_site():
+    # 调用栈里最近的一帧项目代码（不是django/第三方库，也不是本模块）
+    from django.conf import settings
+    base = getattr(settings, 'BASE_DIR', '')
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        filename = os.path.abspath(frame.filename)
+        if filename == _HERE or 'site-packages' in filename or not filename.startswith(base):
+            continue
+        return '%s:%d in %s' % (os.path.relpath(filename, base), frame.lineno, frame.name)
+    return ''
+
+
+class RequestStats(object):
+
+    def __init__(self, view=''):
+        self.view = view
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.mongo_count = 0
+        self.mongo_time = 0.0
+        self.total_time = 0.0
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.sql_count += 1
+            self.sql_time += elapsed
+            registry.check_slow('sql', elapsed, self.view, lambda: normalize_sql(sql))
+
+    def as_headers(self):
+        return {
+            'X-SQL-Queries': str(self.sql_count),
+            'X-SQL-Time-Ms': '%.2f' % (self.sql_time * 1000),
+            'X-Mongo-Commands': str(self.mongo_count),
+            'X-Mongo-Time-Ms': '%.2f' % (self.mongo_time * 1000),
+            'X-View-Time-Ms': '%.2f' % (self.total_time * 1000),
+        }
+
+
+def current_stats():
+    return getattr(_local, 'stats', None)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    # 没有收到结束事件的命令（比如连接断开）最多保留max_pending条，超过时丢掉最早的
+
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self._started = OrderedDict()
+
+    def started(self, event):
+        command = (event.command_name, normalize_mongo(event.command_name, event.command))
+        limit = self.max_pending or _setting('DB_STATS_MONGO_PENDING', 10000)
+        with self.lock:
+            self._started[(event.connection_id, event.request_id)] = command
+            while len(self._started) > limit:
+                self._started.popitem(last=False)
+
+    def _finish(self, event):
+        with self.lock:
+            command = self._started.pop((event.connection_id, event.request_id), None)
+        stats = current_stats()
+        elapsed = event.duration_micros / 1e6
+        if stats is not None:
+            stats.mongo_count += 1
+            stats.mongo_time += elapsed
+        if command is not None:
+            registry.check_slow('mongo', elapsed, stats.view if stats else '', lambda: command[1])
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+
+mongo_listener = MongoCommandListener()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class StatsRegistry(object):
+    METRICS = ('total_ms', 'sql_queries', 'sql_ms', 'mongo_commands', 'mongo_ms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.slow = None
+
+    def _window(self):
+        return _setting('DB_STATS_WINDOW', 1000)
+
+    def record(self, stats):
+        sample = (stats.total_time * 1000, stats.sql_count, stats.sql_time * 1000,
+                  stats.mongo_count, stats.mongo_time * 1000)
+        with self.lock:
+            if stats.view not in self.samples:
+                self.samples[stats.view] = deque(maxlen=self._window())
+            self.samples[stats.view].append(sample)
+
+    def check_slow(self, kind, elapsed, view, statement):
+        if elapsed * 1000 < _setting('DB_STATS_SLOW_MS', 100):
+            return
+        entry = {
+            'kind': kind,
+            'ms': round(elapsed * 1000, 2),
+            'statement': statement(),
+            'call_site': call_site(),
+            'view': view,
+            'at': time.time(),
+        }
+        logger.warning('slow %s %.1fms %s at %s', kind, entry['ms'], entry['statement'], entry['call_site'])
+        with self.lock:
+            if self.slow is None:
+                self.slow = deque(maxlen=_setting('DB_STATS_SLOW_LOG_SIZE', 200))
+            self.slow.append(entry)
+
+    def snapshot(self):
+        with self.lock:
+            samples = {view: list(values) for view, values in self.samples.items()}
+            slow = list(self.slow or ())
+        views = {}
+        for view, values in samples.items():
+            columns = list(zip(*values))
+            views[view] = {'count': len(values)}
+            for name, column in zip(self.METRICS, columns):
+                views[view][name] = {
+                    'p50': percentile(column, 50),
+                    'p90': percentile(column, 90),
+                    'p99': percentile(column, 99),
+                    'max': max(column),
+                }
+        return {'views': views, 'slow': slow}
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.slow = None
+
+
+registry = StatsRegistry()
+
+UNRESOLVED = '<unresolved>'
+
+
+class QueryStatsMiddleware(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats(request.path)
+        start = time.perf_counter()
+        with self.collect(stats):
+            response = self.get_response(request)
+        stats.total_time = time.perf_counter() - start
+        # 没有匹配到URL的请求（404）都记在同一个键下，否则每个随便拼的路径都会占一份统计
+        match = getattr(request, 'resolver_match', None)
+        stats.view = match.view_name if match is not None else UNRESOLVED
+        # 流式响应的查询发生在返回之后，响应头里只有视图函数本身的部分，
+        # 完整的统计在内容发送完以后记录
+        for header, value in stats.as_headers().items():
+            response[header] = value
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, stats, start)
+        else:
+            registry.record(stats)
+        return response
+
+    def stream(self, content, stats, start):
+        try:
+            with self.collect(stats):
+                for chunk in content:
+                    yield chunk
+        finally:
+            stats.total_time = time.perf_counter() - start
+            registry.record(stats)
+
+    @contextmanager
+    def collect(self, stats):
+        from django.db import connections
+        previous = current_stats()
+        _local.stats = stats
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.sql_wrapper))
+                yield stats
+        finally:
+            _local.stats = previous
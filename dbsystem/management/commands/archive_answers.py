@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from dbsystem import rollups
+
+
+class Command(BaseCommand):
+    help = '把早于指定日期的练习/题目完成情况按月归档到压缩文件，并从数据库删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True, help='YYYY-MM-DD，向前对齐到周一')
+        parser.add_argument('--dir', help='默认settings.ANSWER_ARCHIVE_DIR')
+
+    def handle(self, *args, **options):
+        before = parse_date(options['before'])
+        if before is None:
+            raise CommandError('invalid date: %s' % options['before'])
+        archived = rollups.archive(before, options['dir'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS('archived %d answers before %s' % (
+            archived, rollups.bucket_of('week', before))))
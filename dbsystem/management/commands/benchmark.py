@@ -0,0 +1,78 @@
+import json
+import os
+import subprocess
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from dbsystem import aggregates, benchmark
+from dbsystem.synthetic import SCALES, Generator
+
+
+class Command(BaseCommand):
+    help = '生成模拟数据并对核心负载计时，结果写成JSON，可以和之前的结果对比'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--only', action='append', help='只跑指定的负载，可以重复')
+        parser.add_argument('--output', help='结果JSON文件')
+        parser.add_argument('--compare', help='之前的结果JSON，比较每个负载的最短用时')
+        parser.add_argument('--threshold', type=float, default=1.25, help='变慢超过这个倍数算退化')
+        parser.add_argument('--use-existing', action='store_true',
+                            help='直接用当前数据库里的数据，不新建测试库、不生成数据')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['use_existing']:
+            # 和测试一样在单独的测试库里生成数据，sqlite默认是内存库
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            if not options['use_existing']:
+                counts = Generator(options['seed'], options['scale']).run()
+                aggregates.rebuild()
+                self.stdout.write('generated %s' % ', '.join('%s=%d' % item for item in sorted(counts.items())))
+            report = {
+                'commit': self.commit(),
+                'created': datetime.now().isoformat(),
+                'database': connection.vendor,
+                'scale': None if options['use_existing'] else options['scale'],
+                'seed': options['seed'],
+                'results': benchmark.run(options['repeat'], options['seed'], options['only'], self.stdout.write),
+            }
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if options['compare']:
+            self.compare(report, options['compare'], options['threshold'])
+
+    def commit(self):
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def compare(self, report, path, threshold):
+        with open(path) as f:
+            base = json.load(f)
+        regressions = []
+        self.stdout.write('compared with %s (%s)' % (base.get('commit'), os.path.basename(path)))
+        for name, result in sorted(report['results'].items()):
+            before = base['results'].get(name)
+            if not before or not before['min']:
+                continue
+            ratio = result['min'] / before['min']
+            self.stdout.write('%-32s %10.4fs -> %10.4fs  x%.2f' % (name, before['min'], result['min'], ratio))
+            if ratio > threshold:
+                regressions.append(name)
+        if regressions:
+            raise CommandError('regressed: %s' % ', '.join(regressions))
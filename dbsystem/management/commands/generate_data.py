@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dbsystem import aggregates, mastery, profiles, taggraph
+from dbsystem.synthetic import SCALES, Generator
+
+
+class Command(BaseCommand):
+    help = '按随机种子生成模拟数据（学校/班级/学生/教材/标签/题目/练习/答题记录）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                            help='覆盖规模参数，例如 --set students_per_class=50')
+
+    def handle(self, *args, **options):
+        overrides = {}
+        for item in options['set']:
+            key, _, value = item.partition('=')
+            if key not in SCALES[options['scale']] or not value.isdigit():
+                raise CommandError('bad --set %r, keys: %s' % (item, ', '.join(sorted(SCALES['small']))))
+            overrides[key] = int(value)
+        counts = Generator(options['seed'], options['scale'], **overrides).run(log=self.stdout.write)
+        aggregates.rebuild()
+        mastery.invalidate()
+        profiles.invalidate()
+        taggraph.invalidate()
+        self.stdout.write(self.style.SUCCESS('generated %d rows' % sum(counts.values())))
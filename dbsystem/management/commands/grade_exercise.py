@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dbsystem import grading
+from dbsystem.models_mysql import Exercise
+
+
+class Command(BaseCommand):
+    help = '批量批改练习的作答（Submission），写入题目/练习完成情况并更新标签掌握程度'
+
+    def add_arguments(self, parser):
+        parser.add_argument('exercises', nargs='*', type=int, help='练习ID，重复批改结果相同')
+        parser.add_argument('--closed', action='store_true', help='批改所有已经结束、还有未批改作答的考试')
+        parser.add_argument('--new-only', action='store_true', help='只批改还没有批改过的作答')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=grading.CHUNK_SIZE, help='每个事务写入的作答数')
+
+    def handle(self, *args, **options):
+        missing = set(options['exercises']) - set(Exercise.objects.filter(
+            pk__in=options['exercises']).values_list('pk', flat=True))
+        if missing:
+            raise CommandError('unknown exercises: %s' % ', '.join(map(str, sorted(missing))))
+        # 结束的考试只批改新作答；明确指定的练习按--new-only
+        todo = {exercise_id: True for exercise_id in grading.closed_exams()} if options['closed'] else {}
+        todo.update((exercise_id, options['new_only']) for exercise_id in options['exercises'])
+        if not todo:
+            raise CommandError('no exercise to grade')
+        for exercise_id, new_only in todo.items():
+            report = grading.grade(exercise_id, workers=options['workers'], chunk_size=options['chunk_size'],
+                                   new_only=new_only, log=self.stdout.write)
+            self.stdout.write(self.style.SUCCESS(
+                'exercise %d: %d submissions (%d new, %d regraded, %d without answer key, %d correct), '
+                '%d students, %d abilities, %.2fs, %.0f rows/s' % (
+                    exercise_id, report['submissions'], report['created'], report['updated'], report['no_key'],
+                    report['correct'], report['students'], report['abilities'], report['seconds'],
+                    report['rows_per_sec'] or 0)))
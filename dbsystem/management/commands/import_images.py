@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from dbsystem import images
+from dbsystem.bulk import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = '把Mongo里题目/解答存在GridFS的图片导入内容寻址存储（去重），并生成缩略图'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            for document in images.DOCUMENTS:
+                counts = images.import_gridfs(document, options['batch_size'], log=self.stdout.write)
+                self.stdout.write(self.style.SUCCESS('%s: %d documents, %d images, %d distinct' % (
+                    document.__name__, counts['documents'], counts['images'], counts['distinct'])))
+        finally:
+            images.shutdown()
@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 -*-
+
+# 历史答题记录批量导入
+# 输入是CSV（带表头）或者JSONL文件，每条记录是一次答题，字段：
+#   student, problem, exercise, finish_time, result, judge, cost, points
+# 同一个(exercise, student)的记录归到同一条ExerciseCondition下面，
+# 写入ProblemCondition，并在ExerciseCondition.results中间表里建立关联
+#
+# 主进程顺序读文件（CSV用csv.reader切分记录，引号里可以有换行），按批交给进程池解析；
+# 外键通过批量查询的ID缓存校验，每个chunk在一个事务里用bulk_create写入。主键用bulk.next_id按当前最大值顺序分配
+# （Django在sqlite/mysql上bulk_create不回填主键），分配时拿的锁持有到chunk提交，导入时可以同时批改和在线提交。
+# 每提交一个chunk输出一次offset（记录序号，不是行号），中断后用 --resume-from 从该offset继续
+
+import csv
+import json
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dbsystem.bulk import next_id
+from dbsystem.models_mysql import Exercise, ExerciseCondition, Problem, ProblemCondition, Student
+
+
+FIELDS = ('student', 'problem', 'exercise', 'finish_time', 'result', 'judge', 'cost', 'points')
+
+QUERY_BATCH = 500
+
+CACHE_LIMIT = 1000000
+
+
+def _convert(record):
+    finish_time = parse_datetime(str(record['finish_time']))
+    if finish_time is None:
+        raise ValueError('bad finish_time %r' % record['finish_time'])
+    return (int(record['student']), int(record['problem']), int(record['exercise']), finish_time,
+            record.get('result') or '', record.get('judge') or '',
+            int(record.get('cost') or 0), float(record.get('points') or 0))
+
+
+def parse_batch(task):
+    # 在子进程里执行，只做解析和类型转换，不访问数据库
+    # CSV的records是已经切好的字段列表，JSONL是每行的文本
+    fmt, header, offset, records = task
+    if fmt == 'csv':
+        records = (dict(zip(header, row)) for row in records)
+    parsed, errors = [], []
+    for i, record in enumerate(records):
+        try:
+            if fmt != 'csv':
+                record = json.loads(record)
+            parsed.append((offset + i,) + _convert(record))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append((offset + i, str(e)))
+    return parsed, errors
+
+
+def _batched(items, size=QUERY_BATCH):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class IdCache(object):
+    # 记住已经确认存在/不存在的主键，只对没见过的ID批量查询
+
+    def __init__(self, model):
+        self.model = model
+        self.known = set()
+        self.missing = set()
+
+    def resolve(self, ids):
+        ids = set(ids)
+        if len(self.known) + len(self.missing) > CACHE_LIMIT:
+            self.known, self.missing = set(), set()
+        for batch in _batched(ids - self.known - self.missing):
+            found = set(self.model.objects.filter(pk__in=batch).values_list('pk', flat=True))
+            self.known |= found
+            self.missing |= set(batch) - found
+        return ids & self.known
+
+
+class Command(BaseCommand):
+    help = '从CSV/JSONL批量导入历史答题记录（ProblemCondition/ExerciseCondition）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='默认按扩展名判断')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--parse-batch', type=int, default=5000, help='每个解析任务的记录数')
+        parser.add_argument('--chunk-size', type=int, default=20000, help='每个事务写入的记录数')
+        parser.add_argument('--resume-from', type=int, default=0, help='跳过前N条记录（所有文件连续计数）')
+        parser.add_argument('--skip-stats', action='store_true', help='导入后不重建题目/练习统计')
+
+    def handle(self, *args, **options):
+        self.chunk_size = options['chunk_size']
+        self.students = IdCache(Student)
+        self.problems = IdCache(Problem)
+        self.exercises = IdCache(Exercise)
+        self.exercise_conditions = {}
+        self.written = self.skipped = 0
+        self.started = time.time()
+        offset = options['resume_from']
+
+        tasks = self._tasks(options['files'], options['format'], options['parse_batch'], offset)
+        pending = []
+        pool = Pool(options['workers']) if options['workers'] > 1 else None
+        try:
+            results = pool.imap(parse_batch, tasks) if pool else map(parse_batch, tasks)
+            for parsed, errors in results:
+                for line, error in errors:
+                    self.stderr.write('record %d: %s' % (line, error))
+                self.skipped += len(errors)
+                pending.extend(parsed)
+                while len(pending) >= self.chunk_size:
+                    offset = self._write(pending[:self.chunk_size])
+                    pending = pending[self.chunk_size:]
+            if pending:
+                offset = self._write(pending)
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        elapsed = time.time() - self.started
+        self.stdout.write(self.style.SUCCESS('done: %d written, %d skipped, %.0f rows/s, next offset %d' % (
+            self.written, self.skipped, self.written / elapsed if elapsed else 0, offset)))
+        if not options['skip_stats'] and self.written:
+            call_command('rebuild_stats', stdout=self.stdout)
+
+    def _tasks(self, files, fmt, batch_size, resume_from):
+        # 流式读文件，按batch_size条记录切成解析任务，offset是所有文件连续的记录序号
+        offset = 0
+        for path in files:
+            file_format = fmt or ('csv' if path.endswith('.csv') else 'jsonl')
+            with open(path, encoding='utf-8', newline='') as f:
+                header = None
+                if file_format == 'csv':
+                    reader = csv.reader(f)
+                    header = next(reader, [])
+                    if not set(FIELDS) <= set(header):
+                        raise CommandError('%s: csv header must contain %s' % (path, ', '.join(FIELDS)))
+                    records = (row for row in reader if row)
+                else:
+                    records = (line for line in f if line.strip())
+                if offset < resume_from:
+                    skip = resume_from - offset
+                    offset += sum(1 for _ in islice(records, skip))
+                    if offset < resume_from:
+                        continue
+                while True:
+                    batch = list(islice(records, batch_size))
+                    if not batch:
+                        break
+                    yield file_format, header, offset, batch
+                    offset += len(batch)
+
+    def _write(self, records):
+        next_offset = records[-1][0] + 1
+        students = self.students.resolve(r[1] for r in records)
+        problems = self.problems.resolve(r[2] for r in records)
+        exercises = self.exercises.resolve(r[3] for r in records)
+        valid = [r for r in records if r[1] in students and r[2] in problems and r[3] in exercises]
+        self.skipped += len(records) - len(valid)
+
+        with transaction.atomic():
+            condition_ids = self._exercise_conditions(valid)
+            first = next_id(ProblemCondition)
+            problem_conditions, links = [], []
+            for i, (_, student, problem, exercise, finish_time, result, judge, cost, points) in enumerate(valid):
+                problem_conditions.append(ProblemCondition(
+                    pk=first + i, student_id=student, problem_id=problem,
+                    result=result, judge=judge, cost=cost, points=points))
+                links.append(ExerciseCondition.results.through(
+                    exercisecondition_id=condition_ids[(exercise, student)], problemcondition_id=first + i))
+            ProblemCondition.objects.bulk_create(problem_conditions, batch_size=QUERY_BATCH)
+            ExerciseCondition.results.through.objects.bulk_create(links, batch_size=QUERY_BATCH)
+
+        self.written += len(valid)
+        elapsed = time.time() - self.started
+        self.stdout.write('offset %d: %d written, %d skipped, %.0f rows/s' % (
+            next_offset, self.written, self.skipped, self.written / elapsed if elapsed else 0))
+        return next_offset
+
+    def _exercise_conditions(self, records):
+        finish_times = {}
+        for _, student, problem, exercise, finish_time, *rest in records:
+            if settings.USE_TZ and timezone.is_naive(finish_time):
+                finish_time = timezone.make_aware(finish_time)
+            key = (exercise, student)
+            if key not in finish_times or finish_time > finish_times[key]:
+                finish_times[key] = finish_time
+
+        if len(self.exercise_conditions) > CACHE_LIMIT:
+            self.exercise_conditions = {}
+        unseen = [key for key in finish_times if key not in self.exercise_conditions]
+        for batch in _batched(unseen):
+            keys = set(batch)
+            # (练习, 学生)是唯一的；按主键升序，万一有重复时后写入的新记录覆盖旧的
+            existing = ExerciseCondition.objects.filter(
+                exercise_id__in={k[0] for k in keys}, student_id__in={k[1] for k in keys}
+            ).order_by('pk').values_list('exercise_id', 'student_id', 'pk')
+            for exercise, student, pk in existing:
+                if (exercise, student) in keys:
+                    self.exercise_conditions[(exercise, student)] = pk
+
+        created = [key for key in unseen if key not in self.exercise_conditions]
+        if created:
+            first = next_id(ExerciseCondition)
+            conditions = []
+            for i, (exercise, student) in enumerate(created):
+                conditions.append(ExerciseCondition(pk=first + i, exercise_id=exercise, student_id=student,
+                                                    finish_time=finish_times[(exercise, student)]))
+                self.exercise_conditions[(exercise, student)] = first + i
+            ExerciseCondition.objects.bulk_create(conditions, batch_size=QUERY_BATCH)
+
+        # 追加到已有ExerciseCondition的记录更晚时，完成时间跟着往后移，和答题写在同一个事务里
+        appended = {self.exercise_conditions[key]: finish_times[key] for key in finish_times if key not in created}
+        moved = []
+        for batch in _batched(appended):
+            for condition in ExerciseCondition.objects.filter(pk__in=batch).only('pk', 'finish_time'):
+                if appended[condition.pk] > condition.finish_time:
+                    condition.finish_time = appended[condition.pk]
+                    moved.append(condition)
+        if moved:
+            ExerciseCondition.objects.bulk_update(moved, ['finish_time'], batch_size=QUERY_BATCH)
+        return self.exercise_conditions
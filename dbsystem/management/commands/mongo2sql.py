@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+
+# Mongo数据迁移到SQL，见dbsystem/mongosync.py
+# 不指定集合时按依赖顺序迁移全部集合；可以重复运行，已经迁移的文档会跳过
+
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from dbsystem import mongosync
+from dbsystem.bulk import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = '把Mongo集合分批迁移到SQL，并按文档校验两边是否一致'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collections', nargs='*', help='默认全部：%s' % ', '.join(mongosync.MAPPINGS_BY_COLLECTION))
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='每批读取的文档数，每批一个事务')
+        parser.add_argument('--verify', action='store_true', help='迁移后校验')
+        parser.add_argument('--verify-only', action='store_true', help='只校验不迁移')
+        parser.add_argument('--skip-stats', action='store_true', help='迁移后不重建题目/练习统计')
+
+    def handle(self, *args, **options):
+        unknown = set(options['collections']) - set(mongosync.MAPPINGS_BY_COLLECTION)
+        if unknown:
+            raise CommandError('unknown collections: %s' % ', '.join(sorted(unknown)))
+        mappings = [mapping for mapping in mongosync.MAPPINGS
+                    if not options['collections'] or mapping.collection in options['collections']]
+
+        if not options['verify_only']:
+            written = {}
+            for mapping in mappings:
+                counts = mongosync.migrate(mapping, options['batch_size'], log=self.stdout.write)
+                written[mapping.collection] = counts['written']
+                self.stdout.write(self.style.SUCCESS('%s: %s' % (mapping.collection, json.dumps(counts))))
+            if not options['skip_stats'] and written.get('problem_condition'):
+                call_command('rebuild_stats', stdout=self.stdout)
+
+        if options['verify'] or options['verify_only']:
+            failed = []
+            for mapping in mappings:
+                report = mongosync.verify(mapping, options['batch_size'])
+                style = self.style.SUCCESS if report['ok'] else self.style.ERROR
+                self.stdout.write(style(json.dumps(report, ensure_ascii=False)))
+                if not report['ok']:
+                    failed.append(mapping.collection)
+            if failed:
+                raise CommandError('verification failed: %s' % ', '.join(failed))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from dbsystem import hierarchy
+
+
+class Command(BaseCommand):
+    help = '全量重建Chapter/Folder/Problem的层级索引（ancestors/depth）和Problem.chapters'
+
+    def handle(self, *args, **options):
+        for document in hierarchy.DOCUMENTS:
+            count = hierarchy.rebuild(document)
+            self.stdout.write(self.style.SUCCESS('rebuilt %s: %d nodes' % (document.__name__, count)))
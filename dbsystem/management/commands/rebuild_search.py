@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from dbsystem import search
+
+
+class Command(BaseCommand):
+    help = '全量重建题目全文检索的索引（settings.SEARCH_INDEX_PATH）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='索引文件，默认settings.SEARCH_INDEX_PATH')
+        parser.add_argument('--chunk-size', type=int, default=search.CHUNK_SIZE, help='每批读取的题目数')
+
+    def handle(self, *args, **options):
+        count = search.rebuild(options['path'], chunk_size=options['chunk_size'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS('indexed %d problems' % count))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from dbsystem import aggregates
+
+
+class Command(BaseCommand):
+    help = '从ProblemCondition全量重建题目/练习统计表（ProblemStat/ExerciseStat）'
+
+    def handle(self, *args, **options):
+        problems, exercises = aggregates.rebuild()
+        self.stdout.write(self.style.SUCCESS('rebuilt %d problem stats, %d exercise stats' % (problems, exercises)))
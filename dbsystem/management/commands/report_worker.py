@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dbsystem import reports
+
+
+class Command(BaseCommand):
+    help = '执行排队的后台报表任务（ReportJob），结果压缩后写到REPORT_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.REPORT_WORKERS, help='进程数，0是在当前进程里执行')
+        parser.add_argument('--poll', type=float, default=settings.REPORT_POLL_SECONDS, help='没有任务时的轮询间隔秒数')
+        parser.add_argument('--once', action='store_true', help='做完当前排队的任务就退出')
+
+    def handle(self, *args, **options):
+        finished = reports.work(options['workers'], options['poll'], options['once'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS('finished %d report jobs' % finished))
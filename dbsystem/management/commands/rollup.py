@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from dbsystem import rollups
+
+
+class Command(BaseCommand):
+    help = '增量刷新按天/按周的答题汇总（AnswerRollup）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='清空后全量重建')
+        parser.add_argument('--from', dest='first', help='重算从这一天（YYYY-MM-DD）开始的汇总')
+        parser.add_argument('--to', dest='last', help='和--from一起使用，默认同一天')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            written = rollups.rebuild()
+        elif options['first']:
+            first = parse_date(options['first'])
+            last = parse_date(options['last'] or options['first'])
+            if first is None or last is None or last < first:
+                raise CommandError('invalid date range')
+            written = rollups.rebuild_range(first, last)
+        else:
+            written = rollups.refresh()
+        self.stdout.write(self.style.SUCCESS('wrote %d rollup rows' % written))
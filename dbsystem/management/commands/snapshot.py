@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dbsystem import snapshot
+
+
+class Command(BaseCommand):
+    help = '把答题数据写成按列存放的.npy快照（SNAPSHOT_DIR），默认按主键水位增量追加'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', help='只写这些表：%s' % ', '.join(snapshot.TABLES))
+        parser.add_argument('--rebuild', action='store_true', help='整表重写，修改或删除过已有行以后使用')
+        parser.add_argument('--directory', help='快照目录，默认SNAPSHOT_DIR')
+
+    def handle(self, *args, **options):
+        unknown = set(options['tables']) - set(snapshot.TABLES)
+        if unknown:
+            raise CommandError('unknown tables: %s' % ', '.join(sorted(unknown)))
+        written = snapshot.write(options['tables'] or None, options['directory'], options['rebuild'],
+                                 log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS('wrote %d rows to %d tables' % (sum(written.values()), len(written))))
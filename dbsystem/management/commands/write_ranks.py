@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from dbsystem import ranking
+
+
+class Command(BaseCommand):
+    help = '全量扫描练习完成情况建立排行榜，按人均总分把名次写回班级排名和学校区县排名'
+
+    def handle(self, *args, **options):
+        ranking.invalidate()
+        changed = ranking.write_ranks()
+        self.stdout.write(self.style.SUCCESS('%d boards, updated %d class ranks, %d school ranks' % (
+            len(ranking.get_ranking().boards), changed['classes'], changed['schools'])))
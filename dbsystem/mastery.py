@@ -0,0 +1,283 @@
+# -*- coding: UTF-8 -*-
+
+# 学生×标签掌握程度矩阵
+# TagAbility整表一次读进numpy数组，按学生行压缩存储（CSR），
+# 学生ID/标签ID到行列号的映射是排好序的数组，用searchsorted查找。
+# 班级/学校平均、每个学生最弱的k个标签、阈值比较都是整批的数组运算，不再逐个遍历ORM对象
+
+import itertools
+import operator
+import threading
+
+import numpy as np
+from django.db import connection
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from dbsystem.models_mysql import People, Student, TagAbility
+
+
+COMPARE = {
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'eq': operator.eq,
+    'ne': operator.ne,
+}
+
+
+class MasteryMatrix(object):
+
+    def __init__(self, student_ids, tag_ids, degrees, schools=None, classes=None):
+        # student_ids/tag_ids/degrees 等长，一条TagAbility一个元素
+        # schools: (学生ID, 学校ID) 两个数组；classes: (学生ID, 班级ID) 两个数组
+        student_ids = np.asarray(student_ids, dtype=np.int64)
+        tag_ids = np.asarray(tag_ids, dtype=np.int64)
+        degrees = np.asarray(degrees, dtype=np.int64)
+        self.students = np.unique(student_ids)
+        self.tags = np.unique(tag_ids)
+        rows = np.searchsorted(self.students, student_ids)
+        cols = np.searchsorted(self.tags, tag_ids)
+
+        # 同一个(学生, 标签)有多条记录时保留最后一条
+        key = rows * len(self.tags) + cols
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        last = np.ones(len(key), dtype=bool)
+        last[:-1] = key[1:] != key[:-1]
+        order = order[last]
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.data = degrees[order].astype(np.int32)
+        self.indptr = np.searchsorted(self.rows, np.arange(len(self.students) + 1))
+
+        self.school_of_row = np.full(len(self.students), -1, dtype=np.int64)
+        if schools is not None:
+            rows, found = self._row_index(schools[0])
+            self.school_of_row[rows[found]] = np.asarray(schools[1], dtype=np.int64)[found]
+        self.class_rows = np.zeros(0, dtype=np.int64)
+        self.class_ids = np.zeros(0, dtype=np.int64)
+        if classes is not None:
+            rows, found = self._row_index(classes[0])
+            self.class_rows = rows[found]
+            self.class_ids = np.asarray(classes[1], dtype=np.int64)[found]
+
+    @classmethod
+    def load(cls, chunk_size=100000):
+        meta = TagAbility._meta
+        quote = connection.ops.quote_name
+        sql = 'SELECT %s, %s, %s FROM %s ORDER BY %s' % (
+            quote(meta.get_field('student').column), quote(meta.get_field('tag').column),
+            quote(meta.get_field('degree').column), quote(meta.db_table), quote(meta.pk.column))
+        chunks = [np.zeros((0, 3), dtype=np.int64)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 3))
+        abilities = np.concatenate(chunks)
+        schools = np.array(Student.objects.values_list('pk', 'school_id'), dtype=np.int64).reshape(-1, 2)
+        classes = np.array(People.classes.through.objects.values_list('people_id', 'class_id'),
+                           dtype=np.int64).reshape(-1, 2)
+        return cls(abilities[:, 0], abilities[:, 1], abilities[:, 2],
+                   schools=(schools[:, 0], schools[:, 1]), classes=(classes[:, 0], classes[:, 1]))
+
+    @property
+    def shape(self):
+        return len(self.students), len(self.tags)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @staticmethod
+    def _index(keys, ids):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        index = np.searchsorted(keys, ids)
+        clipped = np.minimum(index, max(len(keys) - 1, 0))
+        found = (index < len(keys)) & (keys[clipped] == ids) if len(keys) else np.zeros(len(ids), dtype=bool)
+        return clipped, found
+
+    def _row_index(self, student_ids):
+        return self._index(self.students, student_ids)
+
+    def _col_index(self, tag_ids):
+        return self._index(self.tags, tag_ids)
+
+    def _expand(self, rows):
+        # 给定若干行（可以重复），返回 (每个元素属于第几个给定行, 元素下标)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        offsets = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return owner, starts[owner] + offsets
+
+    def _entries(self, student_ids=None):
+        if student_ids is None:
+            return self.rows, np.arange(self.nnz)
+        rows, found = self._row_index(student_ids)
+        rows = rows[found]
+        owner, entries = self._expand(rows)
+        return rows[owner], entries
+
+    def set(self, student_id, tag_id, degree):
+        # 只更新已存在的元素，返回是否成功；新元素需要重新加载
+        rows, found = self._row_index([student_id])
+        if not found[0]:
+            return False
+        cols, found = self._col_index([tag_id])
+        if not found[0]:
+            return False
+        start, end = self.indptr[rows[0]], self.indptr[rows[0] + 1]
+        i = start + np.searchsorted(self.cols[start:end], cols[0])
+        if i >= end or self.cols[i] != cols[0]:
+            return False
+        self.data[i] = degree
+        return True
+
+    def row(self, student_id):
+        rows, found = self._row_index([student_id])
+        if not found[0]:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        start, end = self.indptr[rows[0]], self.indptr[rows[0] + 1]
+        return self.tags[self.cols[start:end]], self.data[start:end]
+
+    def dense(self, student_ids=None, tag_ids=None, fill=np.nan):
+        student_ids = self.students if student_ids is None else np.asarray(student_ids, dtype=np.int64)
+        tag_ids = self.tags if tag_ids is None else np.asarray(tag_ids, dtype=np.int64)
+        result = np.full((len(student_ids), len(tag_ids)), fill, dtype=np.float32)
+        rows, found = self._row_index(student_ids)
+        owner, entries = self._expand(rows[found])
+        owner = np.flatnonzero(found)[owner]
+        # 矩阵列号到结果列号
+        target = np.full(len(self.tags), -1, dtype=np.int64)
+        cols, col_found = self._col_index(tag_ids)
+        target[cols[col_found]] = np.flatnonzero(col_found)
+        target = target[self.cols[entries]]
+        keep = target >= 0
+        result[owner[keep], target[keep]] = self.data[entries[keep]]
+        return result
+
+    def group_means(self, student_ids, labels):
+        # (学生ID, 分组ID)成对给出，一个学生可以属于多个分组；
+        # 返回 (分组ID数组, 分组数×标签数的平均掌握程度，没有数据的是nan)
+        rows, found = self._row_index(student_ids)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)[found]
+        return self._group_means(rows[found], labels)
+
+    def _group_means(self, rows, labels):
+        groups, group_index = np.unique(labels, return_inverse=True)
+        owner, entries = self._expand(rows)
+        key = group_index.reshape(-1)[owner] * len(self.tags) + self.cols[entries]
+        size = len(groups) * len(self.tags)
+        sums = np.bincount(key, weights=self.data[entries], minlength=size)
+        counts = np.bincount(key, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return groups, means.reshape(len(groups), len(self.tags))
+
+    def class_means(self, class_ids=None):
+        rows, labels = self.class_rows, self.class_ids
+        if class_ids is not None:
+            keep = np.isin(labels, class_ids)
+            rows, labels = rows[keep], labels[keep]
+        return self._group_means(rows, labels)
+
+    def school_means(self, school_ids=None):
+        rows = np.flatnonzero(self.school_of_row >= 0)
+        labels = self.school_of_row[rows]
+        if school_ids is not None:
+            keep = np.isin(labels, school_ids)
+            rows, labels = rows[keep], labels[keep]
+        return self._group_means(rows, labels)
+
+    def top_k(self, k, largest=False, student_ids=None):
+        # 每个学生掌握程度最低（largest=True时最高）的k个标签，
+        # 返回 (学生ID, 标签ID, 掌握程度) 三个数组，同一学生内按掌握程度排好序
+        rows, entries = self._entries(student_ids)
+        values = self.data[entries].astype(np.int64)
+        if largest:
+            values = -values
+        values -= values.min() if len(values) else 0
+        order = np.argsort(rows.astype(np.int64) << 32 | values)
+        rows, entries = rows[order], entries[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+        rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+        keep = entries[rank < k]
+        return self.students[self.rows[keep]], self.tags[self.cols[keep]], self.data[keep]
+
+    def where(self, op, threshold, student_ids=None):
+        # threshold 可以是一个数，也可以是 {标签ID: 阈值}，没给阈值的标签不参与比较
+        compare = COMPARE[op]
+        rows, entries = self._entries(student_ids)
+        values = self.data[entries]
+        if isinstance(threshold, dict):
+            per_tag = np.full(len(self.tags), np.nan)
+            cols, found = self._col_index(list(threshold.keys()))
+            per_tag[cols[found]] = np.array(list(threshold.values()), dtype=np.float64)[found]
+            limits = per_tag[self.cols[entries]]
+            mask = compare(values, limits) & ~np.isnan(limits)
+        else:
+            mask = compare(values, threshold)
+        entries = entries[mask]
+        return self.students[rows[mask]], self.tags[self.cols[entries]], values[mask]
+
+
+_matrix = None
+_lock = threading.Lock()
+# 和taggraph一样，每次作废换一个新值
+_generations = itertools.count(1)
+_generation = 0
+
+
+def get_matrix():
+    global _matrix
+    matrix = _matrix
+    if matrix is None:
+        with _lock:
+            matrix = _matrix
+            if matrix is None:
+                generation = _generation
+                matrix = MasteryMatrix.load()
+                # 加载期间被作废过：读到的可能是改之前的数据，只给这一次调用用，不放进缓存
+                if generation == _generation:
+                    _matrix = matrix
+    return matrix
+
+
+@receiver(post_delete, sender=TagAbility)
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+@receiver(m2m_changed, sender=People.classes.through)
+def invalidate(**kwargs):
+    # bulk_create/update不发信号，批量写入后需要手动调用
+    global _matrix, _generation
+    _generation = next(_generations)
+    _matrix = None
+
+
+@receiver(pre_save, sender=TagAbility)
+def remember_ability(sender, instance, raw, **kwargs):
+    # 矩阵已经加载时记下原来的(学生, 标签)，改了学生或者标签时旧位置上的值也要去掉
+    instance._mastery_old = None
+    if raw or instance.pk is None or _matrix is None:
+        return
+    instance._mastery_old = TagAbility.objects.filter(pk=instance.pk).values_list('student_id', 'tag_id').first()
+
+
+@receiver(post_save, sender=TagAbility)
+def update_ability(sender, instance, created, **kwargs):
+    old = getattr(instance, '_mastery_old', None)
+    instance._mastery_old = None
+    matrix = _matrix
+    if matrix is None:
+        # 可能正在加载，让这次加载的结果不进缓存
+        invalidate()
+        return
+    # old为None：新建的，或者保存前矩阵还没有加载
+    if created or old != (instance.student_id, instance.tag_id) or \
+            not matrix.set(instance.student_id, instance.tag_id, instance.degree):
+        invalidate()
@@ -1,4 +1,4 @@
-# Generated by Django 2.1.4 on 2018-12-20 06:51
+# Generated by Django 2.2.28 on 2026-10-18 11:32
 
 from django.db import migrations, models
 import django.db.models.deletion
@@ -13,24 +13,233 @@ class Migration(migrations.Migration):
 
     operations = [
         migrations.CreateModel(
-            name='Choice',
+            name='Book',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='书目ID')),
+                ('name', models.CharField(max_length=64, verbose_name='书目名称')),
+                ('series', models.CharField(max_length=64, verbose_name='书目系列')),
+            ],
+            options={
+                'verbose_name': '书目',
+                'verbose_name_plural': '书目',
+            },
+        ),
+        migrations.CreateModel(
+            name='Chapter',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='章节ID')),
+                ('name', models.CharField(max_length=64, verbose_name='章节名称')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Book', verbose_name='书目')),
+            ],
+            options={
+                'verbose_name': '章节',
+                'verbose_name_plural': '章节',
+            },
+        ),
+        migrations.CreateModel(
+            name='Class',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='班级ID')),
+                ('name', models.CharField(max_length=64, verbose_name='班级名字')),
+                ('entry_year', models.IntegerField(verbose_name='入学年份')),
+                ('rank', models.IntegerField(verbose_name='班级排名')),
+            ],
+            options={
+                'verbose_name': '班级',
+                'verbose_name_plural': '班级',
+            },
+        ),
+        migrations.CreateModel(
+            name='People',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='人员ID')),
+                ('name', models.CharField(max_length=64, verbose_name='人员名字')),
+                ('born_year', models.IntegerField(verbose_name='出生年份')),
+                ('sex', models.CharField(choices=[('male', '男'), ('female', '女'), ('other', '未知')], max_length=16, verbose_name='性别')),
+                ('classes', models.ManyToManyField(to='dbsystem.Class', verbose_name='所属班级')),
+            ],
+            options={
+                'verbose_name': '人员',
+                'verbose_name_plural': '人员',
+            },
+        ),
+        migrations.CreateModel(
+            name='Problem',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='问题ID')),
+                ('name', models.CharField(max_length=64, verbose_name='问题名字')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='School',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='学校ID')),
+                ('name', models.CharField(max_length=64, verbose_name='学校名字')),
+                ('area', models.CharField(max_length=16, verbose_name='所属地区代码')),
+                ('administrator', models.CharField(max_length=64, verbose_name='所属单位')),
+                ('property', models.CharField(choices=[('public', ''), ('private', ''), ('other', '')], max_length=16, verbose_name='学校性质')),
+                ('rank', models.IntegerField(verbose_name='学校区县排名')),
+                ('description', models.CharField(max_length=512, verbose_name='学校描述')),
+                ('level', models.CharField(choices=[('provincial', ''), ('municipal', ''), ('county', ''), ('other', '')], max_length=16, verbose_name='学校等级')),
+            ],
+            options={
+                'verbose_name': '学校',
+                'verbose_name_plural': '学校',
+            },
+        ),
+        migrations.CreateModel(
+            name='Subject',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='科目ID')),
+                ('name', models.CharField(max_length=64, verbose_name='科目名字')),
+            ],
+            options={
+                'verbose_name': '科目',
+                'verbose_name_plural': '科目',
+            },
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='标签ID')),
+                ('name', models.CharField(max_length=64, verbose_name='标签名字')),
+                ('category', models.CharField(choices=[('T', '题型'), ('N', '能力'), ('Z', '知识'), ('C', '易错')], max_length=16, verbose_name='标签类型')),
+                ('difficulty', models.IntegerField(verbose_name='标签难度')),
+                ('description', models.CharField(max_length=512, verbose_name='标签描述')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Book', verbose_name='书目')),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Chapter', verbose_name='章节')),
+                ('precursor', models.ManyToManyField(to='dbsystem.Tag', verbose_name='前序知识')),
+            ],
+            options={
+                'verbose_name': '标签',
+                'verbose_name_plural': '标签',
+            },
+        ),
+        migrations.CreateModel(
+            name='Student',
+            fields=[
+                ('people_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='dbsystem.People')),
+                ('hardness', models.IntegerField(verbose_name='努力程度')),
+                ('frustration', models.IntegerField(verbose_name='抗挫折能力')),
+                ('habit', models.IntegerField(verbose_name='学习习惯')),
+                ('correct', models.IntegerField(verbose_name='改正能力')),
+                ('comprehensive', models.IntegerField(verbose_name='理解力')),
+                ('logic', models.IntegerField(verbose_name='逻辑思维能力')),
+                ('abstract', models.IntegerField(verbose_name='抽象思维能力')),
+                ('spatial', models.IntegerField(verbose_name='空间想象力')),
+                ('conclusive', models.IntegerField(verbose_name='归纳总结能力')),
+                ('subjects', models.ManyToManyField(to='dbsystem.Subject', verbose_name='考试学科')),
+            ],
+            options={
+                'verbose_name': '学生',
+                'verbose_name_plural': '学生',
+            },
+            bases=('dbsystem.people',),
+        ),
+        migrations.CreateModel(
+            name='Stuff',
+            fields=[
+                ('people_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='dbsystem.People')),
+                ('entry_year', models.IntegerField(verbose_name='入职年份')),
+            ],
+            options={
+                'verbose_name': '职员',
+                'verbose_name_plural': '职员',
+            },
+            bases=('dbsystem.people',),
+        ),
+        migrations.CreateModel(
+            name='ProblemCondition',
             fields=[
                 ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('choice_text', models.CharField(max_length=200)),
-                ('votes', models.IntegerField(default=0)),
+                ('result', models.CharField(max_length=512, verbose_name='题目完成结果')),
+                ('judge', models.CharField(max_length=512, verbose_name='错误答案列表')),
+                ('cost', models.IntegerField(verbose_name='完成所花时间')),
+                ('points', models.FloatField(verbose_name='得到分数')),
+                ('problem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Problem', verbose_name='问题')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Student', verbose_name='学生')),
             ],
+            options={
+                'verbose_name': '题目完成情况',
+                'verbose_name_plural': '题目完成情况',
+            },
+        ),
+        migrations.AddField(
+            model_name='people',
+            name='school',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.School', verbose_name='所属学校'),
         ),
         migrations.CreateModel(
-            name='Question',
+            name='Exercise',
+            fields=[
+                ('entity_id', models.AutoField(db_index=True, primary_key=True, serialize=False, verbose_name='练习ID')),
+                ('name', models.CharField(max_length=64, verbose_name='练习名字')),
+                ('release_time', models.DateTimeField(verbose_name='布置时刻')),
+                ('length', models.IntegerField(verbose_name='布置时长')),
+                ('aim', models.CharField(choices=[('1', '思考'), ('2', '新接触'), ('3', '巩固'), ('4', '评测')], max_length=16, verbose_name='布置目的')),
+                ('types', models.CharField(choices=[('1', '作业'), ('2', '考试'), ('3', '其他')], max_length=16, verbose_name='练习类型')),
+                ('problems', models.ManyToManyField(to='dbsystem.Problem', verbose_name='题目列表')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Subject', verbose_name='学科')),
+            ],
+            options={
+                'verbose_name': '练习',
+                'verbose_name_plural': '练习',
+            },
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='subject',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Subject', verbose_name='科目'),
+        ),
+        migrations.CreateModel(
+            name='Teacher',
+            fields=[
+                ('people_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='dbsystem.People')),
+                ('position', models.CharField(max_length=64, verbose_name='老师职位')),
+                ('entry_year', models.IntegerField(verbose_name='入职年份')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Subject', verbose_name='教授学科')),
+            ],
+            options={
+                'verbose_name': '老师',
+                'verbose_name_plural': '老师',
+            },
+            bases=('dbsystem.people',),
+        ),
+        migrations.CreateModel(
+            name='TagAbility',
             fields=[
                 ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('question_test', models.CharField(max_length=200)),
-                ('pub_date', models.DateTimeField(verbose_name='data published')),
+                ('degree', models.IntegerField(verbose_name='掌握程度')),
+                ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Tag', verbose_name='标签')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Student', verbose_name='学生')),
             ],
+            options={
+                'verbose_name': '学生标签掌握程度',
+                'verbose_name_plural': '学生标签掌握程度',
+            },
+        ),
+        migrations.CreateModel(
+            name='ExerciseCondition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('finish_time', models.DateTimeField(verbose_name='完成时间')),
+                ('exercise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Exercise', verbose_name='练习')),
+                ('results', models.ManyToManyField(to='dbsystem.ProblemCondition', verbose_name='题目完成结果列表')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Student', verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '练习完成情况',
+                'verbose_name_plural': '练习完成情况',
+            },
+        ),
+        migrations.AddField(
+            model_name='exercise',
+            name='release_people',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='dbsystem.Teacher', verbose_name='布置人'),
         ),
         migrations.AddField(
-            model_name='choice',
-            name='question',
-            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Question'),
+            model_name='exercise',
+            name='release_target',
+            field=models.ManyToManyField(to='dbsystem.Teacher', verbose_name='布置对象'),
         ),
     ]
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExerciseStat',
+            fields=[
+                ('exercise', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stat', serialize=False, to='dbsystem.Exercise', verbose_name='练习')),
+                ('count', models.IntegerField(default=0, verbose_name='完成题数')),
+                ('correct_count', models.IntegerField(default=0, verbose_name='正确题数')),
+                ('points_sum', models.FloatField(default=0, verbose_name='总得分')),
+                ('cost_sum', models.BigIntegerField(default=0, verbose_name='总用时')),
+            ],
+            options={
+                'verbose_name': '练习统计',
+                'verbose_name_plural': '练习统计',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProblemStat',
+            fields=[
+                ('problem', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stat', serialize=False, to='dbsystem.Problem', verbose_name='问题')),
+                ('count', models.IntegerField(default=0, verbose_name='完成次数')),
+                ('correct_count', models.IntegerField(default=0, verbose_name='正确次数')),
+                ('points_sum', models.FloatField(default=0, verbose_name='总得分')),
+                ('cost_sum', models.BigIntegerField(default=0, verbose_name='总用时')),
+            ],
+            options={
+                'verbose_name': '题目统计',
+                'verbose_name_plural': '题目统计',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0002_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MongoIdMap',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('collection', models.CharField(max_length=64, verbose_name='Mongo集合')),
+                ('mongo_id', models.CharField(max_length=24, verbose_name='Mongo文档ID')),
+                ('sql_id', models.IntegerField(verbose_name='SQL主键')),
+            ],
+            options={
+                'verbose_name': 'Mongo ID对照',
+                'verbose_name_plural': 'Mongo ID对照',
+                'unique_together': {('collection', 'mongo_id')},
+                'index_together': {('collection', 'sql_id')},
+            },
+        ),
+    ]
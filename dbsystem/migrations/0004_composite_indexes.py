@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:52
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0003_mongo_id_map'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='exercisecondition',
+            unique_together={('exercise', 'student')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='tagability',
+            unique_together={('student', 'tag')},
+        ),
+        migrations.AlterIndexTogether(
+            name='exercise',
+            index_together={('subject', 'release_time')},
+        ),
+        migrations.AlterIndexTogether(
+            name='problemcondition',
+            index_together={('student', 'problem')},
+        ),
+    ]
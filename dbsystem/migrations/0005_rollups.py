@@ -0,0 +1,47 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0004_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_exercise_condition', models.IntegerField(default=0, verbose_name='已汇总的练习完成情况ID')),
+                ('archived_before', models.DateField(blank=True, null=True, verbose_name='已归档到')),
+            ],
+            options={
+                'verbose_name': '汇总状态',
+                'verbose_name_plural': '汇总状态',
+            },
+        ),
+        migrations.CreateModel(
+            name='AnswerRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', '天'), ('week', '周')], max_length=16, verbose_name='周期')),
+                ('bucket', models.DateField(verbose_name='周期开始日期')),
+                ('count', models.IntegerField(default=0, verbose_name='完成次数')),
+                ('correct_count', models.IntegerField(default=0, verbose_name='正确次数')),
+                ('points_sum', models.FloatField(default=0, verbose_name='总得分')),
+                ('cost_sum', models.BigIntegerField(default=0, verbose_name='总用时')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Class', verbose_name='班级')),
+                ('problem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Problem', verbose_name='问题')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Subject', verbose_name='学科')),
+            ],
+            options={
+                'verbose_name': '答题汇总',
+                'verbose_name_plural': '答题汇总',
+                'unique_together': {('period', 'group', 'subject', 'bucket', 'problem')},
+                'index_together': {('period', 'problem', 'bucket')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0005_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problem',
+            name='tags',
+            field=models.ManyToManyField(blank=True, to='dbsystem.Tag', verbose_name='标签列表'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0006_problem_tags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Submission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer', models.CharField(blank=True, max_length=512, verbose_name='作答')),
+                ('cost', models.IntegerField(default=0, verbose_name='完成所花时间')),
+                ('submitted_at', models.DateTimeField(verbose_name='提交时间')),
+                ('exercise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Exercise', verbose_name='练习')),
+                ('problem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Problem', verbose_name='问题')),
+                ('problem_condition', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='submission', to='dbsystem.ProblemCondition', verbose_name='批改结果')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Student', verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '作答提交',
+                'verbose_name_plural': '作答提交',
+                'unique_together': {('exercise', 'student', 'problem')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AnswerKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answer', models.CharField(max_length=512, verbose_name='标准答案')),
+                ('points', models.FloatField(default=0, verbose_name='分值')),
+                ('exercise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_keys', to='dbsystem.Exercise', verbose_name='练习')),
+                ('problem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dbsystem.Problem', verbose_name='问题')),
+            ],
+            options={
+                'verbose_name': '标准答案',
+                'verbose_name_plural': '标准答案',
+                'unique_together': {('exercise', 'problem')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0007_grading'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='problem',
+            name='description',
+            field=models.TextField(blank=True, default='', verbose_name='题目描述'),
+        ),
+        migrations.AddField(
+            model_name='problem',
+            name='formula',
+            field=models.TextField(blank=True, default='', verbose_name='公式'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0008_problem_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='SHA-256')),
+                ('content_type', models.CharField(max_length=64, verbose_name='原图类型')),
+                ('thumbnail_type', models.CharField(max_length=64, verbose_name='缩略图类型')),
+                ('width', models.IntegerField(verbose_name='宽')),
+                ('height', models.IntegerField(verbose_name='高')),
+                ('size', models.IntegerField(verbose_name='字节数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='上传时间')),
+            ],
+            options={
+                'verbose_name': '图片',
+                'verbose_name_plural': '图片',
+            },
+        ),
+    ]
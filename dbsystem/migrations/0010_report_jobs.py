@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0009_image_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='数据')),
+                ('version', models.BigIntegerField(default=0, verbose_name='版本号')),
+            ],
+            options={
+                'verbose_name': '数据版本',
+                'verbose_name_plural': '数据版本',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=64, verbose_name='报表类型')),
+                ('params', models.TextField(verbose_name='参数')),
+                ('cache_key', models.CharField(db_index=True, max_length=64, verbose_name='缓存键')),
+                ('status', models.CharField(choices=[('queued', '排队中'), ('running', '运行中'), ('done', '完成'), ('failed', '失败')], db_index=True, default='queued', max_length=16, verbose_name='状态')),
+                ('progress', models.IntegerField(default=0, verbose_name='已写行数')),
+                ('total', models.IntegerField(blank=True, null=True, verbose_name='总行数')),
+                ('size', models.BigIntegerField(default=0, verbose_name='文件字节数')),
+                ('error', models.TextField(blank=True, verbose_name='错误')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='提交时间')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完成时间')),
+            ],
+            options={
+                'verbose_name': '报表任务',
+                'verbose_name_plural': '报表任务',
+            },
+        ),
+    ]
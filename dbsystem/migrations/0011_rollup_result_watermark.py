@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0010_report_jobs'),
+    ]
+
+    # 水位从ExerciseCondition主键换成中间表主键，从0开始：下次刷新重算所有没归档的日期
+    operations = [
+        migrations.RemoveField(
+            model_name='rollupstate',
+            name='last_exercise_condition',
+        ),
+        migrations.AddField(
+            model_name='rollupstate',
+            name='last_result',
+            field=models.IntegerField(default=0, verbose_name='已汇总的答题关联ID'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def create_state(apps, schema_editor):
+    # 汇总状态只有一行，迁移时建好，rollups里只读不建，并发刷新时不会抢着创建
+    RollupState = apps.get_model('dbsystem', 'RollupState')
+    RollupState.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbsystem', '0011_rollup_result_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_state, migrations.RunPython.noop),
+    ]
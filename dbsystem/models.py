@@ -5,11 +5,15 @@ from mongoengine import *
 # admin里面看不见的话把这行去掉 上行注释
 # from django_mongoengine import *
 
+from .prefetch import PrefetchQuerySet
+
 
 class Subject(Document):
     _id = fields.ObjectIdField()
     name = fields.StringField()
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Book(Document):
     _id = fields.ObjectIdField()
@@ -17,12 +21,19 @@ class Book(Document):
     series = fields.StringField()
     subject = fields.ReferenceField(Subject)
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Chapter(Document):
     _id = fields.ObjectIdField()
     name = fields.StringField()
     book = fields.ReferenceField(Book)
     sub = fields.ListField(fields.ReferenceField('Chapter'))
+    # 层级索引，由hierarchy.py维护：所有上级（从根开始）和深度
+    ancestors = fields.ListField(fields.ObjectIdField())
+    depth = fields.IntField(default=0)
+
+    meta = {'queryset_class': PrefetchQuerySet, 'indexes': ['ancestors', 'sub']}
 
 
 class School(Document):
@@ -35,6 +46,8 @@ class School(Document):
     description = fields.StringField()
     register = fields.StringField()
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Group(Document):
     _id = fields.ObjectIdField()
@@ -43,6 +56,8 @@ class Group(Document):
     year = fields.DateField()
     school = fields.ReferenceField(School)
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Folder(Document):
     _id = fields.ObjectIdField()
@@ -50,6 +65,10 @@ class Folder(Document):
     sub = fields.ListField(fields.ReferenceField('Folder'))
     problems = fields.ListField(fields.ReferenceField('Problem'))
     exercises = fields.ListField(fields.ReferenceField('Exercise'))
+    ancestors = fields.ListField(fields.ObjectIdField())
+    depth = fields.IntField(default=0)
+
+    meta = {'queryset_class': PrefetchQuerySet, 'indexes': ['ancestors', 'sub']}
 
 
 class People(Document):
@@ -65,7 +84,7 @@ class People(Document):
     password = fields.StringField()
     favorites = fields.ReferenceField(Folder)
 
-    meta = {'allow_inheritance': True}
+    meta = {'allow_inheritance': True, 'queryset_class': PrefetchQuerySet}
 
 
 class Teacher(People):
@@ -91,8 +110,12 @@ class Solution(Document):
     _id = fields.ObjectIdField()
     description = fields.ListField(fields.StringField())
     images = fields.ListField(fields.ImageField())
+    # images在内容寻址存储（dbsystem/images.py）里的SHA-256，和images一一对应
+    image_digests = fields.ListField(fields.StringField())
     formula = fields.ListField(fields.StringField())
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Problem(Document):
     _id = fields.ObjectIdField()
@@ -100,12 +123,19 @@ class Problem(Document):
     types = fields.StringField()
     description = fields.ListField(fields.StringField())
     images = fields.ListField(fields.ImageField())
+    image_digests = fields.ListField(fields.StringField())
     formula = fields.ListField(fields.StringField())
     sub = fields.ListField(fields.ReferenceField('Problem'))
     book = fields.ReferenceField('Book')
     chapter = fields.ReferenceField('Chapter')
     tags = fields.ListField(fields.ReferenceField('Tag'))
     solutions = fields.ListField(fields.ReferenceField('Solution'))
+    ancestors = fields.ListField(fields.ObjectIdField())
+    depth = fields.IntField(default=0)
+    # 所属章节及其所有上级章节
+    chapters = fields.ListField(fields.ObjectIdField())
+
+    meta = {'queryset_class': PrefetchQuerySet, 'indexes': ['ancestors', 'sub', 'chapter', 'chapters']}
 
 
 class Exercise(Document):
@@ -121,6 +151,8 @@ class Exercise(Document):
     targets = fields.ListField(fields.ReferenceField(Student))
     subject = fields.ReferenceField(Subject)
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Tag(Document):
     _id = fields.ObjectIdField()
@@ -131,6 +163,8 @@ class Tag(Document):
     book = fields.ReferenceField(Book)
     topic = fields.ListField(fields.ListField(fields.ReferenceField(Chapter)))
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class Wrong(Document):
     _id = fields.ObjectIdField()
@@ -138,6 +172,8 @@ class Wrong(Document):
     description = fields.StringField()
     tags = fields.ListField(fields.ReferenceField(Tag))
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class ProblemCondition(Document):
     _id = fields.ObjectIdField()
@@ -148,6 +184,8 @@ class ProblemCondition(Document):
     wrong = fields.ListField(fields.StringField())
     times = fields.IntField()
 
+    meta = {'queryset_class': PrefetchQuerySet}
+
 
 class ExerciseCondition(Document):
     _id = fields.ObjectIdField()
@@ -156,3 +194,5 @@ class ExerciseCondition(Document):
     degree = fields.IntField()
     result = fields.StringField()
     times = fields.IntField()
+
+    meta = {'queryset_class': PrefetchQuerySet}
@@ -53,11 +53,19 @@ class Chapter(models.Model):
         verbose_name = '章节'
         verbose_name_plural = verbose_name
 
+    def cached_book(self):
+        # 没有和书目一起查出来时走引用缓存，不为了显示名字单独查一次
+        if Chapter.book.is_cached(self):
+            return self.book
+        from dbsystem import refcache
+        return refcache.get(Book, self.book_id)
+
     def __str__(self):
-        return self.name + "@" + self.book.name + "@" + self.book.series
+        book = self.cached_book()
+        return self.name + "@" + book.name + "@" + book.series
 
     def __repr__(self):
-        return self.name + "@" + self.book.name + "@" + self.book.series
+        return str(self)
 
 
 class Tag(models.Model):
@@ -205,6 +213,7 @@ class TagAbility(models.Model):
     class Meta:
         verbose_name = '学生标签掌握程度'
         verbose_name_plural = verbose_name
+        unique_together = (('student', 'tag'),)
 
     def __str__(self):
         return self.student.name + '@' + self.tag.name
@@ -224,6 +233,10 @@ class Problem(models.Model):
     # 这些小题的顺序还必须考虑。。。有的会对解答有影响）
     entity_id = models.AutoField(primary_key=True, verbose_name='问题ID', db_index=True)
     name = models.CharField(max_length=SHORT_CHAR, verbose_name='问题名字')
+    tags = models.ManyToManyField(Tag, verbose_name='标签列表', blank=True)
+    # Mongo里description/formula是字符串列表，这里按行连接
+    description = models.TextField(verbose_name='题目描述', blank=True, default='')
+    formula = models.TextField(verbose_name='公式', blank=True, default='')
     # 2. 一个题目的标签是有序的
     # 3. 题目的步骤也是有有序的，且一个题目可能有多个步骤，步骤之间有
     # 存在各种并列、序列关系
@@ -253,12 +266,13 @@ class Exercise(models.Model):
     class Meta:
         verbose_name = '练习'
         verbose_name_plural = verbose_name
+        index_together = (('subject', 'release_time'),)
 
     def __str__(self):
-        return self.entity_id
+        return self.name
 
     def __repr__(self):
-        return self.entity_id
+        return self.name
 
 
 class ProblemCondition(models.Model):
@@ -279,6 +293,11 @@ class ProblemCondition(models.Model):
     class Meta:
         verbose_name = '题目完成情况'
         verbose_name_plural = verbose_name
+        index_together = (('student', 'problem'),)
+
+    def is_correct(self):
+        # 有作答并且没有出现错误答案才算正确
+        return bool(self.result) and not self.judge
 
     def __str__(self):
         return self.student.name + '@%d' % self.problem.entity_id
@@ -297,6 +316,8 @@ class ExerciseCondition(models.Model):
     class Meta:
         verbose_name = '练习完成情况'
         verbose_name_plural = verbose_name
+        # 每个学生每个练习一条，多次作答记在results里
+        unique_together = (('exercise', 'student'),)
 
     def __str__(self):
         return self.student.name + '@%d' % self.exercise.entity_id
@@ -305,3 +326,245 @@ class ExerciseCondition(models.Model):
         return self.student.name + '@%d' % self.exercise.entity_id
 
 
+class ProblemStat(models.Model):
+    # 题目完成情况的物化汇总，由aggregates.py里的信号增量维护，
+    # 数据回填后用 manage.py rebuild_stats 重建
+    objects = models.Manager()
+    problem = models.OneToOneField(Problem, primary_key=True, verbose_name='问题', on_delete=models.CASCADE,
+                                   related_name='stat')
+    count = models.IntegerField(default=0, verbose_name='完成次数')
+    correct_count = models.IntegerField(default=0, verbose_name='正确次数')
+    points_sum = models.FloatField(default=0, verbose_name='总得分')
+    cost_sum = models.BigIntegerField(default=0, verbose_name='总用时')
+
+    class Meta:
+        verbose_name = '题目统计'
+        verbose_name_plural = verbose_name
+
+    @property
+    def accuracy(self):
+        return self.correct_count / self.count if self.count else None
+
+    @property
+    def average_points(self):
+        return self.points_sum / self.count if self.count else None
+
+    @property
+    def average_cost(self):
+        return self.cost_sum / self.count if self.count else None
+
+    def __str__(self):
+        return '%d@%d' % (self.problem_id, self.count)
+
+    def __repr__(self):
+        return '%d@%d' % (self.problem_id, self.count)
+
+
+class ExerciseStat(models.Model):
+    objects = models.Manager()
+    exercise = models.OneToOneField(Exercise, primary_key=True, verbose_name='练习', on_delete=models.CASCADE,
+                                    related_name='stat')
+    count = models.IntegerField(default=0, verbose_name='完成题数')
+    correct_count = models.IntegerField(default=0, verbose_name='正确题数')
+    points_sum = models.FloatField(default=0, verbose_name='总得分')
+    cost_sum = models.BigIntegerField(default=0, verbose_name='总用时')
+
+    class Meta:
+        verbose_name = '练习统计'
+        verbose_name_plural = verbose_name
+
+    @property
+    def accuracy(self):
+        return self.correct_count / self.count if self.count else None
+
+    @property
+    def average_points(self):
+        return self.points_sum / self.count if self.count else None
+
+    @property
+    def average_cost(self):
+        return self.cost_sum / self.count if self.count else None
+
+    def __str__(self):
+        return '%d@%d' % (self.exercise_id, self.count)
+
+    def __repr__(self):
+        return '%d@%d' % (self.exercise_id, self.count)
+
+
+class MongoIdMap(models.Model):
+    # Mongo文档ObjectId到SQL主键的对照表，由mongosync.py在迁移和双写时维护
+    objects = models.Manager()
+    collection = models.CharField(max_length=SHORT_CHAR, verbose_name='Mongo集合')
+    mongo_id = models.CharField(max_length=24, verbose_name='Mongo文档ID')
+    sql_id = models.IntegerField(verbose_name='SQL主键')
+
+    class Meta:
+        verbose_name = 'Mongo ID对照'
+        verbose_name_plural = verbose_name
+        unique_together = (('collection', 'mongo_id'),)
+        index_together = (('collection', 'sql_id'),)
+
+    def __str__(self):
+        return '%s:%s' % (self.collection, self.mongo_id)
+
+    def __repr__(self):
+        return '%s:%s' % (self.collection, self.mongo_id)
+
+
+class AnswerRollup(models.Model):
+    # 按天/按周的答题汇总，由rollups.py按ExerciseCondition.finish_time增量刷新；
+    # 学生在多个班级时每个班级各算一次
+    objects = models.Manager()
+    period = models.CharField(max_length=CODE_CHAR, verbose_name='周期', choices=(('day', '天'), ('week', '周')))
+    bucket = models.DateField(verbose_name='周期开始日期')
+    group = models.ForeignKey(Class, verbose_name='班级', on_delete=models.CASCADE)
+    subject = models.ForeignKey(Subject, verbose_name='学科', on_delete=models.CASCADE)
+    problem = models.ForeignKey(Problem, verbose_name='问题', on_delete=models.CASCADE)
+    count = models.IntegerField(default=0, verbose_name='完成次数')
+    correct_count = models.IntegerField(default=0, verbose_name='正确次数')
+    points_sum = models.FloatField(default=0, verbose_name='总得分')
+    cost_sum = models.BigIntegerField(default=0, verbose_name='总用时')
+
+    class Meta:
+        verbose_name = '答题汇总'
+        verbose_name_plural = verbose_name
+        unique_together = (('period', 'group', 'subject', 'bucket', 'problem'),)
+        index_together = (('period', 'problem', 'bucket'),)
+
+    @property
+    def accuracy(self):
+        return self.correct_count / self.count if self.count else None
+
+    def __str__(self):
+        return '%s %s@%d' % (self.period, self.bucket, self.problem_id)
+
+    def __repr__(self):
+        return '%s %s@%d' % (self.period, self.bucket, self.problem_id)
+
+
+class RollupState(models.Model):
+    # 只有一行：已经汇总到的ExerciseCondition.results中间表主键，以及已归档的日期界限
+    objects = models.Manager()
+    last_result = models.IntegerField(default=0, verbose_name='已汇总的答题关联ID')
+    archived_before = models.DateField(null=True, blank=True, verbose_name='已归档到')
+
+    class Meta:
+        verbose_name = '汇总状态'
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return '%d' % self.last_result
+
+    def __repr__(self):
+        return '%d' % self.last_result
+
+
+class AnswerKey(models.Model):
+    # 练习里每道题的标准答案和分值，同一道题在不同练习里分值可以不同；grading.py批改时使用
+    objects = models.Manager()
+    exercise = models.ForeignKey(Exercise, verbose_name='练习', on_delete=models.CASCADE, related_name='answer_keys')
+    problem = models.ForeignKey(Problem, verbose_name='问题', on_delete=models.CASCADE)
+    answer = models.CharField(max_length=LONG_CHAR, verbose_name='标准答案')
+    points = models.FloatField(default=0, verbose_name='分值')
+
+    class Meta:
+        verbose_name = '标准答案'
+        verbose_name_plural = verbose_name
+        unique_together = (('exercise', 'problem'),)
+
+    def __str__(self):
+        return '%d@%d' % (self.exercise_id, self.problem_id)
+
+    def __repr__(self):
+        return '%d@%d' % (self.exercise_id, self.problem_id)
+
+
+class Submission(models.Model):
+    # 学生提交的原始作答，每道题保留最后一次；批改后写入ProblemCondition并记在problem_condition上，
+    # 重新批改时更新同一条ProblemCondition
+    objects = models.Manager()
+    exercise = models.ForeignKey(Exercise, verbose_name='练习', on_delete=models.CASCADE)
+    student = models.ForeignKey(Student, verbose_name='学生', on_delete=models.CASCADE)
+    problem = models.ForeignKey(Problem, verbose_name='问题', on_delete=models.CASCADE)
+    answer = models.CharField(max_length=LONG_CHAR, blank=True, verbose_name='作答')
+    cost = models.IntegerField(default=0, verbose_name='完成所花时间')
+    submitted_at = models.DateTimeField(verbose_name='提交时间')
+    problem_condition = models.OneToOneField(ProblemCondition, null=True, blank=True, verbose_name='批改结果',
+                                             on_delete=models.SET_NULL, related_name='submission')
+
+    class Meta:
+        verbose_name = '作答提交'
+        verbose_name_plural = verbose_name
+        unique_together = (('exercise', 'student', 'problem'),)
+
+    def __str__(self):
+        return '%d@%d@%d' % (self.student_id, self.exercise_id, self.problem_id)
+
+    def __repr__(self):
+        return '%d@%d@%d' % (self.student_id, self.exercise_id, self.problem_id)
+
+
+class ImageBlob(models.Model):
+    # 题目/解答图片的内容寻址存储（dbsystem/images.py），主键是图片内容的SHA-256，
+    # 同样的图片只存一份；文件和缩略图在settings.IMAGE_STORE_DIR
+    objects = models.Manager()
+    digest = models.CharField(max_length=64, primary_key=True, verbose_name='SHA-256')
+    content_type = models.CharField(max_length=SHORT_CHAR, verbose_name='原图类型')
+    thumbnail_type = models.CharField(max_length=SHORT_CHAR, verbose_name='缩略图类型')
+    width = models.IntegerField(verbose_name='宽')
+    height = models.IntegerField(verbose_name='高')
+    size = models.IntegerField(verbose_name='字节数')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='上传时间')
+
+    class Meta:
+        verbose_name = '图片'
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return self.digest
+
+    def __repr__(self):
+        return self.digest
+
+
+class DataVersion(models.Model):
+    # 数据的版本号，相关数据每次写入都加一；报表结果（dbsystem/reports.py）按版本判断是否过期
+    objects = models.Manager()
+    name = models.CharField(max_length=SHORT_CHAR, primary_key=True, verbose_name='数据')
+    version = models.BigIntegerField(default=0, verbose_name='版本号')
+
+    class Meta:
+        verbose_name = '数据版本'
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return '%s@%d' % (self.name, self.version)
+
+
+class ReportJob(models.Model):
+    # 后台报表任务（dbsystem/reports.py），manage.py report_worker 执行；结果压缩后存在settings.REPORT_DIR，
+    # cache_key由报表类型、参数和数据版本算出，数据没变时同样的请求直接返回已有结果
+    objects = models.Manager()
+    kind = models.CharField(max_length=SHORT_CHAR, verbose_name='报表类型')
+    params = models.TextField(verbose_name='参数')
+    cache_key = models.CharField(max_length=64, db_index=True, verbose_name='缓存键')
+    status = models.CharField(max_length=CODE_CHAR, default='queued', db_index=True, verbose_name='状态',
+                              choices=(('queued', '排队中'), ('running', '运行中'), ('done', '完成'), ('failed', '失败')))
+    progress = models.IntegerField(default=0, verbose_name='已写行数')
+    total = models.IntegerField(null=True, blank=True, verbose_name='总行数')
+    size = models.BigIntegerField(default=0, verbose_name='文件字节数')
+    error = models.TextField(blank=True, verbose_name='错误')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='提交时间')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='开始时间')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='完成时间')
+
+    class Meta:
+        verbose_name = '报表任务'
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return '%s#%d' % (self.kind, self.pk)
+
+    def __repr__(self):
+        return '%s#%d' % (self.kind, self.pk)
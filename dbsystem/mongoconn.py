@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+
+# Mongo连接的配置、连接池统计和健康检查
+# settings.MONGO_CONNECTIONS 按别名配置连接（数据库、地址、读偏好、连接池大小和各种超时），
+# register()在应用启动时只登记参数，不建立连接：mongoengine在第一次访问这个别名的集合时才创建MongoClient，
+# 所以manage.py命令、测试和WSGI进程启动时不会因为Mongo慢或者连不上而卡住。
+# settings.MONGO_ALIASES 把文档类映射到别名（没有列出的用default），继承的子类一起改。
+# 每个别名一个连接池监听器，记录正在使用/已打开的连接数、等待和取连接超时的次数，
+# health()检查SQL和各个Mongo别名能不能ping通、连接池是否快用满，/health/ 返回结果
+
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from mongoengine import DEFAULT_CONNECTION_NAME, disconnect, get_connection, register_connection
+from mongoengine.base import get_document
+from pymongo import ReadPreference, monitoring
+
+from dbsystem.instrumentation import mongo_listener
+
+
+READ_PREFERENCES = {preference.mongos_mode: preference for preference in (
+    ReadPreference.PRIMARY, ReadPreference.PRIMARY_PREFERRED, ReadPreference.SECONDARY,
+    ReadPreference.SECONDARY_PREFERRED, ReadPreference.NEAREST)}
+
+# pymongo的默认连接池大小
+DEFAULT_POOL_SIZE = 100
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    # 副本集里每台服务器一个连接池，按地址分别计数
+
+    def __init__(self, alias, max_pool_size):
+        self.alias = alias
+        self.max_pool_size = max_pool_size
+        self.lock = threading.Lock()
+        self.pools = defaultdict(lambda: {'open': 0, 'in_use': 0, 'waiting': 0, 'peak_in_use': 0})
+        self.check_out_failures = 0
+        self.cleared = 0
+
+    def _count(self, event, **deltas):
+        with self.lock:
+            pool = self.pools[event.address]
+            for name, delta in deltas.items():
+                pool[name] += delta
+            pool['peak_in_use'] = max(pool['peak_in_use'], pool['in_use'])
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        with self.lock:
+            self.pools.pop(event.address, None)
+
+    def connection_created(self, event):
+        self._count(event, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(event, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._count(event, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._count(event, waiting=-1)
+        with self.lock:
+            self.check_out_failures += 1
+
+    def connection_checked_out(self, event):
+        self._count(event, waiting=-1, in_use=1)
+
+    def connection_checked_in(self, event):
+        self._count(event, in_use=-1)
+
+    def snapshot(self):
+        with self.lock:
+            pools = {'%s:%s' % address: dict(pool) for address, pool in self.pools.items()}
+            failures, cleared = self.check_out_failures, self.cleared
+        in_use = max([pool['in_use'] for pool in pools.values()] or [0])
+        return {
+            'max_pool_size': self.max_pool_size,
+            'pools': pools,
+            # 最忙的那台服务器上正在使用的连接占连接池的比例
+            'saturation': in_use / self.max_pool_size if self.max_pool_size else 0.0,
+            'check_out_failures': failures,
+            'cleared': cleared,
+        }
+
+
+_listeners = {}
+
+# 上一次register()改过别名的文档类，重新登记时先恢复成default
+_assigned = set()
+
+
+def connections():
+    return getattr(settings, 'MONGO_CONNECTIONS', {'default': {'db': 'dbsystem'}})
+
+
+def register():
+    # 登记所有别名的连接参数，已经建立的连接先断开
+    configured = connections()
+    _listeners.clear()
+    for alias, options in configured.items():
+        options = dict(options)
+        mode = options.pop('read_preference', 'primary')
+        if mode not in READ_PREFERENCES:
+            raise ImproperlyConfigured('MONGO_CONNECTIONS[%r]: read_preference should be one of %s' % (
+                alias, ', '.join(READ_PREFERENCES)))
+        listener = _listeners[alias] = PoolListener(alias, options.get('maxPoolSize', DEFAULT_POOL_SIZE))
+        disconnect(alias)
+        register_connection(alias, read_preference=READ_PREFERENCES[mode],
+                            event_listeners=[mongo_listener, listener], **options)
+    aliases = dict.fromkeys(_assigned, DEFAULT_CONNECTION_NAME)
+    for name, alias in getattr(settings, 'MONGO_ALIASES', {}).items():
+        if alias not in configured:
+            raise ImproperlyConfigured('MONGO_ALIASES[%r]: unknown alias %r' % (name, alias))
+        aliases.update(dict.fromkeys(get_document(name)._subclasses, alias))
+    for name, alias in aliases.items():
+        document = get_document(name)
+        document._meta['db_alias'] = alias
+        # 已经缓存的集合属于原来的连接
+        document._collection = None
+    _assigned.clear()
+    _assigned.update(name for name, alias in aliases.items() if alias != DEFAULT_CONNECTION_NAME)
+
+
+def pool_stats():
+    return {alias: listener.snapshot() for alias, listener in _listeners.items()}
+
+
+def _probe(check):
+    started = time.perf_counter()
+    try:
+        check()
+    except Exception as e:
+        return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e),
+                'ms': (time.perf_counter() - started) * 1000}
+    return {'ok': True, 'ms': (time.perf_counter() - started) * 1000}
+
+
+def _ping_sql():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+
+
+def health():
+    # 返回 (是否就绪, 详情)；连不上或者连接池使用率超过MONGO_POOL_SATURATION_LIMIT时不就绪
+    limit = getattr(settings, 'MONGO_POOL_SATURATION_LIMIT', 0.9)
+    report = {'sql': _probe(_ping_sql), 'mongo': {}}
+    ready = report['sql']['ok']
+    stats = pool_stats()
+    for alias in connections():
+        # 超时由连接参数里的serverSelectionTimeoutMS决定
+        result = _probe(lambda: get_connection(alias).admin.command('ping'))
+        if alias in stats:
+            result['pool'] = stats[alias]
+            result['saturated'] = stats[alias]['saturation'] >= limit
+        ready = ready and result['ok'] and not result.get('saturated', False)
+        report['mongo'][alias] = result
+    report['ready'] = ready
+    return ready, report
@@ -0,0 +1,518 @@
+# -*- coding: UTF-8 -*-
+
+# Mongo（models.py）到SQL（models_mysql.py）的数据迁移
+# 每个集合按_id顺序分批读取原始文档（不经过mongoengine，不解引用），
+# ReferenceField/ListField(ReferenceField)通过MongoIdMap对照表批量翻译成外键/多对多，
+# 每批在一个事务里bulk_create写入。已经有对照记录的文档直接跳过，中断后重新运行即可续传。
+# 双写模式下mongoengine的post_save/post_delete把单个文档同步到SQL，走ORM保存，
+# aggregates等模块的信号照常维护。verify()逐个文档比较两边字段的校验和。
+#
+# 没有迁移的部分：Folder/Wrong/Solution在SQL里没有对应的表；Mongo的ExerciseCondition没有练习引用；
+# Exercise.targets是学生，而SQL的release_target是老师
+
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from mongoengine import signals
+
+from dbsystem import models as mongo
+from dbsystem.bulk import BATCH_SIZE, bulk_insert, next_id
+from dbsystem.prefetch import document_id, reference_ids
+from dbsystem.models_mysql import *
+
+
+logger = logging.getLogger('dbsystem.mongosync')
+
+CACHE_LIMIT = 1000000
+
+
+def _year(value):
+    return value.year if isinstance(value, (date, datetime)) else 0
+
+
+def _aware(value):
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def _choice(model, name, value, default):
+    return value if value in dict(model._meta.get_field(name).choices) else default
+
+
+class IdTranslator(object):
+    # ObjectId → SQL主键。按集合批量查询MongoIdMap，查过的（包括没有对照的）留在内存里
+
+    def __init__(self):
+        self.known = {}
+        self.size = 0
+        # Mapping.prepare()放每批的附加查询结果
+        self.context = {}
+
+    def prefetch(self, document, object_ids):
+        collection = document._get_collection_name()
+        cache = self.known.setdefault(collection, {})
+        missing = list({str(object_id) for object_id in object_ids} - cache.keys())
+        if self.size + len(missing) > CACHE_LIMIT:
+            self.known = {collection: cache}
+            cache.clear()
+            self.size = 0
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            found = dict(MongoIdMap.objects.filter(collection=collection, mongo_id__in=batch)
+                         .values_list('mongo_id', 'sql_id'))
+            for mongo_id in batch:
+                cache[mongo_id] = found.get(mongo_id)
+        self.size += len(missing)
+
+    def prefetch_refs(self, mapping, docs):
+        for name, document in mapping.refs.items():
+            self.prefetch(document, [object_id for doc in docs for object_id in reference_ids(doc.get(name))])
+
+    def add(self, document, pairs):
+        cache = self.known.setdefault(document._get_collection_name(), {})
+        for object_id, sql_id in pairs:
+            cache[str(object_id)] = sql_id
+
+    def one(self, document, value):
+        object_ids = list(reference_ids(value))
+        if not object_ids:
+            return None
+        key = str(object_ids[0])
+        if key not in self.known.get(document._get_collection_name(), {}):
+            self.prefetch(document, object_ids[:1])
+        return self.known[document._get_collection_name()][key]
+
+    def many(self, document, value):
+        ids = (self.one(document, object_id) for object_id in reference_ids(value))
+        return list(dict.fromkeys(sql_id for sql_id in ids if sql_id is not None))
+
+
+class Mapping(ABC):
+    document = None
+    model = None
+    # 引用字段名 → 被引用的Document，用于批量预取对照
+    refs = {}
+
+    @property
+    def collection(self):
+        return self.document._get_collection_name()
+
+    def prepare(self, docs, ids):
+        pass
+
+    @abstractmethod
+    def convert(self, doc, ids):
+        # 返回 (SQL模型, {attname: 值}, {多对多字段名: [SQL主键]})，缺少必需的引用时返回None
+        pass
+
+
+class SubjectMapping(Mapping):
+    document = mongo.Subject
+    model = Subject
+
+    def convert(self, doc, ids):
+        return Subject, {'name': doc.get('name') or ''}, {}
+
+
+class BookMapping(Mapping):
+    document = mongo.Book
+    model = Book
+    refs = {'subject': mongo.Subject}
+
+    def convert(self, doc, ids):
+        subject = ids.one(mongo.Subject, doc.get('subject'))
+        if subject is None:
+            return None
+        return Book, {'name': doc.get('name') or '', 'series': doc.get('series') or '', 'subject_id': subject}, {}
+
+
+class ChapterMapping(Mapping):
+    document = mongo.Chapter
+    model = Chapter
+    refs = {'book': mongo.Book}
+
+    def convert(self, doc, ids):
+        book = ids.one(mongo.Book, doc.get('book'))
+        if book is None:
+            return None
+        return Chapter, {'name': doc.get('name') or '', 'book_id': book}, {}
+
+
+class SchoolMapping(Mapping):
+    document = mongo.School
+    model = School
+
+    def convert(self, doc, ids):
+        return School, {
+            'name': doc.get('name') or '',
+            'area': doc.get('area_code') or '',
+            'administrator': doc.get('administrator') or '',
+            'property': _choice(School, 'property', doc.get('types'), 'other'),
+            'rank': doc.get('rank') or 0,
+            'description': doc.get('description') or '',
+            'level': _choice(School, 'level', doc.get('register'), 'other'),
+        }, {}
+
+
+class GroupMapping(Mapping):
+    document = mongo.Group
+    model = Class
+
+    def convert(self, doc, ids):
+        return Class, {'name': doc.get('name') or '', 'entry_year': _year(doc.get('year')),
+                       'rank': doc.get('rank') or 0}, {}
+
+
+class PeopleMapping(Mapping):
+    # People/Teacher/Student在Mongo里是同一个集合，用_cls区分
+    document = mongo.People
+    model = People
+    refs = {'school': mongo.School, 'group': mongo.Group, 'subject': mongo.Subject}
+
+    SEX = {'male': 'male', 'female': 'female', '男': 'male', '女': 'female'}
+
+    STUDENT_FIELDS = (('effort', 'hardness'), ('frustration', 'frustration'), ('habits', 'habit'),
+                      ('correction', 'correct'), ('comprehension', 'comprehensive'), ('logics', 'logic'),
+                      ('abstraction', 'abstract'), ('imagination', 'spatial'), ('summary', 'conclusive'))
+
+    def convert(self, doc, ids):
+        school = ids.one(mongo.School, doc.get('school'))
+        if school is None:
+            return None
+        fields = {
+            'name': doc.get('name') or '',
+            'born_year': _year(doc.get('born')),
+            'sex': self.SEX.get(doc.get('sexuality'), 'other'),
+            'school_id': school,
+        }
+        m2m = {'classes': ids.many(mongo.Group, doc.get('group'))}
+        kind = doc.get('_cls', 'People')
+        if kind == 'People.Teacher':
+            subjects = ids.many(mongo.Subject, doc.get('subject'))
+            if not subjects:
+                return None
+            fields.update(position=doc.get('position') or '', subject_id=subjects[0],
+                          entry_year=_year(doc.get('year')))
+            return Teacher, fields, m2m
+        if kind == 'People.Student':
+            fields.update({name: doc.get(field) or 0 for field, name in self.STUDENT_FIELDS})
+            return Student, fields, m2m
+        return People, fields, m2m
+
+
+class ProblemMapping(Mapping):
+    document = mongo.Problem
+    model = Problem
+    refs = {'tags': mongo.Tag}
+
+    def convert(self, doc, ids):
+        return Problem, {
+            'name': doc.get('name') or '',
+            'description': '\n'.join(doc.get('description') or ()),
+            'formula': '\n'.join(doc.get('formula') or ()),
+        }, {'tags': ids.many(mongo.Tag, doc.get('tags'))}
+
+
+class ExerciseMapping(Mapping):
+    document = mongo.Exercise
+    model = Exercise
+    refs = {'problems': mongo.Problem, 'publisher': mongo.People, 'subject': mongo.Subject}
+
+    def prepare(self, docs, ids):
+        # release_people只能是老师，publisher里可能有其他人员
+        people = {sql_id for doc in docs for sql_id in ids.many(mongo.People, doc.get('publisher'))}
+        ids.context['teachers'] = set(Teacher.objects.filter(pk__in=people).values_list('pk', flat=True))
+
+    def convert(self, doc, ids):
+        subject = ids.one(mongo.Subject, doc.get('subject'))
+        publishers = [pk for pk in ids.many(mongo.People, doc.get('publisher')) if pk in ids.context['teachers']]
+        release_time = _aware(doc.get('publish_time'))
+        if subject is None or not publishers or release_time is None:
+            return None
+        return Exercise, {
+            'name': doc.get('name') or '',
+            'release_time': release_time,
+            'length': doc.get('allow_time') or 0,
+            'aim': _choice(Exercise, 'aim', doc.get('aim'), '1'),
+            'release_people_id': publishers[0],
+            'subject_id': subject,
+            'types': _choice(Exercise, 'types', doc.get('types'), '3'),
+        }, {'problems': ids.many(mongo.Problem, doc.get('problems'))}
+
+
+class TagMapping(Mapping):
+    document = mongo.Tag
+    model = Tag
+    refs = {'book': mongo.Book, 'topic': mongo.Chapter}
+
+    def convert(self, doc, ids):
+        book = ids.one(mongo.Book, doc.get('book'))
+        # topic是章节列表的列表，SQL只有一个章节，取第一个
+        chapters = ids.many(mongo.Chapter, doc.get('topic'))
+        if book is None or not chapters:
+            return None
+        return Tag, {
+            'name': doc.get('name') or '',
+            'category': _choice(Tag, 'category', doc.get('types'), 'Z'),
+            'difficulty': doc.get('difficulty') or 0,
+            'description': doc.get('description') or '',
+            'book_id': book,
+            'chapter_id': chapters[0],
+        }, {}
+
+
+class ProblemConditionMapping(Mapping):
+    # Mongo里没有用时和得分，写0；错误答案列表用逗号连接
+    document = mongo.ProblemCondition
+    model = ProblemCondition
+    refs = {'student': mongo.People, 'problem': mongo.Problem}
+
+    def convert(self, doc, ids):
+        student = ids.one(mongo.People, doc.get('student'))
+        problem = ids.one(mongo.Problem, doc.get('problem'))
+        if student is None or problem is None:
+            return None
+        return ProblemCondition, {
+            'student_id': student,
+            'problem_id': problem,
+            'result': doc.get('result') or '',
+            'judge': ','.join(doc.get('wrong') or ()),
+            'cost': 0,
+            'points': 0,
+        }, {}
+
+
+# 按依赖顺序排列
+MAPPINGS = (SubjectMapping(), BookMapping(), ChapterMapping(), SchoolMapping(), GroupMapping(), PeopleMapping(),
+            TagMapping(), ProblemMapping(), ExerciseMapping(), ProblemConditionMapping())
+
+MAPPINGS_BY_COLLECTION = {mapping.collection: mapping for mapping in MAPPINGS}
+
+
+def stream(document, batch_size=BATCH_SIZE):
+    # 按_id翻页，不用游标的skip，也不会因为长时间打开游标而超时
+    collection = document._get_collection()
+    last = None
+    while True:
+        query = {'_id': {'$gt': last}} if last is not None else {}
+        docs = list(collection.find(query).sort('_id', 1).limit(batch_size))
+        if not docs:
+            return
+        yield docs
+        last = docs[-1]['_id']
+
+
+def _instance(model, pk, fields):
+    obj = model(**fields)
+    # 多表继承时父表主键和子表指针都要赋值
+    for field in model._meta.concrete_fields:
+        if field.primary_key:
+            setattr(obj, field.attname, pk)
+    return obj
+
+
+def _through(model, name):
+    field = model._meta.get_field(name)
+    through = field.remote_field.through
+    return (through, through._meta.get_field(field.m2m_field_name()).attname,
+            through._meta.get_field(field.m2m_reverse_field_name()).attname)
+
+
+def _load(mapping, docs, ids):
+    ids.prefetch(mapping.document, [doc['_id'] for doc in docs])
+    new = [doc for doc in docs if ids.one(mapping.document, doc['_id']) is None]
+    ids.prefetch_refs(mapping, new)
+    mapping.prepare(new, ids)
+    rows = []
+    for doc in new:
+        converted = mapping.convert(doc, ids)
+        if converted is not None:
+            rows.append((doc['_id'],) + converted)
+    if rows:
+        first = next_id(mapping.model)
+        objs = {}
+        links = {}
+        for pk, (object_id, model, fields, m2m) in enumerate(rows, first):
+            objs.setdefault(model, []).append(_instance(model, pk, fields))
+            for name, targets in m2m.items():
+                through, source, target = _through(model, name)
+                links.setdefault(through, []).extend(through(**{source: pk, target: t}) for t in targets)
+        for model, instances in objs.items():
+            bulk_insert(model, instances)
+        for through, instances in links.items():
+            through.objects.bulk_create(instances, batch_size=BATCH_SIZE)
+        pairs = [(row[0], pk) for pk, row in enumerate(rows, first)]
+        MongoIdMap.objects.bulk_create([MongoIdMap(collection=mapping.collection, mongo_id=str(object_id), sql_id=pk)
+                                        for object_id, pk in pairs], batch_size=BATCH_SIZE)
+        ids.add(mapping.document, pairs)
+    return len(rows), len(docs) - len(new), len(new) - len(rows)
+
+
+def migrate(mapping, batch_size=BATCH_SIZE, log=None):
+    # 主键用bulk.next_id分配，每批在一个事务里写完；双写可以在迁移完成后再打开
+    log = log or (lambda message: None)
+    ids = IdTranslator()
+    counts = {'read': 0, 'written': 0, 'existing': 0, 'skipped': 0}
+    for docs in stream(mapping.document, batch_size):
+        with transaction.atomic():
+            written, existing, skipped = _load(mapping, docs, ids)
+        counts['read'] += len(docs)
+        counts['written'] += written
+        counts['existing'] += existing
+        counts['skipped'] += skipped
+        log('%s: %d read, %d written, %d existing, %d skipped, last _id %s' % (
+            mapping.collection, counts['read'], counts['written'], counts['existing'], counts['skipped'],
+            docs[-1]['_id']))
+    return counts
+
+
+def migrate_all(batch_size=BATCH_SIZE, log=None):
+    return {mapping.collection: migrate(mapping, batch_size, log) for mapping in MAPPINGS}
+
+
+# 校验
+
+def _canonical(value):
+    if isinstance(value, datetime):
+        return _aware(value).astimezone(timezone.utc).isoformat()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Mongo里的整数写进FloatField以后读出来是浮点数
+        return repr(float(value))
+    return repr(value)
+
+
+def checksum(fields, m2m):
+    parts = sorted((name, _canonical(value)) for name, value in fields.items())
+    parts += sorted((name, tuple(sorted(set(targets)))) for name, targets in m2m.items())
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _sql_rows(expected):
+    # expected: {pk: (model, fields, m2m)}，按模型批量读SQL里的同名字段和多对多
+    by_model = {}
+    for pk, (model, fields, m2m) in expected.items():
+        by_model.setdefault(model, []).append(pk)
+    actual = {}
+    for model, pks in by_model.items():
+        _, fields, m2m = expected[pks[0]]
+        for row in model.objects.filter(pk__in=pks).values('pk', *fields):
+            actual[row.pop('pk')] = (row, {name: [] for name in m2m})
+        for name in m2m:
+            through, source, target = _through(model, name)
+            for pk, target_id in through.objects.filter(**{source + '__in': pks}).values_list(source, target):
+                if pk in actual:
+                    actual[pk][1][name].append(target_id)
+    return actual
+
+
+def verify(mapping, batch_size=BATCH_SIZE, examples=20):
+    report = {'collection': mapping.collection, 'documents': 0, 'skipped': 0, 'missing': 0, 'mismatched': 0,
+              'orphaned': 0, 'examples': []}
+    mongo_digest = sql_digest = 0
+    mapped = 0
+    ids = IdTranslator()
+    for docs in stream(mapping.document, batch_size):
+        ids.prefetch(mapping.document, [doc['_id'] for doc in docs])
+        ids.prefetch_refs(mapping, docs)
+        mapping.prepare(docs, ids)
+        expected = {}
+        object_ids = {}
+        for doc in docs:
+            report['documents'] += 1
+            pk = ids.one(mapping.document, doc['_id'])
+            mapped += pk is not None
+            converted = mapping.convert(doc, ids)
+            if converted is None:
+                report['skipped'] += 1
+            elif pk is None:
+                report['missing'] += 1
+                report['examples'].append(('missing', str(doc['_id'])))
+            else:
+                expected[pk] = converted
+                object_ids[pk] = doc['_id']
+        actual = _sql_rows(expected)
+        for pk, (model, fields, m2m) in expected.items():
+            want = checksum(fields, m2m)
+            mongo_digest ^= int(want, 16)
+            if pk not in actual:
+                report['missing'] += 1
+                report['examples'].append(('missing', str(object_ids[pk])))
+                continue
+            have = checksum(*actual[pk])
+            sql_digest ^= int(have, 16)
+            if have != want:
+                report['mismatched'] += 1
+                report['examples'].append(('mismatched', str(object_ids[pk])))
+    # Mongo里已经删除、SQL里还留着的
+    report['orphaned'] = MongoIdMap.objects.filter(collection=mapping.collection).count() - mapped
+    report['examples'] = report['examples'][:examples]
+    report['mongo_checksum'] = '%032x' % mongo_digest
+    report['sql_checksum'] = '%032x' % sql_digest
+    report['ok'] = (mongo_digest == sql_digest and not report['missing'] and not report['mismatched']
+                    and not report['orphaned'])
+    return report
+
+
+# 双写
+
+def sync(document):
+    mapping = MAPPINGS_BY_COLLECTION.get(document._get_collection_name())
+    if mapping is None:
+        return None
+    doc = document.to_mongo().to_dict()
+    doc['_id'] = document_id(document)
+    ids = IdTranslator()
+    with transaction.atomic():
+        ids.prefetch(mapping.document, [doc['_id']])
+        ids.prefetch_refs(mapping, [doc])
+        mapping.prepare([doc], ids)
+        converted = mapping.convert(doc, ids)
+        if converted is None:
+            logger.warning('%s %s: referenced documents are not migrated yet, skipped', mapping.collection, doc['_id'])
+            return None
+        model, fields, m2m = converted
+        pk = ids.one(mapping.document, doc['_id'])
+        obj = _instance(model, pk, fields) if pk is not None else model(**fields)
+        obj.save()
+        if pk is None:
+            MongoIdMap.objects.create(collection=mapping.collection, mongo_id=str(doc['_id']), sql_id=obj.pk)
+        for name, targets in m2m.items():
+            getattr(obj, name).set(targets)
+    return obj
+
+
+def remove(document):
+    mapping = MAPPINGS_BY_COLLECTION.get(document._get_collection_name())
+    if mapping is None:
+        return
+    with transaction.atomic():
+        entries = MongoIdMap.objects.filter(collection=mapping.collection, mongo_id=str(document_id(document)))
+        mapping.model.objects.filter(pk__in=list(entries.values_list('sql_id', flat=True))).delete()
+        entries.delete()
+
+
+def _post_save(sender, document, **kwargs):
+    sync(document)
+
+
+def _post_delete(sender, document, **kwargs):
+    remove(document)
+
+
+def enable_dual_write():
+    if not signals.signals_available:
+        raise ImproperlyConfigured('MONGO_DUAL_WRITE needs blinker for mongoengine signals')
+    signals.post_save.connect(_post_save)
+    signals.post_delete.connect(_post_delete)
+
+
+def disable_dual_write():
+    signals.post_save.disconnect(_post_save)
+    signals.post_delete.disconnect(_post_delete)
@@ -0,0 +1,143 @@
+# -*- coding: UTF-8 -*-
+
+# Mongo引用字段的批量解引用
+# mongoengine按文档逐个解引用，练习→40道题→每题的标签要几十上百次往返。
+# prefetch(documents, 'problems__tags') 按层收集所有引用的_id，每层每个集合一次$in查询，
+# 再把加载的文档填回引用字段；同一次预取里相同的引用只加载一次，得到同一个对象（identity map）。
+# models.py里的Document用PrefetchQuerySet，可以直接写 Exercise.objects.prefetch('problems__tags')
+
+from bson import DBRef, ObjectId
+from mongoengine import Document, QuerySet
+from mongoengine.base import BaseList
+from mongoengine.errors import LookUpError
+from mongoengine.fields import ListField, ReferenceField
+
+
+BATCH_SIZE = 1000
+
+
+def document_id(document):
+    # models.py里显式声明了_id字段：新保存的文档主键在pk上，从数据库读出来的在_id字段上
+    return document.pk if document.pk is not None else document._data.get('_id')
+
+
+def reference_ids(value):
+    if isinstance(value, ObjectId):
+        yield value
+    elif isinstance(value, DBRef):
+        yield value.id
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from reference_ids(item)
+
+
+def _target(field):
+    while isinstance(field, ListField):
+        field = field.field
+    return field.document_type if isinstance(field, ReferenceField) else None
+
+
+def _tree(lookups):
+    tree = {}
+    for lookup in lookups:
+        node = tree
+        for name in lookup.split('__'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def _stitch(value, loaded):
+    # 把ObjectId/DBRef换成加载好的文档，找不到的引用保持原样
+    if isinstance(value, (list, tuple)):
+        return [_stitch(item, loaded) for item in value]
+    for object_id in reference_ids(value):
+        return loaded.get(object_id, value)
+    return value
+
+
+def _documents(value):
+    if isinstance(value, Document):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _documents(item)
+
+
+def _fetch(document, object_ids, identity_map):
+    collection = document._get_collection()
+    missing = [object_id for object_id in object_ids if (collection.name, object_id) not in identity_map]
+    for i in range(0, len(missing), BATCH_SIZE):
+        for son in collection.find({'_id': {'$in': missing[i:i + BATCH_SIZE]}}):
+            identity_map[collection.name, son['_id']] = document._from_son(son)
+    return {object_id: identity_map[collection.name, object_id] for object_id in object_ids
+            if (collection.name, object_id) in identity_map}
+
+
+def _prefetch(documents, tree, identity_map):
+    for name, subtree in tree.items():
+        # 同一层可能混有不同的子类（People/Teacher/Student），只处理有这个字段的
+        fields = {type(doc): type(doc)._fields.get(name) for doc in documents}
+        targets = {_target(field) for field in fields.values() if field is not None}
+        if not targets or None in targets:
+            raise LookUpError('Cannot prefetch %r: not a reference field' % name)
+        for target in targets:
+            holders = [doc for doc in documents if _target(fields[type(doc)]) is target]
+            object_ids = list(dict.fromkeys(object_id for doc in holders
+                                            for object_id in reference_ids(doc._data.get(name))))
+            loaded = _fetch(target, object_ids, identity_map)
+            for doc in holders:
+                value = _stitch(doc._data.get(name), loaded)
+                if isinstance(value, list):
+                    value = BaseList(value, doc, name)
+                    value._dereferenced = True
+                doc._data[name] = value
+        # 包括之前已经解引用过、字段里本来就是文档的
+        related = [item for doc in documents for item in _documents(doc._data.get(name))]
+        if subtree:
+            _prefetch(list({id(doc): doc for doc in related}.values()), subtree, identity_map)
+
+
+def prefetch(documents, *lookups, identity_map=None):
+    identity_map = {} if identity_map is None else identity_map
+    documents = list(documents)
+    for doc in documents:
+        identity_map.setdefault((doc._get_collection_name(), document_id(doc)), doc)
+    if documents and lookups:
+        _prefetch(documents, _tree(lookups), identity_map)
+    return documents
+
+
+class PrefetchQuerySet(QuerySet):
+    _prefetch_lookups = ()
+    _identity_map = None
+
+    def prefetch(self, *lookups):
+        queryset = self.clone()
+        queryset._prefetch_lookups = self._prefetch_lookups + lookups
+        return queryset
+
+    def _clone_into(self, new_qs):
+        new_qs = super()._clone_into(new_qs)
+        new_qs._prefetch_lookups = self._prefetch_lookups
+        return new_qs
+
+    def _populate_cache(self):
+        # 每次从游标取一块（ITER_CHUNK_SIZE条），整块一起预取
+        start = len(self._result_cache or ())
+        super()._populate_cache()
+        if self._prefetch_lookups and not self._scalar and not self._as_pymongo:
+            if self._identity_map is None:
+                self._identity_map = {}
+            prefetch(self._result_cache[start:], *self._prefetch_lookups, identity_map=self._identity_map)
+
+    def get(self, *q_objs, **query):
+        doc = super().get(*q_objs, **query)
+        if self._prefetch_lookups:
+            prefetch([doc], *self._prefetch_lookups)
+        return doc
+
+    def first(self):
+        doc = super().first()
+        if doc is not None and self._prefetch_lookups:
+            prefetch([doc], *self._prefetch_lookups)
+        return doc
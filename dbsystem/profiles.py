@@ -0,0 +1,381 @@
+# -*- coding: UTF-8 -*-
+
+# 学生能力画像（Student的九项能力值）的相似学生查询和分组
+# 整个学生表一次读进 学生数×9 的numpy矩阵，学生ID是排好序的数组，用searchsorted查行号。
+# 各项能力的量纲不一定相同，按加载时的均值/标准差标准化，距离是标准化以后的欧氏距离。
+#   neighbors()   一批学生各自最相近的k个学生：查询矩阵和候选矩阵分块相乘得到距离平方，
+#                 每块只把比当前第k近还近的合并进结果，内存只和块大小有关
+#   kmeans()      把一个学校/班级的学生按能力分成若干组（k-means++初始化，Lloyd迭代）
+# 都可以限定在一个学校或者一个班级内。
+#
+# 增量维护：学生保存后原地更新那一行，新学生先放在pending里，下次查询前一次合并；
+# 删除的学生只做标记；班级成员变化只改动涉及的学生/班级。
+
+import itertools
+import threading
+
+import numpy as np
+from django.db import connection
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from dbsystem.models_mysql import People, Student
+
+
+FIELDS = ('hardness', 'frustration', 'habit', 'correct', 'comprehensive', 'logic', 'abstract', 'spatial',
+          'conclusive')
+
+# 每次和多少个候选学生算距离；查询多时每QUERY_BATCH个一批，距离矩阵留在缓存里
+BLOCK_SIZE = 16384
+QUERY_BATCH = 256
+
+MAX_K = 100
+
+# k-means的距离矩阵是 学生数×组数，组数不跟着请求参数无限变大
+MAX_GROUPS = 100
+
+
+def _lookup(keys, ids):
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    index = np.searchsorted(keys, ids)
+    clipped = np.minimum(index, max(len(keys) - 1, 0))
+    found = (index < len(keys)) & (keys[clipped] == ids) if len(keys) else np.zeros(len(ids), dtype=bool)
+    return clipped, found
+
+
+class ProfileIndex(object):
+
+    def __init__(self, student_ids, values, schools=None, classes=None):
+        # values: 学生数×9，列顺序同FIELDS；schools: 每个学生的学校ID；classes: (人员ID, 班级ID) 两个数组
+        student_ids = np.asarray(student_ids, dtype=np.int64).reshape(-1)
+        order = np.argsort(student_ids, kind='stable')
+        self.students = student_ids[order]
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(FIELDS))[order]
+        # 之后的增量更新沿用同一组标准化参数
+        self.mean = values.mean(axis=0) if len(values) else np.zeros(len(FIELDS))
+        std = values.std(axis=0) if len(values) else np.ones(len(FIELDS))
+        self.std = np.where(std > 0, std, 1.0)
+        self.vectors = self._standardize(values)
+        self.norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.alive = np.ones(len(self.students), dtype=bool)
+        self.school_of_row = np.full(len(self.students), -1, dtype=np.int64)
+        if schools is not None:
+            self.school_of_row[:] = np.asarray(schools, dtype=np.int64).reshape(-1)[order]
+        # 班级成员按学生ID存，合并新学生改变行号时不受影响
+        self.class_students = np.zeros(0, dtype=np.int64)
+        self.class_ids = np.zeros(0, dtype=np.int64)
+        if classes is not None:
+            self.class_students = np.asarray(classes[0], dtype=np.int64).reshape(-1)
+            self.class_ids = np.asarray(classes[1], dtype=np.int64).reshape(-1)
+        # 还没合并的新学生：{学生ID: (能力值, 学校ID)}
+        self.pending = {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, chunk_size=100000):
+        sql, params = Student.objects.order_by().values_list('pk', 'school_id', *FIELDS).query.sql_with_params()
+        chunks = [np.zeros((0, 2 + len(FIELDS)), dtype=np.int64)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 2 + len(FIELDS)))
+        data = np.concatenate(chunks)
+        classes = np.array(People.classes.through.objects.values_list('people_id', 'class_id'),
+                           dtype=np.int64).reshape(-1, 2)
+        return cls(data[:, 0], data[:, 2:], schools=data[:, 1], classes=(classes[:, 0], classes[:, 1]))
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.pending)
+
+    def _standardize(self, values):
+        return ((np.asarray(values, dtype=np.float64).reshape(-1, len(FIELDS)) - self.mean) / self.std
+                ).astype(np.float32)
+
+    def _row_index(self, student_ids):
+        return _lookup(self.students, student_ids)
+
+    # 增量维护
+
+    def update(self, student_id, values, school_id):
+        with self.lock:
+            rows, found = self._row_index([student_id])
+            if not found[0]:
+                self.pending[student_id] = (list(values), school_id)
+                return
+            row = rows[0]
+            self.vectors[row] = self._standardize(values)[0]
+            self.norms[row] = self.vectors[row] @ self.vectors[row]
+            self.school_of_row[row] = school_id
+            self.alive[row] = True
+
+    def remove(self, student_id):
+        with self.lock:
+            self.pending.pop(student_id, None)
+            rows, found = self._row_index([student_id])
+            if found[0]:
+                self.alive[rows[0]] = False
+
+    def set_student_classes(self, student_id, class_ids):
+        with self.lock:
+            keep = self.class_students != student_id
+            self.class_students = np.concatenate([self.class_students[keep],
+                                                  np.full(len(class_ids), student_id, dtype=np.int64)])
+            self.class_ids = np.concatenate([self.class_ids[keep], np.asarray(class_ids, dtype=np.int64)])
+
+    def set_class_members(self, class_id, student_ids):
+        with self.lock:
+            keep = self.class_ids != class_id
+            self.class_students = np.concatenate([self.class_students[keep],
+                                                  np.asarray(student_ids, dtype=np.int64)])
+            self.class_ids = np.concatenate([self.class_ids[keep],
+                                             np.full(len(student_ids), class_id, dtype=np.int64)])
+
+    def _merge(self):
+        if not self.pending:
+            return
+        ids = np.array(list(self.pending), dtype=np.int64)
+        vectors = self._standardize([values for values, _ in self.pending.values()])
+        schools = np.array([school_id for _, school_id in self.pending.values()], dtype=np.int64)
+        order = np.argsort(np.concatenate([self.students, ids]), kind='stable')
+        self.students = np.concatenate([self.students, ids])[order]
+        self.vectors = np.concatenate([self.vectors, vectors])[order]
+        self.norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])[order]
+        self.school_of_row = np.concatenate([self.school_of_row, schools])[order]
+        self.pending = {}
+
+    # 查询
+
+    def candidates(self, school_id=None, class_id=None):
+        # 候选行号（排好序）；不限定时返回None，表示全部
+        if class_id is not None:
+            rows, found = self._row_index(self.class_students[self.class_ids == class_id])
+            rows = np.unique(rows[found])
+            rows = rows[self.alive[rows]]
+            if school_id is not None:
+                rows = rows[self.school_of_row[rows] == school_id]
+            return rows
+        if school_id is not None:
+            return np.flatnonzero(self.alive & (self.school_of_row == school_id))
+        return None
+
+    def _search(self, queries, k, rows=None, exclude=None):
+        # queries: 标准化以后的 m×9；exclude: 每个查询要排除的行号（查询学生自己），-1为不排除
+        # 返回 (m×k 行号，不足k个时是-1, m×k 距离)
+        if len(queries) <= QUERY_BATCH:
+            return self._search_batch(queries, k, rows, exclude)
+        results = [self._search_batch(queries[i:i + QUERY_BATCH], k, rows,
+                                      None if exclude is None else exclude[i:i + QUERY_BATCH])
+                   for i in range(0, len(queries), QUERY_BATCH)]
+        return np.concatenate([r for r, _ in results]), np.concatenate([d for _, d in results])
+
+    def _search_batch(self, queries, k, rows, exclude):
+        m = len(queries)
+        best_d = np.full((m, k), np.inf, dtype=np.float32)
+        best_r = np.full((m, k), -1, dtype=np.int64)
+        total = len(self.students) if rows is None else len(rows)
+        if not m or not k or not total:
+            return best_r, best_d
+        positions = np.full(m, -1, dtype=np.int64)
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64)
+            if rows is None:
+                positions = exclude
+            else:
+                index, found = _lookup(rows, exclude)
+                positions = np.where(found & (exclude >= 0), index, -1)
+        # 距离平方 = |x|² - 2x·q + |q|²，|q|²对同一个查询是常数，比较时不用加
+        weights = np.ascontiguousarray(-2 * queries.T, dtype=np.float32)
+        queries_of = np.repeat(np.arange(m), k)
+        for start in range(0, total, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, total)
+            block = slice(start, end) if rows is None else rows[start:end]
+            distances = self.vectors[block] @ weights
+            distances += self.norms[block][:, None]
+            dead = ~self.alive[block]
+            if dead.any():
+                distances[dead] = np.inf
+            hit = np.flatnonzero((positions >= start) & (positions < end))
+            distances[positions[hit] - start, hit] = np.inf
+            # 只有比当前第k近的还近才需要合并，第一块以后通常只剩很少几个
+            closer = distances < best_d[:, -1]
+            near = np.flatnonzero(closer.any(axis=1))
+            if not len(near):
+                continue
+            which, query = np.nonzero(closer[near])
+            near = near[which]
+            if len(near) > 4 * m * k:
+                dense = np.ascontiguousarray(distances.T)
+                kk = min(k, end - start)
+                part = np.argpartition(dense, kk - 1, axis=1)[:, :kk]
+                near, query = part.ravel(), np.repeat(np.arange(m), kk)
+            candidate_q = np.concatenate([queries_of, query])
+            candidate_d = np.concatenate([best_d.ravel(), distances[near, query]])
+            candidate_r = np.concatenate([best_r.ravel(), near + start if rows is None else block[near]])
+            order = np.lexsort((candidate_d, candidate_q))
+            candidate_q = candidate_q[order]
+            # 每个查询按距离排好，保留前k个；原来的k个都在，所以每个查询正好k个
+            keep = order[np.arange(len(order)) - np.searchsorted(candidate_q, candidate_q) < k]
+            best_d = candidate_d[keep].reshape(m, k)
+            best_r = candidate_r[keep].reshape(m, k)
+        best_r[~np.isfinite(best_d)] = -1
+        best_d += np.einsum('ij,ij->i', queries, queries)[:, None]
+        return best_r, np.sqrt(np.maximum(best_d, 0))
+
+    def _result(self, rows, distances):
+        if not len(self.students):
+            return np.full(rows.shape, -1, dtype=np.int64), distances
+        return np.where(rows >= 0, self.students[np.maximum(rows, 0)], -1), distances
+
+    def neighbors(self, student_ids, k=10, school_id=None, class_id=None):
+        # 每个学生最相近的k个学生（不含自己），返回 (m×k 学生ID，不足时是-1, m×k 距离)；不存在的学生整行是-1
+        with self.lock:
+            self._merge()
+            rows, found = self._row_index(student_ids)
+            if len(self.students):
+                found &= self.alive[rows]
+            rows = rows[found]
+            result_rows, distances = self._search(self.vectors[rows], k, self.candidates(school_id, class_id), rows)
+            ids = np.full((len(found), k), -1, dtype=np.int64)
+            all_distances = np.full((len(found), k), np.inf, dtype=np.float32)
+            ids[found], all_distances[found] = self._result(result_rows, distances)
+            return ids, all_distances
+
+    def similar_to(self, values, k=10, school_id=None, class_id=None):
+        # 和给定能力值（m×9）最相近的k个学生
+        with self.lock:
+            self._merge()
+            return self._result(*self._search(self._standardize(values), k, self.candidates(school_id, class_id)))
+
+    def kmeans(self, groups, school_id=None, class_id=None, iterations=50, seed=0):
+        # 返回 (学生ID, 每个学生的组号, 组数×9 的各组平均能力值)
+        with self.lock:
+            self._merge()
+            rows = self.candidates(school_id, class_id)
+            if rows is None:
+                rows = np.flatnonzero(self.alive)
+            points = self.vectors[rows].astype(np.float64)
+            student_ids = self.students[rows]
+        groups = max(1, min(groups, len(rows)))
+        if not len(rows):
+            return student_ids, np.zeros(0, dtype=np.int64), np.zeros((0, len(FIELDS)))
+        rnd = np.random.RandomState(seed)
+        norms = np.einsum('ij,ij->i', points, points)
+
+        def squared_distances(centers):
+            return np.maximum(norms[:, None] - 2 * points @ centers.T + np.einsum('ij,ij->i', centers, centers), 0)
+
+        # k-means++：离已选中心越远的点越可能被选为下一个中心
+        centers = points[[rnd.randint(len(points))]]
+        nearest = squared_distances(centers)[:, 0]
+        while len(centers) < groups:
+            total = nearest.sum()
+            i = rnd.choice(len(points), p=nearest / total) if total > 0 else rnd.randint(len(points))
+            centers = np.vstack([centers, points[i]])
+            nearest = np.minimum(nearest, squared_distances(centers[-1:])[:, 0])
+
+        labels = None
+        for _ in range(iterations):
+            distances = squared_distances(centers)
+            new_labels = distances.argmin(axis=1)
+            if labels is not None and np.array_equal(labels, new_labels):
+                break
+            labels = new_labels
+            counts = np.bincount(labels, minlength=groups)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, points)
+            empty = counts == 0
+            centers = np.where(empty[:, None], centers, sums / np.maximum(counts, 1)[:, None])
+            if empty.any():
+                # 空组换成离自己中心最远的点
+                farthest = np.argsort(distances[np.arange(len(points)), labels])[::-1][:int(empty.sum())]
+                centers[empty] = points[farthest]
+        return student_ids, labels, centers * self.std + self.mean
+
+
+_index = None
+_lock = threading.Lock()
+# 和taggraph一样，每次作废换一个新值
+_generations = itertools.count(1)
+_generation = 0
+
+
+def get_index():
+    global _index
+    index = _index
+    if index is None:
+        with _lock:
+            index = _index
+            if index is None:
+                generation = _generation
+                index = ProfileIndex.load()
+                # 加载期间被作废过（或者有增量修改没能记进去），这次的结果不放进缓存
+                if generation == _generation:
+                    _index = index
+    return index
+
+
+def invalidate(**kwargs):
+    # bulk_create/update不发信号，批量写入后需要手动调用
+    global _index, _generation
+    _generation = next(_generations)
+    _index = None
+
+
+def _loaded():
+    # 信号处理用：索引还没加载时可能正在加载，修改记不进去，让那次加载的结果作废
+    index = _index
+    if index is None:
+        invalidate()
+    return index
+
+
+def similar(student_ids, k=10, school_id=None, class_id=None):
+    # 返回 {学生ID: [(相近学生ID, 距离)]}
+    student_ids = list(student_ids)
+    k = max(1, min(k, MAX_K))
+    ids, distances = get_index().neighbors(student_ids, k, school_id, class_id)
+    return {student_id: [(int(other), float(distance)) for other, distance in zip(row_ids, row_distances)
+                         if other >= 0]
+            for student_id, row_ids, row_distances in zip(student_ids, ids, distances)}
+
+
+def study_groups(groups, school_id=None, class_id=None, seed=0):
+    # 能力相近的学生分在一组，返回 [[学生ID]]
+    groups = max(1, min(groups, MAX_GROUPS))
+    student_ids, labels, _ = get_index().kmeans(groups, school_id, class_id, seed=seed)
+    result = [[] for _ in range(labels.max() + 1 if len(labels) else 0)]
+    for student_id, label in zip(student_ids.tolist(), labels.tolist()):
+        result[label].append(student_id)
+    return result
+
+
+@receiver(post_save, sender=Student)
+def update_student(sender, instance, raw, **kwargs):
+    index = _loaded()
+    if index is not None and not raw:
+        index.update(instance.pk, [getattr(instance, name) for name in FIELDS], instance.school_id)
+
+
+@receiver(post_delete, sender=Student)
+def delete_student(sender, instance, **kwargs):
+    index = _loaded()
+    if index is not None:
+        index.remove(instance.pk)
+
+
+@receiver(m2m_changed, sender=People.classes.through)
+def change_classes(sender, instance, action, reverse, **kwargs):
+    index = _loaded()
+    if index is None or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    through = People.classes.through
+    if reverse:
+        index.set_class_members(instance.pk, list(through.objects.filter(class_id=instance.pk)
+                                                  .values_list('people_id', flat=True)))
+    else:
+        index.set_student_classes(instance.pk, list(through.objects.filter(people_id=instance.pk)
+                                                    .values_list('class_id', flat=True)))
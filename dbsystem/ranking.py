@@ -0,0 +1,361 @@
+# -*- coding: UTF-8 -*-
+
+# 学生排名和班级/学校排名
+# 三类排行榜常驻内存，每个榜是按得分排好序的SortedList（元素是 (-得分, 学生ID)），
+# 学生的名次、前N名、百分位都是二分查找，不再对ExerciseCondition整体排序：
+#   ('exercise', 练习ID)              一次练习的得分
+#   ('class', 班级ID, 学科ID)          这个学科所有练习的总分，在班里的排名
+#   ('school', 学校ID, 学科ID)         同上，在学校里的排名
+# 得分是学生在练习里所有题目完成情况的points之和，同分同名次（1、2、2、4）。
+#
+# load() 一次GROUP BY扫描ExerciseCondition建立所有榜。
+# 增量维护：答题、练习完成情况、学生的学校/班级变化后只记下学生，
+# 下次查询前一次查询重读这些学生的得分，只改动他们所在的榜。
+# write_ranks() 按人均总分把名次写回Class.rank（所有班级）和School.rank（同一地区内），只写变化的行。
+# bulk_create/queryset.update不发信号，批量写入以后调用mark_stale()或者invalidate()
+
+import itertools
+import threading
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from sortedcontainers import SortedList
+
+from dbsystem.bulk import BATCH_SIZE
+from dbsystem.models_mysql import Class, Exercise, ExerciseCondition, People, ProblemCondition, School, Student
+
+
+SCOPES = ('exercise', 'class', 'school')
+
+MAX_LIMIT = 1000
+
+Results = ExerciseCondition.results.through
+
+_INF = float('inf')
+
+
+class Board(object):
+
+    def __init__(self, scores=None):
+        self.scores = dict(scores or {})
+        self.order = SortedList((-score, member) for member, score in self.scores.items())
+
+    def __len__(self):
+        return len(self.scores)
+
+    def set(self, member, score):
+        old = self.scores.get(member)
+        if old == score:
+            return
+        if old is not None:
+            self.order.remove((-old, member))
+        self.scores[member] = score
+        self.order.add((-score, member))
+
+    def remove(self, member):
+        old = self.scores.pop(member, None)
+        if old is not None:
+            self.order.remove((-old, member))
+
+    def rank(self, member):
+        # 得分比他高的人数 + 1
+        score = self.scores.get(member)
+        return None if score is None else self.order.bisect_left((-score,)) + 1
+
+    def percentile(self, member):
+        # 得分低于他的比例，同分的算一半，0-100
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        higher = self.order.bisect_left((-score,))
+        not_lower = self.order.bisect_right((-score, _INF))
+        return 100.0 * (len(self.order) - not_lower + (not_lower - higher) / 2) / len(self.order)
+
+    def top(self, n):
+        # [(学生ID, 得分, 名次)]
+        result = []
+        for i, (negative, member) in enumerate(self.order.islice(0, n)):
+            rank = result[-1][2] if result and result[-1][1] == -negative else i + 1
+            result.append((member, -negative, rank))
+        return result
+
+
+def _entries(state):
+    # 一个学生在各个榜上的得分；state: (学校ID, 班级ID元组, {练习ID: (学科ID, 得分)})
+    school_id, class_ids, exercises = state
+    entries = {}
+    subjects = {}
+    for exercise_id in sorted(exercises):
+        subject_id, score = exercises[exercise_id]
+        entries[('exercise', exercise_id)] = score
+        subjects[subject_id] = subjects.get(subject_id, 0.0) + score
+    for subject_id, total in subjects.items():
+        for class_id in class_ids:
+            entries[('class', class_id, subject_id)] = total
+        entries[('school', school_id, subject_id)] = total
+    return entries
+
+
+def _states(student_ids=None):
+    # 读学生的学校、班级和每次练习的得分；student_ids为None时读全部
+    students = Student.objects.all()
+    memberships = People.classes.through.objects.all()
+    conditions = ExerciseCondition.objects.all()
+    if student_ids is not None:
+        students = students.filter(pk__in=student_ids)
+        memberships = memberships.filter(people_id__in=student_ids)
+        conditions = conditions.filter(student_id__in=student_ids)
+    states = {pk: (school_id, [], {}) for pk, school_id in students.values_list('pk', 'school_id').iterator()}
+    for people_id, class_id in memberships.values_list('people_id', 'class_id').iterator():
+        if people_id in states:
+            states[people_id][1].append(class_id)
+    # 同一个学生同一次练习有多条完成情况时合在一起
+    for student_id, exercise_id, subject_id, points in conditions.values(
+            'student_id', 'exercise_id', 'exercise__subject_id').annotate(points=Sum('results__points')).values_list(
+            'student_id', 'exercise_id', 'exercise__subject_id', 'points').order_by().iterator():
+        if student_id in states:
+            states[student_id][2][exercise_id] = (subject_id, points or 0.0)
+    return {pk: (school_id, tuple(sorted(class_ids)), exercises)
+            for pk, (school_id, class_ids, exercises) in states.items()}
+
+
+def _key(scope, scope_id, subject_id=None):
+    if scope not in SCOPES:
+        raise ValueError('scope should be one of %s' % ', '.join(SCOPES))
+    return (scope, scope_id) if scope == 'exercise' else (scope, scope_id, subject_id)
+
+
+def _competition(means):
+    # {ID: 人均分} → {ID: 名次}，同分同名次
+    ranks = {}
+    previous = None
+    for i, (pk, mean) in enumerate(sorted(means.items(), key=lambda item: (-item[1], item[0]))):
+        ranks[pk] = ranks[previous[0]] if previous is not None and previous[1] == mean else i + 1
+        previous = (pk, mean)
+    return ranks
+
+
+class Ranking(object):
+
+    def __init__(self, states):
+        self.students = dict(states)
+        scores = defaultdict(dict)
+        for student_id, state in self.students.items():
+            for key, score in _entries(state).items():
+                scores[key][student_id] = score
+        self.boards = {key: Board(board_scores) for key, board_scores in scores.items()}
+        self.stale = set()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls):
+        return cls(_states())
+
+    def mark_stale(self, student_ids):
+        with self.lock:
+            self.stale.update(student_ids)
+
+    def students_with(self, position, value):
+        # 状态里第position项（1是班级，2是练习）包含value的学生
+        with self.lock:
+            return [student_id for student_id, state in self.students.items() if value in state[position]]
+
+    def _set_state(self, student_id, state):
+        old = _entries(self.students[student_id]) if student_id in self.students else {}
+        new = _entries(state) if state is not None else {}
+        for key in old.keys() - new.keys():
+            board = self.boards[key]
+            board.remove(student_id)
+            if not board:
+                del self.boards[key]
+        for key, score in new.items():
+            if old.get(key) != score:
+                self.boards.setdefault(key, Board()).set(student_id, score)
+        if state is None:
+            self.students.pop(student_id, None)
+        else:
+            self.students[student_id] = state
+
+    def refresh(self):
+        with self.lock:
+            if not self.stale:
+                return
+            stale = list(self.stale)
+            self.stale.clear()
+            for i in range(0, len(stale), BATCH_SIZE):
+                batch = stale[i:i + BATCH_SIZE]
+                states = _states(batch)
+                for student_id in batch:
+                    self._set_state(student_id, states.get(student_id))
+
+    def rank(self, scope, scope_id, student_id, subject_id=None):
+        # 返回 {'rank', 'score', 'percentile', 'size'}，不在榜上时返回None
+        with self.lock:
+            self.refresh()
+            board = self.boards.get(_key(scope, scope_id, subject_id))
+            if board is None or student_id not in board.scores:
+                return None
+            return {'rank': board.rank(student_id), 'score': board.scores[student_id],
+                    'percentile': board.percentile(student_id), 'size': len(board)}
+
+    def top(self, scope, scope_id, n=10, subject_id=None):
+        with self.lock:
+            self.refresh()
+            board = self.boards.get(_key(scope, scope_id, subject_id))
+            return board.top(n) if board is not None else []
+
+    def means(self):
+        # 班级/学校的人均总分（所有学科），没有答题的学生算0分
+        with self.lock:
+            self.refresh()
+            class_sizes, school_sizes = Counter(), Counter()
+            for school_id, class_ids, _ in self.students.values():
+                class_sizes.update(class_ids)
+                school_sizes[school_id] += 1
+            class_totals, school_totals = defaultdict(float), defaultdict(float)
+            for key, board in self.boards.items():
+                if key[0] == 'class':
+                    class_totals[key[1]] += sum(board.scores.values())
+                elif key[0] == 'school':
+                    school_totals[key[1]] += sum(board.scores.values())
+        return ({pk: class_totals[pk] / size for pk, size in class_sizes.items()},
+                {pk: school_totals[pk] / size for pk, size in school_sizes.items()})
+
+
+_ranking = None
+_lock = threading.Lock()
+# 和taggraph一样，每次作废换一个新值
+_generations = itertools.count(1)
+_generation = 0
+# 排行榜还没放进缓存时得分有变化的学生，放进缓存以后重读
+_pending = set()
+
+
+def get_ranking():
+    global _ranking, _pending
+    ranking = _ranking
+    if ranking is None:
+        with _lock:
+            ranking = _ranking
+            if ranking is None:
+                generation = _generation
+                ranking = Ranking.load()
+                # 加载期间被作废过，这次的结果不放进缓存
+                if generation == _generation:
+                    _ranking = ranking
+                    # 加载期间变化的学生，load()可能读到了也可能没有，再重读一次
+                    pending, _pending = _pending, set()
+                    ranking.mark_stale(pending)
+    return ranking
+
+
+def invalidate():
+    global _ranking, _generation
+    _generation = next(_generations)
+    _ranking = None
+
+
+def _loaded():
+    # 信号处理用：要从排行榜里找学生、但排行榜还没加载时，让可能正在进行的加载作废
+    ranking = _ranking
+    if ranking is None:
+        invalidate()
+    return ranking
+
+
+def mark_stale(student_ids):
+    ranking = _ranking
+    if ranking is None:
+        student_ids = list(student_ids)
+        _pending.update(student_ids)
+        # 加进去的时候排行榜可能刚放进缓存，已经错过了这一次
+        ranking = _ranking
+    if ranking is not None:
+        ranking.mark_stale(student_ids)
+
+
+def rank(scope, scope_id, student_id, subject_id=None):
+    return get_ranking().rank(scope, scope_id, student_id, subject_id)
+
+
+def top(scope, scope_id, n=10, subject_id=None):
+    return get_ranking().top(scope, scope_id, n, subject_id)
+
+
+def write_ranks():
+    # 没有学生的班级/学校排在最后；返回改动的行数
+    class_means, school_means = get_ranking().means()
+    classes = dict(Class.objects.values_list('pk', 'rank'))
+    class_ranks = _competition({pk: class_means.get(pk, 0.0) for pk in classes})
+    schools = {pk: (area, current) for pk, area, current in School.objects.values_list('pk', 'area', 'rank')}
+    by_area = defaultdict(dict)
+    for pk, (area, _) in schools.items():
+        by_area[area][pk] = school_means.get(pk, 0.0)
+    school_ranks = {}
+    for means in by_area.values():
+        school_ranks.update(_competition(means))
+    changed_classes = [Class(pk=pk, rank=rank) for pk, rank in class_ranks.items() if classes[pk] != rank]
+    changed_schools = [School(pk=pk, rank=rank) for pk, rank in school_ranks.items() if schools[pk][1] != rank]
+    with transaction.atomic():
+        Class.objects.bulk_update(changed_classes, ['rank'], batch_size=BATCH_SIZE)
+        School.objects.bulk_update(changed_schools, ['rank'], batch_size=BATCH_SIZE)
+    return {'classes': len(changed_classes), 'schools': len(changed_schools)}
+
+
+@receiver(post_save, sender=ProblemCondition)
+@receiver(post_delete, sender=ProblemCondition)
+@receiver(post_save, sender=ExerciseCondition)
+@receiver(post_delete, sender=ExerciseCondition)
+def answer_changed(sender, instance, **kwargs):
+    mark_stale([instance.student_id])
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def student_changed(sender, instance, **kwargs):
+    mark_stale([instance.pk])
+
+
+@receiver(m2m_changed, sender=Results)
+def change_result_links(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    mark_stale([instance.student_id])
+    if reverse and pk_set:
+        mark_stale(ExerciseCondition.objects.filter(pk__in=pk_set).values_list('student_id', flat=True))
+
+
+@receiver(m2m_changed, sender=People.classes.through)
+def change_classes(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        mark_stale([instance.pk])
+        return
+    ranking = _loaded()
+    if ranking is None:
+        return
+    # 清空以后pk_set是None，原来的成员从内存里找
+    ranking.mark_stale(ranking.students_with(1, instance.pk))
+    ranking.mark_stale(pk_set or ())
+
+
+@receiver(post_delete, sender=Class)
+def delete_class(sender, instance, **kwargs):
+    # 自动生成的中间表级联删除时不发信号
+    ranking = _loaded()
+    if ranking is not None:
+        ranking.mark_stale(ranking.students_with(1, instance.pk))
+
+
+@receiver(post_save, sender=Exercise)
+def update_exercise(sender, instance, created, raw, **kwargs):
+    # 学科可能变了
+    if created or raw:
+        return
+    ranking = _loaded()
+    if ranking is not None:
+        ranking.mark_stale(ranking.students_with(2, instance.pk))
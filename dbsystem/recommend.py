@@ -0,0 +1,344 @@
+# -*- coding: UTF-8 -*-
+
+# 下一题推荐
+# ProblemIndex常驻内存：标签 → 题目的倒排表，以及每道题的难度（所属标签Tag.difficulty的平均值）
+# 和正确率（ProblemStat）。每个标签的题目列表预先按“正确率离TARGET_ACCURACY多近、难度”排好序。
+# 推荐一个学生时：
+#   1. 从mastery的掌握程度矩阵取学生各标签的degree，>= MASTERED算已掌握，没有记录的算0
+#   2. 候选标签：没掌握、而且所有前序知识（taggraph的传递闭包）都已掌握
+#   3. 候选标签按 (难度, -degree, 拓扑序) 排，依次从每个标签里取学生没做过的题，每个标签最多per_tag道；
+#      题目的所有标签都要是已掌握或者候选的
+# 除了查一次学生做过的题以外全是内存操作。班级批量推荐共用一次查询。
+#
+# 索引增量维护：题目标签变化、标签难度变化只改受影响的题目和标签；
+# 题目完成情况保存后只记下题目，下次推荐前一次查询刷新这些题的正确率。
+# bulk_create/queryset.update不发信号，批量导入或者rebuild_stats以后调用invalidate()
+
+import itertools
+import threading
+from collections import namedtuple
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from dbsystem import mastery, refcache, taggraph
+from dbsystem.models_mysql import Book, People, Problem, ProblemCondition, ProblemStat, Tag
+
+
+MASTERED = 60
+
+TARGET_ACCURACY = 0.7
+
+# 没有人做过的题，当作正确率离目标这么远
+UNKNOWN_DISTANCE = 0.25
+
+BATCH_SIZE = 1000
+
+Recommendation = namedtuple('Recommendation', ('problem_id', 'tag_id', 'difficulty', 'accuracy'))
+
+
+class ProblemIndex(object):
+
+    def __init__(self, tags, links, stats):
+        # tags: (标签ID, 难度, 学科ID)；links: (题目ID, 标签ID)；stats: (题目ID, 完成次数, 正确次数)
+        self.tag_difficulty = {}
+        self.tag_subject = {}
+        for tag_id, difficulty, subject_id in tags:
+            self.tag_difficulty[tag_id] = difficulty
+            self.tag_subject[tag_id] = subject_id
+        self.problem_tags = {}
+        for problem_id, tag_id in links:
+            if tag_id in self.tag_difficulty:
+                self.problem_tags.setdefault(problem_id, []).append(tag_id)
+        self.accuracy = {problem_id: correct / count for problem_id, count, correct in stats
+                         if count and problem_id in self.problem_tags}
+        self.difficulty = {}
+        self.by_tag = {}
+        for problem_id, tag_ids in self.problem_tags.items():
+            self.difficulty[problem_id] = self._difficulty(tag_ids)
+            for tag_id in tag_ids:
+                self.by_tag.setdefault(tag_id, []).append(problem_id)
+        for problem_ids in self.by_tag.values():
+            problem_ids.sort(key=self._key)
+        # 正确率待刷新的题目
+        self.stale = set()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls):
+        through = Problem.tags.through
+        return cls(Tag.objects.values_list('pk', 'difficulty', 'book__subject_id').order_by(),
+                   through.objects.values_list('problem_id', 'tag_id').order_by(),
+                   ProblemStat.objects.values_list('problem_id', 'count', 'correct_count').order_by())
+
+    def _difficulty(self, tag_ids):
+        return sum(self.tag_difficulty[tag_id] for tag_id in tag_ids) / len(tag_ids)
+
+    def _key(self, problem_id):
+        accuracy = self.accuracy.get(problem_id)
+        distance = UNKNOWN_DISTANCE if accuracy is None else abs(accuracy - TARGET_ACCURACY)
+        return distance, self.difficulty[problem_id], problem_id
+
+    def _resort(self, tag_ids):
+        for tag_id in tag_ids:
+            if tag_id in self.by_tag:
+                self.by_tag[tag_id].sort(key=self._key)
+
+    def problems(self, tag_id):
+        with self.lock:
+            self.refresh_accuracy()
+            return list(self.by_tag.get(tag_id, ()))
+
+    # 增量维护
+
+    def set_problem_tags(self, problem_id, tag_ids):
+        with self.lock:
+            old = self.problem_tags.pop(problem_id, [])
+            for tag_id in old:
+                self.by_tag[tag_id].remove(problem_id)
+            tag_ids = [tag_id for tag_id in dict.fromkeys(tag_ids) if tag_id in self.tag_difficulty]
+            if not tag_ids:
+                self.difficulty.pop(problem_id, None)
+                self.accuracy.pop(problem_id, None)
+                return
+            self.problem_tags[problem_id] = tag_ids
+            self.difficulty[problem_id] = self._difficulty(tag_ids)
+            for tag_id in tag_ids:
+                self.by_tag.setdefault(tag_id, []).append(problem_id)
+            # 难度变了，原来的标签里也要重新排
+            self._resort(set(old) | set(tag_ids))
+
+    def reload_problems(self, problem_ids):
+        problem_ids = list(problem_ids)
+        links = {problem_id: [] for problem_id in problem_ids}
+        through = Problem.tags.through
+        for i in range(0, len(problem_ids), BATCH_SIZE):
+            for problem_id, tag_id in through.objects.filter(
+                    problem_id__in=problem_ids[i:i + BATCH_SIZE]).values_list('problem_id', 'tag_id'):
+                links[problem_id].append(tag_id)
+        with self.lock:
+            self.stale.update(problem_ids)
+            for problem_id, tag_ids in links.items():
+                self.set_problem_tags(problem_id, tag_ids)
+
+    def set_tag(self, tag_id, difficulty, subject_id):
+        with self.lock:
+            changed = self.tag_difficulty.get(tag_id) != difficulty
+            self.tag_difficulty[tag_id] = difficulty
+            self.tag_subject[tag_id] = subject_id
+            if not changed:
+                return
+            affected = set()
+            for problem_id in self.by_tag.get(tag_id, ()):
+                tag_ids = self.problem_tags[problem_id]
+                self.difficulty[problem_id] = self._difficulty(tag_ids)
+                affected.update(tag_ids)
+            self._resort(affected)
+
+    def remove_tag(self, tag_id):
+        with self.lock:
+            for problem_id in list(self.by_tag.get(tag_id, ())):
+                self.set_problem_tags(problem_id, [t for t in self.problem_tags[problem_id] if t != tag_id])
+            self.by_tag.pop(tag_id, None)
+            self.tag_difficulty.pop(tag_id, None)
+            self.tag_subject.pop(tag_id, None)
+
+    def remove_problem(self, problem_id):
+        with self.lock:
+            self.set_problem_tags(problem_id, [])
+            self.stale.discard(problem_id)
+
+    def mark_stale(self, problem_ids):
+        with self.lock:
+            self.stale.update(problem_id for problem_id in problem_ids if problem_id in self.problem_tags)
+
+    def refresh_accuracy(self):
+        with self.lock:
+            if not self.stale:
+                return
+            stale = list(self.stale)
+            self.stale.clear()
+            found = {}
+            for i in range(0, len(stale), BATCH_SIZE):
+                for problem_id, count, correct in ProblemStat.objects.filter(
+                        problem_id__in=stale[i:i + BATCH_SIZE]).values_list('problem_id', 'count', 'correct_count'):
+                    found[problem_id] = count, correct
+            affected = set()
+            for problem_id in stale:
+                if problem_id not in self.problem_tags:
+                    continue
+                count, correct = found.get(problem_id, (0, 0))
+                if count:
+                    self.accuracy[problem_id] = correct / count
+                else:
+                    self.accuracy.pop(problem_id, None)
+                affected.update(self.problem_tags[problem_id])
+            self._resort(affected)
+
+    # 推荐
+
+    def candidate_tags(self, graph, degrees, subject_id=None):
+        # degrees: {标签ID: 掌握程度}；返回 (候选标签列表, 已掌握或者可以学的标签集合)
+        mastered = graph.mask(tag_id for tag_id, degree in degrees.items() if degree >= MASTERED)
+        candidates = []
+        unlocked = set()
+        for tag_id in self.by_tag:
+            i = graph.index.get(tag_id)
+            if i is None or graph.up[i] & ~mastered:
+                continue
+            unlocked.add(tag_id)
+            if mastered >> i & 1:
+                continue
+            if subject_id is not None and self.tag_subject.get(tag_id) != subject_id:
+                continue
+            candidates.append(tag_id)
+        candidates.sort(key=lambda tag_id: (self.tag_difficulty[tag_id], -degrees.get(tag_id, 0),
+                                            graph.rank[graph.index[tag_id]]))
+        return candidates, unlocked
+
+    def recommend(self, graph, degrees, done, k=10, per_tag=2, subject_id=None):
+        with self.lock:
+            self.refresh_accuracy()
+            result = []
+            chosen = set()
+            candidates, unlocked = self.candidate_tags(graph, degrees, subject_id)
+            for tag_id in candidates:
+                taken = 0
+                for problem_id in self.by_tag[tag_id]:
+                    if problem_id in done or problem_id in chosen:
+                        continue
+                    # 题目的其他标签还有没学到的前序知识
+                    if any(other not in unlocked for other in self.problem_tags[problem_id]):
+                        continue
+                    result.append(Recommendation(problem_id, tag_id, self.difficulty[problem_id],
+                                                 self.accuracy.get(problem_id)))
+                    chosen.add(problem_id)
+                    taken += 1
+                    if len(result) >= k:
+                        return result
+                    if taken >= per_tag:
+                        break
+            return result
+
+
+_index = None
+_lock = threading.Lock()
+# 和taggraph一样，每次作废换一个新值
+_generations = itertools.count(1)
+_generation = 0
+# 索引还没放进缓存时完成情况有变化的题目，不用为它们作废整个索引
+_pending = set()
+
+
+def get_index():
+    global _index
+    index = _index
+    if index is None:
+        with _lock:
+            index = _index
+            if index is None:
+                generation = _generation
+                index = ProblemIndex.load()
+                # 加载期间被作废过（或者有增量修改没能记进去），这次的结果不放进缓存
+                if generation == _generation:
+                    _index = index
+                    _drain_pending(index)
+    return index
+
+
+def _drain_pending(index):
+    # 加载期间保存的题目完成情况，加载时可能已经读到了，也可能没有，都再刷新一次正确率
+    global _pending
+    pending, _pending = _pending, set()
+    if pending:
+        index.mark_stale(pending)
+
+
+def invalidate():
+    global _index, _generation
+    _generation = next(_generations)
+    _index = None
+
+
+def _loaded():
+    # 信号处理用：索引还没加载时可能正在加载，修改记不进去，让那次加载的结果作废
+    index = _index
+    if index is None:
+        invalidate()
+    return index
+
+
+def _degrees(matrix, student_id):
+    tag_ids, degrees = matrix.row(student_id)
+    return dict(zip(tag_ids.tolist(), degrees.tolist()))
+
+
+def recommend(student_id, k=10, per_tag=2, subject_id=None):
+    done = set(ProblemCondition.objects.filter(student_id=student_id).values_list('problem_id', flat=True))
+    return get_index().recommend(taggraph.get_graph(), _degrees(mastery.get_matrix(), student_id), done,
+                                 k=k, per_tag=per_tag, subject_id=subject_id)
+
+
+def recommend_class(class_id, k=10, per_tag=2, subject_id=None):
+    # 整个班级一起推荐，返回 {学生ID: [Recommendation]}
+    student_ids = list(People.classes.through.objects.filter(class_id=class_id, people__student__isnull=False)
+                       .values_list('people_id', flat=True))
+    done = {student_id: set() for student_id in student_ids}
+    for i in range(0, len(student_ids), BATCH_SIZE):
+        for student_id, problem_id in ProblemCondition.objects.filter(
+                student_id__in=student_ids[i:i + BATCH_SIZE]).values_list('student_id', 'problem_id'):
+            done[student_id].add(problem_id)
+    index, graph, matrix = get_index(), taggraph.get_graph(), mastery.get_matrix()
+    return {student_id: index.recommend(graph, _degrees(matrix, student_id), done[student_id],
+                                        k=k, per_tag=per_tag, subject_id=subject_id)
+            for student_id in student_ids}
+
+
+@receiver(m2m_changed, sender=Problem.tags.through)
+def change_problem_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    index = _loaded()
+    if index is None or action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:
+        if action != 'pre_clear':
+            index.reload_problems([instance.pk])
+    elif action == 'pre_clear':
+        # 清空以后就不知道原来有哪些题了，先记下来
+        instance._recommend_problems = list(index.by_tag.get(instance.pk, ()))
+    elif action == 'post_clear':
+        index.reload_problems(getattr(instance, '_recommend_problems', ()))
+    else:
+        index.reload_problems(pk_set)
+
+
+@receiver(post_save, sender=Tag)
+def update_tag(sender, instance, raw, **kwargs):
+    index = _loaded()
+    if index is not None and not raw:
+        index.set_tag(instance.pk, instance.difficulty, refcache.get(Book, instance.book_id).subject_id)
+
+
+@receiver(post_delete, sender=Tag)
+def delete_tag(sender, instance, **kwargs):
+    index = _loaded()
+    if index is not None:
+        index.remove_tag(instance.pk)
+
+
+@receiver(post_delete, sender=Problem)
+def delete_problem(sender, instance, **kwargs):
+    index = _loaded()
+    if index is not None:
+        index.remove_problem(instance.pk)
+
+
+@receiver(post_save, sender=ProblemCondition)
+@receiver(post_delete, sender=ProblemCondition)
+def answer_changed(sender, instance, **kwargs):
+    index = _index
+    if index is None:
+        _pending.add(instance.problem_id)
+        # 加进去的时候索引可能刚放进缓存，已经错过了这一次drain
+        index = _index
+    if index is not None:
+        index.mark_stale([instance.problem_id])
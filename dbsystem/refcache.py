@@ -0,0 +1,206 @@
+# -*- coding: UTF-8 -*-
+
+# 很少变化的引用数据（学科、书目、章节、标签、学校、班级）的读穿透缓存
+# 每个模型一个进程内LRU，条目有过期时间（REF_CACHE_TTL秒）；配置了REF_CACHE_BACKEND时，
+# 进程内没有的再查Django的共享缓存（settings.CACHES里的别名），最后才查数据库，查到的两级都写入。
+#   get(Chapter, 3)              一个对象，不存在时返回None
+#   get_many(Tag, [1, 2, 3])     {主键: 对象}，没缓存的合成一次in_bulk
+# 章节/标签缓存时一起带上书目（select_related），str(chapter)不再查询。
+# 保存/删除（以及多对多变化）时通过信号作废本进程和共享缓存里的条目，事务提交后再作废一次；
+# 其他进程的进程内缓存只能等过期，所以TTL不要设得太长。
+# 缓存里的对象是共享的，不要修改后保存。stats()返回各模型的命中/未命中次数，/dbstats/ 里也有
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from dbsystem.models_mysql import Book, Chapter, Class, School, Subject, Tag
+
+
+class RefCache(object):
+
+    def __init__(self, model, related=(), dependents=()):
+        self.model = model
+        self.related = related
+        # (模型, 外键名)：这些模型的缓存对象里带着本模型的对象，本模型变化时一起作废
+        self.dependents = dependents
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = dict.fromkeys(('hits', 'shared_hits', 'misses', 'evictions', 'invalidations'), 0)
+
+    @property
+    def maxsize(self):
+        return getattr(settings, 'REF_CACHE_SIZE', 10000)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'REF_CACHE_TTL', 300)
+
+    @property
+    def backend(self):
+        alias = getattr(settings, 'REF_CACHE_BACKEND', None)
+        return caches[alias] if alias else None
+
+    def key(self, pk):
+        return 'refcache:%s:%s' % (self.model._meta.label_lower, pk)
+
+    def _local(self, pks):
+        found = {}
+        now = time.monotonic()
+        with self.lock:
+            for pk in pks:
+                entry = self.entries.get(pk)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[pk]
+                    continue
+                self.entries.move_to_end(pk)
+                found[pk] = entry[1]
+            self.counters['hits'] += len(found)
+        return found
+
+    def _store(self, objs):
+        expires = time.monotonic() + self.ttl
+        maxsize = self.maxsize
+        with self.lock:
+            for pk, obj in objs.items():
+                self.entries[pk] = (expires, obj)
+                self.entries.move_to_end(pk)
+            while len(self.entries) > maxsize:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def get_many(self, pks):
+        pks = list(dict.fromkeys(pks))
+        found = self._local(pks)
+        missing = [pk for pk in pks if pk not in found]
+        if not missing:
+            return found
+        backend = self.backend
+        if backend is not None:
+            keys = {self.key(pk): pk for pk in missing}
+            shared = {keys[key]: obj for key, obj in backend.get_many(list(keys)).items()}
+            with self.lock:
+                self.counters['shared_hits'] += len(shared)
+            self._store(shared)
+            found.update(shared)
+            missing = [pk for pk in missing if pk not in shared]
+        if missing:
+            with self.lock:
+                self.counters['misses'] += len(missing)
+            queryset = self.model.objects.all()
+            if self.related:
+                queryset = queryset.select_related(*self.related)
+            loaded = queryset.in_bulk(missing)
+            self._store(loaded)
+            if backend is not None and loaded:
+                backend.set_many({self.key(pk): obj for pk, obj in loaded.items()}, self.ttl)
+            found.update(loaded)
+        return found
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    def invalidate(self, pks=None):
+        # pks为None时清空本进程的全部条目，共享缓存里的只能等过期
+        with self.lock:
+            if pks is None:
+                self.entries.clear()
+            else:
+                for pk in pks:
+                    self.entries.pop(pk, None)
+            self.counters['invalidations'] += 1
+        backend = self.backend
+        if backend is not None and pks:
+            backend.delete_many([self.key(pk) for pk in pks])
+
+    def reset_counters(self):
+        with self.lock:
+            for name in self.counters:
+                self.counters[name] = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, size=len(self.entries))
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['shared_hits']) / lookups if lookups else None
+        return stats
+
+
+REGISTRY = {
+    Subject: RefCache(Subject),
+    Book: RefCache(Book, dependents=((Chapter, 'book'), (Tag, 'book'))),
+    Chapter: RefCache(Chapter, related=('book',), dependents=((Tag, 'chapter'),)),
+    Tag: RefCache(Tag, related=('book', 'chapter')),
+    School: RefCache(School),
+    Class: RefCache(Class),
+}
+
+
+def get(model, pk):
+    return REGISTRY[model].get(pk)
+
+
+def get_many(model, pks):
+    return REGISTRY[model].get_many(pks)
+
+
+def invalidate(model=None, pks=None):
+    for cache in REGISTRY.values() if model is None else (REGISTRY[model],):
+        cache.invalidate(pks)
+
+
+def stats():
+    return {model.__name__: cache.stats() for model, cache in REGISTRY.items()}
+
+
+def reset_counters():
+    for cache in REGISTRY.values():
+        cache.reset_counters()
+
+
+def _changed(model, pks):
+    cache = REGISTRY[model]
+
+    def drop():
+        cache.invalidate(pks)
+        for dependent, field in cache.dependents:
+            REGISTRY[dependent].invalidate(list(dependent.objects.filter(**{field + '__in': pks})
+                                                .values_list('pk', flat=True)))
+    drop()
+    # 事务提交前其他线程可能又把旧值读进了缓存
+    transaction.on_commit(drop)
+
+
+def _saved(sender, instance, raw, **kwargs):
+    _changed(sender, [instance.pk])
+
+
+def _deleted(sender, instance, **kwargs):
+    _changed(sender, [instance.pk])
+
+
+def _m2m(model):
+    def changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if not action.startswith('post_'):
+            return
+        if not reverse:
+            _changed(model, [instance.pk])
+        elif pk_set:
+            _changed(model, list(pk_set))
+        else:
+            invalidate(model)
+    return changed
+
+
+for _model in REGISTRY:
+    post_save.connect(_saved, sender=_model, weak=False)
+    post_delete.connect(_deleted, sender=_model, weak=False)
+    for _field in _model._meta.many_to_many:
+        m2m_changed.connect(_m2m(_model), sender=_field.remote_field.through, weak=False)
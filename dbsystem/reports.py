@@ -0,0 +1,263 @@
+# -*- coding: UTF-8 -*-
+
+# 后台报表任务
+# 全部练习的学生题目情况这类大报表在请求里生成会超时，改成提交任务：
+#   enqueue() 写一条ReportJob（排队中）并返回，页面轮询 /reports/<id>/ 查看进度，完成后从 /reports/<id>/download/ 下载；
+#   manage.py report_worker 常驻运行，用进程池执行排队的任务，每写CHUNK_SIZE行更新一次进度。
+# 结果文件放在REPORT_DIR，文件名是cache_key：报表类型、参数和数据版本的SHA-256。
+# CSV用gzip压缩存放，浏览器支持gzip时原样返回；XLSX本身就是压缩过的。
+# 数据版本 = DataVersion里的计数 + 答题表的最大主键：
+#   通过ORM写入/删除答题、改学生/题目/练习名字时由信号在事务提交以后加一，
+#   批量追加（bulk_create）不发信号，但会改变最大主键；批量修改/删除（批改、归档、重建统计）以后调用bump()。
+# 数据没变时同样的请求直接返回已有的结果；数据变了以后cache_key跟着变，重新生成，旧文件在新结果完成时删除。
+
+import gzip
+import hashlib
+import json
+import os
+import time
+import traceback
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import F, Max
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from dbsystem.export import CHUNK_SIZE, problem_rows, stream_csv, stream_xlsx
+from dbsystem.models_mysql import DataVersion, Exercise, ExerciseCondition, Problem, ProblemCondition, ReportJob, \
+    Student
+
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+ANSWERS = 'answers'
+
+FORMATS = {
+    'csv': ('.csv.gz', 'text/csv; charset=utf-8', stream_csv),
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', stream_xlsx),
+}
+
+Results = ExerciseCondition.results.through
+
+
+def _students2problem(params):
+    # 返回 (行的迭代器, 总行数)
+    exercise_id = params.get('exercise')
+    links = Results.objects.all()
+    if exercise_id is not None:
+        links = links.filter(exercisecondition__exercise_id=exercise_id)
+    return problem_rows(exercise_id), links.count()
+
+
+# 报表类型 → (生成函数, 下载文件名)
+KINDS = {
+    'students2problem': (_students2problem, 'students2problem'),
+}
+
+
+def bump(name=ANSWERS):
+    updated = DataVersion.objects.filter(pk=name).update(version=F('version') + 1)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            DataVersion.objects.create(pk=name, version=1)
+    except IntegrityError:
+        bump(name)
+
+
+def bump_on_commit():
+    # 信号里用：提交以后再加一，不在写入方的事务里持有DataVersion的行锁；同一个事务只加一次
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.in_atomic_block and any(func is bump for _, func in connection.run_on_commit):
+        return
+    transaction.on_commit(bump)
+
+
+def data_version():
+    version = DataVersion.objects.filter(pk=ANSWERS).values_list('version', flat=True).first() or 0
+    last_condition = ProblemCondition.objects.aggregate(last=Max('pk'))['last'] or 0
+    last_link = Results.objects.aggregate(last=Max('pk'))['last'] or 0
+    return '%d.%d.%d' % (version, last_condition, last_link)
+
+
+def canonical(params):
+    return json.dumps(params, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def cache_key(kind, params, version):
+    return hashlib.sha256(('%s\n%s\n%s' % (kind, canonical(params), version)).encode('utf-8')).hexdigest()
+
+
+def result_path(job):
+    fmt = json.loads(job.params)['format']
+    return os.path.join(settings.REPORT_DIR, job.cache_key + FORMATS[fmt][0])
+
+
+def filename(job):
+    fmt = json.loads(job.params)['format']
+    return '%s.%s' % (KINDS[job.kind][1], fmt)
+
+
+def enqueue(kind, params):
+    # params里必须有format；数据没变时返回已有的任务（完成的、排队或者运行中的），否则新建一个
+    if kind not in KINDS:
+        raise ValueError('kind should be one of %s' % ', '.join(KINDS))
+    if params.get('format') not in FORMATS:
+        raise ValueError('format should be one of %s' % ', '.join(FORMATS))
+    key = cache_key(kind, params, data_version())
+    job = ReportJob.objects.filter(cache_key=key).exclude(status=FAILED).order_by('-pk').first()
+    if job is not None and (job.status != DONE or os.path.exists(result_path(job))):
+        return job
+    return ReportJob.objects.create(kind=kind, params=canonical(params), cache_key=key)
+
+
+def _progress(rows, job_id):
+    count = 0
+    for count, row in enumerate(rows, 1):
+        yield row
+        if count % CHUNK_SIZE == 0:
+            ReportJob.objects.filter(pk=job_id).update(progress=count)
+
+
+def _write(path, chunks, compress):
+    # 先写临时文件再改名，下载的人不会读到写了一半的文件
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        # mtime固定，同样的内容压缩出来的文件也一样
+        with (gzip.GzipFile(temp, 'wb', mtime=0) if compress else open(temp, 'wb')) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return os.path.getsize(path)
+
+
+def run(job_id):
+    # 在工作进程里执行一个已经认领（运行中）的任务
+    job = ReportJob.objects.get(pk=job_id)
+    try:
+        params = json.loads(job.params)
+        rows, total = KINDS[job.kind][0](params)
+        ReportJob.objects.filter(pk=job_id).update(total=total)
+        os.makedirs(settings.REPORT_DIR, exist_ok=True)
+        path = result_path(job)
+        fmt = params['format']
+        size = _write(path, FORMATS[fmt][2](_progress(rows, job_id)), fmt == 'csv')
+    except Exception:
+        ReportJob.objects.filter(pk=job_id).update(status=FAILED, error=traceback.format_exc(),
+                                                   finished_at=timezone.now())
+        return FAILED
+    ReportJob.objects.filter(pk=job_id).update(status=DONE, progress=total, size=size, finished_at=timezone.now())
+    # 同样参数、比这个任务早提交的结果已经过期；更新的任务可能先做完了，不能删
+    outdated = ReportJob.objects.filter(kind=job.kind, params=job.params, status=DONE, pk__lt=job.pk).exclude(
+        cache_key=job.cache_key)
+    for old in outdated:
+        if os.path.exists(result_path(old)):
+            os.remove(result_path(old))
+        old.delete()
+    return DONE
+
+
+def claim(job_id):
+    # 多个worker同时认领同一个任务时只有一个能改成运行中
+    return ReportJob.objects.filter(pk=job_id, status=QUEUED).update(status=RUNNING, started_at=timezone.now()) == 1
+
+
+def work(workers=None, poll=None, once=False, log=None):
+    # workers为0时在当前进程里执行；once为True时做完排队的任务就返回。返回执行的任务数
+    log = log or (lambda message: None)
+    workers = settings.REPORT_WORKERS if workers is None else workers
+    poll = settings.REPORT_POLL_SECONDS if poll is None else poll
+    # 上次worker退出时没做完的任务重新排队（同一时间只运行一个report_worker）
+    requeued = ReportJob.objects.filter(status=RUNNING).update(status=QUEUED, progress=0)
+    if requeued:
+        log('requeued %d unfinished jobs' % requeued)
+    pool = None
+    if workers:
+        # 子进程不能共用父进程的数据库连接
+        connections.close_all()
+        pool = Pool(workers)
+    running = {}
+    finished = 0
+    try:
+        while True:
+            for job_id, result in list(running.items()):
+                if result.ready():
+                    log('job %d: %s' % (job_id, result.get()))
+                    del running[job_id]
+                    finished += 1
+            free = max(workers, 1) - len(running)
+            claimed = 0
+            if free > 0:
+                queued = ReportJob.objects.filter(status=QUEUED).order_by('pk').values_list('pk', flat=True)
+                for job_id in queued[:free]:
+                    if not claim(job_id):
+                        continue
+                    claimed += 1
+                    if pool is None:
+                        log('job %d: %s' % (job_id, run(job_id)))
+                        finished += 1
+                    else:
+                        running[job_id] = pool.apply_async(run, (job_id,))
+            if once and not claimed and not running:
+                break
+            if not claimed:
+                time.sleep(min(poll, 0.1) if once else poll)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return finished
+
+
+def read(path, decompress=False, chunk_size=64 * 1024):
+    # 客户端不支持gzip时边解压边返回
+    with (gzip.open(path, 'rb') if decompress else open(path, 'rb')) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def describe(job):
+    return {
+        'job': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'size': job.size,
+        'url': '/reports/%d/' % job.pk,
+        'download': '/reports/%d/download/' % job.pk if job.status == DONE else None,
+        'error': job.error or None,
+    }
+
+
+@receiver(post_save, sender=ProblemCondition)
+@receiver(post_delete, sender=ProblemCondition)
+@receiver(post_save, sender=ExerciseCondition)
+@receiver(post_delete, sender=ExerciseCondition)
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+@receiver(post_save, sender=Problem)
+@receiver(post_delete, sender=Problem)
+@receiver(post_save, sender=Exercise)
+@receiver(post_delete, sender=Exercise)
+def data_changed(sender, raw=False, **kwargs):
+    if not raw:
+        bump_on_commit()
+
+
+@receiver(m2m_changed, sender=Results)
+def change_result_links(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_on_commit()
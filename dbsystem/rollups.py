@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+
+# 按天/按周的答题汇总（AnswerRollup）和历史答题记录归档
+#
+# 汇总键是 (周期, 班级, 学科, 题目, 周期开始日期)，日期按ExerciseCondition.finish_time在当前时区取。
+# refresh() 只看上次之后新增的答题关联（ExerciseCondition.results中间表按主键的水位），
+# 包括接在已有ExerciseCondition后面的答题（在线提交、批改），找出它们落在哪些天，
+# 把这些天所在的日/周汇总整段重算（删除后按GROUP BY重新写入），补录的旧数据也能算进去。
+# 修改或删除已有记录后用 rebuild_range() 重算对应日期。
+# SQL里题目和标签没有关联（标签在Mongo的Problem.tags上），所以这里按题目汇总。
+#
+# archive() 把finish_time早于界限的ExerciseCondition和它们的题目完成情况按月追加到gzip压缩的CSV，
+# 然后从热表删除。归档前先刷新汇总，界限按周对齐，归档过的日期以后不再重算。
+# 删除不发信号，ProblemStat/ExerciseStat保留包括归档部分在内的累计值，已经生成的报表在归档后过期。
+
+import csv
+import gzip
+import os
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, Max, Sum, When
+from django.db.models.functions import TruncDate, TruncWeek
+from django.db.models.fields import DateField
+from django.utils import timezone
+
+from dbsystem import reports
+from dbsystem.aggregates import correct_q
+from dbsystem.bulk import BATCH_SIZE
+from dbsystem.models_mysql import AnswerRollup, ExerciseCondition, ProblemCondition, RollupState, Submission
+
+
+Results = ExerciseCondition.results.through
+
+PERIODS = {
+    'day': timedelta(days=1),
+    'week': timedelta(days=7),
+}
+
+ARCHIVE_FIELDS = ('exercise_condition', 'exercise', 'student', 'finish_time', 'problem_condition', 'problem',
+                  'result', 'judge', 'points', 'cost')
+
+
+def _state():
+    # 这一行由迁移0012建立；被手工删掉时才在这里补建
+    try:
+        return RollupState.objects.get(pk=1)
+    except RollupState.DoesNotExist:
+        state, _ = RollupState.objects.get_or_create(pk=1)
+        return state
+
+
+def bucket_of(period, day):
+    return day - timedelta(days=day.weekday()) if period == 'week' else day
+
+
+def _start(day):
+    return timezone.make_aware(datetime.combine(day, time.min)) if settings.USE_TZ else datetime.combine(day, time.min)
+
+
+def _runs(period, buckets):
+    # 连续的周期合成一段，每段一次GROUP BY
+    step = PERIODS[period]
+    runs = []
+    for bucket in sorted(buckets):
+        if runs and runs[-1][1] + step == bucket:
+            runs[-1][1] = bucket
+        else:
+            runs.append([bucket, bucket])
+    return runs
+
+
+def _aggregate(period, first, last):
+    finish_time = 'exercisecondition__finish_time'
+    trunc = TruncWeek(finish_time, output_field=DateField()) if period == 'week' else TruncDate(finish_time)
+    links = Results.objects.filter(**{
+        finish_time + '__gte': _start(first),
+        finish_time + '__lt': _start(last + PERIODS[period]),
+        'exercisecondition__student__classes__isnull': False,
+    })
+    rows = links.annotate(bucket=trunc).values(
+        'bucket', 'exercisecondition__student__classes', 'exercisecondition__exercise__subject_id',
+        'problemcondition__problem_id',
+    ).annotate(
+        total=Count('pk'),
+        correct=Sum(Case(When(correct_q('problemcondition__'), then=1), default=0, output_field=IntegerField())),
+        points=Sum('problemcondition__points'),
+        cost=Sum('problemcondition__cost'),
+    ).order_by()
+    for row in rows:
+        yield AnswerRollup(
+            period=period, bucket=row['bucket'], group_id=row['exercisecondition__student__classes'],
+            subject_id=row['exercisecondition__exercise__subject_id'],
+            problem_id=row['problemcondition__problem_id'], count=row['total'], correct_count=row['correct'] or 0,
+            points_sum=row['points'] or 0.0, cost_sum=row['cost'] or 0,
+        )
+
+
+def _rebuild_days(days, archived_before):
+    if archived_before is not None:
+        days = {day for day in days if day >= archived_before}
+    written = 0
+    for period in PERIODS:
+        for first, last in _runs(period, {bucket_of(period, day) for day in days}):
+            with transaction.atomic():
+                AnswerRollup.objects.filter(period=period, bucket__gte=first, bucket__lte=last).delete()
+                rows = list(_aggregate(period, first, last))
+                AnswerRollup.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+            written += len(rows)
+    return written
+
+
+def refresh():
+    state = _state()
+    new = Results.objects.filter(pk__gt=state.last_result)
+    last = new.aggregate(last=Max('pk'))['last']
+    if last is None:
+        return 0
+    days = set(new.filter(pk__lte=last).annotate(day=TruncDate('exercisecondition__finish_time'))
+               .values_list('day', flat=True).distinct().order_by())
+    written = _rebuild_days(days, state.archived_before)
+    RollupState.objects.filter(pk=state.pk).update(last_result=last)
+    return written
+
+
+def rebuild_range(first, last):
+    # 重算 [first, last] 这些天所在的日/周汇总
+    days = {first + timedelta(days=i) for i in range((last - first).days + 1)}
+    return _rebuild_days(days, _state().archived_before)
+
+
+def rebuild():
+    state = _state()
+    # 已归档日期的汇总没有明细可以重算，保留
+    stale = AnswerRollup.objects.all()
+    if state.archived_before is not None:
+        stale = stale.filter(bucket__gte=state.archived_before)
+    stale.delete()
+    bounds = Results.objects.aggregate(last=Max('pk'))
+    days = set(ExerciseCondition.objects.annotate(day=TruncDate('finish_time'))
+               .values_list('day', flat=True).distinct().order_by())
+    written = _rebuild_days(days, state.archived_before)
+    RollupState.objects.filter(pk=state.pk).update(last_result=bounds['last'] or 0)
+    return written
+
+
+def trend(group_id, subject_id=None, problem_id=None, period='week', first=None, last=None):
+    # 一个班级按周期的正确率走势，只读汇总表
+    queryset = AnswerRollup.objects.filter(period=period, group_id=group_id)
+    if subject_id is not None:
+        queryset = queryset.filter(subject_id=subject_id)
+    if problem_id is not None:
+        queryset = queryset.filter(problem_id=problem_id)
+    if first is not None:
+        queryset = queryset.filter(bucket__gte=bucket_of(period, first))
+    if last is not None:
+        queryset = queryset.filter(bucket__lte=last)
+    rows = list(queryset.values('bucket').annotate(
+        count=Sum('count'), correct_count=Sum('correct_count'), points_sum=Sum('points_sum'),
+        cost_sum=Sum('cost_sum'),
+    ).order_by('bucket'))
+    for row in rows:
+        row['accuracy'] = row['correct_count'] / row['count'] if row['count'] else None
+    return rows
+
+
+def _append(directory, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(timezone.localtime(row[3]).strftime('%Y-%m') if settings.USE_TZ
+                            else row[3].strftime('%Y-%m'), []).append(row)
+    for month, month_rows in sorted(by_month.items()):
+        path = os.path.join(directory, 'answers-%s.csv.gz' % month)
+        exists = os.path.exists(path)
+        # 每次追加一个gzip成员，gzip.open读取时会自动拼接
+        with gzip.open(path, 'at', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if not exists:
+                writer.writerow(ARCHIVE_FIELDS)
+            writer.writerows([row[:3] + (row[3].isoformat(),) + row[4:] for row in month_rows])
+
+
+def archive(before, directory=None, log=None):
+    log = log or (lambda message: None)
+    directory = directory or settings.ANSWER_ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    before = bucket_of('week', before)
+    refresh()
+    state = _state()
+    if state.archived_before is None or state.archived_before < before:
+        RollupState.objects.filter(pk=state.pk).update(archived_before=before)
+    cutoff = _start(before)
+    archived = 0
+    while True:
+        conditions = list(ExerciseCondition.objects.filter(finish_time__lt=cutoff).order_by('pk')
+                          .values_list('pk', flat=True)[:BATCH_SIZE])
+        if not conditions:
+            break
+        links = Results.objects.filter(exercisecondition_id__in=conditions)
+        rows = list(links.order_by('pk').values_list(
+            'exercisecondition_id', 'exercisecondition__exercise_id', 'exercisecondition__student_id',
+            'exercisecondition__finish_time', 'problemcondition_id', 'problemcondition__problem_id',
+            'problemcondition__result', 'problemcondition__judge', 'problemcondition__points',
+            'problemcondition__cost'))
+        # 先写文件再删除；中途失败重跑时文件里可能有重复行，按problem_condition去重即可
+        _append(directory, rows)
+        with transaction.atomic():
+            problem_conditions = {row[4] for row in rows}
+            # 不走Django的级联删除：不发信号，也不逐行查询关联
+            links._raw_delete(links.db)
+            shared = set(Results.objects.filter(problemcondition_id__in=problem_conditions)
+                         .values_list('problemcondition_id', flat=True))
+            # 批改前的原始作答和结果一起删除
+            submissions = Submission.objects.filter(problem_condition_id__in=problem_conditions - shared)
+            submissions._raw_delete(submissions.db)
+            orphans = ProblemCondition.objects.filter(pk__in=problem_conditions - shared)
+            orphans._raw_delete(orphans.db)
+            done = ExerciseCondition.objects.filter(pk__in=conditions)
+            done._raw_delete(done.db)
+        archived += len(rows)
+        log('archived %d answers' % archived)
+    if archived:
+        reports.bump()
+    return archived
+
+
+def read_archive(path):
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        yield from csv.DictReader(f)
@@ -0,0 +1,331 @@
+# -*- coding: UTF-8 -*-
+
+# 题目全文检索：题目名字、描述、公式，以及题目标签的名字和描述
+# 倒排索引放在单独的SQLite文件里（settings.SEARCH_INDEX_PATH），用FTS5：
+#   - 中文等CJK文字按二元组切分（“单调递增” → 单调 调递 递增 增），每段最后一个字单独再记一次，
+#     查询时两个字以上按相邻的二元组做短语匹配，单个字用前缀匹配；字母数字按词切分，转小写
+#   - 公式（formula，以及描述里 $...$、\(...\) 包住的部分）按LaTeX切分：命令（\frac）、单个字母的变量、数字、
+#     运算符（^ _ = + - ...）各是一个词，括号不算，所以 x^2 和 x^{2} 一样
+#   - 书目/章节/标签ID写成 b12 c34 t56 放在facets列，过滤就是再和这些词取交集，不用回主库
+# 分词在Python里完成，FTS5只按空格切开（tokenchars让运算符也能成为词）。排序用bm25，名字和公式的权重高于描述。
+#
+# rebuild()从主库全量重建；题目保存/删除、题目标签变化、标签修改/删除时通过信号增量更新。
+# 索引记录了从哪个数据库建的，只有当前数据库建好的索引才会增量更新，测试库和没建索引的环境里信号什么都不做。
+# 索引文件不在主库的事务里，信号只记下要更新哪些题，事务提交以后再写索引，回滚的修改不会进索引；
+# bulk_create/queryset.update不发信号，批量导入以后用reindex()或者重建（manage.py rebuild_search）
+
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from dbsystem.bulk import BATCH_SIZE
+from dbsystem.models_mysql import Problem, Tag
+
+
+DEFAULT_LIMIT = 20
+
+MAX_LIMIT = 100
+
+CHUNK_SIZE = 5000
+
+# bm25的列权重：name, description, formula, tags, facets
+WEIGHTS = (4.0, 1.0, 2.0, 2.0, 0.0)
+
+SCHEMA = (
+    "CREATE VIRTUAL TABLE problem_fts USING fts5(name, description, formula, tags, facets, "
+    "tokenize = \"unicode61 remove_diacritics 0 tokenchars '\\^_=+-*/<>|!.'\")",
+    "INSERT INTO problem_fts (problem_fts, rank) VALUES ('rank', 'bm25(%s)')" % ', '.join(map(str, WEIGHTS)),
+    'CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT)',
+)
+
+INSERT = 'INSERT INTO problem_fts (rowid, name, description, formula, tags, facets) VALUES (?, ?, ?, ?, ?, ?)'
+
+Hit = namedtuple('Hit', ('problem_id', 'score'))
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+
+# (CJK段, 字母数字词)
+_TEXT = re.compile(r'([%s]+)|((?:(?![%s])[^\W_])+)' % (_CJK, _CJK))
+
+_MATH = re.compile(r'\$\$(.+?)\$\$|\$(.+?)\$|\\\((.+?)\\\)|\\\[(.+?)\\\]', re.S)
+
+# (命令, 变量, 数字, 运算符, CJK段)，\, \{ 这类转义符号不算词
+_LATEX = re.compile(r'(\\[a-zA-Z]+)|\\.|([a-zA-Z])|(\d+(?:\.\d+)?)|([=+\-*/<>^_|!])|([%s]+)' % _CJK)
+
+# 只影响排版的命令
+_LAYOUT = {'\\left', '\\right', '\\big', '\\Big', '\\displaystyle', '\\text', '\\mathrm', '\\quad', '\\qquad',
+           '\\limits'}
+
+# 查询里带这些字符的项按公式切分
+_LATEX_HINT = re.compile(r'[\\^_{}=<>]')
+
+
+def _bigrams(run):
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def _plain_tokens(text):
+    tokens = []
+    for cjk, word in _TEXT.findall(text):
+        if cjk:
+            tokens += _bigrams(cjk)
+            tokens.append(cjk[-1])
+        else:
+            tokens.append(word.lower())
+    return tokens
+
+
+def latex_tokens(formula):
+    tokens = []
+    for command, variable, number, operator, cjk in _LATEX.findall(unicodedata.normalize('NFKC', formula or '')):
+        if command:
+            if command not in _LAYOUT:
+                tokens.append(command)
+        elif cjk:
+            tokens += _bigrams(cjk)
+            tokens.append(cjk[-1])
+        elif variable or number or operator:
+            tokens.append(variable or number or operator)
+    return tokens
+
+
+def text_tokens(text):
+    text = unicodedata.normalize('NFKC', text or '')
+    tokens = []
+    position = 0
+    for match in _MATH.finditer(text):
+        tokens += _plain_tokens(text[position:match.start()])
+        tokens += latex_tokens(next(group for group in match.groups() if group is not None))
+        position = match.end()
+    return tokens + _plain_tokens(text[position:])
+
+
+# 查询
+
+def _phrase(tokens, prefix=False):
+    if not tokens:
+        return None
+    return '"%s"%s' % (' '.join(token.replace('"', '""') for token in tokens), ' *' if prefix else '')
+
+
+def _text_phrase(term):
+    runs = _TEXT.findall(term)
+    tokens = []
+    prefix = False
+    for i, (cjk, word) in enumerate(runs):
+        last = i == len(runs) - 1
+        if not cjk:
+            tokens.append(word.lower())
+        elif len(cjk) == 1 and last:
+            # 文档里每个字要么是某个二元组的第一个字，要么是一段的最后一个字
+            tokens.append(cjk)
+            prefix = True
+        else:
+            tokens += _bigrams(cjk)
+            if not last:
+                # 后面还有别的词，文档里这一段的最后一个字也单独记过
+                tokens.append(cjk[-1])
+    return _phrase(tokens, prefix)
+
+
+def match_expression(query, book=None, chapter=None, tag=None):
+    # 空白分开的每一项是一个短语，各项之间是AND；$...$ 或者带 \ ^ _ { } = < > 的项按公式切分
+    query = unicodedata.normalize('NFKC', query or '')
+    phrases = [_phrase(latex_tokens(next(group for group in match.groups() if group is not None)))
+               for match in _MATH.finditer(query)]
+    for term in _MATH.sub(' ', query).split():
+        phrases.append(_phrase(latex_tokens(term)) if _LATEX_HINT.search(term) else _text_phrase(term))
+    phrases = [phrase for phrase in phrases if phrase is not None]
+    for prefix, value in (('b', book), ('c', chapter), ('t', tag)):
+        if value is not None:
+            phrases.append('facets : "%s%d"' % (prefix, value))
+    return ' AND '.join(phrases) or None
+
+
+# 索引文件
+
+_local = threading.local()
+
+
+def _source():
+    return str(connection.settings_dict['NAME'])
+
+
+def _connect(path=None, create=False):
+    # 每个线程每个文件一个连接；文件不存在并且不是要新建时返回None
+    path = path or settings.SEARCH_INDEX_PATH
+    connections = _local.__dict__.setdefault('connections', {})
+    db = connections.get(path)
+    if db is None:
+        if not create and not os.path.exists(path):
+            return None
+        db = sqlite3.connect(path, timeout=30)
+        # 重建/增量写入时不挡住查询
+        db.execute('PRAGMA journal_mode = WAL')
+        connections[path] = db
+    return db
+
+
+def close(path=None):
+    # 关闭本线程打开的索引连接
+    db = _local.__dict__.get('connections', {}).pop(path or settings.SEARCH_INDEX_PATH, None)
+    if db is not None:
+        db.close()
+
+
+def _active(path=None):
+    db = _connect(path)
+    if db is None:
+        return None
+    try:
+        row = db.execute("SELECT value FROM search_meta WHERE key = 'source'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return db if row is not None and row[0] == _source() else None
+
+
+def _documents(problems, links):
+    # problems/links是同一批题目的查询集，返回写入索引的行
+    problem_tags = {}
+    for problem_id, tag_id in links.values_list('problem_id', 'tag_id').order_by('pk'):
+        problem_tags.setdefault(problem_id, []).append(tag_id)
+    tags = {}
+    tag_ids = list({tag_id for tag_ids in problem_tags.values() for tag_id in tag_ids})
+    for i in range(0, len(tag_ids), BATCH_SIZE):
+        for pk, name, description, book_id, chapter_id in Tag.objects.filter(
+                pk__in=tag_ids[i:i + BATCH_SIZE]).values_list('pk', 'name', 'description', 'book_id', 'chapter_id'):
+            tags[pk] = (' '.join(text_tokens(name) + text_tokens(description)),
+                        'b%d c%d t%d' % (book_id, chapter_id, pk))
+    for pk, name, description, formula in problems.values_list('pk', 'name', 'description', 'formula'):
+        row_tags = [tags[tag_id] for tag_id in problem_tags.get(pk, ()) if tag_id in tags]
+        yield (pk, ' '.join(text_tokens(name)), ' '.join(text_tokens(description)), ' '.join(latex_tokens(formula)),
+               ' '.join(text for text, _ in row_tags), ' '.join(sorted({facet for _, facets in row_tags
+                                                                         for facet in facets.split()})))
+
+
+def rebuild(path=None, chunk_size=CHUNK_SIZE, log=None):
+    log = log or (lambda message: None)
+    db = _connect(path, create=True)
+    with db:
+        db.execute('DROP TABLE IF EXISTS problem_fts')
+        db.execute('DROP TABLE IF EXISTS search_meta')
+        for statement in SCHEMA:
+            db.execute(statement)
+    through = Problem.tags.through
+    last = 0
+    written = 0
+    while True:
+        ids = list(Problem.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            break
+        rows = list(_documents(Problem.objects.filter(pk__gt=last, pk__lte=ids[-1]),
+                               through.objects.filter(problem_id__gt=last, problem_id__lte=ids[-1])))
+        with db:
+            db.executemany(INSERT, rows)
+        written += len(rows)
+        last = ids[-1]
+        log('indexed %d problems' % written)
+    with db:
+        # 合并各批写入的段，查询时只读一棵b树
+        db.execute("INSERT INTO problem_fts (problem_fts) VALUES ('optimize')")
+        db.execute("INSERT INTO search_meta (key, value) VALUES ('source', ?)", (_source(),))
+    return written
+
+
+def reindex(problem_ids, path=None):
+    # 重新索引这些题目，已经删除的从索引里去掉；索引没建好时什么都不做
+    db = _active(path)
+    if db is None:
+        return 0
+    problem_ids = list(problem_ids)
+    through = Problem.tags.through
+    written = 0
+    with db:
+        for i in range(0, len(problem_ids), BATCH_SIZE):
+            batch = problem_ids[i:i + BATCH_SIZE]
+            rows = list(_documents(Problem.objects.filter(pk__in=batch), through.objects.filter(problem_id__in=batch)))
+            db.executemany('DELETE FROM problem_fts WHERE rowid = ?', [(pk,) for pk in batch])
+            db.executemany(INSERT, rows)
+            written += len(rows)
+    return written
+
+
+def search(query, book=None, chapter=None, tag=None, limit=DEFAULT_LIMIT, offset=0, path=None):
+    # 按相关度返回 [Hit(题目ID, 分数)]，分数越大越相关
+    expression = match_expression(query, book, chapter, tag)
+    if expression is None:
+        return []
+    db = _connect(path)
+    if db is None:
+        raise ImproperlyConfigured('search index %s has not been built, run manage.py rebuild_search'
+                                   % (path or settings.SEARCH_INDEX_PATH))
+    limit = max(1, min(limit, MAX_LIMIT))
+    rows = db.execute('SELECT rowid, rank FROM problem_fts WHERE problem_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?',
+                      (expression, limit, max(0, offset))).fetchall()
+    return [Hit(problem_id, -rank) for problem_id, rank in rows]
+
+
+# 增量更新
+
+def _tag_problems(tag_id):
+    return list(Problem.tags.through.objects.filter(tag_id=tag_id).values_list('problem_id', flat=True))
+
+
+def _reindex_on_commit(problem_ids):
+    # 要更新的题目现在就算好（清空/删除以后就查不到了），读题目内容放到提交以后，读到的是提交的数据
+    problem_ids = list(problem_ids)
+    transaction.on_commit(lambda: reindex(problem_ids))
+
+
+@receiver(post_save, sender=Problem)
+def problem_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        _reindex_on_commit([instance.pk])
+
+
+@receiver(post_delete, sender=Problem)
+def problem_deleted(sender, instance, **kwargs):
+    _reindex_on_commit([instance.pk])
+
+
+@receiver(m2m_changed, sender=Problem.tags.through)
+def problem_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear') or _active() is None:
+        return
+    if not reverse:
+        if action != 'pre_clear':
+            _reindex_on_commit([instance.pk])
+    elif action == 'pre_clear':
+        # 清空以后就不知道原来有哪些题了，先记下来
+        instance._search_problems = _tag_problems(instance.pk)
+    elif action == 'post_clear':
+        _reindex_on_commit(getattr(instance, '_search_problems', ()))
+    else:
+        _reindex_on_commit(pk_set)
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, raw, created, **kwargs):
+    if not raw and not created and _active() is not None:
+        _reindex_on_commit(_tag_problems(instance.pk))
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_deleting(sender, instance, **kwargs):
+    # 级联删除题目标签关联时不发m2m信号
+    if _active() is not None:
+        instance._search_problems = _tag_problems(instance.pk)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    _reindex_on_commit(getattr(instance, '_search_problems', ()))
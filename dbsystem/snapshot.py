@@ -0,0 +1,351 @@
+# -*- coding: UTF-8 -*-
+
+# 答题数据的列式快照，给分析用：不经过ORM，numpy直接内存映射读取
+# SNAPSHOT_DIR下每张表一个目录，每列一个.npy文件，meta.json记录行数、主键水位和各列的类型：
+#   problem_conditions   id, student, problem, answered, correct, points, cost
+#   exercise_conditions  id, exercise, student, finish_time（UTC，datetime64[us]）
+#   results              id, exercise_condition, problem_condition（两张表之间的关联）
+#   tag_abilities        id, student, tag, degree
+# 外键列做字典编码：<列>.npy是int32编码，<列>.dict.npy是按第一次出现顺序排列的ID，
+# 追加时新ID接在字典后面，已有的编码不变。answered/correct和aggregates.correct_q()的定义一致，不保存原始作答文本。
+#
+# write() 按主键水位增量追加：只读主键大于上次水位的行，接在各列文件后面，再改写.npy头里的行数（头部留有余量）；
+# meta.json最后原子替换，中途失败时以meta里的行数为准，下次追加先截掉多写的部分。
+# 已有行的修改和删除（重新批改、归档）追加不到，需要 rebuild；TagAbility是原地更新的，每次都整表重写。
+# 重写先写到临时目录再换掉原目录，已经打开的读者不受影响。
+#
+# 读取：table = open_table('problem_conditions')
+#   table['points'] / table['student']          内存映射的列（字典列是编码）
+#   table.mask(student=[1, 2], correct=True)    按ID或者值过滤，返回布尔数组
+#   table.values('student', mask)               字典列解码成ID
+#   table.group('problem', 'points', mask)      按字典列分组，返回 (ID, 行数, 求和)
+
+import json
+import os
+import shutil
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from dbsystem.models_mysql import ExerciseCondition, ProblemCondition, TagAbility
+
+
+CHUNK_SIZE = 50000
+
+Results = ExerciseCondition.results.through
+
+
+def _naive_utc(value):
+    return timezone.make_naive(value, timezone.utc) if timezone.is_aware(value) else value
+
+
+def _problem_conditions(rows):
+    ids, students, problems, results, judges, points, costs = zip(*rows)
+    answered = np.fromiter((bool(result) for result in results), dtype=bool, count=len(rows))
+    correct = answered & np.fromiter((not judge for judge in judges), dtype=bool, count=len(rows))
+    return {'id': ids, 'student': students, 'problem': problems, 'answered': answered, 'correct': correct,
+            'points': points, 'cost': costs}
+
+
+def _exercise_conditions(rows):
+    ids, exercises, students, finish_times = zip(*rows)
+    return {'id': ids, 'exercise': exercises, 'student': students,
+            'finish_time': np.array([_naive_utc(value) for value in finish_times], dtype='datetime64[us]')}
+
+
+def _results(rows):
+    ids, exercise_conditions, problem_conditions = zip(*rows)
+    return {'id': ids, 'exercise_condition': exercise_conditions, 'problem_condition': problem_conditions}
+
+
+def _tag_abilities(rows):
+    ids, students, tags, degrees = zip(*rows)
+    return {'id': ids, 'student': students, 'tag': tags, 'degree': degrees}
+
+
+class Spec(object):
+
+    def __init__(self, model, fields, convert, columns, dictionaries=(), incremental=True):
+        # fields第一项是主键；columns: (列名, dtype)，dictionaries里的列做字典编码
+        self.model = model
+        self.fields = fields
+        self.convert = convert
+        self.columns = columns
+        self.dictionaries = frozenset(dictionaries)
+        self.incremental = incremental
+
+
+TABLES = {
+    'problem_conditions': Spec(
+        ProblemCondition, ('pk', 'student_id', 'problem_id', 'result', 'judge', 'points', 'cost'),
+        _problem_conditions,
+        (('id', '<i8'), ('student', '<i8'), ('problem', '<i8'), ('answered', '|b1'), ('correct', '|b1'),
+         ('points', '<f8'), ('cost', '<i4')),
+        dictionaries=('student', 'problem')),
+    'exercise_conditions': Spec(
+        ExerciseCondition, ('pk', 'exercise_id', 'student_id', 'finish_time'), _exercise_conditions,
+        (('id', '<i8'), ('exercise', '<i8'), ('student', '<i8'), ('finish_time', '<M8[us]')),
+        dictionaries=('exercise', 'student')),
+    'results': Spec(
+        Results, ('pk', 'exercisecondition_id', 'problemcondition_id'), _results,
+        (('id', '<i8'), ('exercise_condition', '<i8'), ('problem_condition', '<i8'))),
+    # 批改时原地更新掌握程度，主键水位看不到，每次整表重写
+    'tag_abilities': Spec(
+        TagAbility, ('pk', 'student_id', 'tag_id', 'degree'), _tag_abilities,
+        (('id', '<i8'), ('student', '<i8'), ('tag', '<i8'), ('degree', '<i2')),
+        dictionaries=('student', 'tag'), incremental=False),
+}
+
+CODE_DTYPE = '<i4'
+
+
+def directory():
+    return settings.SNAPSHOT_DIR
+
+
+def _header(dtype, rows):
+    return {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (rows,)}
+
+
+class _ColumnWriter(object):
+    # 一维.npy文件的追加：数据接在文件末尾，关闭时改写头里的行数
+
+    def __init__(self, path, dtype, rows=0):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows = rows
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, _header(self.dtype, 0))
+        self.file = open(path, 'r+b')
+        np.lib.format.read_magic(self.file)
+        np.lib.format.read_array_header_1_0(self.file)
+        self.offset = self.file.tell()
+        # meta.json以后多写的部分（上次中途失败）丢掉
+        self.file.truncate(self.offset + rows * self.dtype.itemsize)
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        self.file.seek(0)
+        np.lib.format.write_array_header_1_0(self.file, _header(self.dtype, self.rows))
+        if self.file.tell() != self.offset:
+            # 写头时预留了行数增长的位置，正常不会发生
+            raise ValueError('%s: header size changed' % self.path)
+        self.file.close()
+
+
+class _Dictionary(object):
+    # 外键ID → int32编码，编码按第一次出现的顺序分配
+
+    def __init__(self, path, size=0):
+        self.writer = _ColumnWriter(path, '<i8', size)
+        values = np.load(path, mmap_mode='r')[:size] if size else np.zeros(0, dtype=np.int64)
+        order = np.argsort(values, kind='stable')
+        self.keys = np.asarray(values[order], dtype=np.int64)
+        self.codes = order.astype(np.int32)
+
+    def encode(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        unique = np.unique(ids)
+        index = np.searchsorted(self.keys, unique)
+        known = index < len(self.keys)
+        known[known] = self.keys[index[known]] == unique[known]
+        new = unique[~known]
+        if len(new):
+            codes = np.arange(self.writer.rows, self.writer.rows + len(new), dtype=np.int32)
+            self.writer.append(new)
+            keys = np.concatenate([self.keys, new])
+            order = np.argsort(keys, kind='stable')
+            self.keys, self.codes = keys[order], np.concatenate([self.codes, codes])[order]
+        return self.codes[np.searchsorted(self.keys, ids)]
+
+    @property
+    def size(self):
+        return self.writer.rows
+
+    def close(self):
+        self.writer.close()
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_meta(path, meta):
+    temp = os.path.join(path, 'meta.json.tmp')
+    with open(temp, 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(temp, os.path.join(path, 'meta.json'))
+
+
+def _column_types(spec):
+    return {name: {'dtype': dtype, 'dictionary': name in spec.dictionaries} for name, dtype in spec.columns}
+
+
+def _append(spec, path, meta):
+    # 把主键大于水位的行追加到path下的列文件，返回新的meta
+    rows, watermark = meta['rows'], meta['watermark']
+    columns = {}
+    dictionaries = {}
+    for name, dtype in spec.columns:
+        if name in spec.dictionaries:
+            dictionaries[name] = _Dictionary(os.path.join(path, name + '.dict.npy'),
+                                             meta['columns'][name].get('dictionary_size', 0))
+            dtype = CODE_DTYPE
+        columns[name] = _ColumnWriter(os.path.join(path, name + '.npy'), dtype, rows)
+    queryset = spec.model.objects.order_by('pk')
+    try:
+        while True:
+            chunk = list(queryset.filter(pk__gt=watermark).values_list(*spec.fields)[:CHUNK_SIZE])
+            if not chunk:
+                break
+            for name, values in spec.convert(chunk).items():
+                columns[name].append(dictionaries[name].encode(values) if name in dictionaries else values)
+            rows += len(chunk)
+            watermark = chunk[-1][0]
+    finally:
+        for writer in list(columns.values()) + list(dictionaries.values()):
+            writer.close()
+    meta = dict(meta, rows=rows, watermark=watermark, updated_at=timezone.now().isoformat())
+    for name, dictionary in dictionaries.items():
+        meta['columns'][name]['dictionary_size'] = dictionary.size
+    _write_meta(path, meta)
+    return meta
+
+
+def _rebuild(name, spec, path):
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    now = timezone.now().isoformat()
+    meta = {'table': name, 'rows': 0, 'watermark': 0, 'columns': _column_types(spec), 'created_at': now,
+            'updated_at': now}
+    try:
+        meta = _append(spec, temp, meta)
+        old = path + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(temp, path)
+        shutil.rmtree(old, ignore_errors=True)
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+    return meta
+
+
+def write(tables=None, path=None, rebuild=False, log=None):
+    # 返回 {表名: 这次写入的行数}
+    log = log or (lambda message: None)
+    path = path or directory()
+    os.makedirs(path, exist_ok=True)
+    written = {}
+    for name in tables or TABLES:
+        if name not in TABLES:
+            raise ValueError('table should be one of %s' % ', '.join(TABLES))
+        spec = TABLES[name]
+        table_path = os.path.join(path, name)
+        meta = _read_meta(table_path)
+        if rebuild or not spec.incremental or meta is None or meta['columns'].keys() != _column_types(spec).keys():
+            meta = _rebuild(name, spec, table_path)
+            written[name] = meta['rows']
+        else:
+            before = meta['rows']
+            meta = _append(spec, table_path, meta)
+            written[name] = meta['rows'] - before
+        log('%s: %d rows written, %d total, watermark %d' % (name, written[name], meta['rows'], meta['watermark']))
+    return written
+
+
+class Table(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        if self.meta is None:
+            raise FileNotFoundError(os.path.join(path, 'meta.json'))
+        self.rows = self.meta['rows']
+        self._columns = {}
+        self._dictionaries = {}
+        self._lookups = {}
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def columns(self):
+        return list(self.meta['columns'])
+
+    def is_dictionary(self, name):
+        return self.meta['columns'][name]['dictionary']
+
+    def __getitem__(self, name):
+        # 只读的内存映射，字典列返回编码
+        if name not in self._columns:
+            if name not in self.meta['columns']:
+                raise KeyError(name)
+            self._columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')[:self.rows]
+        return self._columns[name]
+
+    def dictionary(self, name):
+        if name not in self._dictionaries:
+            if not self.is_dictionary(name):
+                raise ValueError('%s is not dictionary encoded' % name)
+            size = self.meta['columns'][name]['dictionary_size']
+            self._dictionaries[name] = np.load(os.path.join(self.path, name + '.dict.npy'), mmap_mode='r')[:size]
+        return self._dictionaries[name]
+
+    def codes(self, name, ids):
+        # ID → 编码，不在字典里的是-1
+        if name not in self._lookups:
+            order = np.argsort(self.dictionary(name), kind='stable')
+            self._lookups[name] = (np.asarray(self.dictionary(name))[order], order.astype(np.int32))
+        keys, codes = self._lookups[name]
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        index = np.minimum(np.searchsorted(keys, ids), max(len(keys) - 1, 0))
+        found = (keys[index] == ids) if len(keys) else np.zeros(len(ids), dtype=bool)
+        return np.where(found, codes[index] if len(keys) else -1, -1)
+
+    def mask(self, **filters):
+        # 列名=值 或 列名=[值, ...]；字典列按ID过滤。多个条件同时满足
+        mask = np.ones(self.rows, dtype=bool)
+        for name, wanted in filters.items():
+            column = self[name]
+            if self.is_dictionary(name):
+                wanted = self.codes(name, np.atleast_1d(wanted))
+                wanted = wanted[wanted >= 0]
+            if np.ndim(wanted):
+                mask &= np.isin(column, wanted)
+            else:
+                mask &= column == wanted
+        return mask
+
+    def values(self, name, mask=None):
+        column = self[name] if mask is None else self[name][mask]
+        return np.asarray(self.dictionary(name))[column] if self.is_dictionary(name) else np.asarray(column)
+
+    def group(self, by, column=None, mask=None):
+        # 按字典列分组：返回 (ID, 行数, column的和)，只含有数据的组；column为None时和是None
+        codes = self[by] if mask is None else self[by][mask]
+        size = len(self.dictionary(by))
+        counts = np.bincount(codes, minlength=size)
+        sums = None
+        if column is not None:
+            weights = self[column] if mask is None else self[column][mask]
+            sums = np.bincount(codes, weights=weights, minlength=size)
+        present = counts > 0
+        return (np.asarray(self.dictionary(by))[present], counts[present],
+                None if sums is None else sums[present])
+
+
+def open_table(name, path=None):
+    return Table(os.path.join(path or directory(), name))
@@ -0,0 +1,422 @@
+# -*- coding: UTF-8 -*-
+
+# 在线答题提交（/api/answers/）和组提交
+# 请求体是NDJSON，每行一条答题记录，字段和 manage.py ingest_answers 相同：
+#   student, exercise, problem 必填；result, judge, cost, points, finish_time（默认当前时间）可选
+# 请求线程只做解析，然后把整批放进进程内的队列，等它提交以后才返回（返回时已经写进数据库）。
+#
+# 组提交：同一时间只有一个请求线程当“领头的”，一次取走队列里所有批次（最多SUBMIT_GROUP_ROWS行），
+# 在一个事务里校验并bulk_create；其他请求线程排队等待，领头的提交完以后由下一个排队的接着提交。
+# 一次提交期间到达的请求自然合并成下一组，并发越高每组越大，事务数不随请求数增长。
+# 队列里（包括正在提交的）最多SUBMIT_QUEUE_ROWS行，满了以后新请求最多等SUBMIT_WAIT_SECONDS，
+# 还是没有空位就返回503，让客户端稍后重试。
+#
+# 校验走缓存：练习包含哪些题目（Exercise.problems）、学生是否存在、(练习, 学生) 对应的ExerciseCondition。
+# 同一个练习同一个学生只有一条ExerciseCondition，新答题接在它的results后面。
+# 事务里先给DataVersion加一（报表过期），再用bulk.next_id分配主键：它和批改、导入共用一把分配锁，
+# 持有到事务提交，同时批改考试也不会分到重复的主键。
+# bulk_create不发信号，题目/练习统计按差值更新，排行榜标记过期。
+# 答题汇总（rollups.refresh，按中间表主键的水位）不在请求线程里刷新：有提交以后唤醒组提交的后台线程，
+# 攒SUBMIT_ROLLUP_SECONDS秒再刷新一次；失败时记日志，下一轮重试。
+# 一组里有一批写入失败时，逐批重试，只有出错的那批返回错误。
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dbsystem import aggregates, ranking, reports, rollups
+from dbsystem.bulk import BATCH_SIZE, insert_rows, next_id
+from dbsystem.models_mysql import Exercise, ExerciseCondition, ProblemCondition, Student
+
+
+logger = logging.getLogger('dbsystem.submit')
+
+Results = ExerciseCondition.results.through
+
+CACHE_LIMIT = 1000000
+
+
+class Busy(Exception):
+    # 队列满了
+    pass
+
+
+def _convert(record):
+    finish_time = record.get('finish_time')
+    if finish_time:
+        finish_time = parse_datetime(str(finish_time))
+        if finish_time is None:
+            raise ValueError('bad finish_time %r' % record['finish_time'])
+        if settings.USE_TZ and timezone.is_naive(finish_time):
+            finish_time = timezone.make_aware(finish_time)
+    else:
+        finish_time = timezone.now()
+    return (int(record['student']), int(record['exercise']), int(record['problem']), finish_time,
+            str(record.get('result') or ''), str(record.get('judge') or ''),
+            int(record.get('cost') or 0), float(record.get('points') or 0))
+
+
+def parse(body):
+    # 返回 (记录, 错误)；记录是 (行号, 学生, 练习, 题目, 完成时间, 结果, 错误答案, 用时, 得分)，行号从1开始
+    records, errors = [], []
+    for line, text in enumerate(body.splitlines(), 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+            if not isinstance(record, dict):
+                raise ValueError('expected an object')
+            records.append((line,) + _convert(record))
+        except KeyError as e:
+            errors.append({'line': line, 'error': 'missing %s' % e.args[0]})
+        except (TypeError, ValueError) as e:
+            errors.append({'line': line, 'error': str(e)})
+    return records, errors
+
+
+class Batch(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.accepted = 0
+        self.rejected = []
+        self.error = None
+        self.done = False
+
+
+class RollupRefresher(object):
+    # 组提交的后台线程：第一次提交时启动，有新提交时被唤醒。
+    # 刷新时占用组提交的领头位置，同一进程里仍然只有一个线程在写（sqlite同时只能有一个写事务），
+    # 这期间到达的请求在队列里等，合并成下一组
+
+    def __init__(self, committer):
+        self.committer = committer
+        self.due = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.runs = 0
+        self.failures = 0
+
+    def notify(self):
+        self.due.set()
+        with self.lock:
+            if self.stopped.is_set() or self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='rollup-refresher', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.lock:
+            self.stopped.set()
+            thread = self.thread
+        self.due.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self.due.wait()
+            # 攒一段时间的提交再刷新，期间新来的提交算在这一轮里
+            if self.stopped.wait(settings.SUBMIT_ROLLUP_SECONDS):
+                return
+            self.due.clear()
+            try:
+                self.refresh()
+            finally:
+                connection.close()
+
+    def refresh(self):
+        try:
+            with self.committer.lead():
+                written = rollups.refresh()
+        except Exception:
+            self.failures += 1
+            logger.exception('refreshing answer rollups failed, will retry')
+            self.due.set()
+            return 0
+        self.runs += 1
+        return written
+
+
+class GroupCommitter(object):
+
+    def __init__(self, queue_rows, group_rows):
+        self.queue_rows = queue_rows
+        self.group_rows = group_rows
+        self.changed = threading.Condition()
+        self.queue = deque()
+        # 排队和正在提交的行数
+        self.pending_rows = 0
+        self.leading = False
+        self.commits = 0
+        self.batches = 0
+        # 练习ID → 题目ID的frozenset，练习不存在时是None
+        self.exercises = {}
+        self.students = set()
+        self.missing_students = set()
+        # (练习ID, 学生ID) → ExerciseCondition主键
+        self.exercise_conditions = {}
+        self.cache_lock = threading.Lock()
+        self.rollups = RollupRefresher(self)
+
+    def submit(self, records, timeout=None):
+        # 阻塞到这批记录提交（或者校验失败）；队列满了等timeout秒还没有空位时抛出Busy
+        batch = Batch(records)
+        deadline = time.monotonic() + (settings.SUBMIT_WAIT_SECONDS if timeout is None else timeout)
+        with self.changed:
+            # 队列是空的时候，再大的一批也接受
+            while self.pending_rows and self.pending_rows + len(records) > self.queue_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Busy()
+                self.changed.wait(remaining)
+            self.queue.append(batch)
+            self.pending_rows += len(records)
+            while not batch.done:
+                if self.leading:
+                    self.changed.wait()
+                    continue
+                self.leading = True
+                group = self._take()
+                self.changed.release()
+                try:
+                    self._commit(group)
+                finally:
+                    self.changed.acquire()
+                    self.leading = False
+                    for done in group:
+                        done.done = True
+                        self.pending_rows -= len(done.records)
+                    self.changed.notify_all()
+        if batch.error is not None:
+            raise batch.error
+        return batch
+
+    @contextmanager
+    def lead(self):
+        # 在组提交之外写数据库时，先等当前这组提交完，占住领头的位置
+        with self.changed:
+            while self.leading:
+                self.changed.wait()
+            self.leading = True
+        try:
+            yield
+        finally:
+            with self.changed:
+                self.leading = False
+                self.changed.notify_all()
+
+    def _take(self):
+        group = [self.queue.popleft()]
+        rows = len(group[0].records)
+        while self.queue and rows + len(self.queue[0].records) <= self.group_rows:
+            rows += len(self.queue[0].records)
+            group.append(self.queue.popleft())
+        return group
+
+    def _commit(self, group):
+        try:
+            self._write(group)
+        except Exception as e:
+            # 回滚以后缓存里可能有没写进去的ExerciseCondition
+            self.forget()
+            if len(group) == 1:
+                group[0].error = e
+                return
+            for batch in group:
+                try:
+                    self._write([batch])
+                except Exception as error:
+                    self.forget()
+                    batch.error = error
+
+    def _write(self, group):
+        records = [record for batch in group for record in batch.records]
+        checked = self._validate(records)
+        valid = [record for record, error in zip(records, checked) if error is None]
+        if valid:
+            with transaction.atomic():
+                # 和grading一样先bump再分配主键，两把锁的顺序一致
+                reports.bump()
+                condition_ids = self._exercise_conditions(valid)
+                first = next_id(ProblemCondition)
+                conditions = [ProblemCondition(pk=first + i, student_id=student, problem_id=problem, result=result,
+                                               judge=judge, cost=cost, points=points)
+                              for i, (_, student, _, problem, _, result, judge, cost, points) in enumerate(valid)]
+                # 一组几千行，不经过bulk_create逐个字段转换
+                insert_rows(ProblemCondition, ('id', 'student', 'problem', 'result', 'judge', 'cost', 'points'),
+                            [(first + i, student, problem, result, judge, cost, points)
+                             for i, (_, student, _, problem, _, result, judge, cost, points) in enumerate(valid)])
+                insert_rows(Results, ('exercisecondition', 'problemcondition'),
+                            [(condition_ids[(record[2], record[1])], first + i) for i, record in enumerate(valid)])
+                aggregates.add_created(conditions, [record[2] for record in valid])
+            ranking.mark_stale({record[1] for record in valid})
+            self.rollups.notify()
+            self.commits += 1
+        checked = iter(checked)
+        for batch in group:
+            batch.accepted, batch.rejected = 0, []
+            for record in batch.records:
+                error = next(checked)
+                if error is None:
+                    batch.accepted += 1
+                else:
+                    batch.rejected.append({'line': record[0], 'error': error})
+        self.batches += len(group)
+
+    def _validate(self, records):
+        # 每条记录的错误，通过的是None
+        exercise_ids = {record[2] for record in records}
+        student_ids = {record[1] for record in records}
+        with self.cache_lock:
+            if len(self.exercises) > CACHE_LIMIT or len(self.students) + len(self.missing_students) > CACHE_LIMIT:
+                self.exercises, self.students, self.missing_students = {}, set(), set()
+            unknown = exercise_ids - self.exercises.keys()
+            if unknown:
+                problems = {pk: set() for pk in Exercise.objects.filter(pk__in=unknown).values_list('pk', flat=True)}
+                for exercise_id, problem_id in Exercise.problems.through.objects.filter(
+                        exercise_id__in=list(problems)).values_list('exercise_id', 'problem_id'):
+                    problems[exercise_id].add(problem_id)
+                for exercise_id in unknown:
+                    self.exercises[exercise_id] = frozenset(problems[exercise_id]) if exercise_id in problems else None
+            unknown = student_ids - self.students - self.missing_students
+            if unknown:
+                found = set(Student.objects.filter(pk__in=unknown).values_list('pk', flat=True))
+                self.students |= found
+                self.missing_students |= unknown - found
+            exercises, students = self.exercises, self.students
+        errors = []
+        for _, student, exercise, problem, *rest in records:
+            problems = exercises.get(exercise)
+            if problems is None:
+                errors.append('unknown exercise %d' % exercise)
+            elif problem not in problems:
+                errors.append('problem %d is not in exercise %d' % (problem, exercise))
+            elif student not in students:
+                errors.append('unknown student %d' % student)
+            else:
+                errors.append(None)
+        return errors
+
+    def _exercise_conditions(self, records):
+        finish_times = {}
+        for _, student, exercise, _, finish_time, *rest in records:
+            key = (exercise, student)
+            if key not in finish_times or finish_time > finish_times[key]:
+                finish_times[key] = finish_time
+        with self.cache_lock:
+            if len(self.exercise_conditions) > CACHE_LIMIT:
+                self.exercise_conditions = {}
+            known = {key: self.exercise_conditions[key] for key in finish_times if key in self.exercise_conditions}
+        unseen = [key for key in finish_times if key not in known]
+        for i in range(0, len(unseen), BATCH_SIZE):
+            keys = set(unseen[i:i + BATCH_SIZE])
+            for exercise, student, pk in ExerciseCondition.objects.filter(
+                    exercise_id__in={key[0] for key in keys}, student_id__in={key[1] for key in keys}
+            ).values_list('exercise_id', 'student_id', 'pk'):
+                if (exercise, student) in keys:
+                    known[(exercise, student)] = pk
+        created = [key for key in unseen if key not in known]
+        if created:
+            first = next_id(ExerciseCondition)
+            ExerciseCondition.objects.bulk_create([
+                ExerciseCondition(pk=first + i, exercise_id=exercise, student_id=student,
+                                  finish_time=finish_times[(exercise, student)])
+                for i, (exercise, student) in enumerate(created)], batch_size=BATCH_SIZE)
+            known.update((key, first + i) for i, key in enumerate(created))
+        with self.cache_lock:
+            self.exercise_conditions.update(known)
+        return known
+
+    def forget(self, exercise_id=None, student_id=None, exercise_condition=None):
+        # 不带参数时清空所有缓存
+        with self.cache_lock:
+            if exercise_id is None and student_id is None and exercise_condition is None:
+                self.exercises, self.students, self.missing_students = {}, set(), set()
+                self.exercise_conditions = {}
+                return
+            if exercise_id is not None:
+                self.exercises.pop(exercise_id, None)
+            if student_id is not None:
+                self.students.discard(student_id)
+                self.missing_students.discard(student_id)
+            if exercise_condition is not None:
+                self.exercise_conditions.pop(exercise_condition, None)
+
+    def stats(self):
+        with self.changed:
+            return {'commits': self.commits, 'batches': self.batches, 'pending_rows': self.pending_rows}
+
+
+_committer = None
+_lock = threading.Lock()
+
+
+def get_committer():
+    global _committer
+    committer = _committer
+    if committer is None:
+        with _lock:
+            if _committer is None:
+                _committer = GroupCommitter(settings.SUBMIT_QUEUE_ROWS, settings.SUBMIT_GROUP_ROWS)
+            committer = _committer
+    return committer
+
+
+def invalidate():
+    global _committer
+    committer, _committer = _committer, None
+    if committer is not None:
+        committer.rollups.stop()
+
+
+def submit(records, timeout=None):
+    return get_committer().submit(records, timeout)
+
+
+def _forget(**kwargs):
+    committer = _committer
+    if committer is not None:
+        committer.forget(**kwargs)
+
+
+@receiver(post_save, sender=Exercise)
+@receiver(post_delete, sender=Exercise)
+def exercise_changed(sender, instance, **kwargs):
+    _forget(exercise_id=instance.pk)
+
+
+@receiver(m2m_changed, sender=Exercise.problems.through)
+def change_problems(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _forget(exercise_id=instance.pk)
+    elif pk_set:
+        for exercise_id in pk_set:
+            _forget(exercise_id=exercise_id)
+    else:
+        # 从题目一端清空，不知道涉及哪些练习
+        _forget()
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def student_changed(sender, instance, **kwargs):
+    _forget(student_id=instance.pk)
+
+
+@receiver(post_delete, sender=ExerciseCondition)
+def exercise_condition_deleted(sender, instance, **kwargs):
+    _forget(exercise_condition=(instance.exercise_id, instance.student_id))
@@ -0,0 +1,293 @@
+# -*- coding: UTF-8 -*-
+
+# 按固定随机种子生成models_mysql里所有表的模拟数据
+# 学校 → 班级 → 学生、老师、职员，学科 → 书目 → 章节 → 标签（前序知识是一个DAG），题目，练习，
+# 以及每个练习布置给若干班级后产生的练习完成情况和题目完成情况。
+# 全部用bulk_create写入，主键按当前最大值顺序分配；
+# 多表继承的Student/Teacher/Stuff先批量写People，再直接插入子表
+
+import random
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from dbsystem.bulk import BATCH_SIZE, insert_children, next_id
+from dbsystem.models_mysql import *
+
+
+SCALES = {
+    # 题目完成情况条数 = exercises * classes_per_exercise * students_per_class * problems_per_exercise
+    'tiny': dict(schools=1, classes_per_school=2, students_per_class=10, teachers_per_school=2, staff_per_school=1,
+                 subjects=2, books_per_subject=1, chapters_per_book=3, tags_per_chapter=3,
+                 problems=100, exercises=4, problems_per_exercise=5, classes_per_exercise=1,
+                 tags_per_student=5, tags_per_problem=2),
+    'small': dict(schools=2, classes_per_school=4, students_per_class=20, teachers_per_school=4, staff_per_school=2,
+                  subjects=3, books_per_subject=2, chapters_per_book=5, tags_per_chapter=4,
+                  problems=1000, exercises=20, problems_per_exercise=10, classes_per_exercise=2,
+                  tags_per_student=20, tags_per_problem=2),
+    'medium': dict(schools=5, classes_per_school=8, students_per_class=30, teachers_per_school=8, staff_per_school=4,
+                   subjects=4, books_per_subject=3, chapters_per_book=10, tags_per_chapter=5,
+                   problems=10000, exercises=100, problems_per_exercise=20, classes_per_exercise=3,
+                   tags_per_student=50, tags_per_problem=3),
+    'large': dict(schools=20, classes_per_school=20, students_per_class=40, teachers_per_school=20, staff_per_school=10,
+                  subjects=6, books_per_subject=4, chapters_per_book=15, tags_per_chapter=6,
+                  problems=100000, exercises=400, problems_per_exercise=25, classes_per_exercise=5,
+                  tags_per_student=100, tags_per_problem=3),
+}
+
+CHUNK_SIZE = 50000
+
+# 题目描述和公式的素材
+TOPICS = ('函数', '单调性', '集合', '交集', '并集', '三角形', '面积', '周长', '概率', '数列', '等差数列', '等比数列',
+          '导数', '极值', '向量', '圆', '椭圆', '抛物线', '不等式', '方程')
+
+SENTENCES = ('已知%s，求%s的%s。', '证明%s与%s相等，并求%s。', '判断下列关于%s的说法是否正确：%s的%s。')
+
+FORMULAS = (r'f(x) = x^{%(a)d} + %(b)d', r'\frac{%(a)d}{x} + \sqrt{%(b)d}', r'a_n = a_1 + (n - %(a)d) d',
+            r'\sin^2 x + \cos^2 x = %(a)d', r'\int_0^{%(a)d} x \, dx = %(b)d', r'S = \pi r^{%(a)d}')
+
+
+class Generator(object):
+
+    def __init__(self, seed=0, scale='small', **overrides):
+        self.random = random.Random(seed)
+        # 题目文字单独一个随机数序列，其他数据和没有文字时一样
+        self.text_random = random.Random(seed + 1)
+        # 职员也单独一个序列，加上职员以后其他数据不变
+        self.staff_random = random.Random(seed + 2)
+        self.config = dict(SCALES[scale], **overrides)
+        self.counts = {}
+
+    def run(self, log=None):
+        self.log = log or (lambda message: None)
+        with transaction.atomic():
+            self.organisations()
+            self.curriculum()
+            self.people()
+            self.abilities()
+            self.exercises()
+        self.answers()
+        return self.counts
+
+    def _count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+        self.log('%s: %d' % (name, self.counts[name]))
+
+    def organisations(self):
+        c, rnd = self.config, self.random
+        first = next_id(School)
+        School.objects.bulk_create([
+            School(pk=first + i, name='学校%d' % (first + i), area='%06d' % rnd.randint(110000, 659000),
+                   administrator='教育局', property=rnd.choice(['public', 'private', 'other']),
+                   rank=i + 1, description='', level=rnd.choice(['provincial', 'municipal', 'county', 'other']))
+            for i in range(c['schools'])], batch_size=BATCH_SIZE)
+        self.school_ids = list(range(first, first + c['schools']))
+        self._count('School', c['schools'])
+
+        first = next_id(Class)
+        n = c['schools'] * c['classes_per_school']
+        Class.objects.bulk_create([
+            Class(pk=first + i, name='班级%d' % (first + i), entry_year=rnd.randint(2015, 2019),
+                  rank=i % c['classes_per_school'] + 1)
+            for i in range(n)], batch_size=BATCH_SIZE)
+        # 班级按学校顺序连续编号
+        self.class_ids = list(range(first, first + n))
+        self._count('Class', n)
+
+    def curriculum(self):
+        c, rnd = self.config, self.random
+        first = next_id(Subject)
+        Subject.objects.bulk_create([Subject(pk=first + i, name='学科%d' % (first + i))
+                                     for i in range(c['subjects'])])
+        self.subject_ids = list(range(first, first + c['subjects']))
+        self._count('Subject', c['subjects'])
+
+        first = next_id(Book)
+        books = [Book(pk=first + i, name='书目%d' % (first + i), series='系列%d' % (i % 3),
+                      subject_id=self.subject_ids[i // c['books_per_subject']])
+                 for i in range(c['subjects'] * c['books_per_subject'])]
+        Book.objects.bulk_create(books, batch_size=BATCH_SIZE)
+        self._count('Book', len(books))
+
+        first = next_id(Chapter)
+        chapters = [Chapter(pk=first + i, name='章节%d' % (first + i), book_id=books[i // c['chapters_per_book']].pk)
+                    for i in range(len(books) * c['chapters_per_book'])]
+        Chapter.objects.bulk_create(chapters, batch_size=BATCH_SIZE)
+        self._count('Chapter', len(chapters))
+
+        first = next_id(Tag)
+        tags = []
+        for i in range(len(chapters) * c['tags_per_chapter']):
+            chapter = chapters[i // c['tags_per_chapter']]
+            tags.append(Tag(pk=first + i, name='标签%d' % (first + i), category=rnd.choice('TNZC'),
+                            difficulty=rnd.randint(1, 10), description='', book_id=chapter.book_id,
+                            chapter_id=chapter.pk))
+        Tag.objects.bulk_create(tags, batch_size=BATCH_SIZE)
+        self.tag_ids = [tag.pk for tag in tags]
+        self._count('Tag', len(tags))
+
+        # 前序知识只指向编号更小的标签，保证是DAG
+        precursors = []
+        for i, tag in enumerate(tags[1:], 1):
+            for j in rnd.sample(range(max(0, i - 50), i), min(i, rnd.randint(0, 3))):
+                precursors.append(Tag.precursor.through(from_tag_id=tag.pk, to_tag_id=tags[j].pk))
+        Tag.precursor.through.objects.bulk_create(precursors, batch_size=BATCH_SIZE)
+        self._count('Tag.precursor', len(precursors))
+
+        first = next_id(Problem)
+        Problem.objects.bulk_create([Problem(pk=first + i, name='题目%d' % (first + i), **self.problem_text())
+                                     for i in range(c['problems'])], batch_size=BATCH_SIZE)
+        self.problem_ids = list(range(first, first + c['problems']))
+        self._count('Problem', c['problems'])
+
+        # 一道题的标签来自同一章节
+        per_chapter = c['tags_per_chapter']
+        links = []
+        for problem_id in self.problem_ids:
+            start = rnd.randrange(len(chapters)) * per_chapter
+            for tag_id in rnd.sample(self.tag_ids[start:start + per_chapter], min(c['tags_per_problem'], per_chapter)):
+                links.append(Problem.tags.through(problem_id=problem_id, tag_id=tag_id))
+            if len(links) >= CHUNK_SIZE:
+                Problem.tags.through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+                self._count('Problem.tags', len(links))
+                links = []
+        Problem.tags.through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+        self._count('Problem.tags', len(links))
+
+    def problem_text(self):
+        rnd = self.text_random
+        numbers = {'a': rnd.randint(1, 9), 'b': rnd.randint(1, 99)}
+        return {
+            'description': rnd.choice(SENTENCES) % tuple(rnd.sample(TOPICS, 3)),
+            'formula': rnd.choice(FORMULAS) % numbers,
+        }
+
+    def people(self):
+        c, rnd = self.config, self.random
+        first = next_id(People)
+        people, teachers, students, memberships, subjects = [], [], [], [], []
+        self.teachers_by_school = {}
+        self.students_by_class = {}
+        pk = first
+        for s, school_id in enumerate(self.school_ids):
+            for _ in range(c['teachers_per_school']):
+                people.append(People(pk=pk, name='老师%d' % pk, born_year=rnd.randint(1960, 1995),
+                                     sex=rnd.choice(['male', 'female']), school_id=school_id))
+                teachers.append(Teacher(people_ptr_id=pk, position='教师', entry_year=rnd.randint(1985, 2018),
+                                        subject_id=rnd.choice(self.subject_ids)))
+                self.teachers_by_school.setdefault(school_id, []).append(pk)
+                pk += 1
+            for class_id in self.class_ids[s * c['classes_per_school']:(s + 1) * c['classes_per_school']]:
+                for _ in range(c['students_per_class']):
+                    people.append(People(pk=pk, name='学生%d' % pk, born_year=rnd.randint(2000, 2012),
+                                         sex=rnd.choice(['male', 'female']), school_id=school_id))
+                    students.append(Student(
+                        people_ptr_id=pk, hardness=rnd.randint(0, 100), frustration=rnd.randint(0, 100),
+                        habit=rnd.randint(0, 100), correct=rnd.randint(0, 100), comprehensive=rnd.randint(0, 100),
+                        logic=rnd.randint(0, 100), abstract=rnd.randint(0, 100), spatial=rnd.randint(0, 100),
+                        conclusive=rnd.randint(0, 100)))
+                    memberships.append(People.classes.through(people_id=pk, class_id=class_id))
+                    for subject_id in self.subject_ids:
+                        subjects.append(Student.subjects.through(student_id=pk, subject_id=subject_id))
+                    self.students_by_class.setdefault(class_id, []).append(pk)
+                    pk += 1
+        # 职员排在所有老师和学生后面，学生的主键和没有职员时一样
+        staff = []
+        for school_id in self.school_ids:
+            for _ in range(c['staff_per_school']):
+                people.append(People(pk=pk, name='职员%d' % pk, born_year=self.staff_random.randint(1960, 1998),
+                                     sex=self.staff_random.choice(['male', 'female']), school_id=school_id))
+                staff.append(Stuff(people_ptr_id=pk, entry_year=self.staff_random.randint(1985, 2018)))
+                pk += 1
+        People.objects.bulk_create(people, batch_size=BATCH_SIZE)
+        insert_children(Teacher, teachers)
+        insert_children(Student, students)
+        insert_children(Stuff, staff)
+        People.classes.through.objects.bulk_create(memberships, batch_size=BATCH_SIZE)
+        Student.subjects.through.objects.bulk_create(subjects, batch_size=BATCH_SIZE)
+        self.student_ids = [student.people_ptr_id for student in students]
+        self._count('Teacher', len(teachers))
+        self._count('Student', len(students))
+        self._count('Stuff', len(staff))
+
+    def abilities(self):
+        c, rnd = self.config, self.random
+        k = min(c['tags_per_student'], len(self.tag_ids))
+        abilities = []
+        for student_id in self.student_ids:
+            for tag_id in rnd.sample(self.tag_ids, k):
+                abilities.append(TagAbility(student_id=student_id, tag_id=tag_id, degree=rnd.randint(0, 100)))
+            if len(abilities) >= CHUNK_SIZE:
+                TagAbility.objects.bulk_create(abilities, batch_size=BATCH_SIZE)
+                self._count('TagAbility', len(abilities))
+                abilities = []
+        TagAbility.objects.bulk_create(abilities, batch_size=BATCH_SIZE)
+        self._count('TagAbility', len(abilities))
+
+    def exercises(self):
+        c, rnd = self.config, self.random
+        first = next_id(Exercise)
+        now = timezone.now()
+        exercises, problems, targets = [], [], []
+        self.exercise_plan = []
+        for i in range(c['exercises']):
+            pk = first + i
+            class_ids = rnd.sample(self.class_ids, min(c['classes_per_exercise'], len(self.class_ids)))
+            school_id = self.school_ids[(class_ids[0] - self.class_ids[0]) // c['classes_per_school']]
+            teacher_id = rnd.choice(self.teachers_by_school[school_id])
+            release_time = now - timedelta(days=rnd.randint(0, 365 * 3), minutes=rnd.randint(0, 1440))
+            exercises.append(Exercise(pk=pk, name='练习%d' % pk, release_time=release_time,
+                                      length=rnd.choice([20, 40, 90]), aim=rnd.choice('1234'),
+                                      release_people_id=teacher_id, subject_id=rnd.choice(self.subject_ids),
+                                      types=rnd.choice('123')))
+            problem_ids = rnd.sample(self.problem_ids, min(c['problems_per_exercise'], len(self.problem_ids)))
+            problems.extend(Exercise.problems.through(exercise_id=pk, problem_id=p) for p in problem_ids)
+            targets.append(Exercise.release_target.through(exercise_id=pk, teacher_id=teacher_id))
+            self.exercise_plan.append((pk, release_time, class_ids, problem_ids))
+        Exercise.objects.bulk_create(exercises, batch_size=BATCH_SIZE)
+        Exercise.problems.through.objects.bulk_create(problems, batch_size=BATCH_SIZE)
+        Exercise.release_target.through.objects.bulk_create(targets, batch_size=BATCH_SIZE)
+        self._count('Exercise', len(exercises))
+
+    def answers(self):
+        rnd = self.random
+        # results里是 (所属练习完成情况在conditions里的下标, 题目完成情况)
+        conditions, results = [], []
+
+        def flush():
+            # 每块在自己的事务里分配主键并写完，bulk.next_id的锁持有到提交，和同时在写的批改/提交不冲突
+            with transaction.atomic():
+                condition_id = next_id(ExerciseCondition)
+                result_id = next_id(ProblemCondition)
+                for i, condition in enumerate(conditions):
+                    condition.pk = condition_id + i
+                links = []
+                for i, (index, result) in enumerate(results):
+                    result.pk = result_id + i
+                    links.append(ExerciseCondition.results.through(exercisecondition_id=condition_id + index,
+                                                                   problemcondition_id=result.pk))
+                ExerciseCondition.objects.bulk_create(conditions, batch_size=BATCH_SIZE)
+                ProblemCondition.objects.bulk_create([result for _, result in results], batch_size=BATCH_SIZE)
+                ExerciseCondition.results.through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+            self._count('ExerciseCondition', len(conditions))
+            self._count('ProblemCondition', len(results))
+            del conditions[:], results[:]
+
+        for exercise_id, release_time, class_ids, problem_ids in self.exercise_plan:
+            for class_id in class_ids:
+                for student_id in self.students_by_class[class_id]:
+                    finish_time = release_time + timedelta(minutes=rnd.randint(5, 600))
+                    conditions.append(ExerciseCondition(exercise_id=exercise_id, student_id=student_id,
+                                                        finish_time=finish_time))
+                    for problem_id in problem_ids:
+                        answered = rnd.random() < 0.95
+                        correct = answered and rnd.random() < 0.7
+                        results.append((len(conditions) - 1, ProblemCondition(
+                            student_id=student_id, problem_id=problem_id,
+                            result=rnd.choice('ABCD') if answered else '',
+                            judge=rnd.choice(['E1', 'E2', 'E3']) if answered and not correct else '',
+                            cost=rnd.randint(10, 600), points=5.0 if correct else rnd.choice([0.0, 2.0]))))
+                    if len(results) >= CHUNK_SIZE:
+                        flush()
+        flush()
@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+
+# Tag.precursor 的内存索引
+# 每个标签对应一个位置，前序关系和传递闭包都用python的int做位集合，
+# 查询“X的所有前序知识”“哪些标签依赖X”只是取一个int再展开，不查数据库
+# Tag或者前序关系变化时只把缓存作废，下次查询时再整体重建
+
+import itertools
+import threading
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from dbsystem.models_mysql import Tag, TagAbility
+
+
+def _bits(mask):
+    # 位集合展开成位置，反转后的二进制字符串上用find比逐位移位快得多
+    digits = bin(mask)[:1:-1]
+    i = digits.find('1')
+    while i >= 0:
+        yield i
+        i = digits.find('1', i + 1)
+
+
+class TagGraph(object):
+
+    def __init__(self, tag_ids, edges):
+        # edges: (tag_id, precursor_id)，precursor是tag的前序知识
+        self.ids = list(tag_ids)
+        self.index = {tag_id: i for i, tag_id in enumerate(self.ids)}
+        n = len(self.ids)
+        self.direct = [0] * n
+        dependents = [[] for _ in range(n)]
+        for tag_id, precursor_id in edges:
+            i, j = self.index.get(tag_id), self.index.get(precursor_id)
+            if i is None or j is None or i == j:
+                continue
+            if not self.direct[i] >> j & 1:
+                self.direct[i] |= 1 << j
+                dependents[j].append(i)
+
+        # Kahn拓扑排序，前序知识排在前面，剩下的就是在环上或者依赖环的标签
+        indegree = [bin(mask).count('1') for mask in self.direct]
+        order = [i for i in range(n) if indegree[i] == 0]
+        for i in order:
+            for k in dependents[i]:
+                indegree[k] -= 1
+                if indegree[k] == 0:
+                    order.append(k)
+        self.order = order
+        ordered = set(order)
+        self.unordered = [i for i in range(n) if i not in ordered]
+        self.rank = [0] * n
+        for r, i in enumerate(order + self.unordered):
+            self.rank[i] = r
+
+        self.up = [0] * n
+        for i in order:
+            mask = self.direct[i]
+            for j in _bits(self.direct[i]):
+                mask |= self.up[j]
+            self.up[i] = mask
+        changed = bool(self.unordered)
+        while changed:
+            changed = False
+            for i in self.unordered:
+                mask = self.direct[i]
+                for j in _bits(self.direct[i]):
+                    mask |= self.up[j]
+                if mask != self.up[i]:
+                    self.up[i] = mask
+                    changed = True
+
+        self.down = [0] * n
+        for i in range(n):
+            for j in _bits(self.up[i]):
+                self.down[j] |= 1 << i
+
+    @classmethod
+    def load(cls):
+        through = Tag.precursor.through
+        return cls(Tag.objects.order_by('pk').values_list('pk', flat=True),
+                   through.objects.values_list('from_tag_id', 'to_tag_id'))
+
+    def _ids(self, mask):
+        return [self.ids[i] for i in _bits(mask)]
+
+    def mask(self, tag_ids):
+        mask = 0
+        for tag_id in tag_ids:
+            i = self.index.get(tag_id)
+            if i is not None:
+                mask |= 1 << i
+        return mask
+
+    def topological_order(self):
+        return [self.ids[i] for i in self.order]
+
+    def has_cycle(self):
+        return bool(self.unordered)
+
+    def cycle_tags(self):
+        # 在环上的标签，以及依赖了环的标签
+        return [self.ids[i] for i in self.unordered]
+
+    def prerequisite_mask(self, tag_id):
+        return self.up[self.index[tag_id]]
+
+    def dependent_mask(self, tag_id):
+        return self.down[self.index[tag_id]]
+
+    def direct_prerequisites(self, tag_id):
+        return self._ids(self.direct[self.index[tag_id]])
+
+    def prerequisites(self, tag_id):
+        return self._ids(self.up[self.index[tag_id]])
+
+    def dependents(self, tag_id):
+        return self._ids(self.down[self.index[tag_id]])
+
+    def is_prerequisite(self, precursor_id, tag_id):
+        return bool(self.up[self.index[tag_id]] >> self.index[precursor_id] & 1)
+
+    def missing_prerequisites(self, tag_id, mastered):
+        # 到达tag_id路径上还没掌握的前序知识，按拓扑序返回
+        missing = self.up[self.index[tag_id]] & ~self.mask(mastered)
+        return [self.ids[i] for i in sorted(_bits(missing), key=self.rank.__getitem__)]
+
+
+_graph = None
+_lock = threading.Lock()
+# 每次作废换一个新值；next()在持有GIL时完成，不需要另外加锁
+_generations = itertools.count(1)
+_generation = 0
+
+
+def get_graph():
+    global _graph
+    graph = _graph
+    if graph is None:
+        with _lock:
+            graph = _graph
+            if graph is None:
+                generation = _generation
+                graph = TagGraph.load()
+                # 加载期间被作废过：读到的可能是改之前的数据，只给这一次调用用，不放进缓存
+                if generation == _generation:
+                    _graph = graph
+    return graph
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(m2m_changed, sender=Tag.precursor.through)
+def invalidate(**kwargs):
+    global _graph, _generation
+    _generation = next(_generations)
+    _graph = None
+
+
+def lacking_prerequisites(student_id, tag_id, min_degree):
+    # 学生在tag_id的前序知识里，掌握程度低于min_degree的标签
+    graph = get_graph()
+    candidates = graph.prerequisites(tag_id)
+    mastered = TagAbility.objects.filter(student_id=student_id, tag_id__in=candidates,
+                                         degree__gte=min_degree).values_list('tag_id', flat=True)
+    return graph.missing_prerequisites(tag_id, mastered)
+
@@ -1,3 +1,2169 @@
-from django.test import TestCase
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import gridfs
+import numpy as np
+from mongoengine import connect, disconnect, signals
+from PIL import Image
+from pymongo import ReadPreference
+
+from . import aggregates, api, bulk, export, grading, hierarchy, instrumentation, mastery, models as mongo, mongoconn, \
+    mongosync, profiles, ranking, recommend, refcache, reports, rollups, search, snapshot, submit, taggraph, images
+from .models_mysql import *
+from .synthetic import Generator
+
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:
+    mongomock = None
+
+
+class AdminQueryBudgetTest(TestCase):
+    # 列表页的查询次数是固定的，不随每页行数增长
+    BUDGET = 5
+
+    MODELS = (Subject, Book, Chapter, Tag, School, Class, People, Teacher, Student, Stuff, TagAbility,
+              Problem, Exercise, ProblemCondition, ExerciseCondition, ProblemStat, ExerciseStat, MongoIdMap,
+              AnswerRollup, RollupState, AnswerKey, Submission, ImageBlob, DataVersion, ReportJob)
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.count = 0
+
+    def add_rows(self, n):
+        for _ in range(n):
+            self.count += 1
+            i = self.count
+            subject = Subject.objects.create(name='科目%d' % i)
+            book = Book.objects.create(name='书%d' % i, series='系列', subject=subject)
+            chapter = Chapter.objects.create(name='章%d' % i, book=book)
+            tag = Tag.objects.create(name='标签%d' % i, category='Z', difficulty=1, description='',
+                                     book=book, chapter=chapter)
+            school = School.objects.create(name='学校%d' % i, area='1', administrator='', property='public',
+                                           rank=i, description='', level='other')
+            Class.objects.create(name='班级%d' % i, entry_year=2018, rank=i)
+            teacher = Teacher.objects.create(name='老师%d' % i, born_year=1980, sex='male', school=school,
+                                             position='', subject=subject, entry_year=2000)
+            Stuff.objects.create(name='职员%d' % i, born_year=1980, sex='male', school=school, entry_year=2000)
+            student = Student.objects.create(name='学生%d' % i, born_year=2005, sex='female', school=school,
+                                             hardness=1, frustration=1, habit=1, correct=1, comprehensive=1,
+                                             logic=1, abstract=1, spatial=1, conclusive=1)
+            TagAbility.objects.create(student=student, tag=tag, degree=50)
+            problem = Problem.objects.create(name='题%d' % i)
+            exercise = Exercise.objects.create(name='练习%d' % i, release_time=timezone.now(), length=40, aim='4',
+                                               release_people=teacher, subject=subject, types='2')
+            condition = ProblemCondition.objects.create(student=student, problem=problem, result='A', judge='',
+                                                        cost=30, points=5)
+            ExerciseCondition.objects.create(exercise=exercise, student=student,
+                                             finish_time=timezone.now()).results.add(condition)
+            AnswerKey.objects.create(exercise=exercise, problem=problem, answer='A', points=5)
+            Submission.objects.create(exercise=exercise, student=student, problem=problem, answer='A', cost=30,
+                                      submitted_at=timezone.now(), problem_condition=condition)
+            ImageBlob.objects.create(digest='%064x' % i, content_type='image/png', thumbnail_type='image/webp',
+                                     width=1, height=1, size=1)
+            DataVersion.objects.create(name='数据%d' % i, version=i)
+            ReportJob.objects.create(kind='students2problem', params='{}', cache_key='%064x' % i)
+
+    def changelist_queries(self, model):
+        url = reverse('admin:dbsystem_%s_changelist' % model._meta.model_name)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_budget(self):
+        self.add_rows(1)
+        one_row = {model: self.changelist_queries(model) for model in self.MODELS}
+        self.add_rows(29)
+        for model in self.MODELS:
+            queries = self.changelist_queries(model)
+            self.assertEqual(queries, one_row[model], model.__name__)
+            self.assertLessEqual(queries, self.BUDGET, model.__name__)
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=12, scale='tiny').run()
+        aggregates.rebuild()
+        instrumentation.registry.reset()
+        self.addCleanup(instrumentation.registry.reset)
+
+    def test_headers_and_counters(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/problem-conditions/', {'limit': 5})
+        # 每个请求开始时Django会清空connection.queries，先记下来
+        count = len(queries)
+        self.assertEqual(int(response['X-SQL-Queries']), count)
+        self.assertGreater(count, 0)
+        self.assertEqual(response['X-Mongo-Commands'], '0')
+        for header in ('X-SQL-Time-Ms', 'X-Mongo-Time-Ms', 'X-View-Time-Ms'):
+            self.assertGreaterEqual(float(response[header]), 0)
+        self.client.get('/api/problem-conditions/', {'limit': 5})
+        views = instrumentation.registry.snapshot()['views']
+        self.assertEqual(list(views), ['dbsystem.views.ProblemConditions'])
+        stats = views['dbsystem.views.ProblemConditions']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['sql_queries']['max'], count)
+
+        # 流式响应的查询在内容发送完以后才记录
+        exercise = Exercise.objects.order_by('pk').first()
+        response = self.client.get('/Students2Problem/export/', {'exercise_number': exercise.pk, 'format': 'csv'})
+        header = int(response['X-SQL-Queries'])
+        self.assertNotIn('dbsystem.views.Students2ProblemExport', instrumentation.registry.snapshot()['views'])
+        b''.join(response.streaming_content)
+        stats = instrumentation.registry.snapshot()['views']['dbsystem.views.Students2ProblemExport']
+        self.assertGreater(stats['sql_queries']['max'], header)
+
+    def test_unresolved_paths_share_one_key(self):
+        for i in range(20):
+            self.assertEqual(self.client.get('/no-such-page-%d/' % i).status_code, 404)
+        views = instrumentation.registry.snapshot()['views']
+        self.assertEqual(list(views), [instrumentation.UNRESOLVED])
+        self.assertEqual(views[instrumentation.UNRESOLVED]['count'], 20)
+
+    @override_settings(DB_STATS_SLOW_MS=0)
+    def test_slow_log(self):
+        with self.assertLogs('dbsystem.slow_query', 'WARNING'):
+            self.client.get('/api/problem-conditions/', {'limit': 5})
+        slow = instrumentation.registry.snapshot()['slow']
+        self.assertGreater(len(slow), 0)
+        self.assertEqual({entry['kind'] for entry in slow}, {'sql'})
+        self.assertTrue(any(entry['call_site'].startswith('dbsystem/api.py') for entry in slow))
+        self.assertNotIn("'", ''.join(entry['statement'] for entry in slow))
+
+    def test_endpoint(self):
+        self.client.get('/api/problem-conditions/', {'limit': 5})
+        self.assertIn('dbsystem.views.ProblemConditions', self.client.get('/dbstats/').json()['views'])
+        self.assertEqual(self.client.get('/dbstats/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        # 查看不会清空计数，只有POST才清空
+        self.client.get('/dbstats/', {'reset': 1})
+        self.assertIn('dbsystem.views.ProblemConditions', instrumentation.registry.snapshot()['views'])
+        self.assertEqual(self.client.post('/dbstats/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        self.assertIn('dbsystem.views.ProblemConditions', instrumentation.registry.snapshot()['views'])
+        self.assertEqual(self.client.put('/dbstats/').status_code, 405)
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.post('/dbstats/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('dbsystem.views.ProblemConditions', response.json()['views'])
+        self.assertIn('ref_cache', response.json())
+
+    def test_mongo_listener(self):
+        listener = instrumentation.MongoCommandListener(max_pending=3)
+
+        def event(request_id, micros=1000):
+            return SimpleNamespace(connection_id=('localhost', 27017), request_id=request_id, command_name='find',
+                                   command={'find': 'problem', 'filter': {'name': 'x'}}, duration_micros=micros)
+
+        # 没有结束事件的命令不会无限累积
+        for request_id in range(5):
+            listener.started(event(request_id))
+        self.assertEqual(list(listener._started), [(('localhost', 27017), i) for i in (2, 3, 4)])
+        stats = instrumentation.RequestStats('view')
+        with instrumentation.QueryStatsMiddleware(None).collect(stats):
+            listener.failed(event(3, 2000))
+            listener.succeeded(event(4))
+            # 已经被挤掉的命令只计数，不进慢查询日志
+            listener.succeeded(event(0))
+        self.assertEqual(list(listener._started), [(('localhost', 27017), 2)])
+        self.assertEqual(stats.mongo_count, 3)
+        self.assertAlmostEqual(stats.mongo_time, 0.004)
+
+
+class SyntheticDataTest(TestCase):
+
+    def test_tiny_scale(self):
+        counts = Generator(seed=1, scale='tiny').run()
+        aggregates.rebuild()
+        self.assertEqual(Student.objects.count(), counts['Student'])
+        self.assertEqual((Stuff.objects.count(), counts['Stuff']), (1, 1))
+        self.assertEqual(ProblemCondition.objects.count(), 4 * 1 * 10 * 5)
+        self.assertEqual(ExerciseCondition.results.through.objects.count(), ProblemCondition.objects.count())
+        self.assertEqual(sum(ProblemStat.objects.values_list('count', flat=True)), ProblemCondition.objects.count())
+        # 每块答题在自己的事务里分配主键，和已有的数据接着编号
+        with patch('dbsystem.synthetic.CHUNK_SIZE', 7):
+            counts = Generator(seed=2, scale='tiny').run()
+        self.assertEqual(ProblemCondition.objects.count(), 2 * 4 * 1 * 10 * 5)
+        self.assertEqual(ExerciseCondition.objects.count(), 2 * 4 * 1 * 10)
+        self.assertFalse(ExerciseCondition.results.through.objects.exclude(
+            exercisecondition__student_id=F('problemcondition__student_id')).exists())
+        # 前序知识只指向编号更小的标签
+        for tag_id, precursor_id in Tag.precursor.through.objects.values_list('from_tag_id', 'to_tag_id'):
+            self.assertLess(precursor_id, tag_id)
+
+
+class AggregatesTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=8, scale='tiny').run()
+        aggregates.rebuild()
+        self.problems = list(Problem.objects.order_by('pk')[:3])
+        self.conditions = list(ExerciseCondition.objects.order_by('pk')[:3])
+
+    def stats(self):
+        # 全零的行rebuild以后不存在
+        return [sorted((pk, count, correct, round(points, 6), cost) for pk, count, correct, points, cost in
+                       model.objects.values_list('pk', 'count', 'correct_count', 'points_sum', 'cost_sum')
+                       if count or correct or points or cost)
+                for model in (ProblemStat, ExerciseStat)]
+
+    def assertRebuilt(self):
+        incremental = self.stats()
+        aggregates.rebuild()
+        self.assertEqual(incremental, self.stats())
+
+    def answer(self, problem=None, **fields):
+        student = self.conditions[0].student
+        return ProblemCondition.objects.create(**dict({'student': student, 'problem': problem or self.problems[0],
+                                                       'result': 'A', 'judge': '', 'cost': 30, 'points': 2}, **fields))
+
+    def test_save_and_delete(self):
+        condition = self.answer()
+        self.assertRebuilt()
+        self.conditions[0].results.add(condition)
+        self.assertRebuilt()
+        condition.judge, condition.points = 'B', 0
+        condition.save()
+        self.assertRebuilt()
+        # 换到另一道题：两道题的汇总都要改
+        condition.problem = self.problems[1]
+        condition.judge, condition.points = '', 3
+        condition.save()
+        self.assertRebuilt()
+        condition.delete()
+        self.assertRebuilt()
+        self.conditions[1].delete()
+        self.assertRebuilt()
+
+    def test_result_links(self):
+        first, second = self.answer(), self.answer(self.problems[1], judge='C')
+        self.conditions[0].results.add(first, second)
+        self.assertRebuilt()
+        # 不存在的关联不扣减
+        self.conditions[1].results.remove(first)
+        self.assertRebuilt()
+        self.conditions[0].results.remove(first)
+        self.assertRebuilt()
+        first.exercisecondition_set.add(self.conditions[1], self.conditions[2])
+        self.assertRebuilt()
+        first.exercisecondition_set.clear()
+        self.assertRebuilt()
+        # 练习完成情况换到另一个练习，关联跟着走
+        moved = self.conditions[0].exercise
+        moved.pk = None
+        moved.save()
+        self.conditions[0].exercise = moved
+        self.conditions[0].save()
+        self.assertRebuilt()
+        self.conditions[0].results.clear()
+        self.assertRebuilt()
+
+    def test_cascade_counts_each_link_once(self):
+        # 删除学生时题目完成情况和练习完成情况一起删除，两端的pre_delete都看到同一批关联
+        student = self.conditions[0].student
+        self.assertGreater(ExerciseCondition.results.through.objects.filter(
+            exercisecondition__student=student).count(), 0)
+        student.delete()
+        self.assertEqual(aggregates._deleting_links(), set())
+        self.assertRebuilt()
+
+    def test_missing_row_is_created(self):
+        problem = Problem.objects.create(name='新题')
+        exercise = self.conditions[0].exercise
+        ExerciseStat.objects.filter(pk=exercise.pk).delete()
+        self.conditions[0].results.add(self.answer(problem))
+        self.assertEqual(ProblemStat.objects.filter(pk=problem.pk).values_list('count', 'correct_count').get(),
+                         (1, 1))
+        self.assertEqual(ExerciseStat.objects.get(pk=exercise.pk).count, 1)
+
+    def test_missing_row_is_not_created_for_negative_delta(self):
+        # 扣减不建行，不会出现次数/正确数为负的汇总
+        condition = self.answer(Problem.objects.create(name='新题'))
+        ProblemStat.objects.filter(pk=condition.problem_id).delete()
+        condition.judge = 'B'
+        condition.save()
+        self.assertFalse(ProblemStat.objects.filter(pk=condition.problem_id).exists())
+        condition.delete()
+        self.assertFalse(ProblemStat.objects.filter(pk=condition.problem_id).exists())
+        self.assertRebuilt()
+
+
+class IngestAnswersTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=11, scale='tiny').run()
+        aggregates.rebuild()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.existing = ExerciseCondition.objects.order_by('pk').first()
+        self.exercise = Exercise.objects.exclude(pk__in=ExerciseCondition.objects.filter(
+            student=self.existing.student).values('exercise_id')).first()
+        self.problems = list(Problem.objects.order_by('pk').values_list('pk', flat=True)[:3])
+
+    def write_csv(self, rows):
+        path = os.path.join(self.path, 'answers.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('student', 'problem', 'exercise', 'finish_time', 'result', 'judge', 'cost', 'points'))
+            writer.writerows(rows)
+        return path
+
+    def ingest(self, *files, **options):
+        out, err = StringIO(), StringIO()
+        call_command('ingest_answers', *files, stdout=out, stderr=err, **dict({'workers': 1}, **options))
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_records(self):
+        student = self.existing.student_id
+        path = self.write_csv([
+            (student, self.problems[0], self.existing.exercise_id, '2019-03-01 08:00:00', 'A', '', 30, 2),
+            # 引号里的换行属于同一条记录
+            (student, self.problems[1], self.existing.exercise_id, '2019-03-01 08:01:00', '第一行\n第二行',
+             '第一行\n第二行', 40, 0),
+            (student, self.problems[2], self.existing.exercise_id, 'yesterday', 'A', '', 30, 2),
+            (10 ** 9, self.problems[2], self.existing.exercise_id, '2019-03-01 08:02:00', 'A', '', 30, 2),
+            (student, self.problems[2], self.exercise.pk, '2019-03-02 08:00:00', 'B', '', 50, 2),
+        ])
+        before = (ProblemCondition.objects.count(), ExerciseCondition.objects.count())
+        lock = DataVersion.objects.get(pk=bulk.ID_LOCK).version
+        out, err = self.ingest(path, parse_batch=2, chunk_size=2, skip_stats=True)
+        self.assertIn('done: 3 written, 2 skipped', out)
+        self.assertIn('next offset 5', out)
+        self.assertIn('record 2: bad finish_time', err)
+        # 主键经过共用的分配锁，和批改、在线提交排队
+        self.assertGreater(DataVersion.objects.get(pk=bulk.ID_LOCK).version, lock)
+        self.assertEqual(ProblemCondition.objects.count(), before[0] + 3)
+        # 已有的(练习, 学生)沿用原来的练习完成情况
+        self.assertEqual(ExerciseCondition.objects.count(), before[1] + 1)
+        multiline = self.existing.results.get(problem_id=self.problems[1], cost=40)
+        self.assertEqual((multiline.result, multiline.judge), ('第一行\n第二行', '第一行\n第二行'))
+        self.assertEqual(ExerciseCondition.objects.get(exercise=self.exercise, student_id=student).results.get()
+                         .result, 'B')
+
+        # offset按记录计数：从第4条（下标4）继续只导入最后一条
+        out, _ = self.ingest(path, resume_from=4)
+        self.assertIn('done: 1 written, 0 skipped', out)
+        self.assertEqual(ProblemCondition.objects.count(), before[0] + 4)
+        self.assertEqual(sorted(ProblemStat.objects.values_list('problem_id', 'count')),
+                         sorted((pk, totals[0]) for pk, totals in aggregates.problem_totals()))
+
+    def test_appended_answers_move_finish_time(self):
+        student, exercise = self.existing.student_id, self.existing.exercise_id
+        later = self.existing.finish_time + timedelta(days=1)
+        path = self.write_csv([
+            (student, self.problems[0], exercise, (later - timedelta(days=3)).isoformat(), 'A', '', 30, 2),
+            (student, self.problems[1], exercise, later.isoformat(), 'A', '', 30, 2),
+        ])
+        self.ingest(path, skip_stats=True)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.finish_time, later)
+        # 更早的记录不把完成时间往回改
+        path = self.write_csv([
+            (student, self.problems[2], exercise, (later - timedelta(days=2)).isoformat(), 'A', '', 30, 2)])
+        self.ingest(path, skip_stats=True)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.finish_time, later)
+
+    def test_jsonl_and_multiple_files(self):
+        student = self.existing.student_id
+        csv_path = self.write_csv([
+            (student, self.problems[0], self.exercise.pk, '2019-03-01 08:00:00', 'A', '', 30, 2)])
+        jsonl_path = os.path.join(self.path, 'answers.jsonl')
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            for problem in self.problems:
+                f.write(json.dumps({'student': student, 'problem': problem, 'exercise': self.exercise.pk,
+                                    'finish_time': '2019-03-01T09:00:00', 'result': 'C', 'judge': 'C'}) + '\n\n')
+        before = ProblemCondition.objects.count()
+        out, _ = self.ingest(csv_path, jsonl_path, resume_from=2, skip_stats=True)
+        self.assertIn('done: 2 written, 0 skipped, ', out)
+        self.assertIn('next offset 4', out)
+        self.assertEqual(ProblemCondition.objects.count(), before + 2)
+        condition = ExerciseCondition.objects.get(exercise=self.exercise, student_id=student)
+        self.assertEqual(sorted(condition.results.values_list('problem_id', flat=True)), self.problems[1:])
+
+
+class RollupTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=2, scale='tiny', exercises=12).run()
+        aggregates.rebuild()
+
+    def totals(self, period):
+        return sum(AnswerRollup.objects.filter(period=period).values_list('count', flat=True))
+
+    def test_refresh_and_trend(self):
+        rollups.refresh()
+        links = ExerciseCondition.results.through.objects.count()
+        # tiny里每个学生只在一个班级
+        self.assertEqual(self.totals('day'), links)
+        self.assertEqual(self.totals('week'), links)
+        self.assertEqual(rollups.refresh(), 0)
+
+        group = Class.objects.order_by('pk').first()
+        weeks = rollups.trend(group.pk)
+        conditions = ProblemCondition.objects.filter(exercisecondition__student__classes=group)
+        self.assertEqual(sum(week['count'] for week in weeks), conditions.count())
+        self.assertEqual(sum(week['correct_count'] for week in weeks),
+                         conditions.filter(aggregates.correct_q()).count())
+        self.assertEqual([week['bucket'].weekday() for week in weeks], [0] * len(weeks))
+
+        # 补录一条很早以前的记录，只重算它所在的日/周
+        student = Student.objects.filter(classes=group).first()
+        exercise = Exercise.objects.create(name='补录', release_time=timezone.now(), length=40, aim='4',
+                                           release_people=Teacher.objects.first(), subject=Subject.objects.first(),
+                                           types='1')
+        old = ExerciseCondition.objects.create(exercise=exercise, student=student,
+                                               finish_time=timezone.now() - timedelta(days=2000))
+        old.results.add(ProblemCondition.objects.create(student=student, problem=Problem.objects.first(), result='A',
+                                                        judge='', cost=30, points=5))
+        rollups.refresh()
+        self.assertEqual(self.totals('week'), links + 1)
+        day = timezone.localtime(old.finish_time).date()
+        self.assertEqual(AnswerRollup.objects.get(period='day', bucket=day).count, 1)
+
+    def test_answers_added_to_existing_condition(self):
+        rollups.refresh()
+        links = ExerciseCondition.results.through.objects.count()
+        # 在线提交和批改都是在已有的练习完成情况后面追加答题
+        condition = ExerciseCondition.objects.filter(student__classes__isnull=False).order_by('pk').first()
+        problem = Problem.objects.order_by('pk').first()
+        day = AnswerRollup.objects.filter(period='day', bucket=timezone.localtime(condition.finish_time).date(),
+                                          group=condition.student.classes.first(), problem=problem)
+        before = sum(day.values_list('count', flat=True))
+        condition.results.add(ProblemCondition.objects.create(student=condition.student, problem=problem,
+                                                              result='A', judge='', cost=30, points=5))
+        self.assertGreater(rollups.refresh(), 0)
+        self.assertEqual((self.totals('day'), self.totals('week')), (links + 1, links + 1))
+        self.assertEqual(sum(day.values_list('count', flat=True)), before + 1)
+        self.assertEqual(rollups.refresh(), 0)
+
+    def test_archive(self):
+        rollups.refresh()
+        before_counts = (self.totals('day'), self.totals('week'))
+        problem_stats = sorted(ProblemStat.objects.values_list('problem_id', 'count'))
+        cutoff = (timezone.now() - timedelta(days=365)).date()
+        old = ExerciseCondition.objects.filter(finish_time__lt=rollups._start(rollups.bucket_of('week', cutoff)))
+        expected = ExerciseCondition.results.through.objects.filter(exercisecondition__in=old).count()
+        self.assertGreater(expected, 0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('archive_answers', before=cutoff.isoformat(), dir=directory, stdout=StringIO())
+            rows = [row for name in os.listdir(directory)
+                    for row in rollups.read_archive(os.path.join(directory, name))]
+        self.assertEqual(len(rows), expected)
+        self.assertFalse(old.exists())
+        self.assertEqual(ExerciseCondition.results.through.objects.count() + expected,
+                         sum(AnswerRollup.objects.filter(period='week').values_list('count', flat=True)))
+        # 归档不影响汇总和累计统计，之后重算也不会动已归档的日期
+        call_command('rollup', rebuild=True, stdout=StringIO())
+        self.assertEqual((self.totals('day'), self.totals('week')), before_counts)
+        self.assertEqual(sorted(ProblemStat.objects.values_list('problem_id', 'count')), problem_stats)
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=3, scale='tiny').run()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+
+    def test_write_append_and_read(self):
+        out = StringIO()
+        call_command('snapshot', directory=self.path, stdout=out)
+        self.assertIn('4 tables', out.getvalue())
+        table = snapshot.open_table('problem_conditions', self.path)
+        self.assertEqual(len(table), ProblemCondition.objects.count())
+        self.assertIsInstance(table['points'], np.memmap)
+        self.assertEqual(table['student'].dtype, np.int32)
+        problem_ids, counts, correct = table.group('problem', 'correct')
+        self.assertEqual({pk: (count, int(value)) for pk, count, value in zip(problem_ids, counts, correct)},
+                         {pk: totals[:2] for pk, totals in aggregates.problem_totals()})
+        student = Student.objects.order_by('pk').first()
+        mask = table.mask(student=[student.pk, 10 ** 9], answered=True)
+        self.assertEqual(sorted(table.values('id', mask)),
+                         sorted(ProblemCondition.objects.filter(student=student).exclude(result='')
+                                .values_list('pk', flat=True)))
+        self.assertEqual(set(table.values('student', mask)), {student.pk})
+        ability = snapshot.open_table('tag_abilities', self.path)
+        self.assertEqual(sorted(zip(ability.values('student'), ability.values('tag'), ability['degree'])),
+                         sorted(TagAbility.objects.values_list('student_id', 'tag_id', 'degree')))
+
+        # 追加：只写新行，已有的编码不变；上次中途失败多写的部分被截掉
+        codes = np.array(table['student'])
+        with open(os.path.join(self.path, 'problem_conditions', 'points.npy'), 'ab') as f:
+            f.write(b'\0' * 24)
+        newcomer = Student.objects.create(name='转学生', born_year=2005, sex='female', school=School.objects.first(),
+                                          hardness=1, frustration=1, habit=1, correct=1, comprehensive=1, logic=1,
+                                          abstract=1, spatial=1, conclusive=1)
+        condition = ProblemCondition.objects.create(student=newcomer, problem=Problem.objects.first(), result='A',
+                                                    judge='', cost=30, points=5)
+        written = snapshot.write(['problem_conditions'], self.path)
+        self.assertEqual(written, {'problem_conditions': 1})
+        table = snapshot.open_table('problem_conditions', self.path)
+        self.assertEqual(len(table), len(codes) + 1)
+        self.assertEqual(table.meta['watermark'], condition.pk)
+        self.assertTrue(np.array_equal(table['student'][:-1], codes))
+        self.assertEqual(table['student'][-1], len(table.dictionary('student')) - 1)
+        self.assertEqual(list(table.values('student', table.mask(id=condition.pk))), [newcomer.pk])
+        self.assertEqual(float(table['points'][-1]), 5.0)
+        self.assertEqual(np.load(os.path.join(self.path, 'problem_conditions', 'points.npy')).shape, (len(table),))
+        self.assertEqual(snapshot.write(['problem_conditions'], self.path), {'problem_conditions': 0})
+
+        # 修改已有行要整表重写
+        ProblemCondition.objects.filter(pk=condition.pk).update(points=3)
+        snapshot.write(['problem_conditions'], self.path, rebuild=True)
+        self.assertEqual(float(snapshot.open_table('problem_conditions', self.path)['points'][-1]), 3.0)
+
+
+class MasteryTest(TestCase):
+
+    def setUp(self):
+        mastery.invalidate()
+        self.addCleanup(mastery.invalidate)
+        # 学生10的(10, 1)有两条，保留后面的55
+        self.matrix = mastery.MasteryMatrix(
+            [10, 10, 10, 20, 20, 30, 10], [1, 2, 3, 1, 3, 2, 1], [50, 80, 20, 90, 40, 60, 55],
+            schools=([10, 20, 30, 99], [100, 100, 200, 300]), classes=([10, 20, 20, 30], [7, 7, 8, 8]))
+
+    def test_row_and_dense(self):
+        self.assertEqual(self.matrix.shape, (3, 3))
+        self.assertEqual(self.matrix.nnz, 6)
+        tags, degrees = self.matrix.row(10)
+        self.assertEqual((tags.tolist(), degrees.tolist()), ([1, 2, 3], [55, 80, 20]))
+        self.assertEqual([len(part) for part in self.matrix.row(99)], [0, 0])
+        np.testing.assert_array_equal(self.matrix.dense([10, 30, 99], [3, 2]),
+                                      [[20, 80], [np.nan, 60], [np.nan, np.nan]])
+        self.assertTrue(self.matrix.set(30, 2, 65))
+        self.assertFalse(self.matrix.set(30, 1, 65))
+        self.assertEqual(self.matrix.row(30)[1].tolist(), [65])
+
+    def test_group_means(self):
+        groups, means = self.matrix.class_means()
+        self.assertEqual(groups.tolist(), [7, 8])
+        np.testing.assert_array_equal(means, [[72.5, 80, 30], [90, 60, 40]])
+        groups, means = self.matrix.school_means()
+        self.assertEqual(groups.tolist(), [100, 200])
+        np.testing.assert_array_equal(means, [[72.5, 80, 30], [np.nan, 60, np.nan]])
+        groups, means = self.matrix.school_means([200])
+        self.assertEqual(groups.tolist(), [200])
+        groups, means = self.matrix.group_means([30, 20, 99], [1, 1, 1])
+        np.testing.assert_array_equal(means, [[90, 60, 40]])
+
+    def test_top_k_and_where(self):
+        students, tags, degrees = self.matrix.top_k(1)
+        self.assertEqual(list(zip(students.tolist(), tags.tolist(), degrees.tolist())),
+                         [(10, 3, 20), (20, 3, 40), (30, 2, 60)])
+        students, tags, degrees = self.matrix.top_k(2, largest=True, student_ids=[10])
+        self.assertEqual((tags.tolist(), degrees.tolist()), ([2, 1], [80, 55]))
+        students, tags, degrees = self.matrix.where('lt', 50)
+        self.assertEqual(list(zip(students.tolist(), tags.tolist())), [(10, 3), (20, 3)])
+        # 按标签给阈值，没给阈值的标签3不参与比较
+        students, tags, degrees = self.matrix.where('ge', {1: 60, 2: 70, 99: 0})
+        self.assertEqual(list(zip(students.tolist(), tags.tolist(), degrees.tolist())), [(10, 2, 80), (20, 1, 90)])
+        students, tags, degrees = self.matrix.where('ne', 60, student_ids=[30, 99])
+        self.assertEqual(len(students), 0)
+
+    def test_empty(self):
+        matrix = mastery.MasteryMatrix([], [], [])
+        self.assertEqual((matrix.shape, matrix.nnz), ((0, 0), 0))
+        self.assertEqual([len(part) for part in matrix.row(1)], [0, 0])
+        self.assertEqual([len(part) for part in matrix.top_k(3)], [0, 0, 0])
+        self.assertEqual([len(part) for part in matrix.where('lt', 50)], [0, 0, 0])
+        self.assertEqual(matrix.class_means()[1].shape, (0, 0))
+        self.assertEqual(matrix.dense([1], [2]).shape, (1, 1))
+        self.assertFalse(matrix.set(1, 2, 3))
+
+    def test_signal_updates(self):
+        Generator(seed=10, scale='tiny').run()
+        matrix = mastery.get_matrix()
+        self.assertEqual(matrix.nnz, TagAbility.objects.count())
+        ability = TagAbility.objects.order_by('pk').first()
+        ability.degree = 7
+        ability.save()
+        # 已有的元素原地更新，不重新加载
+        self.assertIs(mastery.get_matrix(), matrix)
+        self.assertEqual(dict(zip(*[part.tolist() for part in matrix.row(ability.student_id)]))[ability.tag_id], 7)
+
+        # 换学生：即使矩阵里新位置已经有值（另一条记录批量改走了，还没作废），旧位置上的值也不能留下
+        old_student = ability.student_id
+        other = TagAbility.objects.filter(tag_id=ability.tag_id).exclude(student_id=old_student).first()
+        TagAbility.objects.filter(pk=other.pk).update(tag=Tag.objects.exclude(pk__in=TagAbility.objects.filter(
+            student_id=other.student_id).values('tag_id')).first())
+        ability.student_id = other.student_id
+        ability.save()
+        matrix = mastery.get_matrix()
+        self.assertNotIn(ability.tag_id, matrix.row(old_student)[0].tolist())
+
+        TagAbility.objects.create(student_id=old_student, tag_id=ability.tag_id, degree=9)
+        self.assertIsNot(mastery.get_matrix(), matrix)
+        matrix = mastery.get_matrix()
+        ability.delete()
+        self.assertIsNot(mastery.get_matrix(), matrix)
+        self.assertEqual(mastery.get_matrix().nnz, TagAbility.objects.count())
+
+    def test_write_during_load(self):
+        Generator(seed=10, scale='tiny').run()
+        ability = TagAbility.objects.order_by('pk').first()
+        load = mastery.MasteryMatrix.load
+
+        def racing_load():
+            # 读完以后、放进缓存之前有人改了掌握程度
+            matrix = load()
+            TagAbility.objects.filter(pk=ability.pk).update(degree=3)
+            TagAbility.objects.get(pk=ability.pk).save()
+            return matrix
+
+        with patch.object(mastery.MasteryMatrix, 'load', racing_load):
+            mastery.get_matrix()
+        self.assertIsNone(mastery._matrix)
+        row = mastery.get_matrix().row(ability.student_id)
+        self.assertEqual(dict(zip(*[part.tolist() for part in row]))[ability.tag_id], 3)
+
+
+class TagGraphTest(TestCase):
+    # 4依赖2和3，2和3依赖1，5依赖4；6和7互为前序，8依赖6
+    EDGES = [(2, 1), (3, 1), (4, 2), (4, 3), (5, 4), (4, 2), (6, 7), (7, 6), (8, 6), (5, 5), (5, 99)]
+
+    def setUp(self):
+        taggraph.invalidate()
+        self.addCleanup(taggraph.invalidate)
+
+    def test_closure(self):
+        graph = taggraph.TagGraph(range(1, 9), self.EDGES)
+        self.assertEqual(graph.direct_prerequisites(4), [2, 3])
+        self.assertEqual(graph.prerequisites(5), [1, 2, 3, 4])
+        self.assertEqual(graph.dependents(1), [2, 3, 4, 5])
+        self.assertEqual(graph.prerequisites(1), [])
+        self.assertTrue(graph.is_prerequisite(1, 5))
+        self.assertFalse(graph.is_prerequisite(5, 1))
+        self.assertEqual(graph.prerequisite_mask(4), graph.mask([1, 2, 3]))
+        # 环上的标签互为前序，依赖环的标签也看得到整个环
+        self.assertEqual(graph.prerequisites(6), [6, 7])
+        self.assertEqual(graph.prerequisites(8), [6, 7])
+
+    def test_cycles_and_order(self):
+        graph = taggraph.TagGraph(range(1, 9), self.EDGES)
+        self.assertTrue(graph.has_cycle())
+        self.assertEqual(sorted(graph.cycle_tags()), [6, 7, 8])
+        order = graph.topological_order()
+        self.assertEqual(sorted(order), [1, 2, 3, 4, 5])
+        for tag_id, precursor_id in self.EDGES:
+            if tag_id in order and precursor_id in order and tag_id != precursor_id:
+                self.assertLess(order.index(precursor_id), order.index(tag_id))
+        self.assertEqual(graph.missing_prerequisites(5, [2]), [1, 3, 4])
+
+        acyclic = taggraph.TagGraph(range(1, 6), self.EDGES)
+        self.assertFalse(acyclic.has_cycle())
+        self.assertEqual(acyclic.cycle_tags(), [])
+        self.assertEqual(taggraph.TagGraph([], []).topological_order(), [])
+
+    def test_lacking_prerequisites(self):
+        Generator(seed=9, scale='tiny').run()
+        through = Tag.precursor.through
+        tag_id = through.objects.order_by('-from_tag_id').values_list('from_tag_id', flat=True).first()
+        graph = taggraph.get_graph()
+        self.assertIs(taggraph.get_graph(), graph)
+        student = Student.objects.order_by('pk').first()
+        prerequisites = graph.prerequisites(tag_id)
+        self.assertGreater(len(prerequisites), 0)
+        TagAbility.objects.filter(student=student).delete()
+        TagAbility.objects.create(student=student, tag_id=prerequisites[0], degree=80)
+        lacking = taggraph.lacking_prerequisites(student.pk, tag_id, 60)
+        self.assertEqual(sorted(lacking), prerequisites[1:])
+        self.assertEqual(lacking, [pk for pk in graph.topological_order() if pk in lacking])
+        self.assertEqual(taggraph.lacking_prerequisites(student.pk, tag_id, 90), graph.missing_prerequisites(
+            tag_id, []))
+
+        # 改了前序关系以后重新加载
+        Tag.objects.get(pk=prerequisites[0]).precursor.clear()
+        self.assertIsNot(taggraph.get_graph(), graph)
+
+    def test_invalidate_during_load(self):
+        load = taggraph.TagGraph.load
+
+        def racing_load():
+            graph = load()
+            taggraph.invalidate()
+            return graph
+
+        with patch.object(taggraph.TagGraph, 'load', racing_load):
+            taggraph.get_graph()
+        # 加载期间作废了，读到的旧图不能留在缓存里
+        self.assertIsNone(taggraph._graph)
+        taggraph.get_graph()
+        self.assertIsNotNone(taggraph._graph)
+
+
+class RecommendTest(TestCase):
+
+    def setUp(self):
+        # 缓存是进程级的，别的测试留下的要清掉
+        mastery.invalidate()
+        taggraph.invalidate()
+        recommend.invalidate()
+        subject = Subject.objects.create(name='数学')
+        book = Book.objects.create(name='必修一', series='人教', subject=subject)
+        chapter = Chapter.objects.create(name='集合', book=book)
+        school = School.objects.create(name='一中', area='110', administrator='', property='public', rank=1,
+                                       description='', level='provincial')
+        self.group = Class.objects.create(name='一班', entry_year=2018, rank=1)
+
+        def tag(name, difficulty, *precursors):
+            tag = Tag.objects.create(name=name, category='Z', difficulty=difficulty, description='', book=book,
+                                     chapter=chapter)
+            tag.precursor.set(precursors)
+            return tag
+        self.base = tag('集合', 1)
+        self.union = tag('并集', 3, self.base)
+        self.subset = tag('子集', 2, self.base)
+        self.complement = tag('补集', 1, self.union)
+
+        def problem(name, *tags):
+            problem = Problem.objects.create(name=name)
+            problem.tags.set(tags)
+            return problem
+        self.p_base = problem('基础', self.base)
+        self.p_union = [problem('并%d' % i, self.union) for i in range(3)]
+        self.p_subset = [problem('子%d' % i, self.subset) for i in range(2)]
+        self.p_complement = problem('补', self.complement, self.union)
+
+        def student(name, *degrees):
+            student = Student.objects.create(name=name, born_year=2005, sex='female', school=school, hardness=0,
+                                             frustration=0, habit=0, correct=0, comprehensive=0, logic=0,
+                                             abstract=0, spatial=0, conclusive=0)
+            student.classes.add(self.group)
+            for tag, degree in degrees:
+                TagAbility.objects.create(student=student, tag=tag, degree=degree)
+            return student
+        self.alice = student('甲', (self.base, 90), (self.union, 30))
+        self.bob = student('乙')
+        ProblemCondition.objects.create(student=self.alice, problem=self.p_subset[0], result='A', judge='',
+                                        cost=30, points=5)
+
+    def ids(self, recommendations):
+        return [item.problem_id for item in recommendations]
+
+    def test_prerequisites_and_done(self):
+        items = recommend.recommend(self.alice.pk, k=10, per_tag=10)
+        # 子集更容易排在前面，做过的子0不再推荐；补集的前序并集还没掌握
+        self.assertEqual([item.tag_id for item in items], [self.subset.pk] + [self.union.pk] * 3)
+        self.assertEqual(self.ids(items)[0], self.p_subset[1].pk)
+        self.assertNotIn(self.p_complement.pk, self.ids(items[1:]))
+        self.assertEqual(self.ids(recommend.recommend(self.bob.pk)), [self.p_base.pk])
+        self.assertEqual(len(recommend.recommend(self.alice.pk, k=2, per_tag=1)), 2)
+
+        batch = recommend.recommend_class(self.group.pk, k=10, per_tag=10)
+        self.assertEqual(batch, {self.alice.pk: items, self.bob.pk: recommend.recommend(self.bob.pk)})
+        # isdigit()认上标这类Unicode数字，int()不认
+        self.assertEqual(self.client.get('/recommend/', {'student': '²'}).status_code, 400)
+
+    def test_incremental_index(self):
+        recommend.recommend(self.alice.pk)
+        index = recommend.get_index()
+        with self.assertNumQueries(1):
+            recommend.recommend(self.alice.pk)
+
+        # 并0做对的多，并1全错：正确率离0.7近的排前面
+        for judge in ('', '', '', 'x'):
+            ProblemCondition.objects.create(student=self.bob, problem=self.p_union[0], result='A',
+                                            judge=judge, cost=30, points=5)
+        ProblemCondition.objects.create(student=self.bob, problem=self.p_union[1], result='A', judge='x', cost=30,
+                                        points=5)
+        with self.assertNumQueries(2):
+            # 学生做过的题，再加一次刷新正确率
+            recommend.recommend(self.alice.pk)
+        self.assertEqual(index.problems(self.union.pk)[0], self.p_union[0].pk)
+        self.assertIs(recommend.get_index(), index)
+
+        self.p_base.tags.add(self.subset)
+        self.assertIn(self.p_base.pk, index.problems(self.subset.pk))
+        self.subset.problem_set.remove(self.p_base)
+        self.assertNotIn(self.p_base.pk, index.problems(self.subset.pk))
+
+        self.subset.difficulty = 5
+        self.subset.save()
+        items = recommend.recommend(self.alice.pk, k=1)
+        self.assertEqual(items[0].tag_id, self.union.pk)
+        self.assertEqual(index.difficulty[self.p_complement.pk], 2)
+
+        self.union.delete()
+        self.assertEqual(index.problem_tags[self.p_complement.pk], [self.complement.pk])
+        self.assertIs(recommend.get_index(), index)
+
+    def test_write_during_load(self):
+        recommend.invalidate()
+        load = recommend.ProblemIndex.load
+
+        def racing_load():
+            index = load()
+            self.subset.difficulty = 5
+            self.subset.save()
+            return index
+
+        with patch.object(recommend.ProblemIndex, 'load', racing_load):
+            recommend.get_index()
+        # 标签难度在加载期间变了，读到的旧索引不能留在缓存里
+        self.assertIsNone(recommend._index)
+        self.assertEqual(recommend.get_index().difficulty[self.p_subset[0].pk], 5)
+
+        # 完成情况只记下题目，放进缓存以后刷新正确率，不作废整个索引
+        recommend.invalidate()
+
+        def answering_load():
+            index = load()
+            ProblemCondition.objects.create(student=self.bob, problem=self.p_union[1], result='A', judge='',
+                                            cost=30, points=5)
+            return index
+
+        with patch.object(recommend.ProblemIndex, 'load', answering_load):
+            index = recommend.get_index()
+        self.assertIs(recommend._index, index)
+        self.assertIn(self.p_union[1].pk, index.stale)
+
+
+class ProfileTest(TestCase):
+
+    def setUp(self):
+        profiles.invalidate()
+        self.school = School.objects.create(name='一中', area='110', administrator='', property='public', rank=1,
+                                            description='', level='provincial')
+        self.other_school = School.objects.create(name='二中', area='110', administrator='', property='public',
+                                                  rank=2, description='', level='provincial')
+        self.group = Class.objects.create(name='一班', entry_year=2018, rank=1)
+        # 两团：能力都在20多的和都在80多的
+        self.low = [self.student('低%d' % i, 20 + 2 * i) for i in range(4)]
+        self.high = [self.student('高%d' % i, 80 + i) for i in range(4)]
+        self.far = self.student('外校', 21, school=self.other_school)
+        for student in self.low[:2] + self.high[:2]:
+            student.classes.add(self.group)
+
+    def student(self, name, level, school=None):
+        return Student.objects.create(name=name, born_year=2005, sex='female', school=school or self.school,
+                                      **{field: level for field in profiles.FIELDS})
+
+    def test_write_during_load(self):
+        load = profiles.ProfileIndex.load
+
+        def racing_load():
+            index = load()
+            # 读完以后，外校那个学生的能力变得和高分组一样
+            for field in profiles.FIELDS:
+                setattr(self.far, field, 83)
+            self.far.save()
+            return index
+
+        with patch.object(profiles.ProfileIndex, 'load', racing_load):
+            profiles.get_index()
+        self.assertIsNone(profiles._index)
+        result = profiles.similar([self.high[3].pk], k=1)
+        self.assertEqual(result[self.high[3].pk][0][0], self.far.pk)
+
+    def test_neighbors_and_groups(self):
+        result = profiles.similar([self.low[0].pk, self.high[3].pk], k=2)
+        self.assertEqual([other for other, _ in result[self.low[0].pk]], [self.far.pk, self.low[1].pk])
+        self.assertEqual([other for other, _ in result[self.high[3].pk]], [self.high[2].pk, self.high[1].pk])
+        distances = [distance for _, distance in result[self.low[0].pk]]
+        self.assertLess(distances[0], distances[1])
+
+        # 限定学校/班级；候选不足k个时少返回
+        result = profiles.similar([self.low[0].pk], k=2, school_id=self.school.pk)
+        self.assertEqual([other for other, _ in result[self.low[0].pk]], [self.low[1].pk, self.low[2].pk])
+        result = profiles.similar([self.low[0].pk], k=5, class_id=self.group.pk)
+        self.assertEqual([other for other, _ in result[self.low[0].pk]],
+                         [self.low[1].pk, self.high[0].pk, self.high[1].pk])
+        self.assertEqual(profiles.similar([0], k=3), {0: []})
+
+        groups = profiles.study_groups(2, school_id=self.school.pk)
+        self.assertEqual(sorted(sorted(group) for group in groups),
+                         sorted([sorted(s.pk for s in self.low), sorted(s.pk for s in self.high)]))
+
+        response = self.client.get('/students/similar/', {'student': [self.low[0].pk], 'k': 1, 'school': self.school.pk})
+        self.assertEqual(response.json()['neighbors'][str(self.low[0].pk)][0]['student'], self.low[1].pk)
+        response = self.client.get('/students/groups/', {'class': self.group.pk, 'groups': 2})
+        self.assertEqual(sorted(sorted(group) for group in response.json()['groups']),
+                         sorted([sorted(s.pk for s in self.low[:2]), sorted(s.pk for s in self.high[:2])]))
+        self.assertEqual(self.client.get('/students/similar/').status_code, 400)
+        self.assertEqual(self.client.get('/students/groups/', {'school': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/students/groups/', {'school': '²'}).status_code, 400)
+        self.assertEqual(self.client.get('/students/similar/', {'student': '²'}).status_code, 400)
+        with patch.object(profiles, 'MAX_GROUPS', 1):
+            response = self.client.get('/students/groups/', {'school': self.school.pk, 'groups': 100000})
+        self.assertEqual(len(response.json()['groups']), 1)
+
+    def test_incremental_index(self):
+        index = profiles.get_index()
+        with self.assertNumQueries(0):
+            profiles.similar([self.low[0].pk], k=1)
+
+        # 改能力值原地更新
+        self.high[3].hardness = self.high[3].frustration = 21
+        for field in profiles.FIELDS[2:]:
+            setattr(self.high[3], field, 20)
+        self.high[3].save()
+        self.assertEqual(profiles.similar([self.low[0].pk], k=1)[self.low[0].pk][0][0], self.high[3].pk)
+
+        # 新学生在下次查询前合并进来，删除的学生不再出现
+        new = self.student('新', 20)
+        self.assertEqual(profiles.similar([new.pk], k=1)[new.pk][0], (self.low[0].pk, 0.0))
+        self.low[0].delete()
+        self.assertNotIn(self.low[0].pk, [other for other, _ in profiles.similar([new.pk], k=10)[new.pk]])
+
+        new.classes.add(self.group)
+        self.group.people_set.remove(self.low[1])
+        result = profiles.similar([new.pk], k=5, class_id=self.group.pk)
+        self.assertEqual([other for other, _ in result[new.pk]], [self.high[0].pk, self.high[1].pk])
+        self.assertIs(profiles.get_index(), index)
+
+
+class RankingTest(TestCase):
+
+    def setUp(self):
+        ranking.invalidate()
+        Generator(seed=5, scale='tiny').run()
+
+    def expected(self, scope, scope_id, subject_id=None):
+        # 直接对完成情况按总分排序：{学生ID: (得分, 名次)}
+        conditions = ExerciseCondition.objects.all()
+        if scope == 'exercise':
+            conditions = conditions.filter(exercise_id=scope_id)
+        else:
+            conditions = conditions.filter(exercise__subject_id=subject_id)
+            if scope == 'class':
+                conditions = conditions.filter(student__classes=scope_id)
+            else:
+                conditions = conditions.filter(student__school_id=scope_id)
+        totals = {student_id: points or 0.0 for student_id, points in conditions.values('student_id').annotate(
+            points=Sum('results__points')).values_list('student_id', 'points').order_by()}
+        scores = sorted(totals.values(), reverse=True)
+        return {student_id: (score, scores.index(score) + 1) for student_id, score in totals.items()}
+
+    def boards(self):
+        subjects = list(Subject.objects.values_list('pk', flat=True))
+        boards = [('exercise', pk, None) for pk in Exercise.objects.values_list('pk', flat=True)]
+        boards += [('class', pk, subject_id) for pk in Class.objects.values_list('pk', flat=True)
+                   for subject_id in subjects]
+        boards += [('school', pk, subject_id) for pk in School.objects.values_list('pk', flat=True)
+                   for subject_id in subjects]
+        return boards
+
+    def test_writes_during_load(self):
+        condition = ProblemCondition.objects.filter(exercisecondition__isnull=False).order_by('pk').first()
+        exercise_condition = condition.exercisecondition_set.get()
+        load = ranking.Ranking.load
+
+        def racing_load():
+            # 读完以后，一道题的得分变了
+            board = load()
+            condition.points += 100
+            condition.save()
+            return board
+
+        with patch.object(ranking.Ranking, 'load', racing_load):
+            board = ranking.get_ranking()
+        # 只重读这个学生，不作废整个排行榜
+        self.assertIs(ranking._ranking, board)
+        self.assertEqual(ranking.rank('exercise', exercise_condition.exercise_id, condition.student_id)['score'],
+                         self.expected('exercise', exercise_condition.exercise_id)[condition.student_id][0])
+
+        # 换班级要从排行榜里找原来的成员，加载期间发生时这次的结果不放进缓存
+        ranking.invalidate()
+        group = Class.objects.order_by('pk').first()
+
+        def moving_load():
+            board = load()
+            group.people_set.clear()
+            return board
+
+        with patch.object(ranking.Ranking, 'load', moving_load):
+            ranking.get_ranking()
+        self.assertIsNone(ranking._ranking)
+        self.assertMatches()
+
+    def assertMatches(self):
+        checked = 0
+        for scope, scope_id, subject_id in self.boards():
+            expected = self.expected(scope, scope_id, subject_id)
+            for student_id, (score, rank) in expected.items():
+                result = ranking.rank(scope, scope_id, student_id, subject_id)
+                self.assertEqual((result['score'], result['rank'], result['size']), (score, rank, len(expected)))
+                self.assertTrue(0 <= result['percentile'] < 100)
+            top = ranking.top(scope, scope_id, 3, subject_id)
+            self.assertEqual([(score, rank) for _, score, rank in top],
+                             sorted(expected.values(), key=lambda item: item[1])[:3])
+            checked += len(expected)
+        self.assertGreater(checked, 0)
+
+    def test_matches_full_sort(self):
+        self.assertMatches()
+        condition = ExerciseCondition.objects.first()
+        response = self.client.get('/ranking/', {'exercise': condition.exercise_id, 'student': condition.student_id})
+        self.assertEqual(response.json()['rank'], self.expected('exercise', condition.exercise_id)[
+            condition.student_id][1])
+        response = self.client.get('/ranking/', {'exercise': condition.exercise_id, 'limit': 2})
+        self.assertEqual(len(response.json()['top']), 2)
+        self.assertEqual(self.client.get('/ranking/', {'class': 1}).status_code, 400)
+        self.assertEqual(self.client.get('/ranking/', {'exercise': '²'}).status_code, 400)
+        self.assertEqual(self.client.get('/ranking/', {'exercise': condition.exercise_id, 'student': 0})
+                         .status_code, 404)
+
+    def test_incremental_and_write_ranks(self):
+        board = ranking.get_ranking()
+        condition = ExerciseCondition.objects.filter(results__isnull=False).first()
+        answer = condition.results.first()
+        answer.points += 100
+        answer.save()
+        self.assertEqual(ranking.rank('exercise', condition.exercise_id, condition.student_id)['rank'], 1)
+
+        # 换班、删除练习完成情况、新学生答题
+        student = Student.objects.exclude(pk=condition.student_id).first()
+        old_class, new_class = student.classes.first(), Class.objects.exclude(people=student).first()
+        student.classes.remove(old_class)
+        new_class.people_set.add(student)
+        ExerciseCondition.objects.filter(student=condition.student_id).exclude(pk=condition.pk).first().delete()
+        new = Student.objects.create(name='新', born_year=2005, sex='male', school=School.objects.first(),
+                                     **{field: 50 for field in profiles.FIELDS})
+        new.classes.add(old_class)
+        late = ExerciseCondition.objects.create(exercise=condition.exercise, student=new, finish_time=timezone.now())
+        late.results.add(ProblemCondition.objects.create(student=new, problem=answer.problem, result='A', judge='',
+                                                         cost=10, points=1000))
+        self.assertMatches()
+        self.assertEqual(ranking.rank('exercise', condition.exercise_id, new.pk)['rank'], 1)
+        self.assertIs(ranking.get_ranking(), board)
+
+        # 班级/学校按人均总分写回名次，第二次没有变化
+        school = School.objects.first()
+        empty = School.objects.create(name='新校', area=school.area, administrator='', property='public', rank=0,
+                                      description='', level='county')
+        ranking.write_ranks()
+        means = {}
+        for group in Class.objects.all():
+            members = Student.objects.filter(classes=group)
+            total = ExerciseCondition.objects.filter(student__in=members).aggregate(
+                points=Sum('results__points'))['points']
+            means[group.pk] = (total or 0) / members.count()
+        ordered = sorted(means, key=lambda pk: -means[pk])
+        self.assertEqual([Class.objects.get(pk=pk).rank for pk in ordered], list(range(1, len(ordered) + 1)))
+        self.assertEqual((School.objects.get(pk=school.pk).rank, School.objects.get(pk=empty.pk).rank), (1, 2))
+        self.assertEqual(ranking.write_ranks(), {'classes': 0, 'schools': 0})
+
+
+class RefCacheTest(TestCase):
+
+    def setUp(self):
+        refcache.invalidate()
+        refcache.reset_counters()
+        self.subject = Subject.objects.create(name='数学')
+        self.book = Book.objects.create(name='必修一', series='人教', subject=self.subject)
+        self.chapters = [Chapter.objects.create(name='章%d' % i, book=self.book) for i in range(3)]
+
+    def test_read_through_and_invalidation(self):
+        chapter = self.chapters[0]
+        with self.assertNumQueries(1):
+            self.assertEqual(str(refcache.get(Chapter, chapter.pk)), '章0@必修一@人教')
+        with self.assertNumQueries(0):
+            self.assertEqual(refcache.get(Chapter, chapter.pk).book.name, '必修一')
+        # 没有select_related的章节，书目也从缓存取，第一次以后只有取章节本身的一次查询
+        with self.assertNumQueries(2):
+            str(Chapter.objects.get(pk=self.chapters[1].pk))
+        with self.assertNumQueries(1):
+            plain = Chapter.objects.get(pk=self.chapters[2].pk)
+            str(plain)
+            str(plain)
+        with self.assertNumQueries(1):
+            found = refcache.get_many(Chapter, [c.pk for c in self.chapters] + [0])
+        self.assertEqual(sorted(found), sorted(c.pk for c in self.chapters))
+
+        # 书目改名以后，带着书目的章节也作废
+        self.book.name = '必修二'
+        self.book.save()
+        self.assertEqual(str(refcache.get(Chapter, chapter.pk)), '章0@必修二@人教')
+        chapter.delete()
+        self.assertIsNone(refcache.get(Chapter, chapter.pk))
+
+        tag = Tag.objects.create(name='集合', category='Z', difficulty=1, description='', book=self.book,
+                                 chapter=self.chapters[1])
+        refcache.get(Tag, tag.pk)
+        tag.precursor.add(Tag.objects.create(name='元素', category='Z', difficulty=1, description='',
+                                             book=self.book, chapter=self.chapters[1]))
+        with self.assertNumQueries(1):
+            refcache.get(Tag, tag.pk)
+
+        stats = refcache.stats()['Chapter']
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['misses'], 0)
+        self.assertGreater(stats['invalidations'], 0)
+
+    @override_settings(REF_CACHE_SIZE=2, REF_CACHE_TTL=60)
+    def test_lru_and_ttl(self):
+        refcache.get_many(Chapter, [c.pk for c in self.chapters])
+        self.assertEqual(refcache.stats()['Chapter']['size'], 2)
+        self.assertEqual(refcache.stats()['Chapter']['evictions'], 1)
+        with self.assertNumQueries(0):
+            refcache.get(Chapter, self.chapters[2].pk)
+        with patch('dbsystem.refcache.time.monotonic', return_value=time.monotonic() + 61):
+            with self.assertNumQueries(1):
+                refcache.get(Chapter, self.chapters[2].pk)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'refcache-test'},
+    }, REF_CACHE_BACKEND='shared')
+    def test_shared_backend(self):
+        refcache.get(Subject, self.subject.pk)
+        # 模拟另一个进程：本进程的LRU是空的，共享缓存里有
+        refcache.REGISTRY[Subject].entries.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(refcache.get(Subject, self.subject.pk).name, '数学')
+        self.assertEqual(refcache.stats()['Subject']['shared_hits'], 1)
+        self.subject.name = '物理'
+        self.subject.save()
+        refcache.REGISTRY[Subject].entries.clear()
+        self.assertEqual(refcache.get(Subject, self.subject.pk).name, '物理')
+
+
+class ProblemConditionApiTest(TestCase):
+    URL = '/api/problem-conditions/'
+
+    def setUp(self):
+        refcache.invalidate()
+        Generator(seed=3, scale='tiny').run()
+        aggregates.rebuild()
+
+    def walk(self, **params):
+        ids = []
+        url = self.URL + '?' + '&'.join('%s=%s' % item for item in params.items())
+        while url:
+            data = self.client.get(url).json()
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+        return ids
+
+    def test_filters_and_pages(self):
+        self.assertEqual(self.walk(limit=37),
+                         list(ProblemCondition.objects.order_by('pk').values_list('pk', flat=True)))
+        group = Class.objects.order_by('pk').first()
+        self.assertEqual(self.walk(limit=7, **{'class': group.pk}), list(ProblemCondition.objects.filter(
+            student__classes=group).order_by('pk').values_list('pk', flat=True)))
+        exercise = Exercise.objects.order_by('pk').first()
+        self.assertEqual(self.walk(exercise=exercise.pk), list(ProblemCondition.objects.filter(
+            exercisecondition__exercise=exercise).order_by('pk').values_list('pk', flat=True)))
+        chapter = Tag.objects.filter(problem__problemcondition__isnull=False).first().chapter
+        expected = set(ProblemCondition.objects.filter(problem__tags__chapter=chapter).values_list('pk', flat=True))
+        ids = self.walk(chapter=chapter.pk, limit=3)
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(set(ids), expected)
+
+        student = Student.objects.filter(problemcondition__isnull=False).first()
+        row = self.client.get(self.URL, {'student': student.pk, 'limit': 1}).json()['results'][0]
+        condition = ProblemCondition.objects.filter(student=student).order_by('pk').first()
+        self.assertEqual((row['student_name'], row['problem_id'], row['correct']),
+                         (student.name, condition.problem_id, condition.is_correct()))
+        self.assertEqual(sorted(row['tags']), sorted(condition.problem.tags.values_list('name', flat=True)))
+        self.assertEqual(self.client.get(self.URL, {'student': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(self.URL, {'student': '²'}).status_code, 400)
+
+    def test_deep_page_costs_the_same(self):
+        def queries(after):
+            with CaptureQueriesContext(connection) as captured:
+                api.page(after=after, limit=20)
+            return len(captured)
+        refcache.get_many(Tag, Tag.objects.values_list('pk', flat=True))
+        refcache.get_many(Chapter, Chapter.objects.values_list('pk', flat=True))
+        last = ProblemCondition.objects.order_by('-pk').values_list('pk', flat=True)[30]
+        self.assertEqual(queries(0), queries(last))
+
+    def test_etag(self):
+        response = self.client.get(self.URL, {'limit': 5})
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.URL, {'limit': 5}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        ProblemCondition.objects.order_by('pk').first().delete()
+        self.assertEqual(self.client.get(self.URL, {'limit': 5}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class GradingTest(TestCase):
+    KEYS = ('A', 'B', 'AC', '12', None)
+    ANSWERS = ('A', ' b ', 'c,a', '13', 'A', '', 'B', 'A C', '12', 'D')
+
+    def setUp(self):
+        Generator(seed=4, scale='tiny').run()
+        aggregates.rebuild()
+        self.problems = list(Problem.objects.order_by('pk')[:5])
+        self.students = list(Student.objects.order_by('pk')[:10])
+        self.exam = Exercise.objects.create(name='期中', release_time=timezone.now() - timedelta(hours=3), length=90,
+                                            aim='4', release_people=Teacher.objects.first(),
+                                            subject=Subject.objects.first(), types='2')
+        self.exam.problems.set(self.problems)
+        for problem, answer in zip(self.problems, self.KEYS):
+            if answer is not None:
+                AnswerKey.objects.create(exercise=self.exam, problem=problem, answer=answer, points=2)
+        for i, student in enumerate(self.students):
+            for j, problem in enumerate(self.problems):
+                Submission.objects.create(exercise=self.exam, student=student, problem=problem,
+                                          answer=self.ANSWERS[(i + j) % len(self.ANSWERS)], cost=60,
+                                          submitted_at=timezone.now() - timedelta(hours=2))
+
+    def expected(self, keys):
+        correct = 0
+        for i in range(len(self.students)):
+            for j, key in enumerate(keys):
+                answer = self.ANSWERS[(i + j) % len(self.ANSWERS)]
+                correct += key is not None and grading.normalize(answer) == grading.normalize(key) != ''
+        return correct
+
+    def test_grade_and_regrade(self):
+        self.assertEqual(grading.closed_exams(), [self.exam.pk])
+        before = ProblemCondition.objects.count()
+        report = grading.grade(self.exam.pk, chunk_size=7)
+        self.assertEqual((report['submissions'], report['created'], report['updated'], report['no_key']),
+                         (50, 40, 0, 10))
+        self.assertEqual(report['correct'], self.expected(self.KEYS))
+        self.assertEqual(grading.closed_exams(), [self.exam.pk])  # 没有标准答案的题还没批改
+        self.assertEqual(ProblemCondition.objects.count(), before + 40)
+        self.assertEqual(ExerciseCondition.objects.filter(exercise=self.exam).count(), 10)
+        graded = ProblemCondition.objects.filter(exercisecondition__exercise=self.exam)
+        self.assertEqual(graded.count(), 40)
+        self.assertEqual(graded.filter(aggregates.correct_q()).count(), report['correct'])
+        self.assertEqual(sum(graded.values_list('points', flat=True)), 2 * report['correct'])
+        wrong = graded.get(student=self.students[0], problem=self.problems[3])
+        self.assertEqual((wrong.result, wrong.judge, wrong.points), ('13', '13', 0))
+        blank = graded.get(student=self.students[2], problem=self.problems[3])
+        self.assertEqual((blank.result, blank.judge), ('', ''))
+        stat = ExerciseStat.objects.get(pk=self.exam.pk)
+        self.assertEqual((stat.count, stat.correct_count), (40, report['correct']))
+
+        student = self.students[0]
+        tag = self.problems[0].tags.first()
+        answers = ProblemCondition.objects.filter(student=student, problem__tags=tag)
+        self.assertEqual(TagAbility.objects.get(student=student, tag=tag).degree,
+                         round(100 * answers.filter(aggregates.correct_q()).count() / answers.count()))
+
+        # 改了标准答案以后重新批改，更新原来的记录
+        AnswerKey.objects.filter(exercise=self.exam, problem=self.problems[3]).update(answer='13')
+        report = grading.grade(self.exam.pk, chunk_size=1000)
+        self.assertEqual((report['created'], report['updated']), (0, 40))
+        self.assertEqual(report['correct'], self.expected(self.KEYS[:3] + ('13', None)))
+        self.assertEqual(ProblemCondition.objects.count(), before + 40)
+        self.assertEqual(ExerciseStat.objects.get(pk=self.exam.pk).correct_count, report['correct'])
+        self.assertEqual(ProblemStat.objects.get(pk=self.problems[3].pk).correct_count,
+                         ProblemCondition.objects.filter(aggregates.correct_q(), problem=self.problems[3]).count())
+        # 只批改新作答：剩下的都是没有标准答案的题
+        report = grading.grade(self.exam.pk, new_only=True)
+        self.assertEqual((report['submissions'], report['no_key'], report['created']), (10, 10, 0))
+
+    def test_regrade_keeps_archived_totals(self):
+        grading.grade(self.exam.pk)
+        exam_answers = ProblemCondition.objects.filter(exercisecondition__exercise=self.exam, problem=self.problems[3])
+        correct_before = exam_answers.filter(aggregates.correct_q()).count()
+        stats = {stat.pk: (stat.count, stat.correct_count)
+                 for stat in ProblemStat.objects.filter(pk__in=[problem.pk for problem in self.problems])}
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertGreater(rollups.archive(timezone.localdate() - timedelta(days=14), directory), 0)
+        hot = dict((pk, totals[0]) for pk, totals in aggregates.problem_totals(
+            ProblemCondition.objects.filter(problem__in=self.problems)))
+        self.assertTrue(any(hot.get(pk, 0) < count for pk, (count, _) in stats.items()))
+
+        # 重新批改只按差值改统计，归档掉的记录仍然算在累计里
+        AnswerKey.objects.filter(exercise=self.exam, problem=self.problems[3]).update(answer='A')
+        report = grading.grade(self.exam.pk)
+        self.assertEqual(report['updated'], 40)
+        correct_after = exam_answers.filter(aggregates.correct_q()).count()
+        self.assertNotEqual(correct_after, correct_before)
+        for stat in ProblemStat.objects.filter(pk__in=list(stats)):
+            count, correct = stats[stat.pk]
+            if stat.pk == self.problems[3].pk:
+                correct += correct_after - correct_before
+            self.assertEqual((stat.count, stat.correct_count), (count, correct))
+        self.assertEqual(ExerciseStat.objects.get(pk=self.exam.pk).count, 40)
+
+    def test_worker_processes(self):
+        out = StringIO()
+        call_command('grade_exercise', self.exam.pk, workers=2, chunk_size=9, stdout=out)
+        self.assertIn('40 new', out.getvalue())
+        self.assertEqual(ProblemCondition.objects.filter(exercisecondition__exercise=self.exam,
+                                                         judge='').exclude(result='').count(),
+                         self.expected(self.KEYS))
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=5, scale='tiny').run()
+        aggregates.rebuild()
+        self.exercise = Exercise.objects.order_by('pk').first()
+
+    def expected(self, exercise=None):
+        links = ExerciseCondition.results.through.objects.order_by('pk').select_related(
+            'problemcondition__student', 'problemcondition__problem', 'exercisecondition__exercise')
+        if exercise is not None:
+            links = links.filter(exercisecondition__exercise=exercise)
+        rows = []
+        for link in links:
+            condition, exercise_condition = link.problemcondition, link.exercisecondition
+            finished = bool(condition.result)
+            accuracy = ProblemStat.objects.get(pk=condition.problem_id).accuracy
+            rows.append([condition.student.entity_id, condition.student.name, condition.problem.entity_id,
+                         condition.problem.name, exercise_condition.exercise.entity_id,
+                         exercise_condition.exercise.name,
+                         timezone.localtime(exercise_condition.finish_time).strftime('%Y-%m-%d %H:%M:%S'),
+                         '是' if finished else '否', '是' if finished and not condition.judge else '否',
+                         condition.points, condition.cost, '%.1f%%' % (accuracy * 100)])
+        return rows
+
+    def test_keyset_chunks(self):
+        expected = self.expected()
+        self.assertGreater(len(expected), 7 * 3)
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(export.problem_rows(chunk_size=7))
+        self.assertEqual(rows, expected)
+        # 每块一次取行、一次取正确率，最后一次空块
+        self.assertEqual(len(queries), (len(expected) + 6) // 7 * 2 + 1)
+        self.assertEqual(list(export.problem_rows(self.exercise.pk, chunk_size=7)), self.expected(self.exercise))
+
+    def test_csv_and_xlsx(self):
+        rows = self.expected(self.exercise)
+        response = self.client.post('/Students2Problem/export/', {'exercise_number': self.exercise.pk,
+                                                                  'format': 'csv'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="students2problem.csv"')
+        text = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(text.startswith('\ufeff'))
+        self.assertEqual(list(csv.reader(StringIO(text[1:]))), [export.HEADER] + [[str(value) for value in row]
+                                                                                 for row in rows])
+
+        response = self.client.post('/Students2Problem/export/', {'exercise_number': self.exercise.pk,
+                                                                  'format': 'xlsx'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="students2problem.xlsx"')
+        sheet = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))).read('xl/worksheets/sheet1.xml')
+        cells = [[cell.group(1) or cell.group(2) for cell in re.finditer(r'<t>(.*?)</t>|<v>(.*?)</v>', row)]
+                 for row in re.findall(r'<row>(.*?)</row>', sheet.decode('utf-8'))]
+        self.assertEqual(cells, [export.HEADER] + [[repr(value) if isinstance(value, (int, float)) else value
+                                                    for value in row] for row in rows])
+        self.assertEqual(self.client.post('/Students2Problem/export/', {'exercise_number': 'x'}).status_code, 400)
+        self.assertEqual(self.client.post('/Students2Problem/export/', {'exercise_number': '²'}).status_code, 400)
+
+    def test_non_finite_numbers(self):
+        self.assertEqual(export._xlsx_cell(2.5), '<c><v>2.5</v></c>')
+        self.assertEqual(export._xlsx_cell(float('nan')), '<c t="inlineStr"><is><t>nan</t></is></c>')
+        self.assertEqual(export._xlsx_cell(float('-inf')), '<c t="inlineStr"><is><t>-inf</t></is></c>')
+
+
+class ReportTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=6, scale='tiny').run()
+        aggregates.rebuild()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(REPORT_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def export(self, fmt='csv', **headers):
+        return self.client.post('/Students2Problem/export/', {'exercise_number': '-1', 'format': fmt}, **headers)
+
+    def commit(self):
+        # TestCase整个包在事务里，on_commit的回调不会执行，这里模拟提交
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, func in callbacks:
+            func()
+
+    def test_job_and_cache(self):
+        response = self.export(HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['status'], job['download']), ('queued', None))
+        # 还没做完时同样的请求返回同一个任务
+        self.assertEqual(self.export(HTTP_ACCEPT='application/json').json()['job'], job['job'])
+        out = StringIO()
+        call_command('report_worker', workers=0, once=True, stdout=out)
+        self.assertIn('finished 1 report jobs', out.getvalue())
+        status = self.client.get(job['url']).json()
+        total = ExerciseCondition.results.through.objects.count()
+        self.assertEqual((status['status'], status['progress'], status['total']), ('done', total, total))
+
+        expected = b''.join(export.stream_csv(export.problem_rows()))
+        response = self.client.get(status['download'])
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(b''.join(response.streaming_content), expected)
+        response = self.client.get(status['download'], HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), expected)
+
+        # 数据没变：直接返回上次的结果，不再排队
+        response = self.export(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="students2problem.csv"')
+        self.assertEqual(ReportJob.objects.count(), 1)
+
+        # 改了答题以后重新生成，旧结果在新结果完成时删除
+        old = ReportJob.objects.get()
+        version = reports.data_version()
+        condition = ProblemCondition.objects.filter(exercisecondition__isnull=False).first()
+        condition.points += 1
+        condition.save()
+        condition.save()
+        # 版本号在写入方的事务提交以后才加，同一个事务只加一次
+        self.assertEqual(reports.data_version(), version)
+        self.assertEqual([func for _, func in connection.run_on_commit].count(reports.bump), 1)
+        self.commit()
+        self.assertNotEqual(reports.data_version(), version)
+        response = self.export()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ReportJob.objects.filter(status='queued').count(), 1)
+        self.assertEqual(reports.work(workers=0, once=True), 1)
+        self.assertFalse(os.path.exists(reports.result_path(old)))
+        job = ReportJob.objects.get()
+        self.assertNotEqual(job.cache_key, old.cache_key)
+        response = self.client.get('/reports/%d/download/' % job.pk)
+        self.assertEqual(b''.join(response.streaming_content), b''.join(export.stream_csv(export.problem_rows())))
+        self.assertEqual(self.client.get('/reports/%d/download/' % old.pk).status_code, 404)
+
+    def test_older_job_finishing_last(self):
+        older = reports.enqueue('students2problem', {'exercise': -1, 'format': 'csv'})
+        reports.bump()
+        newer = reports.enqueue('students2problem', {'exercise': -1, 'format': 'csv'})
+        self.assertNotEqual(older.cache_key, newer.cache_key)
+        for job in (newer, older):
+            self.assertTrue(reports.claim(job.pk))
+            self.assertEqual(reports.run(job.pk), 'done')
+        # 后做完的旧任务不删新任务的结果
+        self.assertTrue(os.path.exists(reports.result_path(newer)))
+        self.assertEqual(ReportJob.objects.get(pk=newer.pk).status, 'done')
+
+    def test_xlsx_and_errors(self):
+        self.assertEqual(self.export('pdf').status_code, 400)
+        response = self.export('xlsx')
+        self.assertEqual(response.status_code, 202)
+        self.assertContains(response, '/reports/', status_code=202)
+        job = ReportJob.objects.get()
+        self.assertEqual(self.client.get('/reports/%d/download/' % job.pk).status_code, 404)
+        reports.work(workers=0, once=True)
+        response = self.client.get('/reports/%d/download/' % job.pk)
+        # zip里记录了写入时间，只比较表格内容
+        sheets = [zipfile.ZipFile(BytesIO(data)).read('xl/worksheets/sheet1.xml') for data in (
+            b''.join(response.streaming_content), b''.join(export.stream_xlsx(export.problem_rows())))]
+        self.assertEqual(sheets[0], sheets[1])
+        # 生成失败时记下错误，下次请求重新排队
+        job = reports.enqueue('students2problem', {'exercise': 10 ** 9, 'format': 'csv'})
+        with patch.dict(reports.KINDS, students2problem=(None, 'students2problem')):
+            reports.work(workers=0, once=True)
+        status = self.client.get('/reports/%d/' % job.pk).json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('TypeError', status['error'])
+        self.assertNotEqual(reports.enqueue('students2problem', {'exercise': 10 ** 9, 'format': 'csv'}).pk, job.pk)
+
+
+class SubmitTest(TestCase):
+
+    def setUp(self):
+        Generator(seed=7, scale='tiny').run()
+        aggregates.rebuild()
+        submit.invalidate()
+        self.addCleanup(submit.invalidate)
+        tokens = override_settings(SUBMIT_API_TOKENS=('client-token',))
+        tokens.enable()
+        self.addCleanup(tokens.disable)
+        self.exercise = Exercise.objects.order_by('pk').first()
+        self.problems = list(self.exercise.problems.order_by('pk').values_list('pk', flat=True))
+        self.student = Student.objects.order_by('pk').first()
+
+    def post(self, lines, token='client-token'):
+        body = '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        return self.client.post('/api/answers/', body, content_type='application/x-ndjson',
+                                HTTP_AUTHORIZATION='Bearer %s' % token)
+
+    def answer(self, problem, student=None, **fields):
+        return dict({'student': student or self.student.pk, 'exercise': self.exercise.pk, 'problem': problem,
+                     'result': 'A', 'judge': '', 'cost': 30, 'points': 2}, **fields)
+
+    def test_submit_and_validate(self):
+        other = Problem.objects.exclude(pk__in=self.problems).first()
+        conditions = ProblemCondition.objects.count()
+        lock = DataVersion.objects.get(pk=bulk.ID_LOCK).version
+        response = self.post([self.answer(problem) for problem in self.problems] + [
+            '{"student": 1', self.answer(other.pk), self.answer(self.problems[0], student=10 ** 9),
+            {'exercise': self.exercise.pk}, self.answer(self.problems[0], judge='B', result='B')])
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['accepted'], len(self.problems) + 1)
+        self.assertEqual([item['line'] for item in body['rejected']], [len(self.problems) + i for i in (1, 2, 3, 4)])
+        self.assertIn('not in exercise', body['rejected'][1]['error'])
+        self.assertIn('unknown student', body['rejected'][2]['error'])
+        self.assertEqual(body['rejected'][3]['error'], 'missing student')
+        self.assertEqual(ProblemCondition.objects.count(), conditions + len(self.problems) + 1)
+        self.assertGreater(DataVersion.objects.get(pk=bulk.ID_LOCK).version, lock)
+        # 同一个练习同一个学生只有一条练习完成情况，新答题接在后面
+        condition = ExerciseCondition.objects.get(exercise=self.exercise, student=self.student)
+        self.assertEqual(condition.results.filter(cost=30, points=2).count(), len(self.problems) + 1)
+        self.assertEqual(sorted(ProblemStat.objects.values_list('problem_id', 'count', 'correct_count')),
+                         sorted((pk, totals[0], totals[1]) for pk, totals in aggregates.problem_totals()))
+        stat = ExerciseStat.objects.get(pk=self.exercise.pk)
+        self.assertEqual(stat.count, ExerciseCondition.results.through.objects.filter(
+            exercisecondition__exercise=self.exercise).count())
+
+        # 练习加了题目以后缓存失效
+        self.exercise.problems.add(other)
+        self.assertEqual(self.post([self.answer(other.pk)]).json(), {'accepted': 1, 'rejected': []})
+        self.assertEqual(self.client.get('/api/answers/').status_code, 405)
+        self.assertEqual(self.client.post('/api/answers/', b'\xff', content_type='application/x-ndjson',
+                                          HTTP_AUTHORIZATION='Bearer client-token').status_code, 400)
+
+    def test_rollups_refresh_in_background(self):
+        rollups.rebuild()
+        finished = timezone.now() - timedelta(days=3)
+        rollup = AnswerRollup.objects.filter(period='day', bucket=timezone.localtime(finished).date(),
+                                             problem_id=self.problems[0])
+        before = sum(rollup.values_list('count', flat=True))
+        self.assertEqual(self.post([self.answer(self.problems[0], finish_time=finished.isoformat())])
+                         .json()['accepted'], 1)
+        # 请求线程不刷新汇总
+        self.assertEqual(sum(rollup.values_list('count', flat=True)), before)
+        refresher = submit.get_committer().rollups
+        self.assertTrue(refresher.due.is_set())
+
+        with patch.object(rollups, 'refresh', side_effect=RuntimeError), self.assertLogs('dbsystem.submit', 'ERROR'):
+            refresher.due.clear()
+            self.assertEqual(refresher.refresh(), 0)
+        # 失败以后留到下一轮
+        self.assertTrue(refresher.due.is_set())
+        self.assertGreater(refresher.refresh(), 0)
+        self.assertEqual(sum(rollup.values_list('count', flat=True)), before + 1)
+        self.assertEqual((refresher.runs, refresher.failures), (1, 1))
+
+    def test_requires_token(self):
+        conditions = ProblemCondition.objects.count()
+        lines = [self.answer(problem) for problem in self.problems]
+        response = self.client.post('/api/answers/', json.dumps(lines[0]), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.assertEqual(self.post(lines, token='other-token').status_code, 401)
+        # 登录的管理员也不行，只认令牌
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.assertEqual(self.client.post('/api/answers/', json.dumps(lines[0]),
+                                          content_type='application/x-ndjson').status_code, 401)
+        self.assertEqual(ProblemCondition.objects.count(), conditions)
+        with override_settings(SUBMIT_API_TOKENS=()):
+            self.assertEqual(self.post(lines).status_code, 401)
+
+    def test_throughput(self):
+        pairs = list(Exercise.problems.through.objects.values_list('exercise_id', 'problem_id'))
+        students = list(Student.objects.values_list('pk', flat=True))
+        bodies = ['\n'.join(json.dumps({'exercise': pairs[(i * 7 + j) % len(pairs)][0],
+                                         'problem': pairs[(i * 7 + j) % len(pairs)][1],
+                                         'student': students[(i + j) % len(students)], 'result': 'A', 'points': 1})
+                             for j in range(500)) for i in range(10)]
+        started = time.perf_counter()
+        for body in bodies:
+            self.assertEqual(self.client.post('/api/answers/', body, content_type='application/x-ndjson',
+                                              HTTP_AUTHORIZATION='Bearer client-token').json()['accepted'], 500)
+        elapsed = time.perf_counter() - started
+        # sqlite上每秒几千条
+        self.assertGreater(5000 / elapsed, 2000)
+
+    def test_group_commit_and_backpressure(self):
+        committer = submit.GroupCommitter(queue_rows=40, group_rows=30)
+        groups = []
+        release = threading.Event()
+
+        def write(group):
+            release.wait(5)
+            groups.append([len(batch.records) for batch in group])
+            for batch in group:
+                batch.accepted = len(batch.records)
+
+        with patch.object(committer, '_write', write):
+            leader = threading.Thread(target=committer.submit, args=([None] * 10,))
+            leader.start()
+            while not committer.leading:
+                time.sleep(0.001)
+            # 第一组还没提交完时到达的请求合并成下一组
+            followers = [threading.Thread(target=committer.submit, args=([None] * 10,)) for _ in range(3)]
+            for follower in followers:
+                follower.start()
+            while committer.pending_rows < 40:
+                time.sleep(0.001)
+            # 队列满了
+            with self.assertRaises(submit.Busy):
+                committer.submit([None] * 5, timeout=0.05)
+            release.set()
+            for thread in [leader] + followers:
+                thread.join(5)
+        self.assertEqual(groups, [[10], [10, 10, 10]])
+        self.assertEqual(committer.stats()['pending_rows'], 0)
+
+    def test_failed_batch_is_isolated(self):
+        committer = submit.get_committer()
+        records, errors = submit.parse('\n'.join(json.dumps(self.answer(problem)) for problem in self.problems))
+        self.assertEqual(errors, [])
+        before = ProblemCondition.objects.count()
+        # 用时为空违反NOT NULL，整组回滚以后逐批重试
+        good, bad = submit.Batch(records), submit.Batch(records[:1] + [records[0][:7] + (None, 0.0)])
+        committer._commit([good, bad])
+        self.assertEqual((good.accepted, good.error), (len(records), None))
+        self.assertIsInstance(bad.error, IntegrityError)
+        self.assertEqual(ProblemCondition.objects.count(), before + len(records))
+
+
+class SubmitRollupTest(TransactionTestCase):
+    # 后台线程用自己的连接，只能看到已经提交的数据
+
+    def setUp(self):
+        Generator(seed=7, scale='tiny').run()
+        rollups.rebuild()
+        submit.invalidate()
+        self.addCleanup(submit.invalidate)
+        seconds = override_settings(SUBMIT_ROLLUP_SECONDS=0.05)
+        seconds.enable()
+        self.addCleanup(seconds.disable)
+
+    def test_concurrent_submits(self):
+        pairs = list(Exercise.problems.through.objects.values_list('exercise_id', 'problem_id'))
+        students = list(Student.objects.values_list('pk', flat=True))
+        links = ExerciseCondition.results.through.objects
+        before = links.count()
+        errors = []
+
+        def client(seed):
+            try:
+                for i in range(5):
+                    body = '\n'.join(json.dumps({'exercise': pairs[(seed * 31 + i * 7 + j) % len(pairs)][0],
+                                                 'problem': pairs[(seed * 31 + i * 7 + j) % len(pairs)][1],
+                                                 'student': students[(seed + i + j) % len(students)], 'result': 'A'})
+                                      for j in range(20))
+                    submit.submit(submit.parse(body)[0])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(links.count(), before + 4 * 5 * 20)
+        # tiny里每个学生只在一个班级，汇总次数等于关联数
+        committer, deadline = submit.get_committer(), time.monotonic() + 10
+        while time.monotonic() < deadline:
+            # 占住领头位置再读，不和后台线程的写入撞上（sqlite的内存库按表加锁）
+            with committer.lead():
+                total = sum(AnswerRollup.objects.filter(period='day').values_list('count', flat=True))
+            if total == links.count():
+                break
+            time.sleep(0.05)
+        self.assertEqual(total, links.count())
+        self.assertGreater(committer.rollups.runs, 0)
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'search.sqlite3')
+        settings = override_settings(SEARCH_INDEX_PATH=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(search.close, self.path)
+        Generator(seed=5, scale='tiny').run()
+        self.assertEqual(search.rebuild(chunk_size=30), Problem.objects.count())
+
+    def ids(self, query, **filters):
+        return [hit.problem_id for hit in search.search(query, **filters)]
+
+    def commit(self):
+        # 索引在事务提交以后才更新，这里模拟提交
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, func in callbacks:
+            func()
+
+    def test_tokens(self):
+        self.assertEqual(search.text_tokens('单调递增'), ['单调', '调递', '递增', '增'])
+        self.assertEqual(search.text_tokens('求 f(x) 的ＭＡＸ'), ['求', 'f', 'x', '的', 'max'])
+        self.assertEqual(search.latex_tokens(r'\frac{1}{x^{2}} \, dx'), ['\\frac', '1', 'x', '^', '2', 'd', 'x'])
+        self.assertEqual(search.text_tokens(r'已知$a_n = 3.5$'), ['已知', '知', 'a', '_', 'n', '=', '3.5'])
+        self.assertEqual(search.match_expression('数列 x^2', chapter=3), '"数列" AND "x ^ 2" AND facets : "c3"')
+        self.assertEqual(search.match_expression('递'), '"递" *')
+
+    def test_search_and_incremental_updates(self):
+        problem = Problem.objects.create(name='单调性练习', description='求函数的单调递增区间，并证明 $f(x) > 0$',
+                                         formula=r'\int_0^{1} x^2 \, dx')
+        # 提交以后才写进索引
+        self.assertNotIn(problem.pk, self.ids('单调递增'))
+        self.commit()
+        with self.assertNumQueries(0):
+            self.assertIn(problem.pk, self.ids('单调递增'))
+        self.assertIn(problem.pk, self.ids('递'))
+        self.assertIn(problem.pk, self.ids('区间 x^{2}'))
+        self.assertIn(problem.pk, self.ids(r'$\int_0^1$'))
+        self.assertIn(problem.pk, self.ids('f(x)>0'))
+        self.assertNotIn(problem.pk, self.ids('递减'))
+        # 名字里出现的排在只有描述里出现的前面
+        self.assertEqual(self.ids('单调性')[0], problem.pk)
+
+        tag = Tag.objects.order_by('pk').first()
+        problem.tags.add(tag)
+        self.commit()
+        self.assertEqual(self.ids('单调', tag=tag.pk)[:1], [problem.pk])
+        self.assertIn(problem.pk, self.ids('单调', chapter=tag.chapter_id, book=tag.book_id))
+        other = Chapter.objects.exclude(pk=tag.chapter_id).first()
+        self.assertNotIn(problem.pk, self.ids('单调', chapter=other.pk))
+
+        tag.name = '极限的概念'
+        tag.save()
+        self.commit()
+        self.assertIn(problem.pk, self.ids('极限'))
+        tag.problem_set.clear()
+        self.commit()
+        self.assertNotIn(problem.pk, self.ids('极限'))
+        problem.tags.add(tag)
+        tag_id, problem_id = tag.pk, problem.pk
+        tag.delete()
+        self.commit()
+        self.assertEqual(self.ids('单调', tag=tag_id), [])
+
+        problem.delete()
+        self.commit()
+        self.assertNotIn(problem_id, self.ids('单调递增'))
+
+    def test_synthetic_problems_and_view(self):
+        expected = set(Problem.objects.filter(formula__contains=r'\sqrt').values_list('pk', flat=True))
+        self.assertEqual(set(self.ids(r'\sqrt', limit=100)), expected)
+        expected = set(Problem.objects.filter(description__contains='等比数列').values_list('pk', flat=True))
+        self.assertEqual(set(self.ids('等比数列', limit=100)), expected)
+        data = self.client.get('/search/', {'q': '等比数列', 'limit': 3}).json()
+        self.assertEqual(len(data['results']), min(3, len(expected)))
+        self.assertTrue(all(row['id'] in expected and row['name'] for row in data['results']))
+        self.assertEqual(self.client.get('/search/').status_code, 400)
+        self.assertEqual(self.client.get('/search/', {'q': '数列', 'limit': '²'}).status_code, 400)
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        problem = Problem.objects.order_by('pk').first()
+        try:
+            with transaction.atomic():
+                problem.name = '回滚的名字'
+                problem.save()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.commit()
+        self.assertNotIn(problem.pk, self.ids('回滚的名字'))
+
+    def test_index_of_other_database_is_not_updated(self):
+        search._connect().execute("UPDATE search_meta SET value = 'other'")
+        problem = Problem.objects.create(name='单调性练习')
+        self.assertNotIn(problem.pk, self.ids('单调性'))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite only')
+class QueryPlanTest(TestCase):
+    # 核心查询不能退化成全表扫描；需要复合索引的查询同时检查用到的索引列
+    QUERIES = (
+        ('problem_condition_by_student_problem',
+         lambda: ProblemCondition.objects.filter(student_id=1, problem_id=2), '(student_id=? AND problem_id=?)'),
+        ('problem_condition_by_student', lambda: ProblemCondition.objects.filter(student_id=1), None),
+        ('tag_ability_by_student', lambda: TagAbility.objects.filter(student_id=1).values_list('tag_id', 'degree'),
+         None),
+        ('lacking_prerequisites', lambda: TagAbility.objects.filter(
+            student_id=1, tag_id__in=[1, 2, 3], degree__gte=60).values_list('tag_id', flat=True),
+         '(student_id=? AND tag_id=?)'),
+        ('exercise_condition_lookup', lambda: ExerciseCondition.objects.filter(
+            exercise_id__in=[1, 2], student_id__in=[3, 4]).values_list('exercise_id', 'student_id', 'pk'),
+         '(exercise_id=? AND student_id=?)'),
+        ('exercises_by_subject', lambda: Exercise.objects.filter(subject_id=1).order_by('-release_time'),
+         '(subject_id=?)'),
+        ('export_chunk', lambda: ExerciseCondition.results.through.objects.order_by('id').filter(
+            id__gt=0).values_list(*export._FIELDS)[:2000], None),
+        ('export_one_exercise', lambda: ExerciseCondition.results.through.objects.order_by('id').filter(
+            exercisecondition__exercise_id=1, id__gt=0).values_list(*export._FIELDS)[:2000], None),
+        ('results_by_problem_condition', lambda: ExerciseCondition.results.through.objects.filter(problemcondition_id=1), None),
+        ('problem_stats_in_bulk', lambda: ProblemStat.objects.filter(pk__in=[1, 2, 3]), None),
+        ('mongo_id_lookup', lambda: MongoIdMap.objects.filter(collection='people', mongo_id__in=['a', 'b']),
+         '(collection=? AND mongo_id=?)'),
+    ) + tuple(
+        ('api_page_%s' % name, lambda filters=filters: ProblemCondition.objects.filter(
+            api._filters(**filters), pk__gt=100).only(*api.FIELDS).order_by('pk')[:101], None)
+        for name, filters in (('all', {}), ('student', {'student': 1}), ('class', {'group': 1}),
+                              ('exercise', {'exercise': 1}), ('chapter', {'chapter': 1}))
+    )
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_no_full_table_scan(self):
+        for name, queryset, search in self.QUERIES:
+            plan = self.plan(queryset())
+            for detail in plan:
+                # 老版本是"SCAN TABLE t"，3.36以后是"SCAN t"；覆盖索引的全索引扫描也算
+                self.assertFalse(re.match(r'SCAN (TABLE )?\w+', detail), '%s: %s' % (name, plan))
+            if search:
+                self.assertTrue(any(search in detail for detail in plan), '%s: %s' % (name, plan))
+
+    def test_exercises_by_subject_sorted_by_index(self):
+        # 按学科取最近的练习，索引已经按时间排好，不需要临时排序
+        plan = self.plan(Exercise.objects.filter(subject_id=1).order_by('-release_time'))
+        self.assertFalse(any('TEMP B-TREE' in detail for detail in plan), plan)
+
+
+@skipUnless(mongomock, 'mongomock is not installed')
+class MongomockTestCase(TestCase):
+
+    def setUp(self):
+        disconnect()
+        connect('dbsystem_test', mongo_client_class=mongomock.MongoClient)
+
+    def tearDown(self):
+        mongoconn.register()
+
+    def refs(self, value):
+        # models.py里显式声明了_id，mongoengine的引用校验认不出已保存的文档，这里直接存ObjectId
+        if isinstance(value, list):
+            return [self.refs(item) for item in value]
+        return value.pk if isinstance(value, mongo.Document) else value
+
+    def create(self, document, **fields):
+        doc = document(**{name: self.refs(value) for name, value in fields.items()})
+        doc.save(validate=False)
+        return doc
+
+class MongoConnectionTest(MongomockTestCase):
+
+    def test_lazy_aliases(self):
+        created = []
+
+        class Client(mongomock.MongoClient):
+            def __init__(self, *args, **kwargs):
+                created.append(kwargs)
+                super().__init__(*args, **kwargs)
+
+        options = {'mongo_client_class': Client, 'maxPoolSize': 7, 'serverSelectionTimeoutMS': 100}
+        connections = {'default': dict(options, db='dbsystem_test'),
+                       'answers': dict(options, db='answers_test', read_preference='secondaryPreferred')}
+        with override_settings(MONGO_CONNECTIONS=connections, MONGO_ALIASES={'People': 'answers'}):
+            mongoconn.register()
+            self.assertEqual(created, [])
+            mongo.Student.objects.count()
+            self.assertEqual(len(created), 1)
+            self.assertEqual((created[0]['maxPoolSize'], created[0]['read_preference']),
+                             (7, ReadPreference.SECONDARY_PREFERRED))
+            self.assertEqual(mongo.Teacher._get_db().name, 'answers_test')
+            self.assertEqual(mongo.Subject._get_db().name, 'dbsystem_test')
+            self.assertEqual(len(created), 2)
+        mongoconn.register()
+        self.assertEqual(mongo.Student._meta['db_alias'], 'default')
+        with override_settings(MONGO_ALIASES={'Problem': 'missing'}):
+            self.assertRaises(ImproperlyConfigured, mongoconn.register)
+
+    def test_health(self):
+        response = self.client.get('/health/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['mongo']['default']['ok'])
+
+        # 模拟连接池事件：7个取出、1个归还，50个的池子用了12%
+        listener = mongoconn.PoolListener('default', 50)
+        event = type('Event', (), {'address': ('localhost', 27017)})()
+        for _ in range(7):
+            listener.connection_created(event)
+            listener.connection_check_out_started(event)
+            listener.connection_checked_out(event)
+        listener.connection_checked_in(event)
+        listener.connection_check_out_started(event)
+        listener.connection_check_out_failed(event)
+        stats = listener.snapshot()
+        self.assertEqual(stats['pools']['localhost:27017'], {'open': 7, 'in_use': 6, 'waiting': 0, 'peak_in_use': 7})
+        self.assertEqual((stats['saturation'], stats['check_out_failures']), (0.12, 1))
+
+        with patch.dict(mongoconn._listeners, default=listener), override_settings(MONGO_POOL_SATURATION_LIMIT=0.1):
+            response = self.client.get('/health/')
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response.json()['mongo']['default']['saturated'])
+        with override_settings(MONGO_CONNECTIONS=dict(settings.MONGO_CONNECTIONS, missing={})):
+            ready, report = mongoconn.health()
+        self.assertFalse(ready)
+        self.assertFalse(report['mongo']['missing']['ok'])
+
+
+class MongoMigrationTest(MongomockTestCase):
+
+    def tearDown(self):
+        mongosync.disable_dual_write()
+        super().tearDown()
+
+    def populate(self):
+        subject = self.create(mongo.Subject, name='数学')
+        book = self.create(mongo.Book, name='必修一', series='人教', subject=subject)
+        chapter = self.create(mongo.Chapter, name='集合', book=book)
+        school = self.create(mongo.School, name='一中', area_code='110', types='public', rank=1, register='provincial')
+        group = self.create(mongo.Group, name='一班', rank=1, year=date(2018, 9, 1), school=school)
+        teacher = self.create(mongo.Teacher, name='王老师', sexuality='男', school=school, group=[group],
+                              position='班主任', subject=[subject], year=date(2005, 9, 1))
+        students = [self.create(mongo.Student, name='学生%d' % i, sexuality='女', school=school, group=[group],
+                                born=date(2005, 1, 1), effort=i, logics=i) for i in range(7)]
+        problems = [self.create(mongo.Problem, name='题%d' % i) for i in range(5)]
+        self.create(mongo.Exercise, name='练习', types='2', problems=problems, allow_time=40, aim='4',
+                    publish_time=datetime(2019, 1, 1, 8), publisher=[teacher], subject=subject)
+        self.create(mongo.Tag, name='交集', types='Z', difficulty=2, book=book, topic=[[chapter]])
+        for student in students:
+            for i, problem in enumerate(problems):
+                self.create(mongo.ProblemCondition, student=student, problem=problem, result='A',
+                            wrong=['B'] if i % 2 else [])
+        return students
+
+    def test_migrate_and_verify(self):
+        self.populate()
+        call_command('mongo2sql', batch_size=3, verify=True, stdout=StringIO())
+        self.assertEqual(Teacher.objects.get().subject.name, '数学')
+        self.assertEqual(Student.objects.count(), 7)
+        self.assertEqual(set(Class.objects.get().people_set.values_list('name', flat=True)),
+                         {'王老师'} | {'学生%d' % i for i in range(7)})
+        self.assertEqual(Exercise.objects.get().problems.count(), 5)
+        self.assertEqual(ProblemCondition.objects.count(), 35)
+        self.assertEqual(ProblemStat.objects.get(problem__name='题1').correct_count, 0)
+        self.assertEqual(ProblemStat.objects.get(problem__name='题2').correct_count, 7)
+
+        # 重复运行不会重复写入
+        counts = mongosync.migrate(mongosync.MAPPINGS_BY_COLLECTION['problem_condition'], batch_size=4)
+        self.assertEqual((counts['written'], counts['existing']), (0, 35))
+
+        Student.objects.filter(name='学生3').update(logic=99)
+        report = mongosync.verify(mongosync.MAPPINGS_BY_COLLECTION['people'])
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['mismatched'], 1)
+        self.assertNotEqual(report['mongo_checksum'], report['sql_checksum'])
+
+    @skipUnless(signals.signals_available, 'blinker is not installed')
+    def test_dual_write(self):
+        students = self.populate()
+        mongosync.migrate_all()
+        mongosync.enable_dual_write()
+
+        # 这里的Document显式声明了_id，save()已有文档会插入一条新文档，所以用update修改再同步
+        mongo.Student.objects(name='学生0').update(set__logics=42)
+        mongosync.sync(mongo.Student.objects.get(name='学生0'))
+        self.assertEqual(Student.objects.get(name='学生0').logic, 42)
+
+        problem = self.create(mongo.Problem, name='新题')
+        condition = self.create(mongo.ProblemCondition, student=students[0], problem=problem, result='C')
+        self.assertEqual(ProblemStat.objects.get(problem__name='新题').count, 1)
+
+        condition.delete()
+        # 同样因为显式声明的_id，delete()按主键匹配不到文档，只有信号会触发
+        mongo.ProblemCondition._get_collection().delete_one({'_id': condition.pk})
+        self.assertFalse(ProblemCondition.objects.filter(problem__name='新题').exists())
+        self.assertEqual(ProblemStat.objects.get(problem__name='新题').count, 0)
+        for mapping in mongosync.MAPPINGS:
+            self.assertTrue(mongosync.verify(mapping)['ok'], mapping.collection)
+
+
+class PrefetchTest(MongomockTestCase):
+
+    def test_exercise_problems_tags(self):
+        subject = self.create(mongo.Subject, name='数学')
+        chapters = [self.create(mongo.Chapter, name='章%d' % i) for i in range(3)]
+        tags = [self.create(mongo.Tag, name='标签%d' % i, topic=[[chapters[i % 3]], chapters[:2]]) for i in range(5)]
+        problems = [self.create(mongo.Problem, name='题%d' % i, tags=[tags[i % 5], tags[(i + 1) % 5]])
+                    for i in range(40)]
+        self.create(mongo.Exercise, name='练习', problems=problems, subject=subject)
+
+        with patch.object(mongomock.collection.Collection, 'find', autospec=True,
+                          side_effect=mongomock.collection.Collection.find) as find:
+            exercise = mongo.Exercise.objects.prefetch('problems__tags__topic', 'subject').get(name='练习')
+            names = [[tag.name for tag in problem.tags] for problem in exercise.problems]
+            topics = {chapter.name for problem in exercise.problems for tag in problem.tags
+                      for chapters in tag.topic for chapter in chapters}
+            self.assertEqual(exercise.subject.name, '数学')
+        # 练习、题目、标签、章节、科目各一次
+        self.assertEqual(find.call_count, 5)
+        self.assertEqual(names, [['标签%d' % (i % 5), '标签%d' % ((i + 1) % 5)] for i in range(40)])
+        self.assertEqual(topics, {'章0', '章1', '章2'})
+        self.assertIs(exercise.problems[0].tags[1], exercise.problems[1].tags[0])
+
+        with patch.object(mongomock.collection.Collection, 'find', autospec=True,
+                          side_effect=mongomock.collection.Collection.find) as find:
+            self.assertEqual(len(list(mongo.Problem.objects.prefetch('tags'))), 40)
+        self.assertEqual(find.call_count, 2)
+
+
+class HierarchyTest(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 建树时逐个保存，信号可能没有连接（没有装blinker），最后统一重建
+        self.a11 = self.create(mongo.Chapter, name='a11')
+        self.a1 = self.create(mongo.Chapter, name='a1', sub=[self.a11])
+        self.a = self.create(mongo.Chapter, name='a', sub=[self.a1])
+        self.b = self.create(mongo.Chapter, name='b')
+        self.root = self.create(mongo.Chapter, name='root', sub=[self.a, self.b])
+        for chapter in (self.a11, self.b, self.root):
+            self.create(mongo.Problem, name='题' + chapter.name, chapter=chapter)
+        call_command('rebuild_hierarchy', stdout=StringIO())
+
+    def names(self, queryset):
+        return sorted(doc.name for doc in queryset)
+
+    def test_queries(self):
+        self.assertEqual(self.names(hierarchy.descendants(mongo.Chapter, self.root.pk)), ['a', 'a1', 'a11', 'b'])
+        self.assertEqual(self.names(hierarchy.descendants(mongo.Chapter, self.a.pk)), ['a1', 'a11'])
+        a11 = mongo.Chapter.objects.get(name='a11')
+        self.assertEqual(a11.depth, 3)
+        self.assertEqual([doc.name for doc in hierarchy.ancestors(a11)], ['root', 'a', 'a1'])
+        self.assertEqual(self.names(hierarchy.problems_under(self.a.pk)), ['题a11'])
+        self.assertEqual(self.names(hierarchy.problems_under(self.root.pk)), ['题a11', '题b', '题root'])
+
+    def test_move_subtree(self):
+        hierarchy.detach(mongo.Chapter, self.a.pk, self.a1.pk)
+        hierarchy.attach(mongo.Chapter, self.b.pk, self.a1.pk)
+        self.assertEqual(self.names(hierarchy.descendants(mongo.Chapter, self.a.pk)), [])
+        self.assertEqual(self.names(hierarchy.descendants(mongo.Chapter, self.b.pk)), ['a1', 'a11'])
+        self.assertEqual(self.names(hierarchy.problems_under(self.b.pk)), ['题a11', '题b'])
+        self.assertEqual(mongo.Chapter.objects.get(name='a11').ancestors, [self.root.pk, self.b.pk, self.a1.pk])
+
+        hierarchy.detach(mongo.Chapter, self.b.pk, self.a1.pk)
+        a11 = mongo.Chapter.objects.get(name='a11')
+        self.assertEqual((a11.ancestors, a11.depth), ([self.a1.pk], 1))
+        self.assertEqual(self.names(hierarchy.problems_under(self.root.pk)), ['题b', '题root'])
+
+    @skipUnless(signals.signals_available, 'blinker is not installed')
+    def test_new_documents(self):
+        folder = self.create(mongo.Folder, name='收藏')
+        child = self.create(mongo.Folder, name='子目录')
+        hierarchy.attach(mongo.Folder, folder.pk, child.pk)
+        grandchild = self.create(mongo.Folder, name='孙目录')
+        # 新的上级文档保存时，它的sub整棵刷新
+        parent = self.create(mongo.Folder, name='上级', sub=[folder])
+        hierarchy.attach(mongo.Folder, child.pk, grandchild.pk)
+        self.assertEqual(self.names(hierarchy.descendants(mongo.Folder, parent.pk)), ['子目录', '孙目录', '收藏'])
+        self.create(mongo.Problem, name='新题', chapter=self.a1)
+        self.assertEqual(mongo.Problem.objects.get(name='新题').chapters, [self.root.pk, self.a.pk, self.a1.pk])
+
+
+class ImageTest(MongomockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mongomock.gridfs.enable_gridfs_integration()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(IMAGE_STORE_DIR=directory.name, IMAGE_THUMBNAIL_SIZES=(16, 64), IMAGE_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def image(self, color, mode='RGB'):
+        buffer = BytesIO()
+        Image.new(mode, (100, 50), color).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def thumbnail_size(self, digest, size):
+        with images.storage().open(images.name(digest, size)) as f:
+            return Image.open(f).size
+
+    def get(self, url, **headers):
+        response = self.client.get(url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_dedup_and_thumbnails(self):
+        red = self.image('red')
+        blob = images.put(red)
+        self.assertEqual(blob.digest, hashlib.sha256(red).hexdigest())
+        self.assertEqual((blob.content_type, blob.width, blob.height, blob.size), ('image/png', 100, 50, len(red)))
+        with self.assertNumQueries(1):
+            self.assertEqual(images.put(red).digest, blob.digest)
+        transparent = images.put(self.image((0, 0, 255, 128), mode='RGBA'))
+        self.assertEqual(ImageBlob.objects.count(), 2)
+        for digest in (blob.digest, transparent.digest):
+            self.assertEqual(self.thumbnail_size(digest, 16), (16, 8))
+            self.assertEqual(self.thumbnail_size(digest, 64), (64, 32))
+        with images.storage().open(images.name(transparent.digest, 16)) as f:
+            self.assertIn('A', Image.open(f).getbands())
+        with self.assertRaises(OSError):
+            images.put(b'not an image')
+        self.assertEqual(ImageBlob.objects.count(), 2)
+
+    def test_view(self):
+        data = self.image('green')
+        digest = images.put(data).digest
+        url = '/images/%s/' % digest
+        response, content = self.get(url)
+        self.assertEqual((response.status_code, content, response['Content-Type']), (200, data, 'image/png'))
+        self.assertEqual(response['ETag'], '"%s"' % digest)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"%s"' % digest).status_code, 304)
+
+        response, content = self.get(url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual((response.status_code, content), (206, data[:10]))
+        self.assertEqual(response['Content-Range'], 'bytes 0-9/%d' % len(data))
+        response, content = self.get(url, HTTP_RANGE='bytes=-5')
+        self.assertEqual((response.status_code, content), (206, data[-5:]))
+        response, content = self.get(url, HTTP_RANGE='bytes=%d-' % len(data))
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */%d' % len(data)))
+        response, content = self.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, content), (200, data))
+
+        # 后台还没生成的缩略图当场生成
+        images.storage().delete(images.name(digest, 16))
+        response, content = self.get(url + '16/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(content)).size, (16, 8))
+        self.assertEqual(self.client.get(url + '17/').status_code, 404)
+        self.assertEqual(self.client.get('/images/%s/' % ('0' * 64)).status_code, 404)
+
+    def test_import_gridfs(self):
+        red, blue = self.image('red'), self.image('blue')
+        fs = gridfs.GridFS(mongo.Problem._get_db(), collection='images')
+        problem = mongo.Problem._get_collection().insert_one(
+            {'name': '题', 'images': [fs.put(red), fs.put(blue)]}).inserted_id
+        solution = mongo.Solution._get_collection().insert_one({'images': [fs.put(red)]}).inserted_id
+        out = StringIO()
+        call_command('import_images', stdout=out)
+        self.assertIn('Problem: 1 documents, 2 images, 2 distinct', out.getvalue())
+        self.assertEqual(ImageBlob.objects.count(), 2)
+        digests = [hashlib.sha256(data).hexdigest() for data in (red, blue)]
+        self.assertEqual(mongo.Problem._get_collection().find_one(problem)['image_digests'], digests)
+        self.assertEqual(mongo.Solution._get_collection().find_one(solution)['image_digests'], digests[:1])
+        self.assertEqual(self.thumbnail_size(digests[1], 64), (64, 32))
+
+        # 已经导入的跳过
+        self.assertEqual(images.import_gridfs(mongo.Problem)['documents'], 0)
+        green = images.add_images(mongo.Problem, problem, [self.image('green')])
+        self.assertEqual(images.image_urls(mongo.Problem.objects.get(name='题'), size=16),
+                         ['/images/%s/16/' % digest for digest in digests + green])
+
+    @override_settings(IMAGE_WORKERS=2)
+    def test_thumbnail_pool(self):
+        self.addCleanup(images.shutdown)
+        digest = images.put(self.image('red'), thumbnails=False).digest
+        self.assertFalse(images.storage().exists(images.name(digest, 16)))
+        images.submit_thumbnails([digest]).get(timeout=60)
+        self.assertEqual(self.thumbnail_size(digest, 16), (16, 8))
@@ -1,8 +1,20 @@
 from django.shortcuts import render, render_to_response
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.template import RequestContext
+from django.utils.cache import get_conditional_response
+from django.utils.http import urlencode
+from django.views.decorators.csrf import csrf_exempt
 from datetime import datetime
+import hashlib
+import hmac
+import json
+import os
 from dbsystem.models_mysql import *
+from dbsystem import api, images, mongoconn, profiles, ranking, recommend, refcache, reports, search, submit
+from dbsystem.export import problem_rows, stream_csv, stream_xlsx
+from dbsystem.instrumentation import registry
 
 
 def index(request):
@@ -14,9 +26,298 @@ def IdConfigure(request):
 
 
 def Students2Problem(request):
-    exercise_id = request.POST.get('exercise_number')
-    print(exercise_id)
+    # 表格内容由页面滚动时从 /api/problem-conditions/ 分页加载
+    exercise_id = request.POST.get('exercise_number', '').strip()
+    if not (exercise_id.isascii() and exercise_id.isdigit()):
+        exercise_id = ''
+    return render(request, 'Students2Problem.html', {'exercise_id': exercise_id})
+
+
+def Students2ProblemExport(request):
+    params = request.POST if request.method == 'POST' else request.GET
+    exercise_id = params.get('exercise_number', '-1').strip()
+    fmt = params.get('format', 'xlsx')
     if exercise_id == "-1":
-        print("here")
-    return render(request, 'Students2Problem.html', {'posts':'here'})
-    
+        exercise_id = None
+    elif not (exercise_id.isascii() and exercise_id.isdigit()):
+        return HttpResponseBadRequest("exercise_number should be an exercise id or -1")
+    if fmt not in reports.FORMATS:
+        return HttpResponseBadRequest("format should be csv or xlsx")
+    if exercise_id is None:
+        # 全部练习的数据在请求里导不完，交给后台任务，数据没变时直接返回上次的结果
+        job = reports.enqueue('students2problem', {'exercise': None, 'format': fmt})
+        if job.status == reports.DONE:
+            return _report_file(request, job)
+        return _report_pending(request, job)
+    rows = problem_rows(exercise_id)
+    if fmt == 'csv':
+        response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv; charset=utf-8')
+        filename = 'students2problem.csv'
+    else:
+        response = StreamingHttpResponse(
+            stream_xlsx(rows),
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        filename = 'students2problem.xlsx'
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def _report_file(request, job):
+    path = reports.result_path(job)
+    content_type = reports.FORMATS[json.loads(job.params)['format']][1]
+    if not path.endswith('.gz'):
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        # 压缩好的文件原样返回，由浏览器解压
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = StreamingHttpResponse(reports.read(path, decompress=True), content_type=content_type)
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename="%s"' % reports.filename(job)
+    return response
+
+
+def _report_pending(request, job):
+    # 202：返回任务信息，页面轮询进度，完成后跳转下载
+    if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+        return JsonResponse(reports.describe(job), status=202)
+    return render(request, 'Report.html', {'job': reports.describe(job)}, status=202)
+
+
+def ReportStatus(request, job_id):
+    job = ReportJob.objects.filter(pk=job_id).first()
+    if job is None:
+        raise Http404
+    return JsonResponse(reports.describe(job), json_dumps_params={'ensure_ascii': False})
+
+
+def ReportDownload(request, job_id):
+    job = ReportJob.objects.filter(pk=job_id, status=reports.DONE).first()
+    if job is None or not os.path.exists(reports.result_path(job)):
+        raise Http404
+    return _report_file(request, job)
+
+
+def DBStats(request):
+    # 只对本机和管理员开放；GET查看，POST清空计数
+    if request.META.get('REMOTE_ADDR') not in ('127.0.0.1', '::1') and not request.user.is_staff:
+        return HttpResponseForbidden()
+    if request.method not in ('GET', 'POST'):
+        return HttpResponseNotAllowed(['GET', 'POST'])
+    if request.method == 'POST':
+        registry.reset()
+        refcache.reset_counters()
+    snapshot = registry.snapshot()
+    snapshot['ref_cache'] = refcache.stats()
+    return JsonResponse(snapshot, json_dumps_params={'ensure_ascii': False})
+
+
+def Health(request):
+    # 就绪检查：SQL和Mongo都能连通、连接池没有用满时返回200，否则503
+    ready, report = mongoconn.health()
+    return JsonResponse(report, status=200 if ready else 503)
+
+
+def Recommend(request):
+    # ?student=学生ID 或 ?class=班级ID，可选 k、per_tag、subject
+    params = {}
+    for name in ('student', 'class', 'k', 'per_tag', 'subject'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    options = {'k': params['k'] or 10, 'per_tag': params['per_tag'] or 2, 'subject_id': params['subject']}
+    if params['student'] is not None:
+        result = [item._asdict() for item in recommend.recommend(params['student'], **options)]
+    elif params['class'] is not None:
+        result = {student_id: [item._asdict() for item in items]
+                  for student_id, items in recommend.recommend_class(params['class'], **options).items()}
+    else:
+        return HttpResponseBadRequest("student or class is required")
+    return JsonResponse({'recommendations': result})
+
+
+def Ranking(request):
+    # ?exercise=练习ID，或者 ?class=班级ID&subject=学科ID、?school=学校ID&subject=学科ID；
+    # 有student时返回这个学生的名次和百分位，否则返回前limit名（默认10）
+    params = {}
+    for name in ('exercise', 'class', 'school', 'subject', 'student', 'limit'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    scopes = [scope for scope in ranking.SCOPES if params[scope] is not None]
+    if len(scopes) != 1:
+        return HttpResponseBadRequest("one of exercise, class or school is required")
+    scope = scopes[0]
+    if scope != 'exercise' and params['subject'] is None:
+        return HttpResponseBadRequest("subject is required")
+    if params['student'] is not None:
+        result = ranking.rank(scope, params[scope], params['student'], params['subject'])
+        if result is None:
+            raise Http404("student is not ranked")
+        return JsonResponse(dict(result, student=params['student']))
+    top = ranking.top(scope, params[scope], min(params['limit'] or 10, ranking.MAX_LIMIT), params['subject'])
+    return JsonResponse({'top': [{'student': student_id, 'score': score, 'rank': rank}
+                                 for student_id, score, rank in top]})
+
+
+def ProblemConditions(request):
+    # ?exercise=&class=&student=&chapter= 过滤，after是上一页返回的游标，limit默认100
+    params = {}
+    for name in ('exercise', 'class', 'student', 'chapter', 'after', 'limit'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    rows, after = api.page(after=params['after'] or 0, limit=params['limit'] or api.DEFAULT_LIMIT,
+                           exercise=params['exercise'], group=params['class'], student=params['student'],
+                           chapter=params['chapter'])
+    next_url = None
+    if after is not None:
+        query = {name: value for name, value in request.GET.items() if name != 'after'}
+        query['after'] = after
+        next_url = '%s?%s' % (request.path, urlencode(query))
+    body = json.dumps({'results': rows, 'next': next_url, 'after': after}, ensure_ascii=False)
+    # ETag按内容计算，内容没变时返回304，不重新传输
+    etag = '"%s"' % hashlib.md5(body.encode('utf-8')).hexdigest()
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(body, content_type='application/json; charset=utf-8')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _submit_token_valid(request):
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    return any(hmac.compare_digest(token.encode(), allowed.encode()) for allowed in settings.SUBMIT_API_TOKENS)
+
+
+@csrf_exempt
+def SubmitAnswers(request):
+    # POST NDJSON，每行一条答题记录；返回时已经提交。格式错误和校验不通过的行在rejected里，其他行照常写入
+    # 只接受带SUBMIT_API_TOKENS里令牌的请求（不用session登录，所以不需要CSRF校验）
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not _submit_token_valid(request):
+        response = JsonResponse({'error': 'unauthorized'}, status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    try:
+        body = request.body.decode('utf-8')
+    except UnicodeDecodeError:
+        return HttpResponseBadRequest("body should be utf-8 encoded NDJSON")
+    records, rejected = submit.parse(body)
+    if len(records) + len(rejected) > settings.SUBMIT_MAX_LINES:
+        return HttpResponseBadRequest("at most %d lines per request" % settings.SUBMIT_MAX_LINES)
+    accepted = 0
+    if records:
+        try:
+            batch = submit.submit(records)
+        except submit.Busy:
+            response = JsonResponse({'error': 'busy'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        accepted = batch.accepted
+        rejected = sorted(rejected + batch.rejected, key=lambda item: item['line'])
+    return JsonResponse({'accepted': accepted, 'rejected': rejected}, json_dumps_params={'ensure_ascii': False})
+
+
+def Search(request):
+    # ?q=关键词或公式，可选 book、chapter、tag 过滤，limit/offset 分页
+    params = {}
+    for name in ('book', 'chapter', 'tag', 'limit', 'offset'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return HttpResponseBadRequest("q is required")
+    hits = search.search(query, book=params['book'], chapter=params['chapter'], tag=params['tag'],
+                         limit=params['limit'] or search.DEFAULT_LIMIT, offset=params['offset'] or 0)
+    names = dict(Problem.objects.filter(pk__in=[hit.problem_id for hit in hits]).values_list('pk', 'name'))
+    results = [{'id': hit.problem_id, 'name': names[hit.problem_id], 'score': hit.score}
+               for hit in hits if hit.problem_id in names]
+    return JsonResponse({'query': query, 'results': results}, json_dumps_params={'ensure_ascii': False})
+
+
+def Images(request, digest, size=None):
+    # 原图或者缩略图；内容不会变，ETag就是摘要，可以长期缓存。Range只支持一段
+    blob = ImageBlob.objects.filter(pk=digest).first()
+    if blob is None:
+        raise Http404
+    files = images.storage()
+    if size is None:
+        path, content_type, etag = images.name(digest), blob.content_type, '"%s"' % digest
+    else:
+        size = int(size)
+        if size not in images.thumbnail_sizes():
+            raise Http404
+        path, content_type, etag = images.name(digest, size), blob.thumbnail_type, '"%s-%d"' % (digest, size)
+        if not files.exists(path):
+            # 后台还没有生成完
+            images.make_thumbnails(settings.IMAGE_STORE_DIR, digest, [size])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        length = files.size(path)
+        try:
+            # If-Range和ETag不一致时返回整个文件
+            byte_range = None
+            if request.META.get('HTTP_IF_RANGE', etag) == etag:
+                byte_range = images.parse_range(request.META.get('HTTP_RANGE'), length)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % length
+        else:
+            start, end = byte_range or (0, length - 1)
+            response = StreamingHttpResponse(images.read(files.open(path), start, end), content_type=content_type,
+                                             status=206 if byte_range else 200)
+            response['Content-Length'] = end - start + 1
+            if byte_range:
+                response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, length)
+    response['ETag'] = etag
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def SimilarStudents(request):
+    # ?student=学生ID（可以有多个），可选 k，school 或 class 限定范围
+    student_ids = []
+    for value in request.GET.getlist('student'):
+        if not (value.strip().isascii() and value.strip().isdigit()):
+            return HttpResponseBadRequest("student should be an integer")
+        student_ids.append(int(value))
+    if not student_ids:
+        return HttpResponseBadRequest("student is required")
+    params = {}
+    for name in ('k', 'school', 'class'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    result = profiles.similar(student_ids, k=params['k'] or 10, school_id=params['school'],
+                              class_id=params['class'])
+    return JsonResponse({'neighbors': {student_id: [{'student': other, 'distance': distance}
+                                                    for other, distance in items]
+                                       for student_id, items in result.items()}})
+
+
+def StudyGroups(request):
+    # ?school=学校ID 或 ?class=班级ID，groups 分组数（默认4），seed 随机种子
+    params = {}
+    for name in ('school', 'class', 'groups', 'seed'):
+        value = request.GET.get(name, '').strip()
+        if value and not (value.isascii() and value.isdigit()):
+            return HttpResponseBadRequest("%s should be an integer" % name)
+        params[name] = int(value) if value else None
+    if params['school'] is None and params['class'] is None:
+        return HttpResponseBadRequest("school or class is required")
+    groups = profiles.study_groups(params['groups'] or 4, school_id=params['school'], class_id=params['class'],
+                                   seed=params['seed'] or 0)
+    return JsonResponse({'groups': groups})